@@ -0,0 +1,191 @@
+"""
+Audit log storage: monthly partitions, retention and archival.
+
+On Postgres `audit_log` is range-partitioned by month on `timestamp`
+(`audit_log_p202610` holds October 2026). Partitions are created
+AUDIT_LOG_PARTITIONS_AHEAD months ahead at startup and by the daily
+maintenance pass. Months older than AUDIT_LOG_RETENTION_MONTHS are exported to
+`<AUDIT_ARCHIVE_DIR>/audit_log_<YYYYMM>.jsonl.gz`, then detached and dropped,
+so expiry never runs a row-by-row DELETE. Other databases (the SQLite used
+by the benchmarks) keep a plain table; there expired months are exported the
+same way and then deleted.
+
+An audit_log table from before partitioning (string timestamps) is
+converted in place on first start.
+"""
+
+import os
+import gzip
+import json
+import time
+import logging
+import threading
+from datetime import date, datetime
+
+from sqlalchemy import select, func, text
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+AUDIT_LOG_RETENTION_MONTHS = int(os.environ.get("AUDIT_LOG_RETENTION_MONTHS", "13"))
+AUDIT_LOG_PARTITIONS_AHEAD = int(os.environ.get("AUDIT_LOG_PARTITIONS_AHEAD", "3"))
+AUDIT_ARCHIVE_DIR = os.environ.get("AUDIT_ARCHIVE_DIR", "/app/audit-archive")
+AUDIT_LOG_MAINTENANCE_INTERVAL = int(os.environ.get("AUDIT_LOG_MAINTENANCE_INTERVAL", "86400"))
+# pg advisory lock key: one worker/replica at a time creates, converts or drops partitions
+_LOCK_KEY = 0x4155444954
+
+
+# --- Months ---
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_bound(month):
+    return datetime(month.year, month.month, 1)
+
+
+def partition_name(table, month):
+    return f"{table.name}_p{month:%Y%m}"
+
+
+def _partitioned(engine):
+    return engine.dialect.name == "postgresql"
+
+
+# --- Partitions ---
+def ensure_partitions(conn, table, first, last):
+    """Creates the monthly partitions from first through last (month starts) that do not exist yet."""
+    month = first
+    while month <= last:
+        following = add_months(month, 1)
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(table, month)} PARTITION OF {table.name} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+        ))
+        month = following
+
+
+def list_partitions(conn, table):
+    """[(partition name, month)] of the attached monthly partitions, oldest first."""
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :parent"
+    ), {"parent": table.name}).scalars()
+    prefix = f"{table.name}_p"
+    return sorted((name, date(int(name[-6:-2]), int(name[-2:]), 1)) for name in names
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+
+def _convert_unpartitioned(conn, table):
+    legacy = f"{table.name}_unpartitioned"
+    conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {legacy}"))
+    # Index (and primary key) names stay with the renamed table and would collide with the new ones
+    for index_name in conn.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE tablename = :legacy AND schemaname = current_schema()"
+    ), {"legacy": legacy}).scalars().all():
+        conn.execute(text(f'ALTER INDEX "{index_name}" RENAME TO "{legacy[:20]}_{index_name[:40]}"'))
+    table.create(conn)
+    oldest = conn.execute(text(f"SELECT min(NULLIF(\"timestamp\", '')) FROM {legacy}")).scalar()
+    current = month_start(datetime.utcnow())
+    first = month_start(datetime.fromisoformat(oldest)) if oldest else current
+    ensure_partitions(conn, table, min(first, current), add_months(current, AUDIT_LOG_PARTITIONS_AHEAD))
+    moved = conn.execute(text(
+        f'INSERT INTO {table.name} (id, tenant_id, user_id, action, details, "timestamp") '
+        f'SELECT id, tenant_id, user_id, action, details, '
+        f'COALESCE(NULLIF("timestamp", \'\')::timestamp, now() AT TIME ZONE \'utc\') FROM {legacy}'
+    )).rowcount
+    conn.execute(text(f"DROP TABLE {legacy}"))
+    logger.info("Audit log converted to monthly partitions (%d rows moved)", moved)
+
+
+def prepare(engine, table):
+    """Run once at startup, after metadata.create_all: converts a legacy table and creates upcoming partitions."""
+    if not _partitioned(engine):
+        table.create(engine, checkfirst=True)
+        return
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOCK_KEY})
+        kind = conn.execute(text(
+            "SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE c.relname = :name AND n.nspname = current_schema()"
+        ), {"name": table.name}).scalar()
+        if kind is None:
+            table.create(conn)
+        elif kind == "r":
+            _convert_unpartitioned(conn, table)
+        current = month_start(datetime.utcnow())
+        ensure_partitions(conn, table, current, add_months(current, AUDIT_LOG_PARTITIONS_AHEAD))
+
+
+# --- Retention ---
+def archive_month(engine, table, month, archive_dir=AUDIT_ARCHIVE_DIR):
+    """Streams one month of rows to a gzip JSON-lines file; returns (path, rows)."""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{table.name}_{month:%Y%m}.jsonl.gz")
+    rows = 0
+    query = select(table).where(
+        (table.c.timestamp >= month_bound(month)) & (table.c.timestamp < month_bound(add_months(month, 1)))
+    ).order_by(table.c.timestamp)
+    with engine.connect() as conn, gzip.open(path + ".tmp", "wt", compresslevel=6) as f:
+        for row in conn.execution_options(stream_results=True).execute(query):
+            f.write(json.dumps(dict(row), default=lambda v: v.isoformat() if isinstance(v, datetime) else str(v)) + "\n")
+            rows += 1
+    # Only a complete export replaces the file; the rows are dropped after this returns
+    os.replace(path + ".tmp", path)
+    return path, rows
+
+
+def expire(engine, table, retention_months=AUDIT_LOG_RETENTION_MONTHS, archive_dir=AUDIT_ARCHIVE_DIR):
+    """Archives and removes every month older than the retention window; returns [{month, path, rows}]."""
+    cutoff = add_months(month_start(datetime.utcnow()), -retention_months)
+    archived = []
+    if _partitioned(engine):
+        with engine.connect() as lock_conn:
+            if not lock_conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": _LOCK_KEY}).scalar():
+                return archived  # another worker is already on it
+            try:
+                with engine.begin() as conn:
+                    current = month_start(datetime.utcnow())
+                    ensure_partitions(conn, table, current, add_months(current, AUDIT_LOG_PARTITIONS_AHEAD))
+                    expired = [(name, month) for name, month in list_partitions(conn, table) if month < cutoff]
+                for name, month in expired:
+                    path, rows = archive_month(engine, table, month, archive_dir)
+                    with engine.begin() as conn:
+                        conn.execute(text(f"ALTER TABLE {table.name} DETACH PARTITION {name}"))
+                        conn.execute(text(f"DROP TABLE {name}"))
+                    archived.append({"month": month.isoformat(), "path": path, "rows": rows})
+            finally:
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _LOCK_KEY})
+        return archived
+
+    with engine.connect() as conn:
+        oldest = conn.execute(select(func.min(table.c.timestamp))).scalar()
+    month = month_start(oldest) if oldest else cutoff
+    while month < cutoff:
+        path, rows = archive_month(engine, table, month, archive_dir)
+        with engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.timestamp < month_bound(add_months(month, 1))))
+        if rows:
+            archived.append({"month": month.isoformat(), "path": path, "rows": rows})
+        else:
+            os.remove(path)
+        month = add_months(month, 1)
+    return archived
+
+
+def start_maintenance(engine, table, interval=AUDIT_LOG_MAINTENANCE_INTERVAL):
+    """Background thread: creates upcoming partitions and expires old months every `interval` seconds."""
+    def run():
+        while True:
+            try:
+                for entry in expire(engine, table):
+                    logger.info("Audit log %s archived to %s (%d rows)", entry["month"], entry["path"], entry["rows"])
+            except Exception as e:
+                logger.warning("Audit log maintenance failed: %s", e)
+            time.sleep(interval)
+    threading.Thread(target=run, name="audit-log-maintenance", daemon=True).start()
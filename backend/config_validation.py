@@ -0,0 +1,88 @@
+"""
+Validation of module configs against `modules_registry.config_schema`.
+
+A validator is built once per module and schema version: the schema is
+checked, the validator class for its draft chosen and its $refs resolved at
+that point, and the instance is reused for every activation and pipeline
+step. Entries are keyed by module name and checked against a hash of the
+schema, so a schema changed by register_module (here or, through the module
+cache, on another replica) is picked up on the next lookup.
+invalidate() drops an entry explicitly.
+"""
+
+import json
+import hashlib
+import threading
+
+from jsonschema import Draft202012Validator, FormatChecker, SchemaError, validators
+
+# Errors reported per config; the rest only add noise to the response
+MAX_ERRORS = 20
+
+
+class InvalidSchema(ValueError):
+    pass
+
+
+def _schema_hash(schema):
+    return hashlib.sha1(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+
+
+def compile_schema(schema):
+    """Returns a ready validator for schema, raising InvalidSchema if the schema itself is malformed."""
+    cls = validators.validator_for(schema, default=Draft202012Validator)
+    try:
+        cls.check_schema(schema)
+    except SchemaError as e:
+        raise InvalidSchema(f"{e.message} at /{'/'.join(str(p) for p in e.absolute_path)}") from e
+    return cls(schema, format_checker=FormatChecker())
+
+
+class ConfigValidators:
+    def __init__(self):
+        self._validators = {}  # module name -> (schema object, schema hash, validator)
+        self._lock = threading.Lock()
+
+    def get(self, module_name, schema):
+        """The validator for this module's current schema, or None when the module has no schema."""
+        if not schema:
+            return None
+        entry = self._validators.get(module_name)
+        # The cached registry hands out the same schema object until it is reloaded, which skips hashing
+        if entry and entry[0] is schema:
+            return entry[2]
+        digest = _schema_hash(schema)
+        validator = entry[2] if entry and entry[1] == digest else compile_schema(schema)
+        with self._lock:
+            self._validators[module_name] = (schema, digest, validator)
+        return validator
+
+    def invalidate(self, module_name):
+        with self._lock:
+            self._validators.pop(module_name, None)
+
+    def errors(self, module_name, schema, config):
+        """[{"path", "message"}] for config (up to MAX_ERRORS); empty when it is valid or there is no schema."""
+        validator = self.get(module_name, schema)
+        if validator is None:
+            return []
+        found = sorted(validator.iter_errors(config if config is not None else {}), key=lambda e: list(e.absolute_path))
+        return [{"path": "/" + "/".join(str(p) for p in e.absolute_path), "message": e.message}
+                for e in found[:MAX_ERRORS]]
+
+
+def pipeline_errors(pipeline, registry, checker):
+    """
+    Validates every step of an orchestration pipeline against the registry
+    ({name: module row}); returns [{"step", "module", "path", "message"}].
+    """
+    errors = []
+    for index, step in enumerate(pipeline or []):
+        module_name = step.get("module") if isinstance(step, dict) else None
+        if module_name not in registry:
+            errors.append({"step": index, "module": module_name, "path": "/module",
+                           "message": "Unknown module" if module_name else "Step has no module"})
+            continue
+        for error in checker.errors(module_name, registry[module_name].get("config_schema"), step.get("config", {})):
+            errors.append({"step": index, "module": module_name, **error})
+    return errors
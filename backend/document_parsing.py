@@ -0,0 +1,167 @@
+"""
+Document parsing stage for the ingestion pipeline.
+
+Format-specific extractors run in a process pool and stream pages through a
+bounded queue, so the embedding stage consumes pages as they are produced and
+the parsers block (back-pressure) whenever embedding falls behind.
+"""
+
+import os
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# --- Configuration ---
+DOCUMENT_PARSE_WORKERS = int(os.environ.get("DOCUMENT_PARSE_WORKERS", os.cpu_count() or 2))
+DOCUMENT_PAGE_QUEUE_SIZE = int(os.environ.get("DOCUMENT_PAGE_QUEUE_SIZE", "64"))
+TXT_PAGE_CHARS = int(os.environ.get("TXT_PAGE_CHARS", "4000"))
+DOCX_PARAGRAPHS_PER_PAGE = int(os.environ.get("DOCX_PARAGRAPHS_PER_PAGE", "40"))
+# How often a waiting consumer checks for workers that died without ending their document
+PAGE_POLL_INTERVAL = 1.0
+
+
+class UnsupportedDocumentFormat(ValueError):
+    pass
+
+
+# --- Format-specific Extractors ---
+# Each extractor is a generator yielding (page_number, text) so a document is
+# never held in memory as a whole.
+def extract_txt_pages(path):
+    page_no, buf, size = 1, [], 0
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            buf.append(line)
+            size += len(line)
+            if size >= TXT_PAGE_CHARS:
+                yield page_no, "".join(buf)
+                page_no, buf, size = page_no + 1, [], 0
+    if buf:
+        yield page_no, "".join(buf)
+
+
+def extract_pdf_pages(path):
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    for page_no, page in enumerate(reader.pages, start=1):
+        yield page_no, page.extract_text() or ""
+
+
+def extract_docx_pages(path):
+    # DOCX has no stored pagination; group paragraphs into fixed-size pages.
+    import docx
+    document = docx.Document(path)
+    page_no, buf = 1, []
+    for paragraph in document.paragraphs:
+        buf.append(paragraph.text)
+        if len(buf) >= DOCX_PARAGRAPHS_PER_PAGE:
+            yield page_no, "\n".join(buf)
+            page_no, buf = page_no + 1, []
+    if buf:
+        yield page_no, "\n".join(buf)
+
+
+PAGE_EXTRACTORS = {
+    "txt": extract_txt_pages,
+    "pdf": extract_pdf_pages,
+    "docx": extract_docx_pages,
+}
+
+
+def document_format(path):
+    fmt = os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in PAGE_EXTRACTORS:
+        raise UnsupportedDocumentFormat(f"Unsupported document format: {fmt or 'unknown'}")
+    return fmt
+
+
+# --- Worker ---
+def _parse_into_queue(doc_index, path, fmt, page_queue):
+    """Runs in a pool worker: pushes (doc_index, page_no, text) then (doc_index, None, error)."""
+    error = None
+    try:
+        for page_no, text in PAGE_EXTRACTORS[fmt](path):
+            page_queue.put((doc_index, page_no, text))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        page_queue.put((doc_index, None, error))
+
+
+# --- Pool Management ---
+_pool = None
+_manager = None
+_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    global _pool, _manager
+    with _pool_lock:
+        if _manager is None:
+            _manager = multiprocessing.Manager()
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=DOCUMENT_PARSE_WORKERS)
+        return _pool, _manager
+
+
+def shutdown_parse_pool():
+    global _pool, _manager
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+        if _manager is not None:
+            _manager.shutdown()
+        _pool, _manager = None, None
+
+
+def _discard_broken_pool(pool):
+    """A worker process died: the pool refuses new work, so the next caller gets a fresh one (same manager)."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+def stream_pages(paths):
+    """
+    Parses documents in parallel and yields (doc_index, page_no, text) as pages
+    become available. Pages of one document arrive in order; documents interleave.
+    When a document is finished, (doc_index, None, error) is yielded, where error
+    is None on success or a message describing why parsing failed.
+    """
+    formats = [document_format(p) for p in paths]
+    pool, manager = get_parse_pool()
+    page_queue = manager.Queue(maxsize=DOCUMENT_PAGE_QUEUE_SIZE)
+    futures = {pool.submit(_parse_into_queue, i, p, fmt, page_queue): i for i, (p, fmt) in enumerate(zip(paths, formats))}
+    finished = set()
+
+    def next_item():
+        """The next queued item, or the end of a document whose worker failed without sending it."""
+        while True:
+            try:
+                return page_queue.get(timeout=PAGE_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+            for future, i in futures.items():
+                if i not in finished and future.done() and future.exception() is not None:
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        _discard_broken_pool(pool)
+                    return i, None, f"{type(future.exception()).__name__}: {future.exception()}"
+
+    try:
+        while len(finished) < len(paths):
+            doc_index, page_no, payload = next_item()
+            if doc_index in finished:
+                continue  # late pages or a second end marker of a document already ended
+            if page_no is None:
+                finished.add(doc_index)
+            yield doc_index, page_no, payload
+    finally:
+        # If the consumer stopped early, drain so blocked workers can exit.
+        while len(finished) < len(paths):
+            doc_index, page_no, _ = next_item()
+            if page_no is None:
+                finished.add(doc_index)
@@ -0,0 +1,218 @@
+"""
+Envelope encryption for tenant secrets kept in the database.
+
+Every tenant has data keys (`tenant_data_keys`, one row per version), each a
+random 256-bit Fernet key that is only stored wrapped by the Vault transit key
+VAULT_TRANSIT_KEY. Encrypted values look like `env1:<version>:<fernet token>`.
+Unwrapped keys are cached per process for DATA_KEY_CACHE_TTL, so a read is
+one row lookup plus a local decrypt; Vault is only called when a key is
+created or its cache entry expires.
+
+Rotation:
+- rotate_tenant_key() adds a new version that is used for all new writes;
+  reencrypt() then moves existing values to it in batches of
+  KEY_ROTATION_BATCH rows, one commit per batch.
+- When the transit key itself is rotated in Vault, rewrap_stale() rewraps the
+  stored data keys with its latest version (Vault rewraps without exposing
+  them; the encrypted values do not change). start_maintenance() runs it
+  periodically.
+"""
+
+import os
+import json
+import time
+import base64
+import logging
+import threading
+from datetime import datetime
+
+import hvac
+from cryptography.fernet import Fernet
+from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError
+
+from metrics import upstream_timer
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+VAULT_TRANSIT_MOUNT = os.environ.get("VAULT_TRANSIT_MOUNT", "transit")
+VAULT_TRANSIT_KEY = os.environ.get("VAULT_TRANSIT_KEY", "tenant-data-keys")
+DATA_KEY_CACHE_TTL = float(os.environ.get("DATA_KEY_CACHE_TTL", "300"))
+KEY_ROTATION_BATCH = int(os.environ.get("KEY_ROTATION_BATCH", "200"))
+KEY_REWRAP_INTERVAL = int(os.environ.get("KEY_REWRAP_INTERVAL", "86400"))
+PREFIX = "env1"
+
+
+def key_version(value):
+    """Data key version of an encrypted value, or None for anything not written by this module."""
+    if not value or not value.startswith(PREFIX + ":"):
+        return None
+    return int(value.split(":", 2)[1])
+
+
+class EnvelopeCipher:
+    def __init__(self, engine, keys_table, vault, mount=VAULT_TRANSIT_MOUNT, key_name=VAULT_TRANSIT_KEY,
+                 ttl=DATA_KEY_CACHE_TTL):
+        self.engine = engine
+        self.keys = keys_table
+        self.vault = vault
+        self.mount = mount
+        self.key_name = key_name
+        self.ttl = ttl
+        self._data_keys = {}  # (tenant, version) -> (Fernet, expires_at)
+        self._active = {}  # tenant -> (version, expires_at)
+
+    # --- Transit key ---
+    def ensure_transit_key(self):
+        """Creates the transit key (and enables the engine) when missing; safe to call from every worker."""
+        transit = self.vault.secrets.transit
+        try:
+            transit.read_key(name=self.key_name, mount_point=self.mount)
+            return
+        except hvac.exceptions.InvalidPath:
+            pass
+        try:
+            self.vault.sys.enable_secrets_engine("transit", path=self.mount)
+        except hvac.exceptions.InvalidRequest:
+            pass  # already mounted
+        transit.create_key(name=self.key_name, mount_point=self.mount)
+
+    def _wrap_new_key(self):
+        transit = self.vault.secrets.transit
+        try:
+            with upstream_timer("vault", "transit_datakey"):
+                response = transit.generate_data_key(name=self.key_name, key_type="plaintext", bits=256, mount_point=self.mount)
+        except (hvac.exceptions.InvalidRequest, hvac.exceptions.InvalidPath):
+            # First key before start_maintenance() got to create the transit key
+            self.ensure_transit_key()
+            with upstream_timer("vault", "transit_datakey"):
+                response = transit.generate_data_key(name=self.key_name, key_type="plaintext", bits=256, mount_point=self.mount)
+        return base64.b64decode(response["data"]["plaintext"]), response["data"]["ciphertext"]
+
+    def _unwrap(self, wrapped):
+        with upstream_timer("vault", "transit_decrypt"):
+            response = self.vault.secrets.transit.decrypt_data(name=self.key_name, ciphertext=wrapped,
+                                                               mount_point=self.mount)
+        return base64.b64decode(response["data"]["plaintext"])
+
+    # --- Data keys ---
+    def _cache(self, tenant, version, raw_key):
+        fernet = Fernet(base64.urlsafe_b64encode(raw_key))
+        self._data_keys[(tenant, version)] = (fernet, time.monotonic() + self.ttl)
+        return fernet
+
+    def _data_key(self, tenant, version):
+        cached = self._data_keys.get((tenant, version))
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        with self.engine.connect() as conn:
+            wrapped = conn.execute(select(self.keys.c.wrapped_key).where(
+                (self.keys.c.tenant_id == tenant) & (self.keys.c.version == version))).scalar()
+        if wrapped is None:
+            raise KeyError(f"No data key version {version} for tenant {tenant}")
+        return self._cache(tenant, version, self._unwrap(wrapped))
+
+    def _add_version(self, tenant):
+        """Stores a new data key version for tenant; concurrent callers on other workers may win, then theirs is used."""
+        raw_key, wrapped = self._wrap_new_key()
+        with self.engine.connect() as conn:
+            latest = conn.execute(select(func.max(self.keys.c.version)).where(self.keys.c.tenant_id == tenant)).scalar() or 0
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(self.keys.insert().values(tenant_id=tenant, version=latest + 1, wrapped_key=wrapped,
+                                                       created_at=datetime.utcnow()))
+        except IntegrityError:
+            self._active.pop(tenant, None)
+            return self.active_version(tenant)
+        self._cache(tenant, latest + 1, raw_key)
+        self._active[tenant] = (latest + 1, time.monotonic() + self.ttl)
+        return latest + 1
+
+    def active_version(self, tenant):
+        """The version new values are encrypted with; creates the tenant's first key on demand."""
+        cached = self._active.get(tenant)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        with self.engine.connect() as conn:
+            version = conn.execute(select(func.max(self.keys.c.version)).where(self.keys.c.tenant_id == tenant)).scalar()
+        if version is None:
+            return self._add_version(tenant)
+        self._active[tenant] = (version, time.monotonic() + self.ttl)
+        return version
+
+    # --- Values ---
+    def encrypt(self, tenant, data):
+        return self._encrypt_with(tenant, self.active_version(tenant), data)
+
+    def _encrypt_with(self, tenant, version, data):
+        token = self._data_key(tenant, version).encrypt(json.dumps(data).encode()).decode()
+        return f"{PREFIX}:{version}:{token}"
+
+    def decrypt(self, tenant, value):
+        _, version, token = value.split(":", 2)
+        return json.loads(self._data_key(tenant, int(version)).decrypt(token.encode()))
+
+    # --- Rotation ---
+    def rotate_tenant_key(self, tenant):
+        """Starts a new data key version for tenant; returns it. Existing values stay readable until reencrypt()."""
+        self._active.pop(tenant, None)
+        return self._add_version(tenant)
+
+    def reencrypt(self, table, column, tenant):
+        """
+        Moves every value of table.column for tenant to the key version active when it starts; returns the
+        rows rewritten. A rotation during the run is picked up by the next run, not this one.
+        """
+        version = self.active_version(tenant)
+        current = f"{PREFIX}:{version}:%"
+        rewritten = 0
+        while True:
+            with self.engine.connect() as conn:
+                rows = conn.execute(select(table.c.id, column).where(
+                    (table.c.tenant_id == tenant) & column.like(f"{PREFIX}:%") & ~column.like(current)
+                ).limit(KEY_ROTATION_BATCH)).fetchall()
+            if not rows:
+                return rewritten
+            with self.engine.begin() as conn:
+                for row_id, value in rows:
+                    # A value changed since it was read was written with the active key already
+                    rewritten += conn.execute(table.update().where((table.c.id == row_id) & (column == value))
+                                              .values({column.name: self._encrypt_with(tenant, version, self.decrypt(tenant, value))})).rowcount
+            logger.info("Re-encrypted %d %s rows of tenant %s with data key v%d", rewritten, table.name, tenant, version)
+
+    def rewrap_stale(self):
+        """Rewraps data keys not wrapped with the latest transit key version; returns how many were rewrapped."""
+        with upstream_timer("vault", "transit_read_key"):
+            latest = self.vault.secrets.transit.read_key(name=self.key_name, mount_point=self.mount)["data"]["latest_version"]
+        current = f"vault:v{latest}:%"
+        rewrapped = 0
+        while True:
+            with self.engine.connect() as conn:
+                rows = conn.execute(select(self.keys.c.tenant_id, self.keys.c.version, self.keys.c.wrapped_key)
+                                    .where(~self.keys.c.wrapped_key.like(current)).limit(KEY_ROTATION_BATCH)).fetchall()
+            if not rows:
+                return rewrapped
+            with self.engine.begin() as conn:
+                for tenant, version, wrapped in rows:
+                    with upstream_timer("vault", "transit_rewrap"):
+                        response = self.vault.secrets.transit.rewrap_data(name=self.key_name, ciphertext=wrapped,
+                                                                          mount_point=self.mount)
+                    conn.execute(self.keys.update().where(
+                        (self.keys.c.tenant_id == tenant) & (self.keys.c.version == version)
+                    ).values(wrapped_key=response["data"]["ciphertext"]))
+                    rewrapped += 1
+
+    def start_maintenance(self, interval=KEY_REWRAP_INTERVAL):
+        """Background thread: ensures the transit key exists, then rewraps stale data keys every `interval` seconds."""
+        def run():
+            while True:
+                try:
+                    self.ensure_transit_key()
+                    rewrapped = self.rewrap_stale()
+                    if rewrapped:
+                        logger.info("Rewrapped %d tenant data keys with the latest transit key", rewrapped)
+                except Exception as e:
+                    logger.warning("Data key maintenance failed: %s", e)
+                time.sleep(interval)
+        threading.Thread(target=run, name="data-key-maintenance", daemon=True).start()
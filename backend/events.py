@@ -0,0 +1,308 @@
+"""
+Outbound events: signed webhooks and n8n webhook triggers.
+
+publish() writes one `event_outbox` row per matching subscription in the
+caller's transaction, so an event is delivered if and only if the change it
+describes was committed. A dispatcher thread in every worker then:
+- claims due rows (FOR UPDATE SKIP LOCKED on Postgres, so workers and
+  replicas never claim the same row) by pushing next_attempt_at out by a
+  lease, and commits the claim before any HTTP call is made;
+- POSTs up to WEBHOOK_BATCH_SIZE events per subscription in one request,
+  `{"events": [{"id", "type", "tenant_id", "created_at", "data"}]}`;
+- marks them delivered on 2xx, otherwise retries with exponential backoff
+  and gives up ("dead") after WEBHOOK_MAX_ATTEMPTS.
+
+Delivery is at least once; receivers deduplicate on the event id. Requests
+carry `X-Webhook-Signature: t=<unix time>,v1=<hex HMAC-SHA256 of
+"<t>.<body>" with the subscription secret>`. Subscriptions of kind "n8n"
+name a webhook path that is called on N8N_URL.
+
+Webhook URLs must resolve to public addresses only; this is checked when the
+subscription is created and again before every delivery (the name may have
+been repointed since), and redirects are not followed. Deliveries to
+different subscriptions run in parallel, up to WEBHOOK_CONCURRENCY at a time.
+Errors are stored as a short category (see delivery_error), never as the
+receiver's or the HTTP client's raw text.
+
+publish() wakes the local dispatcher, which waits WEBHOOK_BATCH_WINDOW for the
+publishing transaction to commit and more events to gather; rows published
+by other processes are picked up within WEBHOOK_POLL_INTERVAL.
+"""
+
+import os
+import re
+import hmac
+import json
+import time
+import uuid
+import random
+import socket
+import hashlib
+import logging
+import threading
+import ipaddress
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+from sqlalchemy import select
+
+from metrics import upstream_timer, WEBHOOK_DELIVERIES
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", "50"))
+WEBHOOK_BATCH_WINDOW = float(os.environ.get("WEBHOOK_BATCH_WINDOW", "0.5"))
+WEBHOOK_POLL_INTERVAL = float(os.environ.get("WEBHOOK_POLL_INTERVAL", "5"))
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "10"))
+WEBHOOK_RETRY_BASE = float(os.environ.get("WEBHOOK_RETRY_BASE", "5"))
+WEBHOOK_RETRY_MAX = float(os.environ.get("WEBHOOK_RETRY_MAX", "3600"))
+WEBHOOK_RETENTION_DAYS = int(os.environ.get("WEBHOOK_RETENTION_DAYS", "7"))
+WEBHOOK_SUBSCRIPTION_TTL = float(os.environ.get("WEBHOOK_SUBSCRIPTION_TTL", "30"))
+# Subscriptions delivered to at the same time; each has at most one request in flight
+WEBHOOK_CONCURRENCY = int(os.environ.get("WEBHOOK_CONCURRENCY", "8"))
+# Only for receivers on the platform's own network (e.g. on-premises installs); never on shared deployments
+WEBHOOK_ALLOW_PRIVATE = os.environ.get("WEBHOOK_ALLOW_PRIVATE", "false").lower() == "true"
+
+EVENT_TYPES = (
+    "scan.completed",
+    "orchestration.step_completed",
+    "orchestration.completed",
+    "module.activated",
+    "module.deactivated",
+    "document.ingested",
+)
+WEBHOOK, N8N = "webhook", "n8n"
+PENDING, DELIVERED, DEAD = "pending", "delivered", "dead"
+# n8n webhook paths: segments of letters, digits, "-" and "_", e.g. "scan-finished" or "<uuid>/scan"
+N8N_PATH = re.compile(r"^[A-Za-z0-9_-]+(/[A-Za-z0-9_-]+)*$")
+SUBSCRIPTION_DELETED = "subscription deleted"
+
+
+class UnsafeDestination(ValueError):
+    """A webhook URL that is malformed or resolves to a private, loopback or link-local address."""
+
+
+def check_url(url):
+    """Raises UnsafeDestination unless url is http(s) and every address its host resolves to is public."""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise UnsafeDestination("url must be an http(s) URL with a host")
+    if WEBHOOK_ALLOW_PRIVATE:
+        return
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        infos = socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, ValueError) as e:
+        raise UnsafeDestination(f"cannot resolve {parts.hostname}") from e
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global or address.is_multicast:
+            raise UnsafeDestination(f"{parts.hostname} resolves to a non-public address")
+
+
+def check_n8n_path(path):
+    if not N8N_PATH.match(path or ""):
+        raise UnsafeDestination("n8n webhook path must be segments of letters, digits, '-' and '_'")
+
+
+ERROR_CATEGORIES = ("destination not allowed", "timeout", "connection failed", "delivery failed", SUBSCRIPTION_DELETED)
+
+
+def delivery_error(e):
+    """The category of a failed delivery that is stored and shown to the tenant."""
+    if isinstance(e, UnsafeDestination):
+        return "destination not allowed"
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return f"HTTP {e.response.status_code}"
+    if isinstance(e, requests.Timeout):
+        return "timeout"
+    if isinstance(e, requests.ConnectionError):
+        return "connection failed"
+    return "delivery failed"
+
+
+def public_error(text):
+    """last_error as shown to the tenant; rows written before errors were categorized only say that delivery failed."""
+    if text is None or text in ERROR_CATEGORIES or re.fullmatch(r"HTTP \d{3}", text):
+        return text
+    return "delivery failed"
+
+
+def sign(secret, timestamp, body):
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def retry_delay(attempts):
+    """Seconds before attempt number attempts + 1: exponential with +-20% jitter, capped."""
+    return min(WEBHOOK_RETRY_BASE * 2 ** (attempts - 1), WEBHOOK_RETRY_MAX) * random.uniform(0.8, 1.2)
+
+
+class EventBus:
+    def __init__(self, engine, outbox, subscriptions, decrypt, n8n_url):
+        self.engine = engine
+        self.outbox = outbox
+        self.subscriptions = subscriptions
+        self.decrypt = decrypt
+        self.n8n_url = n8n_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=WEBHOOK_CONCURRENCY))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=WEBHOOK_CONCURRENCY))
+        self._subscribed = {}  # tenant -> ([(subscription id, event types or None)], expires_at)
+        self._wake = threading.Event()
+        self._last_purge = 0.0
+        self._pool = ThreadPoolExecutor(max_workers=WEBHOOK_CONCURRENCY, thread_name_prefix="webhook-delivery")
+
+    # --- Publishing ---
+    def _subscribers(self, db, tenant):
+        cached = self._subscribed.get(tenant)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        rows = db.execute(select(self.subscriptions.c.id, self.subscriptions.c.event_types)
+                          .where(self.subscriptions.c.tenant_id == tenant)).fetchall()
+        subscribers = [(r.id, set(r.event_types) if r.event_types else None) for r in rows]
+        self._subscribed[tenant] = (subscribers, time.monotonic() + WEBHOOK_SUBSCRIPTION_TTL)
+        return subscribers
+
+    def invalidate(self, tenant):
+        self._subscribed.pop(tenant, None)
+
+    def publish(self, db, tenant, event_type, data):
+        """Queues event_type for the tenant's subscribers in db's transaction (the caller commits); returns the event id."""
+        event_id = str(uuid.uuid4())
+        now = datetime.utcnow()
+        rows = [dict(id=str(uuid.uuid4()), event_id=event_id, tenant_id=tenant, subscription_id=subscription_id,
+                     event_type=event_type, payload=data, created_at=now, status=PENDING, attempts=0,
+                     next_attempt_at=now)
+                for subscription_id, types in self._subscribers(db, tenant) if types is None or event_type in types]
+        if rows:
+            db.execute(self.outbox.insert(), rows)
+            self._wake.set()
+        return event_id
+
+    # --- Dispatching ---
+    def _claim(self):
+        """Leases up to a batch per subscription of due rows; returns {subscription id: [rows]}."""
+        outbox = self.outbox
+        now = datetime.utcnow()
+        with self.engine.begin() as conn:
+            rows = conn.execute(
+                select(outbox).where((outbox.c.status == PENDING) & (outbox.c.next_attempt_at <= now))
+                .order_by(outbox.c.created_at).limit(WEBHOOK_BATCH_SIZE * 20)
+                .with_for_update(skip_locked=True)
+            ).fetchall()
+            batches = {}
+            for row in rows:
+                batch = batches.setdefault(row.subscription_id, [])
+                if len(batch) < WEBHOOK_BATCH_SIZE:
+                    batch.append(row)
+            if not batches:
+                return batches
+            # Unsent rows become due again after the lease, e.g. when this worker dies mid-delivery
+            lease = now + timedelta(seconds=WEBHOOK_TIMEOUT * 3)
+            conn.execute(outbox.update().where(outbox.c.id.in_([r.id for b in batches.values() for r in b]))
+                         .values(next_attempt_at=lease))
+        return batches
+
+    def _target(self, subscription):
+        if subscription.kind == N8N:
+            check_n8n_path(subscription.url)
+            return f"{self.n8n_url}/webhook/{subscription.url}"
+        check_url(subscription.url)
+        return subscription.url
+
+    def _deliver(self, subscription, rows):
+        body = json.dumps({"events": [
+            {"id": r.event_id, "type": r.event_type, "tenant_id": r.tenant_id,
+             "created_at": r.created_at.isoformat() + "Z", "data": r.payload} for r in rows
+        ]}, default=str).encode()
+        timestamp = int(time.time())
+        headers = {"Content-Type": "application/json",
+                   "X-Webhook-Signature": sign(self.decrypt(subscription.encrypted_secret), timestamp, body)}
+        with upstream_timer(subscription.kind, "deliver"):
+            response = self.session.post(self._target(subscription), data=body, headers=headers, timeout=WEBHOOK_TIMEOUT,
+                                         allow_redirects=False)
+        if response.is_redirect:
+            raise UnsafeDestination(f"redirected with {response.status_code}")
+        response.raise_for_status()
+
+    def _finish(self, rows, error=None, dead=False):
+        """Marks rows delivered, or records error and schedules a retry (or gives up after the last attempt or when dead)."""
+        outbox = self.outbox
+        now = datetime.utcnow()
+        with self.engine.begin() as conn:
+            if error is None:
+                conn.execute(outbox.update().where(outbox.c.id.in_([r.id for r in rows]))
+                             .values(status=DELIVERED, delivered_at=now, attempts=outbox.c.attempts + 1, last_error=None))
+                return
+            for row in rows:
+                attempts = row.attempts + 1
+                gone = dead or attempts >= WEBHOOK_MAX_ATTEMPTS
+                conn.execute(outbox.update().where(outbox.c.id == row.id).values(
+                    attempts=attempts, last_error=error, status=DEAD if gone else PENDING,
+                    next_attempt_at=now + timedelta(seconds=0 if gone else retry_delay(attempts))
+                ))
+
+    def _send(self, subscription, rows):
+        """Delivers one subscription's batch and records the outcome; returns the number of events delivered."""
+        try:
+            self._deliver(subscription, rows)
+        except Exception as e:
+            logger.warning("Webhook delivery of %d events to %s failed: %s", len(rows), subscription.id, e)
+            self._finish(rows, delivery_error(e))
+            WEBHOOK_DELIVERIES.labels("failed").inc(len(rows))
+            return 0
+        self._finish(rows)
+        WEBHOOK_DELIVERIES.labels("delivered").inc(len(rows))
+        return len(rows)
+
+    def dispatch_once(self):
+        """Delivers everything that is due; returns the number of events delivered."""
+        delivered = 0
+        while True:
+            batches = self._claim()
+            if not batches:
+                return delivered
+            with self.engine.connect() as conn:
+                subscriptions = {s.id: s for s in conn.execute(
+                    select(self.subscriptions).where(self.subscriptions.c.id.in_(list(batches)))
+                ).fetchall()}
+            sends = []
+            for subscription_id, rows in batches.items():
+                subscription = subscriptions.get(subscription_id)
+                if subscription is None:
+                    # Published from a cached subscriber list just before the subscription was deleted
+                    self._finish(rows, SUBSCRIPTION_DELETED, dead=True)
+                    WEBHOOK_DELIVERIES.labels("dropped").inc(len(rows))
+                    continue
+                sends.append((subscription, rows))
+            # One slow receiver holds one slot, not the whole round
+            delivered += sum(self._pool.map(lambda send: self._send(*send), sends))
+
+    def purge(self):
+        """Drops delivered and dead rows older than WEBHOOK_RETENTION_DAYS."""
+        cutoff = datetime.utcnow() - timedelta(days=WEBHOOK_RETENTION_DAYS)
+        with self.engine.begin() as conn:
+            return conn.execute(self.outbox.delete().where(
+                (self.outbox.c.status != PENDING) & (self.outbox.c.created_at < cutoff)
+            )).rowcount
+
+    def start(self):
+        def run():
+            while True:
+                if self._wake.wait(WEBHOOK_POLL_INTERVAL):
+                    self._wake.clear()
+                    # Let the publishing transaction commit and further events join the batch
+                    time.sleep(WEBHOOK_BATCH_WINDOW)
+                try:
+                    self.dispatch_once()
+                    if time.monotonic() - self._last_purge > 3600:
+                        self._last_purge = time.monotonic()
+                        self.purge()
+                except Exception as e:
+                    logger.warning("Webhook dispatch failed: %s", e)
+        threading.Thread(target=run, name="webhook-dispatcher", daemon=True).start()
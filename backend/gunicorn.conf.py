@@ -0,0 +1,43 @@
+"""
+Gunicorn configuration for multi-process serving: `gunicorn -c gunicorn.conf.py main:app`.
+
+Each worker is a uvicorn event loop in its own process. State that must agree
+across workers lives outside them: rate limits and the module cache in Redis,
+everything else in Postgres, and ENCRYPTION_KEY must be configured.
+"""
+
+import os
+import shutil
+
+# --- Configuration ---
+bind = os.environ.get("BIND", "0.0.0.0:9000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Scans and LLM calls can hold a request for minutes
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "300"))
+# After SIGTERM workers get this long to finish; lifecycle.py interrupts and hands off what is still
+# running after DRAIN_TIMEOUT (20s), which leaves time to record it before the worker is killed
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+# Preloading imports the app once in the master (faster boot, shared pages); post_fork then
+# resets what must not be shared. Set GUNICORN_PRELOAD=false to import in each worker instead.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+accesslog = "-"
+
+# Per-worker metric files, aggregated by /metrics. Prepared here rather than in on_starting
+# because preload_app imports main (and creates its metrics) before that hook runs; stale
+# files from a previous run would otherwise be summed into the new one.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus-multiproc")
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def post_fork(server, worker):
+    import sys
+    if "main" in sys.modules:
+        sys.modules["main"].init_worker_process()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,300 @@
+"""
+Graceful shutdown: draining, in-flight job tracking and handoff to other instances.
+
+A worker starts draining on SIGTERM (or when DRAIN_FILE exists, which the
+Kubernetes preStop hook creates so every worker of the pod fails readiness at
+once, before the signal arrives). While draining, /health/ready answers 503
+and endpoints that start long work refuse it with 503 and Retry-After, so
+clients go to another instance instead of starting a run that gets killed.
+
+Work already running is tracked with job(). It gets DRAIN_TIMEOUT to finish.
+After that, the child processes started through popen()/run() (the module
+containers) are terminated, and the code waiting on them gets Interrupted.
+It then records what happened and, where the work can continue elsewhere,
+puts it on the HandoffQueue. Every worker that is not draining claims
+handed-off jobs and resumes them. A claimed row stays in the queue until the
+resumed job has finished (a job interrupted again hands itself off anew), and
+its claim is refreshed while the job runs, so the job is taken over by
+another instance if the claiming one dies. Each claim counts as an attempt: a
+job whose resume failed (or whose claiming instance died)
+HANDOFF_MAX_ATTEMPTS times is marked "dead" with its last error and left for
+an operator.
+
+DRAIN_TIMEOUT has to stay below gunicorn's graceful_timeout, which itself has
+to fit in the pod's terminationGracePeriodSeconds together with the preStop sleep.
+"""
+
+import os
+import time
+import asyncio
+import uuid
+import signal
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "20"))
+DRAIN_FILE = os.environ.get("DRAIN_FILE", "/tmp/draining")
+HANDOFF_POLL_INTERVAL = float(os.environ.get("HANDOFF_POLL_INTERVAL", "10"))
+# A claim older than this belongs to an instance that died before its resumed job finished (running jobs' claims
+# are refreshed every HANDOFF_POLL_INTERVAL)
+HANDOFF_CLAIM_TIMEOUT = float(os.environ.get("HANDOFF_CLAIM_TIMEOUT", "600"))
+HANDOFF_MAX_ATTEMPTS = int(os.environ.get("HANDOFF_MAX_ATTEMPTS", "5"))
+PENDING, DEAD = "pending", "dead"
+
+
+class Interrupted(Exception):
+    """The work was stopped because this instance is shutting down."""
+
+
+class Lifecycle:
+    def __init__(self, drain_file=DRAIN_FILE, timeout=DRAIN_TIMEOUT):
+        self.drain_file = drain_file
+        self.timeout = timeout
+        self._draining = threading.Event()
+        self._interrupted = threading.Event()
+        self._drain_started = None
+        self._jobs = {}  # id -> (kind, details, started_at)
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    @property
+    def draining(self):
+        return self._draining.is_set() or os.path.exists(self.drain_file)
+
+    @property
+    def interrupted(self):
+        """True once the drain deadline passed and remaining work is being stopped."""
+        return self._interrupted.is_set()
+
+    def install_signal_handler(self):
+        """Starts draining on SIGTERM, then passes the signal on (to uvicorn, which stops accepting connections)."""
+        if threading.current_thread() is not threading.main_thread():
+            return  # signals can only be handled there; embedded servers drain from the lifespan shutdown
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(sig, frame):
+            self.begin_drain("SIGTERM")
+            if callable(previous):
+                previous(sig, frame)
+            elif previous == signal.SIG_DFL:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.raise_signal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+    def begin_drain(self, reason):
+        with self._lock:
+            if self._draining.is_set():
+                return
+            self._draining.set()
+            self._drain_started = time.monotonic()
+        logger.info("Draining (%s): %d jobs in flight, deadline in %ss", reason, len(self._jobs), self.timeout)
+        threading.Thread(target=self._enforce_deadline, name="drain-deadline", daemon=True).start()
+
+    def _enforce_deadline(self):
+        deadline = self._drain_started + self.timeout
+        while self._jobs and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if not self._jobs:
+            return
+        self._interrupted.set()
+        with self._lock:
+            jobs = list(self._jobs.values())
+            processes = list(self._processes)
+        logger.warning("Drain deadline passed; interrupting %s", ", ".join(f"{kind} {details}" for kind, details, _ in jobs))
+        for proc in processes:
+            proc.terminate()
+
+    # --- Jobs ---
+    @contextmanager
+    def job(self, kind, **details):
+        """Tracks a unit of work for draining; details identify it in logs and /health/ready."""
+        key = object()
+        with self._lock:
+            self._jobs[key] = (kind, details, time.time())
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._jobs.pop(key, None)
+
+    def jobs(self):
+        with self._lock:
+            return [dict(details, kind=kind, running_s=round(time.time() - started, 1))
+                    for kind, details, started in self._jobs.values()]
+
+    def wait_for_jobs(self, grace=5.0):
+        """Blocks until the tracked jobs are done, at most until grace seconds after the drain deadline; returns those left."""
+        until = (self._drain_started or time.monotonic()) + self.timeout + grace
+        while self._jobs and time.monotonic() < until:
+            time.sleep(0.1)
+        return self.jobs()
+
+    async def race(self, awaitable, poll=0.5):
+        """Awaits awaitable, raising Interrupted if the drain deadline passes first (a thread behind it runs on until exit)."""
+        task = asyncio.ensure_future(awaitable)
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll)
+            if done:
+                return task.result()
+            if self.interrupted:
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                raise Interrupted("shutting down")
+
+    # --- Child processes ---
+    @contextmanager
+    def popen(self, args, **kwargs):
+        """subprocess.Popen that is terminated at the drain deadline; refuses to start once it has passed."""
+        if self.interrupted:
+            raise Interrupted(f"not starting {args[0]}: shutting down")
+        proc = subprocess.Popen(args, **kwargs)
+        with self._lock:
+            self._processes.add(proc)
+        try:
+            yield proc
+        finally:
+            with self._lock:
+                self._processes.discard(proc)
+
+    def run(self, args, timeout):
+        """subprocess.run(args, capture_output=True, text=True, timeout=timeout, check=True) that raises Interrupted when stopped."""
+        with self.popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as proc:
+            try:
+                stdout, stderr = proc.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                raise
+        if proc.returncode and self.interrupted:
+            raise Interrupted(f"{args[0]} stopped: shutting down")
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, args, stdout, stderr)
+        return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+class HandoffQueue:
+    """Jobs interrupted by a shutdown, waiting for another instance to resume them (`job_handoffs`)."""
+
+    def __init__(self, engine, table, lifecycle, max_attempts=HANDOFF_MAX_ATTEMPTS):
+        self.engine = engine
+        self.table = table
+        self.lifecycle = lifecycle
+        self.max_attempts = max_attempts
+        self._running = {}  # row id -> row of the resumed jobs running here
+        self._lock = threading.Lock()
+
+    def put(self, kind, tenant, payload):
+        with self.engine.begin() as conn:
+            conn.execute(self.table.insert().values(id=str(uuid.uuid4()), kind=kind, tenant_id=tenant, payload=payload,
+                                                    created_at=datetime.utcnow(), attempts=0, status=PENDING))
+        logger.info("Handed off %s of tenant %s", kind, tenant)
+
+    def claim(self, limit=10):
+        """Claims up to limit unclaimed (or abandoned) jobs for this process; returns their rows."""
+        table = self.table
+        stale = datetime.utcnow() - timedelta(seconds=HANDOFF_CLAIM_TIMEOUT)
+        unclaimed = (table.c.status == PENDING) & (table.c.claimed_at.is_(None) | (table.c.claimed_at < stale))
+        with self.engine.begin() as conn:
+            # The instances that claimed these for the last time died with them
+            abandoned = conn.execute(table.update().where(unclaimed & (table.c.attempts >= self.max_attempts))
+                                     .values(status=DEAD, last_error="claimed instance stopped responding")).rowcount
+        if abandoned:
+            logger.error("Gave up on %d handed-off jobs after %d attempts", abandoned, self.max_attempts)
+        claimable = unclaimed & (table.c.attempts < self.max_attempts)
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(table).where(claimable).order_by(table.c.created_at).limit(limit)).fetchall()
+        claimed = []
+        for row in rows:
+            with self.engine.begin() as conn:
+                # Only one instance wins a row: the update matches nothing once another one claimed it
+                won = conn.execute(table.update().where((table.c.id == row.id) & claimable)
+                                   .values(claimed_at=datetime.utcnow(), attempts=table.c.attempts + 1)).rowcount
+            if won:
+                claimed.append(row)
+        return claimed
+
+    def done(self, row_id):
+        with self.engine.begin() as conn:
+            conn.execute(self.table.delete().where(self.table.c.id == row_id))
+
+    def failed(self, row, error):
+        """Releases a claimed job for another attempt, or marks it dead after the last one."""
+        attempts = row.attempts + 1
+        dead = attempts >= self.max_attempts
+        logger.error("Resuming %s %s failed (attempt %d of %d%s): %s", row.kind, row.id, attempts,
+                     self.max_attempts, ", giving up" if dead else "", error)
+        with self.engine.begin() as conn:
+            conn.execute(self.table.update().where(self.table.c.id == row.id).values(
+                claimed_at=None, last_error=str(error)[:1000], status=DEAD if dead else PENDING))
+
+    def release(self, row_id):
+        """Lets another instance claim a job right away, e.g. one whose resume never started here."""
+        with self.engine.begin() as conn:
+            conn.execute(self.table.update().where(self.table.c.id == row_id).values(claimed_at=None))
+
+    def heartbeat(self):
+        """Refreshes the claims of the jobs running here, so no other instance takes them over."""
+        with self._lock:
+            running = list(self._running)
+        if running:
+            with self.engine.begin() as conn:
+                conn.execute(self.table.update().where(self.table.c.id.in_(running)).values(claimed_at=datetime.utcnow()))
+
+    def resume_once(self, handlers):
+        """
+        Claims handed-off jobs and passes each to handlers[kind](row_id, tenant, payload), which returns the
+        Future of the job it started (None when there was nothing left to resume). The row is kept until
+        that job has finished. Returns how many were resumed.
+        """
+        resumed = 0
+        for row in self.claim():
+            try:
+                future = handlers[row.kind](row.id, row.tenant_id, row.payload)
+            except Exception as e:
+                self.failed(row, e)
+                continue
+            if future is None:
+                self.done(row.id)
+            else:
+                self._track(row, future)
+            resumed += 1
+        return resumed
+
+    def _track(self, row, future):
+        with self._lock:
+            self._running[row.id] = row
+
+        def finished(future):
+            with self._lock:
+                self._running.pop(row.id, None)
+            try:
+                if future.cancelled():
+                    # Never started (this instance is shutting down); the claim goes to another one
+                    self.release(row.id)
+                elif future.exception():
+                    self.failed(row, future.exception())
+                else:
+                    self.done(row.id)
+            except Exception as e:
+                logger.error("Updating handed-off %s %s failed: %s", row.kind, row.id, e)
+        future.add_done_callback(finished)
+
+    def start(self, handlers):
+        def run():
+            while True:
+                time.sleep(HANDOFF_POLL_INTERVAL)
+                try:
+                    # Also while draining: the resumed jobs still running here are not abandoned
+                    self.heartbeat()
+                    if not self.lifecycle.draining:
+                        self.resume_once(handlers)
+                except Exception as e:
+                    logger.warning("Job handoff poll failed: %s", e)
+        threading.Thread(target=run, name="job-handoff", daemon=True).start()
@@ -0,0 +1,256 @@
+"""
+Live change feed for the frontend over WebSocket or SSE.
+
+Writers call publish(tenant, topic, data) after committing. Each tenant has
+one Redis stream (`live:<tenant>`, trimmed to about LIVE_STREAM_MAXLEN
+entries). The stream entry id is the event's offset, so a client that
+reconnects with the last id it saw gets exactly the events it missed. Every
+worker runs one reader thread that blocks on the streams of the tenants it
+has clients for and fans new entries out to those clients' queues. A replica
+therefore sees writes made on any other replica.
+
+Without REDIS_URL the streams are in-process ring buffers with the same id
+format, which is enough for a single worker.
+
+A client whose offset has already been trimmed away, or whose queue
+overflowed because it reads too slowly, gets a "reset" event and should
+refetch what it shows.
+
+Browsers cannot send an Authorization header on WebSocket or EventSource
+connections, and tokens in URLs end up in proxy and access logs. They get a
+one-time ticket instead (issue_ticket), valid for LIVE_TICKET_TTL seconds and
+stored next to the streams, so any worker or replica can redeem it.
+"""
+
+import os
+import json
+import time
+import secrets
+import asyncio
+import logging
+import threading
+from collections import deque
+
+import redis
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+REDIS_URL = os.environ.get("REDIS_URL", "")
+LIVE_STREAM_MAXLEN = int(os.environ.get("LIVE_STREAM_MAXLEN", "1000"))
+LIVE_CLIENT_BUFFER = int(os.environ.get("LIVE_CLIENT_BUFFER", "500"))
+LIVE_TICKET_TTL = int(os.environ.get("LIVE_TICKET_TTL", "30"))
+STREAM_PREFIX = "live"
+TICKET_PREFIX = "live-ticket"
+
+TOPICS = ("modules", "scans", "orchestrations", "documents", "audit_log", "usage_metrics", "providers", "webhooks")
+
+
+def parse_id(event_id):
+    ms, _, seq = str(event_id).partition("-")
+    return int(ms), int(seq or 0)
+
+
+class Subscription:
+    """One connected client: a bounded asyncio queue fed from the reader thread."""
+
+    def __init__(self, hub, tenant, topics, loop):
+        self.hub = hub
+        self.tenant = tenant
+        self.topics = set(topics or TOPICS)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=LIVE_CLIENT_BUFFER)
+        self.last_id = (0, 0)
+        self.overflowed = False
+
+    def offer(self, event):
+        """Called on the event loop: queues event unless it was already sent or is for another topic."""
+        if event["topic"] not in self.topics or parse_id(event["id"]) <= self.last_id:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def next(self, timeout):
+        """The next event, a reset after an overflow, or None after timeout seconds without events."""
+        if self.overflowed:
+            self.overflowed = False
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            return {"type": "reset", "reason": "client too slow"}
+        try:
+            event = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if parse_id(event["id"]) <= self.last_id:
+            return await self.next(timeout)
+        self.last_id = parse_id(event["id"])
+        return event
+
+    def sent(self, event_id):
+        self.last_id = max(self.last_id, parse_id(event_id))
+
+
+class LiveHub:
+    def __init__(self, redis_url=REDIS_URL, maxlen=LIVE_STREAM_MAXLEN):
+        self.redis_url = redis_url
+        self.maxlen = maxlen
+        self.redis = redis.Redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5) if redis_url else None
+        self._subscriptions = {}  # tenant -> set of Subscription
+        self._cursors = {}  # tenant -> last stream id read by this process
+        self._local = {}  # tenant -> deque of events (no Redis)
+        self._last_local_id = (0, 0)
+        self._lock = threading.Lock()
+        self._reader = None
+        self._tickets = {}  # ticket -> (session JSON, expires at) (no Redis)
+
+    # --- Connection tickets ---
+    def issue_ticket(self, claims, tenant, ttl=LIVE_TICKET_TTL):
+        """A ticket that opens one live connection as claims in tenant within ttl seconds."""
+        ticket = secrets.token_urlsafe(32)
+        session = json.dumps({"claims": claims, "tenant": tenant}, default=str)
+        if self.redis is not None:
+            self.redis.set(f"{TICKET_PREFIX}:{ticket}", session, ex=ttl)
+            return ticket
+        now = time.monotonic()
+        with self._lock:
+            for expired in [t for t, (_, expires) in self._tickets.items() if expires <= now]:
+                del self._tickets[expired]
+            self._tickets[ticket] = (session, now + ttl)
+        return ticket
+
+    def redeem_ticket(self, ticket):
+        """The {"claims", "tenant"} a ticket was issued for; None when it is unknown, expired or was used before."""
+        if self.redis is not None:
+            key = f"{TICKET_PREFIX}:{ticket}"
+            try:
+                # GET and DEL in one transaction: of two concurrent redeems only one sees the session
+                session, _ = self.redis.pipeline(transaction=True).get(key).delete(key).execute()
+            except redis.RedisError as e:
+                logger.warning("Live ticket not redeemed: %s", e)
+                return None
+        else:
+            with self._lock:
+                session, expires = self._tickets.pop(ticket, (None, 0))
+            if expires <= time.monotonic():
+                return None
+        return json.loads(session) if session else None
+
+    # --- Publishing ---
+    def publish(self, tenant, topic, data, op="updated"):
+        """Appends a change to the tenant's stream; never raises, a lost live update only costs a refetch."""
+        event = {"topic": topic, "op": op, "data": data, "ts": time.time()}
+        if self.redis is None:
+            self._publish_local(tenant, event)
+            return
+        try:
+            self.redis.xadd(f"{STREAM_PREFIX}:{tenant}", {"event": json.dumps(event, default=str)},
+                            maxlen=self.maxlen, approximate=True)
+        except redis.RedisError as e:
+            logger.warning("Live update %s for %s not published: %s", topic, tenant, e)
+
+    def _publish_local(self, tenant, event):
+        with self._lock:
+            ms = int(time.time() * 1000)
+            last_ms, last_seq = self._last_local_id
+            self._last_local_id = (ms, 0) if ms > last_ms else (last_ms, last_seq + 1)
+            event["id"] = "%d-%d" % self._last_local_id
+            self._local.setdefault(tenant, deque(maxlen=self.maxlen)).append(event)
+            subscriptions = list(self._subscriptions.get(tenant, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.offer, event)
+
+    # --- Subscribing ---
+    def subscribe(self, tenant, topics, loop):
+        subscription = Subscription(self, tenant, topics, loop)
+        with self._lock:
+            if tenant not in self._subscriptions and self.redis is not None:
+                self._cursors[tenant] = self._stream_tail(tenant)
+            self._subscriptions.setdefault(tenant, set()).add(subscription)
+        self._start_reader()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.tenant)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.tenant]
+                self._cursors.pop(subscription.tenant, None)
+
+    def backlog(self, tenant, last_id):
+        """
+        Events after last_id, or None when the oldest retained event is newer
+        than last_id, i.e. some may have been trimmed (the client has to reset).
+        """
+        after = parse_id(last_id)
+        if self.redis is None:
+            with self._lock:
+                events = list(self._local.get(tenant, ()))
+            if after != (0, 0) and events and parse_id(events[0]["id"]) > after:
+                return None
+            return [e for e in events if parse_id(e["id"]) > after]
+        key = f"{STREAM_PREFIX}:{tenant}"
+        try:
+            first = self.redis.xrange(key, count=1)
+            if after != (0, 0) and first and parse_id(first[0][0].decode()) > after:
+                return None
+            entries = self.redis.xrange(key, min="(%d-%d" % after)
+        except redis.RedisError as e:
+            logger.warning("Live backlog for %s unavailable: %s", tenant, e)
+            return None
+        return [self._decode(entry_id, fields) for entry_id, fields in entries]
+
+    def _stream_tail(self, tenant):
+        try:
+            last = self.redis.xrevrange(f"{STREAM_PREFIX}:{tenant}", count=1)
+        except redis.RedisError:
+            return "0-0"
+        return last[0][0].decode() if last else "0-0"
+
+    @staticmethod
+    def _decode(entry_id, fields):
+        event = json.loads(fields[b"event"])
+        event["id"] = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+        return event
+
+    # --- Fan-out ---
+    def _start_reader(self):
+        if self.redis is None or self._reader is not None:
+            return
+        with self._lock:
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read, name="live-updates-reader", daemon=True)
+                self._reader.start()
+
+    def _read(self):
+        # Own connection: XREAD blocks longer than the publishing client's socket timeout
+        reader = redis.Redis.from_url(self.redis_url, socket_connect_timeout=5, socket_timeout=10)
+        backoff = 0.5
+        while True:
+            with self._lock:
+                cursors = {f"{STREAM_PREFIX}:{t}": c for t, c in self._cursors.items()}
+            if not cursors:
+                time.sleep(0.2)
+                continue
+            try:
+                response = reader.xread(cursors, block=2000, count=500)
+                backoff = 0.5
+            except redis.RedisError as e:
+                logger.warning("Live updates reader reconnecting in %ss: %s", backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            for stream, entries in response or ():
+                tenant = stream.decode()[len(STREAM_PREFIX) + 1:]
+                events = [self._decode(entry_id, fields) for entry_id, fields in entries]
+                with self._lock:
+                    if tenant in self._cursors:
+                        self._cursors[tenant] = events[-1]["id"]
+                    subscriptions = list(self._subscriptions.get(tenant, ()))
+                for subscription in subscriptions:
+                    for event in events:
+                        subscription.loop.call_soon_threadsafe(subscription.offer, event)
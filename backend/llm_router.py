@@ -0,0 +1,101 @@
+"""
+Routing between the local Ollama model and the cloud fallback for /ai/ask.
+
+The scheduler runs OLLAMA_MAX_IN_FLIGHT generations at a time and queues the
+rest, so an interactive request that finds q generations ahead of it takes
+about S * (q // slots + 1), where S is the time for one generation. S is
+tracked as an exponentially weighted average of observed latencies
+normalised that way, which makes the prediction react to both queue depth
+and a slowing model.
+
+Routes:
+- local: predicted latency fits the tenant's SLO (or no cloud budget left).
+- cloud: predicted latency exceeds the SLO and budget remains.
+- hedged: local is started; if it has not answered when only the expected
+  cloud latency is left before the SLO, cloud is started too and the first
+  answer wins.
+
+Queue depth is per process; with several workers the latency average still
+reflects load from all of them because they share one Ollama.
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from metrics import OLLAMA_QUEUE_DEPTH
+from llm_scheduler import OLLAMA_MAX_IN_FLIGHT
+
+# --- Configuration ---
+LLM_LATENCY_EWMA_ALPHA = float(os.environ.get("LLM_LATENCY_EWMA_ALPHA", "0.2"))
+# USD per 1K tokens (prompt and completion together, 4 characters per token); override with a JSON map
+CLOUD_PRICES_PER_1K_TOKENS = {"openai": 0.0006, "anthropic": 0.004, "google": 0.0004}
+CLOUD_PRICES_PER_1K_TOKENS.update(json.loads(os.environ.get("CLOUD_LLM_PRICES", "{}")))
+
+LOCAL, CLOUD, HEDGED = "local", "cloud", "hedged"
+
+
+def estimate_cost(provider, prompt, completion):
+    tokens = (len(prompt) + len(str(completion))) / 4
+    return round(tokens / 1000 * CLOUD_PRICES_PER_1K_TOKENS.get(provider, max(CLOUD_PRICES_PER_1K_TOKENS.values())), 6)
+
+
+class LatencyModel:
+    """EWMA of one upstream's service time, plus (for Ollama) the number of calls in flight."""
+
+    def __init__(self, parallel=1, alpha=LLM_LATENCY_EWMA_ALPHA, gauge=None):
+        self.parallel = max(parallel, 1)
+        self.alpha = alpha
+        self.gauge = gauge
+        self.service_time = None
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self):
+        with self._lock:
+            ahead = self.in_flight
+            self.in_flight += 1
+        if self.gauge is not None:
+            self.gauge.inc()
+        started = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                if ok:
+                    sample = (time.perf_counter() - started) / (ahead // self.parallel + 1)
+                    self.service_time = sample if self.service_time is None else \
+                        self.alpha * sample + (1 - self.alpha) * self.service_time
+            if self.gauge is not None:
+                self.gauge.dec()
+
+    def predict(self):
+        """Expected seconds for a call started now; 0 until the first call has been observed."""
+        with self._lock:
+            if self.service_time is None:
+                return 0.0
+            return self.service_time * (self.in_flight // self.parallel + 1)
+
+
+local_model = LatencyModel(OLLAMA_MAX_IN_FLIGHT, gauge=OLLAMA_QUEUE_DEPTH)
+cloud_model = LatencyModel(parallel=1 << 16)
+
+
+def decide(slo_seconds, budget_left, hedging=True):
+    """Returns (route, reason, predicted_local_seconds, hedge_after_seconds or None)."""
+    predicted = local_model.predict()
+    if budget_left <= 0:
+        return LOCAL, "budget_exhausted", predicted, None
+    if predicted > slo_seconds:
+        return CLOUD, "predicted_slo_miss", predicted, None
+    if not hedging:
+        return LOCAL, "within_slo", predicted, None
+    # Leave the cloud call enough time to land inside the SLO, but never hedge immediately
+    hedge_after = max(slo_seconds - cloud_model.predict(), slo_seconds * 0.25)
+    return HEDGED, "within_slo", predicted, hedge_after
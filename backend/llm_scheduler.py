@@ -0,0 +1,221 @@
+"""
+Scheduler for every call the backend makes to Ollama.
+
+Ollama runs OLLAMA_NUM_PARALLEL requests at a time and queues the rest in
+arrival order, so one agent run or document ingestion could put dozens of
+calls ahead of an interactive question. Here callers wait for one of
+OLLAMA_MAX_IN_FLIGHT slots instead, and a freed slot goes to:
+- the highest waiting priority class (interactive > agent > batch);
+- within a class, the next tenant in round-robin order, so one tenant's burst
+  cannot starve the others.
+
+Slots are taken per HTTP call (one generation, one embedding), so long jobs
+yield between calls. The priority class and tenant come from context
+variables set with llm_priority(); calls made outside one count as batch.
+
+Calls made inside a cancel_scope() stop waiting when the scope is cancelled:
+they leave the queue (or hand on a slot granted at that moment) and raise
+LLMCallCancelled. route_generation() cancels the losing side of a hedge this
+way, so it does not take a slot after the answer is already in.
+
+Slots are per process, not shared: each gunicorn worker and each replica has
+its own OLLAMA_MAX_IN_FLIGHT slots and its own queues. Ollama therefore sees
+up to replicas x workers x OLLAMA_MAX_IN_FLIGHT calls at once, and the
+priority and round-robin order hold within a worker only; between workers,
+calls interleave in Ollama's own arrival order. Set OLLAMA_MAX_IN_FLIGHT so
+that this product matches OLLAMA_NUM_PARALLEL (e.g. 4 workers x 1 slot for
+OLLAMA_NUM_PARALLEL=4), so calls wait here, in priority order, rather than in
+Ollama's queue.
+"""
+
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import requests
+from langchain_community.llms import Ollama
+from langchain_community.embeddings import OllamaEmbeddings
+
+from metrics import LLM_QUEUE_WAIT, LLM_QUEUE_DEPTH, OLLAMA_TOKENS, OLLAMA_EVAL_SECONDS
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "1"))
+OLLAMA_MAX_IN_FLIGHT = int(os.environ.get("OLLAMA_MAX_IN_FLIGHT", str(OLLAMA_NUM_PARALLEL)))
+# How long Ollama keeps models loaded after a request (Ollama's own default is 5m)
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+
+INTERACTIVE, AGENT, BATCH = "interactive", "agent", "batch"
+PRIORITIES = (INTERACTIVE, AGENT, BATCH)
+
+_priority = contextvars.ContextVar("llm_priority", default=BATCH)
+_tenant = contextvars.ContextVar("llm_tenant", default="")
+_cancel_scope = contextvars.ContextVar("llm_cancel_scope", default=None)
+
+
+class LLMCallCancelled(Exception):
+    """The call's cancel scope was cancelled while it waited for a slot."""
+
+
+@contextmanager
+def llm_priority(priority, tenant):
+    """Ollama calls made inside (including from threads started with this context) queue as priority/tenant."""
+    tokens = _priority.set(priority), _tenant.set(tenant)
+    try:
+        yield
+    finally:
+        _priority.reset(tokens[0])
+        _tenant.reset(tokens[1])
+
+
+class CancelScope:
+    """Cancels the slot waits of the calls made inside it, e.g. the losing side of a hedge."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._waiting = set()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            waiting = list(self._waiting)
+        for granted in waiting:
+            granted.set()
+
+    def _watch(self, granted):
+        with self._lock:
+            if self.cancelled:
+                granted.set()
+            else:
+                self._waiting.add(granted)
+
+    def _unwatch(self, granted):
+        with self._lock:
+            self._waiting.discard(granted)
+
+
+@contextmanager
+def cancel_scope():
+    """Ollama calls started inside (including threads started with this context) can be cancelled with the scope."""
+    scope = CancelScope()
+    token = _cancel_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _cancel_scope.reset(token)
+
+
+class LLMScheduler:
+    def __init__(self, max_in_flight=OLLAMA_MAX_IN_FLIGHT):
+        self.max_in_flight = max(max_in_flight, 1)
+        self.in_flight = 0
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}  # tenant -> deque of waiting events
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        priority, tenant, scope = _priority.get(), _tenant.get(), _cancel_scope.get()
+        if scope is not None and scope.cancelled:
+            raise LLMCallCancelled()
+        granted = threading.Event()
+        queued_at = time.perf_counter()
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not any(self._queues.values()):
+                self.in_flight += 1
+                granted.set()
+            else:
+                self._queues[priority].setdefault(tenant, deque()).append(granted)
+                LLM_QUEUE_DEPTH.labels(priority).inc()
+        if scope is not None:
+            scope._watch(granted)
+        granted.wait()
+        if scope is not None:
+            scope._unwatch(granted)
+            if scope.cancelled:
+                if not self._withdraw(priority, tenant, granted):
+                    self._release()  # the slot was handed over just as the scope was cancelled
+                raise LLMCallCancelled()
+        LLM_QUEUE_WAIT.labels(priority).observe(time.perf_counter() - queued_at)
+        try:
+            yield priority
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            for priority in PRIORITIES:
+                tenants = self._queues[priority]
+                if not tenants:
+                    continue
+                tenant, waiting = next(iter(tenants.items()))
+                granted = waiting.popleft()
+                if waiting:
+                    tenants.move_to_end(tenant)
+                else:
+                    del tenants[tenant]
+                LLM_QUEUE_DEPTH.labels(priority).dec()
+                # The slot passes straight to the waiter; in_flight is unchanged
+                granted.set()
+                return
+            self.in_flight -= 1
+
+    def _withdraw(self, priority, tenant, granted):
+        """Takes a waiter out of its queue; False when it was already granted a slot."""
+        with self._lock:
+            waiting = self._queues[priority].get(tenant)
+            if waiting is None or granted not in waiting:
+                return False
+            waiting.remove(granted)
+            if not waiting:
+                del self._queues[priority][tenant]
+            LLM_QUEUE_DEPTH.labels(priority).dec()
+            return True
+
+    def snapshot(self):
+        with self._lock:
+            # Slots and queues of this worker process only (see the module docstring)
+            return {"pid": os.getpid(), "max_in_flight": self.max_in_flight, "in_flight": self.in_flight,
+                    "queued": {p: sum(len(q) for q in self._queues[p].values()) for p in PRIORITIES}}
+
+
+scheduler = LLMScheduler()
+
+
+class ScheduledOllama(Ollama):
+    """Ollama LLM whose generations go through the scheduler and report tokens/sec per priority class."""
+
+    def _generate(self, prompts, stop=None, images=None, run_manager=None, **kwargs):
+        with scheduler.slot() as priority:
+            started = time.perf_counter()
+            result = super()._generate(prompts, stop=stop, images=images, run_manager=run_manager, **kwargs)
+            elapsed = time.perf_counter() - started
+        for [generation] in result.generations:
+            info = generation.generation_info or {}
+            # Ollama's own counts when present; otherwise 4 characters per token over wall time
+            OLLAMA_TOKENS.labels(priority).inc(info.get("eval_count") or len(generation.text) // 4)
+            OLLAMA_EVAL_SECONDS.labels(priority).inc(info["eval_duration"] / 1e9 if info.get("eval_duration")
+                                                     else elapsed / len(result.generations))
+        return result
+
+
+class ScheduledOllamaEmbeddings(OllamaEmbeddings):
+    """Ollama embeddings with one scheduler slot per embedded text."""
+
+    def _process_emb_response(self, input):
+        with scheduler.slot():
+            return super()._process_emb_response(input)
+
+
+def preload_models(base_url, generate_model, embed_model, keep_alive=OLLAMA_KEEP_ALIVE):
+    """Loads both models into Ollama ahead of the first request and pins them for keep_alive."""
+    for path, body in (("/api/generate", {"model": generate_model}), ("/api/embeddings", {"model": embed_model, "prompt": ""})):
+        try:
+            requests.post(f"{base_url}{path}", json={**body, "keep_alive": keep_alive}, timeout=300).raise_for_status()
+        except requests.RequestException as e:
+            logger.warning("Ollama preload of %s failed: %s", body["model"], e)
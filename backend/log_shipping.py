@@ -0,0 +1,200 @@
+"""
+Structured log shipping to the Logstash `json_lines` TCP input.
+
+The handler formats each record into a JSON line on the logging thread, so
+the message, exception, request context and trace id are those of the moment
+it was logged, and appends it to a bounded drop-oldest buffer. Network I/O
+happens on a background shipper thread that batches, reconnects with backoff
+and never blocks callers.
+"""
+
+import os
+import json
+import uuid
+import socket
+import logging
+import threading
+import contextvars
+from collections import deque
+from datetime import datetime, timezone
+
+from opentelemetry import trace
+
+# --- Configuration ---
+LOGSTASH_HOST = os.environ.get("LOGSTASH_HOST", "")
+LOGSTASH_PORT = int(os.environ.get("LOGSTASH_PORT", "5044"))
+LOG_BUFFER_SIZE = int(os.environ.get("LOG_BUFFER_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "500"))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "saas-backend")
+
+# --- Request Context ---
+request_context = contextvars.ContextVar("request_context", default={})
+
+
+class RequestContextMiddleware:
+    """Binds tenant and request ids to the context of each request (X-Request-ID is honoured)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        request_id = headers.get(b"x-request-id", b"").decode() or uuid.uuid4().hex
+        token = request_context.set({
+            "tenant_id": headers.get(b"x-tenant-id", b"default").decode(),
+            "request_id": request_id,
+        })
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", []).append((b"x-request-id", request_id.encode()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_context.reset(token)
+
+
+# --- Formatter ---
+class JsonLinesFormatter(logging.Formatter):
+    """A Logstash json_lines document carrying the request context and trace id of the logging thread."""
+
+    def format(self, record):
+        doc = {
+            "@timestamp": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "service": LOG_SERVICE_NAME,
+            "thread": record.threadName,
+            **request_context.get(),
+        }
+        span_context = trace.get_current_span().get_span_context()
+        if span_context.is_valid:
+            doc["trace_id"] = format(span_context.trace_id, "032x")
+        if record.exc_info:
+            doc["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            doc["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(doc, default=str) + "\n"
+
+
+# --- Handler ---
+class LogstashHandler(logging.Handler):
+    """Non-blocking handler: emit() formats the record and appends it to a bounded deque that drops the oldest."""
+
+    def __init__(self, host, port, buffer_size=LOG_BUFFER_SIZE, batch_size=LOG_BATCH_SIZE):
+        super().__init__()
+        self.address = (host, port)
+        self.batch_size = batch_size
+        self.buffer = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.setFormatter(JsonLinesFormatter())
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._sock = None
+        self._backoff = 0.5
+        self._thread = threading.Thread(target=self._run, name="logstash-shipper", daemon=True)
+        self._thread.start()
+
+    def _restart_after_fork(self):
+        # A forked worker inherits the buffer (the parent ships those records) but not the thread
+        self.buffer.clear()
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._start()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._restart_after_fork()
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            with self._dropped_lock:
+                self.dropped += 1
+        self.buffer.append(line)
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _take_dropped(self):
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, timeout=5)
+        self._backoff = 0.5
+
+    def _send(self, payload):
+        if self._sock is None:
+            self._connect()
+        try:
+            self._sock.sendall(payload)
+        except OSError:
+            self._sock.close()
+            self._sock = None
+            raise
+
+    def _run(self):
+        pending = b""
+        while not self._stopping.is_set() or self.buffer or pending:
+            if not pending:
+                if len(self.buffer) < self.batch_size and not self._stopping.is_set():
+                    self._wakeup.wait(LOG_FLUSH_INTERVAL)
+                    self._wakeup.clear()
+                lines = []
+                while self.buffer and len(lines) < self.batch_size:
+                    lines.append(self.buffer.popleft())
+                dropped = self._take_dropped()
+                if dropped:
+                    lines.append(json.dumps({"@timestamp": datetime.now(timezone.utc).isoformat(),
+                                             "level": "WARNING", "logger": __name__, "service": LOG_SERVICE_NAME,
+                                             "message": f"dropped {dropped} log records on overload"}) + "\n")
+                pending = "".join(lines).encode()
+                if not pending:
+                    continue
+            try:
+                self._send(pending)
+                pending = b""
+            except OSError:
+                if self._stopping.is_set():
+                    return
+                # Keep the batch; new records keep landing in the bounded buffer meanwhile.
+                self._stopping.wait(self._backoff)
+                self._backoff = min(self._backoff * 2, 30)
+
+    def close(self, timeout=5.0):
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        if self._sock is not None:
+            self._sock.close()
+        super().close()
+
+
+def setup_log_shipping(loggers=("uvicorn", "uvicorn.access")):
+    """
+    Attaches a shared LogstashHandler to the root logger, and to the given loggers
+    that do not propagate to root (uvicorn's own config), when LOGSTASH_HOST is set.
+    """
+    if not LOGSTASH_HOST:
+        return None
+    handler = LogstashHandler(LOGSTASH_HOST, LOGSTASH_PORT)
+    logging.getLogger().addHandler(handler)
+    for name in loggers:
+        log = logging.getLogger(name)
+        if not log.propagate:
+            log.addHandler(handler)
+    return handler
@@ -1,27 +1,34 @@
 
 
 import os
+import asyncio
 import logging
 import http.client as http_client
 import json
+import secrets
+import shutil
 import subprocess
+import threading
+import time
 import uuid
-from datetime import datetime
+import contextvars
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import Optional
 
 import docker
 import requests
-from fastapi import FastAPI, Depends, Request, HTTPException, status, UploadFile, Form
+from fastapi import FastAPI, Depends, Request, HTTPException, Query, status, UploadFile, Form, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, JSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from keycloak import KeycloakOpenID
-from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, String, Text, JSON, Table, MetaData
+from pydantic import BaseModel, Field
+from sqlalchemy import create_engine, Column, String, Text, JSON, Integer, Float, Boolean, DateTime, Table, MetaData, Index, func, select, exists
 from sqlalchemy.orm import sessionmaker, Session
-import chromadb
 from langchain_community.vectorstores import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain_community.llms import Ollama
 from crewai import Agent, Task, Crew, Process
 from cryptography.fernet import Fernet
 import hvac
@@ -29,19 +36,71 @@ from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
+from document_parsing import stream_pages, document_format, UnsupportedDocumentFormat
+from metrics import (
+    PrometheusMiddleware, upstream_timer, record_llm_usage, register_db_pool_collector,
+    metrics_response_body, SCANS_IN_FLIGHT, AGENT_JOBS_IN_FLIGHT, LLM_ROUTING_DECISIONS, ORCHESTRATION_STEPS
+)
+from tracing import TracingMiddleware, span, inject_headers, inject_env, docker_env_args, record_child_timing
+from log_shipping import RequestContextMiddleware, setup_log_shipping
+from module_cache import ModuleCache, REGISTRY_KEY, tenant_key
+from config_validation import ConfigValidators, InvalidSchema, compile_schema, pipeline_errors
+from step_cache import StepCache, step_key
+from events import EventBus, EVENT_TYPES, WEBHOOK, N8N, UnsafeDestination, check_url, check_n8n_path, public_error
+from live_updates import LiveHub, LIVE_TICKET_TTL
+from envelope import EnvelopeCipher, key_version
+from vector_shards import ChromaRouter, UnknownShard
+from lifecycle import Lifecycle, HandoffQueue, Interrupted
+from profiling import Profiler, ProfilingMiddleware, is_admin
+from audit_log import prepare as prepare_audit_log, start_maintenance as start_audit_log_maintenance
+from llm_scheduler import (
+    ScheduledOllama, ScheduledOllamaEmbeddings, llm_priority, cancel_scope, preload_models, scheduler, INTERACTIVE, AGENT,
+    BATCH, OLLAMA_KEEP_ALIVE
+)
+from llm_router import CLOUD, decide, estimate_cost, local_model, cloud_model
+from scan_findings import (
+    normalize_output, store_raw_output, load_raw_output, delete_raw_output, summarize_output,
+    merge_nmap_xml, findings_digest
+)
+
 # --- FastAPI App Initialization ---
-limiter = Limiter(key_func=get_remote_address)
+# Limits are counted in Redis when available so they hold across worker processes and replicas
+RATE_LIMIT_STORAGE_URI = os.environ.get("RATE_LIMIT_STORAGE_URI") or os.environ.get("REDIS_URL") or "memory://"
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE_URI, in_memory_fallback_enabled=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in every worker after it is forked, so the background threads belong to this process
+    start_module_cache()
+    start_audit_log_retention()
+    start_event_dispatcher()
+    start_data_key_maintenance()
+    place_vector_tenants()
+    start_lifecycle()
+    preload_ollama_models()
+    yield
+    drain_and_close()
+
 app = FastAPI(
     title="SaaS AI Platform API",
     description="Multi-tenant, modular SaaS AI backend.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+app.add_middleware(PrometheusMiddleware)
+app.add_middleware(TracingMiddleware)
+app.add_middleware(RequestContextMiddleware)
+# Outermost, so a profile's duration is the whole request
+profiler = Profiler()
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
 
 # --- Logging Configuration ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("uvicorn.error")
+# Structured JSON shipping to Logstash (LOGSTASH_HOST); non-blocking, batched in a background thread
+log_handler = setup_log_shipping()
 # http_client.HTTPConnection.debuglevel = 1  # Uncomment for detailed HTTP requests debugging
 
 # --- Environment Variables & Configuration ---
@@ -50,24 +109,54 @@ KEYCLOAK_URL = os.environ.get("KEYCLOAK_URL", "http://keycloak:8080/")
 KEYCLOAK_REALM = os.environ.get("KEYCLOAK_REALM", "saas-platform")
 KEYCLOAK_CLIENT_ID = os.environ.get("KEYCLOAK_CLIENT_ID", "saas-frontend")
 N8N_URL = os.environ.get("N8N_URL", "http://n8n:5678")
-CHROMA_URL = os.environ.get("CHROMA_URL", "http://chromadb:8000")
 OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://ollama:11434")
 MCP_SERVER_URL = os.environ.get("MCP_SERVER_URL", "http://mcp-server:3002")
-ENCRYPTION_KEY = os.environ.get("ENCRYPTION_KEY", Fernet.generate_key().decode())
+MCP_TIMEOUT = float(os.environ.get("MCP_TIMEOUT", "180"))
+CLOUD_ROUTE_TTL = float(os.environ.get("CLOUD_ROUTE_TTL", "60"))
+# Defaults for tenants without an llm_routing_policies row
+LLM_LATENCY_SLO_MS = int(os.environ.get("LLM_LATENCY_SLO_MS", "10000"))
+LLM_MONTHLY_CLOUD_BUDGET_USD = float(os.environ.get("LLM_MONTHLY_CLOUD_BUDGET_USD", "20"))
+LLM_HEDGING = os.environ.get("LLM_HEDGING", "true").lower() == "true"
+LLM_POLICY_TTL = float(os.environ.get("LLM_POLICY_TTL", "60"))
+# Required: every worker and replica must decrypt what any other one encrypted
+ENCRYPTION_KEY = os.environ.get("ENCRYPTION_KEY")
+if not ENCRYPTION_KEY:
+    raise RuntimeError("ENCRYPTION_KEY is not set; generate one with "
+                       "`python -c 'from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())'`")
 cipher_suite = Fernet(ENCRYPTION_KEY.encode())
 VAULT_URL = os.environ.get("VAULT_URL", "http://vault:8200")
 VAULT_TOKEN = os.environ.get("VAULT_TOKEN", "root")
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "/app/uploads")
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+SCAN_JOB_WORKERS = int(os.environ.get("SCAN_JOB_WORKERS", "4"))
+NMAP_JOB_TIMEOUT = int(os.environ.get("NMAP_JOB_TIMEOUT", "3600"))
+# Synchronous scans hold the request open; longer ones belong in the background
+NMAP_SYNC_TIMEOUT = int(os.environ.get("NMAP_SYNC_TIMEOUT", "300"))
+# Upper bound for a request's parallel nmap processes (the module container clamps again)
+NMAP_MAX_WORKERS = int(os.environ.get("NMAP_MAX_WORKERS", "64"))
+SEMGREP_CACHE_VOLUME = os.environ.get("SEMGREP_CACHE_VOLUME", "semgrep-cache")
+SCAN_RETENTION_DAYS = int(os.environ.get("SCAN_RETENTION_DAYS", "30"))
+OLLAMA_PRELOAD = os.environ.get("OLLAMA_PRELOAD", "true").lower() == "true"
+# Seconds between keep-alive messages on idle live update connections (proxies drop silent ones)
+LIVE_HEARTBEAT = float(os.environ.get("LIVE_HEARTBEAT", "25"))
+ORCHESTRATION_STEP_TIMEOUT = int(os.environ.get("ORCHESTRATION_STEP_TIMEOUT", "600"))
+# Service endpoint of an activated module container ({container} is "<tenant>-<module>"), called for each pipeline step
+MODULE_STEP_URL = os.environ.get("MODULE_STEP_URL", "http://{container}:8000/run")
+# How long a resolved image digest is trusted; a retagged image is picked up after this
+IMAGE_DIGEST_TTL = float(os.environ.get("IMAGE_DIGEST_TTL", "60"))
 
 # --- Vault Client ---
 vault_client = hvac.Client(url=VAULT_URL, token=VAULT_TOKEN)
 
-# --- ChromaDB Client ---
-chroma_client = chromadb.HttpClient(host=CHROMA_URL, port=8000)
-embeddings = OllamaEmbeddings(base_url=OLLAMA_URL)
-llm = Ollama(base_url=OLLAMA_URL)
+# Every Ollama call goes through llm_scheduler; callers set the priority class with llm_priority()
+embeddings = ScheduledOllamaEmbeddings(base_url=OLLAMA_URL)
+llm = ScheduledOllama(base_url=OLLAMA_URL, keep_alive=OLLAMA_KEEP_ALIVE)
 
 # --- Database Setup ---
-engine = create_engine(DATABASE_URL)
+# SQLite (local benchmarks) needs connections usable from the threadpool that runs sync endpoints
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {})
+register_db_pool_collector(engine)
+profiler.instrument(engine)
 metadata = MetaData()
 
 # --- Database Tables ---
@@ -106,6 +195,36 @@ semgrep_results_table = Table(
     Column("timestamp", String)
 )
 
+# One row per parsed finding: an nmap port/host or a semgrep result.
+# fingerprint identifies the finding across runs, content_hash what was observed.
+scan_findings_table = Table(
+    "scan_findings", metadata,
+    Column("id", String, primary_key=True),
+    Column("scan_id", String, nullable=False),
+    Column("tenant_id", String, nullable=False),
+    Column("module", String, nullable=False),
+    Column("target", String),
+    Column("host", String),
+    Column("hostname", String),
+    Column("port", Integer),
+    Column("protocol", String),
+    Column("state", String),
+    Column("service", String),
+    Column("rule_id", String),
+    Column("severity", String),
+    Column("path", String),
+    Column("line", Integer),
+    Column("message", Text),
+    Column("fingerprint", String),
+    Column("content_hash", String),
+    Column("timestamp", String),
+    Index("ix_scan_findings_scan_fingerprint", "scan_id", "fingerprint"),
+    Index("ix_scan_findings_tenant_port", "tenant_id", "module", "port", "state"),
+    Index("ix_scan_findings_tenant_host", "tenant_id", "host"),
+    Index("ix_scan_findings_tenant_severity", "tenant_id", "module", "severity", "target"),
+    Index("ix_scan_findings_tenant_rule", "tenant_id", "rule_id")
+)
+
 module_orchestrations_table = Table(
     "module_orchestrations", metadata,
     Column("id", String, primary_key=True),
@@ -114,22 +233,78 @@ module_orchestrations_table = Table(
     Column("pipeline", JSON)
 )
 
+# One trigger of an orchestration; the pipeline runs in the background and each finished step is stored here
+orchestration_runs_table = Table(
+    "orchestration_runs", metadata,
+    Column("id", String, primary_key=True),
+    Column("tenant_id", String, nullable=False, index=True),
+    Column("orchestration_id", String, index=True),
+    Column("status", String),  # queued, running, completed, failed, interrupted
+    Column("input", JSON),
+    Column("options", JSON),  # use_cache / refresh of the trigger, kept for a resumed run
+    Column("results", JSON),
+    Column("cache", JSON),
+    Column("error", Text),
+    Column("handoff_id", String),  # job_handoffs row that resumed the run, taking it over if its instance dies
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime)
+)
+
 providers_table = Table(
     "providers", metadata,
     Column("id", String, primary_key=True),
     Column("tenant_id", String, index=True),
     Column("name", String),
-    Column("encrypted_config", Text)
+    Column("encrypted_config", Text)  # envelope-encrypted with the tenant's data key (see envelope.py)
 )
 
+# Per-tenant data keys, wrapped by the Vault transit key; the highest version encrypts new values
+tenant_data_keys_table = Table(
+    "tenant_data_keys", metadata,
+    Column("tenant_id", String, primary_key=True),
+    Column("version", Integer, primary_key=True),
+    Column("wrapped_key", Text, nullable=False),
+    Column("created_at", DateTime)
+)
+
+# Monthly range partitions on Postgres (see audit_log.py); the partition key has to be part of the primary key.
+# Every lookup is per tenant, so the indexes lead with tenant_id and end with timestamp for range scans.
 audit_log_table = Table(
     "audit_log", metadata,
     Column("id", String, primary_key=True),
-    Column("tenant_id", String, index=True),
+    Column("tenant_id", String, nullable=False),
     Column("user_id", String),
     Column("action", String),
     Column("details", JSON),
-    Column("timestamp", String)
+    Column("timestamp", DateTime, primary_key=True),
+    Index("ix_audit_log_tenant_time", "tenant_id", "timestamp"),
+    Index("ix_audit_log_tenant_action_time", "tenant_id", "action", "timestamp"),
+    Index("ix_audit_log_tenant_user_time", "tenant_id", "user_id", "timestamp"),
+    postgresql_partition_by='RANGE ("timestamp")'
+)
+
+# Jobs an instance stopped while shutting down, for another instance to resume (see lifecycle.py)
+job_handoffs_table = Table(
+    "job_handoffs", metadata,
+    Column("id", String, primary_key=True),
+    Column("kind", String, nullable=False),
+    Column("tenant_id", String, nullable=False),
+    Column("payload", JSON),
+    Column("created_at", DateTime),
+    Column("claimed_at", DateTime),
+    Column("attempts", Integer, nullable=False, default=0),
+    Column("status", String, nullable=False, default="pending"),  # pending, dead (gave up after HANDOFF_MAX_ATTEMPTS)
+    Column("last_error", Text),
+    Index("ix_job_handoffs_claimable", "status", "claimed_at")
+)
+
+# Chroma shard holding a tenant's collections (see vector_shards.py); migrating_to is set while it moves
+vector_placements_table = Table(
+    "vector_placements", metadata,
+    Column("tenant_id", String, primary_key=True),
+    Column("shard", String, nullable=False),
+    Column("migrating_to", String),
+    Column("updated_at", DateTime)
 )
 
 documents_table = Table(
@@ -151,6 +326,45 @@ usage_metrics_table = Table(
     Column("timestamp", String)
 )
 
+llm_routing_policies_table = Table(
+    "llm_routing_policies", metadata,
+    Column("tenant_id", String, primary_key=True),
+    Column("latency_slo_ms", Integer),
+    Column("monthly_cloud_budget_usd", Float),
+    Column("hedging", Boolean)
+)
+
+# Outbound event targets: an external URL (kind "webhook") or an n8n webhook path (kind "n8n")
+webhook_subscriptions_table = Table(
+    "webhook_subscriptions", metadata,
+    Column("id", String, primary_key=True),
+    Column("tenant_id", String, nullable=False, index=True),
+    Column("kind", String, nullable=False),
+    Column("url", Text, nullable=False),
+    Column("event_types", JSON),  # null: every event type
+    Column("encrypted_secret", Text, nullable=False),
+    Column("created_at", DateTime)
+)
+
+# Transactional outbox: one row per event and subscription, written with the change it reports (see events.py)
+event_outbox_table = Table(
+    "event_outbox", metadata,
+    Column("id", String, primary_key=True),
+    Column("event_id", String, nullable=False),
+    Column("tenant_id", String, nullable=False),
+    Column("subscription_id", String, nullable=False),
+    Column("event_type", String, nullable=False),
+    Column("payload", JSON),
+    Column("created_at", DateTime, nullable=False),
+    Column("status", String, nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("next_attempt_at", DateTime, nullable=False),
+    Column("delivered_at", DateTime),
+    Column("last_error", Text),
+    Index("ix_event_outbox_due", "status", "next_attempt_at"),
+    Index("ix_event_outbox_subscription", "subscription_id", "created_at")
+)
+
 migration_model_table = Table(
     "migration_model", metadata,
     Column("id", String, primary_key=True),
@@ -158,9 +372,34 @@ migration_model_table = Table(
     Column("applied_on", String)
 )
 
-metadata.create_all(engine)
+# audit_log is created by audit_log.prepare, which also converts a pre-partitioning table
+metadata.create_all(engine, tables=[t for t in metadata.sorted_tables if t is not audit_log_table])
+prepare_audit_log(engine, audit_log_table)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# --- Outbound Events ---
+event_bus = EventBus(engine, event_outbox_table, webhook_subscriptions_table,
+                     lambda secret: cipher_suite.decrypt(secret.encode()).decode(), N8N_URL)
+# Tenant-scoped change feed for the frontend (see live_updates.py); publish after committing
+live_hub = LiveHub()
+# Provider configs are encrypted locally with cached per-tenant data keys; Vault only wraps the keys
+envelope = EnvelopeCipher(engine, tenant_data_keys_table, vault_client)
+# --- ChromaDB: one or more instances (CHROMA_SHARDS), each tenant's collections on one of them ---
+chroma_router = ChromaRouter(engine, vector_placements_table)
+# --- Graceful shutdown: draining, in-flight jobs, handoff of interrupted ones ---
+lifecycle = Lifecycle()
+handoffs = HandoffQueue(engine, job_handoffs_table, lifecycle)
+
+# --- Worker Process Initialization ---
+def init_worker_process():
+    """
+    Called by gunicorn's post_fork hook when the app is preloaded in the master:
+    drops pooled connections inherited from the parent (they must not be shared
+    across processes) and recreates clients that opened sockets at import time.
+    """
+    engine.dispose(close=False)
+    chroma_router.reset()
+
 # --- Dependency for Database Session ---
 def get_db():
     db = SessionLocal()
@@ -169,18 +408,164 @@ def get_db():
     finally:
         db.close()
 
+# --- Module Cache ---
+# Registry and per-tenant activation state: process-local tier over Redis, invalidated via pub/sub on writes
+module_cache = ModuleCache()
+
+def _load_registry() -> list:
+    db = SessionLocal()
+    try:
+        return [dict(m) for m in db.execute(modules_table.select()).fetchall()]
+    finally:
+        db.close()
+
+def _load_active_modules(tenant: str) -> list:
+    db = SessionLocal()
+    try:
+        rows = db.execute(select(tenant_modules_table.c.module_name)
+                          .where(tenant_modules_table.c.tenant_id == tenant)).fetchall()
+        return sorted(r.module_name for r in rows)
+    finally:
+        db.close()
+
+def get_registry() -> list:
+    return module_cache.get(REGISTRY_KEY, _load_registry)[0]
+
+# --- Module Config Validation ---
+config_validators = ConfigValidators()
+
+def _invalid_config(message: str, errors: list) -> HTTPException:
+    return HTTPException(status_code=422, detail={"message": message, "errors": errors})
+
+def check_module_config(module_row: dict, config):
+    """Raises 422 unless config satisfies the module's config_schema."""
+    try:
+        errors = config_validators.errors(module_row["name"], module_row.get("config_schema"), config)
+    except InvalidSchema as e:
+        raise HTTPException(status_code=500, detail=f"Module {module_row['name']} has an invalid config_schema: {e}")
+    if errors:
+        raise _invalid_config(f"Invalid config for module {module_row['name']}", errors)
+
+def check_pipeline(pipeline: list):
+    """Raises 422 unless every step names a registered module and its config satisfies that module's schema."""
+    registry = {m["name"]: m for m in get_registry()}
+    try:
+        errors = pipeline_errors(pipeline, registry, config_validators)
+    except InvalidSchema as e:
+        raise HTTPException(status_code=500, detail=f"A module in the pipeline has an invalid config_schema: {e}")
+    if errors:
+        raise _invalid_config("Invalid orchestration pipeline", errors)
+
+def warm_module_cache(tenants: Optional[list] = None) -> int:
+    """Loads the registry and the activation state of the given tenants (default: all) with one query per 500 tenants."""
+    module_cache.get(REGISTRY_KEY, _load_registry)
+    db = SessionLocal()
+    try:
+        if tenants is None:
+            tenants = [r.tenant_id for r in db.execute(select(tenant_modules_table.c.tenant_id).distinct()).fetchall()]
+
+        def load(keys):
+            active = {}
+            for i in range(0, len(tenants), 500):
+                rows = db.execute(select(tenant_modules_table.c.tenant_id, tenant_modules_table.c.module_name)
+                                  .where(tenant_modules_table.c.tenant_id.in_(tenants[i:i + 500]))).fetchall()
+                for r in rows:
+                    active.setdefault(tenant_key(r.tenant_id), []).append(r.module_name)
+            return {k: sorted(v) for k, v in active.items()}
+
+        return module_cache.warm([tenant_key(t) for t in tenants], load)
+    finally:
+        db.close()
+
+def start_module_cache():
+    module_cache.start()
+
+    def warm():
+        try:
+            logger.info("Module cache warmed for %d tenants", warm_module_cache())
+        except Exception as e:
+            logger.warning("Module cache warmup failed: %s", e)
+    threading.Thread(target=warm, name="module-cache-warmup", daemon=True).start()
+
+def start_audit_log_retention():
+    # Creates upcoming partitions and archives expired months daily; one worker at a time does the work
+    start_audit_log_maintenance(engine, audit_log_table)
+
+def start_event_dispatcher():
+    # Every worker delivers; claimed rows are locked, so no event is sent twice by two workers
+    event_bus.start()
+
+def start_data_key_maintenance():
+    # Creates the transit key on first start and rewraps data keys after the transit key is rotated in Vault
+    envelope.start_maintenance()
+
+def place_vector_tenants():
+    # Tenants that ingested before CHROMA_SHARDS was set stay on the instance that has their collections
+    try:
+        with engine.connect() as conn:
+            tenants = conn.execute(select(documents_table.c.tenant_id).distinct()).scalars().all()
+        chroma_router.backfill(tenants)
+        stale = chroma_router.stale_placements()
+    except Exception as e:
+        logger.error("Checking Chroma placements failed: %s", e)
+        return
+    for shard, tenants in stale.items():
+        logger.error("Chroma shard %r is not in CHROMA_SHARDS but %d tenants are placed on it (%s); "
+                     "move them with PUT /vector-store/placements/{tenant_id}", shard, len(tenants), ", ".join(tenants[:10]))
+
+@app.exception_handler(UnknownShard)
+async def unknown_shard_handler(request: Request, exc: UnknownShard):
+    logger.error("Vector store request for tenant %s failed: %s", request.headers.get("X-Tenant-ID", "default"), exc)
+    return JSONResponse(status_code=503, content={"detail": "The tenant's vector store is not available on any configured shard"})
+
+def start_lifecycle():
+    # SIGTERM starts draining right away, not only once uvicorn has finished the open requests
+    lifecycle.install_signal_handler()
+    handoffs.start({"nmap_scan": resume_nmap_job, "orchestration_run": resume_orchestration_run})
+
+def drain_and_close():
+    """
+    Runs after uvicorn stopped accepting connections and the open requests ended
+    (those past the drain deadline were interrupted). Hands queued background
+    scans to other instances, waits for running ones to finish or hand
+    themselves off, then flushes logs and closes pools.
+    """
+    lifecycle.begin_drain("shutdown")
+    scan_executor.shutdown(wait=False, cancel_futures=True)
+    # Jobs still listed never started (a started job removes itself)
+    for handoff, args in list(_queued_scan_jobs.values()):
+        handoff(*args)
+    left = lifecycle.wait_for_jobs()
+    if left:
+        logger.error("Shutting down with unfinished jobs: %s", left)
+    mcp_session.close()
+    event_bus.session.close()
+    engine.dispose()
+    if log_handler:
+        log_handler.close()
+
+def preload_ollama_models():
+    # Load the models before the first question instead of making it pay the load time
+    if OLLAMA_PRELOAD:
+        threading.Thread(target=preload_models, args=(OLLAMA_URL, llm.model, embeddings.model),
+                         name="ollama-preload", daemon=True).start()
+
+def _cached_response(request: Request, value, etag: str):
+    """Answers conditional GETs with 304 when the client already has this version."""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in (t.strip() for t in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(value, headers=headers)
+
 # --- Audit Log Helper ---
 def log_audit_event(db: Session, tenant_id: str, user_id: str, action: str, details: dict):
     """Logs an audit event to the database."""
-    db.execute(audit_log_table.insert().values(
-        id=str(uuid.uuid4()),
-        tenant_id=tenant_id,
-        user_id=user_id,
-        action=action,
-        details=details,
-        timestamp=datetime.utcnow().isoformat()
-    ))
-    db.commit()
+    entry = dict(id=str(uuid.uuid4()), tenant_id=tenant_id, user_id=user_id, action=action, details=details,
+                 timestamp=datetime.utcnow())
+    with span("db.commit", table="audit_log"):
+        db.execute(audit_log_table.insert().values(**entry))
+        db.commit()
+    live_hub.publish(tenant_id, "audit_log", entry, "created")
 
 # --- Encryption/Decryption Helpers ---
 def encrypt_data(data: dict) -> str:
@@ -192,14 +577,12 @@ def decrypt_data(encrypted_data: str) -> dict:
 # --- Usage Metrics Helper ---
 def record_usage(db: Session, tenant_id: str, metric_name: str, value: dict):
     """Records a usage metric to the database."""
-    db.execute(usage_metrics_table.insert().values(
-        id=str(uuid.uuid4()),
-        tenant_id=tenant_id,
-        metric_name=metric_name,
-        value=value,
-        timestamp=datetime.utcnow().isoformat()
-    ))
-    db.commit()
+    entry = dict(id=str(uuid.uuid4()), tenant_id=tenant_id, metric_name=metric_name, value=value,
+                 timestamp=datetime.utcnow().isoformat())
+    with span("db.commit", table="usage_metrics"):
+        db.execute(usage_metrics_table.insert().values(**entry))
+        db.commit()
+    live_hub.publish(tenant_id, "usage_metrics", entry, "created")
 
 # --- Authentication Setup ---
 keycloak_openid = KeycloakOpenID(
@@ -213,16 +596,26 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 def get_current_user(token: str = Depends(oauth2_scheme)):
     """Validates token and returns user info."""
     try:
-        public_key = "-----BEGIN PUBLIC KEY-----\n" + keycloak_openid.public_key() + "\n-----END PUBLIC KEY-----"
+        with upstream_timer("keycloak", "public_key"):
+            public_key = "-----BEGIN PUBLIC KEY-----\n" + keycloak_openid.public_key() + "\n-----END PUBLIC KEY-----"
         return keycloak_openid.decode_token(token, key=public_key, options={"verify_signature": True, "verify_aud": False, "exp": True})
     except Exception as e:
-        logger.error(f"Token validation failed: {e}")
+        logger.error("Token validation failed: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+def require_admin(user: dict = Depends(get_current_user)):
+    """Allows only users with the platform admin realm role (PROFILE_ADMIN_ROLE)."""
+    if not is_admin(user):
+        raise HTTPException(status_code=403, detail="Platform admin role required")
+    return user
+
+# The profiling header only counts from admins
+profiler.authorize = lambda token: is_admin(get_current_user(token))
+
 def get_tenant(request: Request) -> str:
     """Extracts tenant ID from request headers, defaults to 'default'."""
     return request.headers.get("X-Tenant-ID", "default")
@@ -241,10 +634,15 @@ class ModuleRegisterRequest(BaseModel):
 class NmapScanRequest(BaseModel):
     targets: list
     options: Optional[str] = "-sV"
+    shard_size: Optional[int] = Field(None, ge=1, le=65536)  # max addresses per nmap process
+    workers: Optional[int] = Field(None, ge=1, le=NMAP_MAX_WORKERS)  # parallel nmap processes in the container
+    shard_timeout: Optional[int] = Field(None, ge=1, le=NMAP_JOB_TIMEOUT)  # seconds per shard attempt
+    background: bool = False  # return immediately; poll the result for shard progress
 
 class SemgrepScanRequest(BaseModel):
     target: str
     rules: Optional[str] = "auto"
+    incremental: bool = False  # rescan only files changed since the last scan with the same ruleset
 
 class WorkflowCreateRequest(BaseModel):
     name: str
@@ -254,16 +652,40 @@ class OrchestrationCreateRequest(BaseModel):
     name: str
     pipeline: list[dict]
 
+class OrchestrationTriggerRequest(BaseModel):
+    input: Optional[dict] = None  # input of the first step
+    use_cache: bool = True  # false: run every step and store nothing
+    refresh: bool = False  # run every step and replace the cached outputs
+
+class WebhookCreateRequest(BaseModel):
+    url: str  # for kind "n8n": the webhook path, e.g. "scan-finished"
+    kind: str = WEBHOOK
+    event_types: Optional[list[str]] = None  # default: every event type
+
 class ProviderCreateRequest(BaseModel):
     name: str
     config: dict
 
+class RoutingPolicyRequest(BaseModel):
+    latency_slo_ms: Optional[int] = None  # /ai/ask answers slower than this are routed or hedged to cloud
+    monthly_cloud_budget_usd: Optional[float] = None  # estimated cloud spend cap per calendar month
+    hedging: Optional[bool] = None
+
+class VectorPlacementRequest(BaseModel):
+    shard: str  # a name from CHROMA_SHARDS
+
 class DocumentUploadRequest(BaseModel):
     module_id: str
     name: str
 
 # --- API Endpoints ---
 
+# --- Metrics Endpoint ---
+@app.get("/metrics", summary="Prometheus metrics", tags=["Monitoring"], include_in_schema=False)
+def metrics():
+    body, content_type = metrics_response_body()
+    return Response(content=body, media_type=content_type)
+
 # --- Protected Test Endpoint ---
 @app.get("/protected", summary="Protected endpoint", tags=["Auth"])
 @limiter.limit("5/minute")
@@ -295,43 +717,49 @@ def create_inventory(data: dict, tenant: str = Depends(get_tenant), user: dict =
 
 # --- Module Management Endpoints ---
 @app.get("/modules", summary="List available modules", tags=["Modules"])
-def list_available_modules(db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
-    """Lists all modules in the registry."""
-    modules = db.execute(modules_table.select()).fetchall()
-    return [dict(m) for m in modules]
+def list_available_modules(request: Request, user: dict = Depends(get_current_user)):
+    """Lists all modules in the registry. Supports `If-None-Match`."""
+    modules, etag = module_cache.get(REGISTRY_KEY, _load_registry)
+    return _cached_response(request, modules, etag)
 
 @app.get("/modules/active", summary="List active modules for tenant", tags=["Modules"])
-def list_active_modules(tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
-    """Lists active modules for the current tenant."""
-    rows = db.execute(tenant_modules_table.select().where(tenant_modules_table.c.tenant_id == tenant)).fetchall()
-    return [r.module_name for r in rows]
+def list_active_modules(request: Request, tenant: str = Depends(get_tenant), user: dict = Depends(get_current_user)):
+    """Lists active modules for the current tenant. Supports `If-None-Match`."""
+    active, etag = module_cache.get(tenant_key(tenant), lambda: _load_active_modules(tenant))
+    return _cached_response(request, active, etag)
 
 @app.post("/modules/activate", summary="Activate module for tenant", tags=["Modules"])
 def activate_module(req: ModuleActivateRequest, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     """Activates a module for the current tenant by launching a Docker container."""
-    module_row = db.execute(modules_table.select().where(modules_table.c.name == req.module_name)).fetchone()
+    module_row = next((m for m in get_registry() if m["name"] == req.module_name), None)
     if not module_row:
         raise HTTPException(status_code=404, detail="Module not found")
+    # Fail before a container is started with a config it would reject
+    check_module_config(module_row, req.config)
 
     db.execute(tenant_modules_table.insert().values(tenant_id=tenant, module_name=req.module_name, config=req.config))
     db.commit()
+    module_cache.invalidate(tenant_key(tenant))
+    live_hub.publish(tenant, "modules", {"module": req.module_name, "active": True}, "created")
 
     try:
         client = docker.from_env()
         container_name = f"{tenant}-{req.module_name}"
         env_vars = {"TENANT_ID": tenant, "MODULE_CONFIG": json.dumps(req.config)}
-        client.containers.run(
-            module_row.image,
-            name=container_name,
-            environment=env_vars,
-            detach=True,
-            network="default",
-            restart_policy={"Name": "unless-stopped"}
-        )
+        with upstream_timer("docker", "containers.run"):
+            client.containers.run(
+                module_row["image"],
+                name=container_name,
+                environment=env_vars,
+                detach=True,
+                network="default",
+                restart_policy={"Name": "unless-stopped"}
+            )
+        event_bus.publish(db, tenant, "module.activated", {"module": req.module_name, "config": req.config})
         log_audit_event(db, tenant, user.get("sub"), "activate_module", {"module_name": req.module_name})
         return {"status": "activated", "module": req.module_name, "tenant": tenant}
     except docker.errors.APIError as e:
-        logger.error(f"Docker error activating module {req.module_name} for tenant {tenant}: {e}")
+        logger.error("Docker error activating module %s for tenant %s: %s", req.module_name, tenant, e)
         raise HTTPException(status_code=500, detail=f"Failed to activate module: {e}")
 
 @app.post("/modules/deactivate", summary="Deactivate module for tenant", tags=["Modules"])
@@ -340,26 +768,35 @@ def deactivate_module(req: ModuleActivateRequest, tenant: str = Depends(get_tena
     db.execute(tenant_modules_table.delete().where(
         (tenant_modules_table.c.tenant_id == tenant) & (tenant_modules_table.c.module_name == req.module_name)
     ))
+    event_bus.publish(db, tenant, "module.deactivated", {"module": req.module_name})
     db.commit()
+    module_cache.invalidate(tenant_key(tenant))
+    live_hub.publish(tenant, "modules", {"module": req.module_name, "active": False}, "deleted")
 
     try:
         client = docker.from_env()
         container_name = f"{tenant}-{req.module_name}"
-        container = client.containers.get(container_name)
-        container.stop()
-        container.remove()
+        with upstream_timer("docker", "containers.stop"):
+            container = client.containers.get(container_name)
+            container.stop()
+            container.remove()
         log_audit_event(db, tenant, user.get("sub"), "deactivate_module", {"module_name": req.module_name})
         return {"status": "deactivated", "module": req.module_name, "tenant": tenant}
     except docker.errors.NotFound:
-        logger.warning(f"Container {container_name} not found for deactivation.")
+        logger.warning("Container %s not found for deactivation.", container_name)
         return {"status": "deactivated", "module": req.module_name, "tenant": tenant, "info": "Container not found, removed from DB."}
     except docker.errors.APIError as e:
-        logger.error(f"Docker error deactivating module {req.module_name} for tenant {tenant}: {e}")
+        logger.error("Docker error deactivating module %s for tenant %s: %s", req.module_name, tenant, e)
         raise HTTPException(status_code=500, detail=f"Failed to deactivate module: {e}")
 
 @app.post("/modules/register", summary="Register a new module", tags=["Modules"])
 def register_module(req: ModuleRegisterRequest, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
-    """Registers a new module in the system."""
+    """Registers a new module in the system. `config_schema` must be a valid JSON Schema."""
+    if req.config_schema:
+        try:
+            compile_schema(req.config_schema)
+        except InvalidSchema as e:
+            raise HTTPException(status_code=422, detail=f"Invalid config_schema: {e}")
     db.execute(modules_table.insert().values(
         name=req.name,
         image=req.image,
@@ -367,32 +804,317 @@ def register_module(req: ModuleRegisterRequest, db: Session = Depends(get_db), u
         config_schema=req.config_schema
     ))
     db.commit()
+    module_cache.invalidate(REGISTRY_KEY)
+    config_validators.invalidate(req.name)
     return {"status": "registered", "module": req.name}
 
-# --- Nmap Module Endpoints ---
-@app.post("/modules/nmap/scan", summary="Trigger Nmap scan", tags=["Nmap"])
-def trigger_nmap_scan(req: NmapScanRequest, request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
-    """Triggers an Nmap scan via a Docker container."""
-    tenant = get_tenant(request)
-    scan_id = str(uuid.uuid4())
-    scan_input = json.dumps({"targets": req.targets, "options": req.options})
+# --- Scan Container Helpers ---
+def _record_container_trace(module: str, output: dict):
+    """Turns the timing a scan container reports under "trace" into a child span."""
+    timing = output.pop("trace", None) if isinstance(output, dict) else None
+    if timing:
+        record_child_timing(f"{module}.container", timing["start_ns"], timing["end_ns"],
+                            returncode=output.get("returncode", -1))
+
+FINDING_FIELDS = ("host", "hostname", "port", "protocol", "state", "service", "rule_id", "severity", "path", "line", "message",
+                  "fingerprint", "content_hash")
+
+def _store_scan_findings(db: Session, module: str, scan_id: str, tenant: str, target: str, output: dict) -> dict:
+    """Parses scanner output into scan_findings rows, moves raw output to a compressed blob and returns the summary to keep in the result row."""
+    findings, parse_error = normalize_output(module, output)
+    if parse_error:
+        logger.warning("Could not parse %s output for scan %s: %s", module, scan_id, parse_error)
+    blob_path = store_raw_output(tenant, module, scan_id, output) if isinstance(output, dict) and "stdout" in output else None
+    _insert_findings(db, module, scan_id, tenant, target, findings)
+    summary = summarize_output(output, len(findings), blob_path, parse_error)
+    summary["findings_digest"] = findings_digest((f["fingerprint"], f["content_hash"]) for f in findings)
+    return summary
+
+def _insert_findings(db: Session, module: str, scan_id: str, tenant: str, target: str, findings: list):
+    if findings:
+        timestamp = datetime.utcnow().isoformat()
+        db.execute(scan_findings_table.insert(), [
+            dict({c: None for c in FINDING_FIELDS}, **f, id=str(uuid.uuid4()), scan_id=scan_id, tenant_id=tenant,
+                 module=module, target=target, timestamp=timestamp)
+            for f in findings
+        ])
+
+def _scan_digest(db: Session, scan_id: str) -> str:
+    rows = db.execute(select(scan_findings_table.c.fingerprint, scan_findings_table.c.content_hash)
+                      .where(scan_findings_table.c.scan_id == scan_id)).fetchall()
+    return findings_digest(tuple(r) for r in rows)
+
+# --- Draining ---
+def accepting_work():
+    """Dependency of endpoints that start long work: while this instance drains, clients are sent elsewhere."""
+    if lifecycle.draining:
+        raise HTTPException(status_code=503, detail="Server is shutting down; retry", headers={"Retry-After": "1"})
+
+def interrupted_error(db: Session, tenant: str, user_id: Optional[str], kind: str, details: dict) -> HTTPException:
+    """Records work a shutdown stopped and tells the client to retry, which lands on another instance."""
+    log_audit_event(db, tenant, user_id, "job_interrupted", {"kind": kind, **details})
+    return HTTPException(status_code=503, detail=f"{kind} interrupted by a server restart; retry",
+                         headers={"Retry-After": "1"})
+
+@app.get("/debug/profiles", summary="Captured request profiles", tags=["Monitoring"])
+def list_profiles(route: Optional[str] = None, tenant_id: Optional[str] = None, user: dict = Depends(require_admin)):
+    """Newest first, without stacks and SQL; filter by route template or tenant."""
+    return [{k: v for k, v in c.items() if k not in ("stacks", "functions", "sql")}
+            | {"sql_statements": c["sql"]["statements"], "sql_ms": c["sql"]["total_ms"]}
+            for c in profiler.captures()
+            if (route is None or c["route"] == route) and (tenant_id is None or c["tenant"] == tenant_id)]
+
+@app.get("/debug/profiles/{profile_id}", summary="A captured request profile", tags=["Monitoring"])
+def get_profile(profile_id: str, user: dict = Depends(require_admin)):
+    capture = profiler.get(profile_id)
+    if capture is None:
+        raise HTTPException(status_code=404, detail="Profile not found (it may have left the ring buffer)")
+    return capture
+
+@app.get("/health/live", summary="Liveness probe", tags=["Monitoring"], include_in_schema=False)
+def health_live():
+    return {"status": "ok"}
+
+@app.get("/health/ready", summary="Readiness probe", tags=["Monitoring"], include_in_schema=False)
+def health_ready():
+    """503 as soon as the instance drains, so the load balancer stops routing to it."""
+    if lifecycle.draining:
+        return JSONResponse({"status": "draining", "jobs": lifecycle.jobs()}, status_code=503)
+    return {"status": "ready", "jobs": len(lifecycle.jobs())}
+
+# --- Scan Jobs ---
+# Long scans run on this bounded pool; the job record is updated as shards finish.
+scan_executor = ThreadPoolExecutor(max_workers=SCAN_JOB_WORKERS, thread_name_prefix="scan-job")
+# (handoff, arguments) of submitted jobs that have not started yet, handed off if the instance stops first
+_queued_scan_jobs = {}
+
+def submit_scan_job(fn, *args, handoff: bool = True):
+    """
+    Runs fn on the scan pool with the caller's context (trace, request ids). With
+    handoff=False a job that never starts is not handed off at shutdown (a resumed
+    job, whose handoff row is kept until it finishes).
+    """
+    key = object()
+
+    def run():
+        _queued_scan_jobs.pop(key, None)
+        return fn(*args)
+    handoff = handoff and {_run_nmap_job: handoff_nmap_job, _run_orchestration: handoff_orchestration_run}.get(fn)
+    if handoff:
+        _queued_scan_jobs[key] = (handoff, args)
+    return scan_executor.submit(contextvars.copy_context().run, run)
+
+def _remaining_request(scan_request: dict, previous: dict) -> dict:
+    """The scan request without the shards `previous` completed."""
+    done = [s["index"] for s in previous.get("shards", []) if s["status"] == "done"]
+    if scan_request.get("shards"):
+        return dict(scan_request, shards=[s for s in scan_request["shards"] if s["index"] not in done])
+    # The module plans the same shards from the same targets, so completed ones can be skipped by index
+    return dict(scan_request, skip_shards=sorted(set(scan_request.get("skip_shards", [])) | set(done)))
+
+def handoff_nmap_job(scan_id: str, tenant: str, scan_request: dict, previous: Optional[dict] = None):
+    """Queues the shards of a scan that have not completed for another instance."""
+    previous = previous or {}
+    resume = _remaining_request(scan_request, previous)
+    with engine.begin() as conn:
+        # A scan that never left the queue is still marked queued; resuming (or retrying) needs it interrupted
+        conn.execute(nmap_results_table.update().where(
+            (nmap_results_table.c.scan_id == scan_id) & (nmap_results_table.c.result["status"].as_string() == "queued")
+        ).values(result=dict(previous, status="interrupted",
+                             params={k: scan_request[k] for k in SHARD_PARAMS if k in scan_request})))
+    handoffs.put("nmap_scan", tenant, {"scan_id": scan_id, "scan_request": resume, "previous": previous})
+
+def resume_nmap_job(handoff_id: str, tenant: str, payload: dict):
+    """
+    Resumes a handed-off scan unless it was retried by hand since (only one of the two
+    may run it). A scan this handoff resumed before is still queued or running with its
+    id when the instance running it died; it is taken over after the shards that
+    instance completed.
+    """
+    scan_id = payload["scan_id"]
+    status = nmap_results_table.c.result["status"].as_string()
+    ours = (status == "interrupted") | (status.in_(("queued", "running")) &
+                                        (nmap_results_table.c.result["handoff"].as_string() == handoff_id))
+    with engine.begin() as conn:
+        current = conn.execute(select(nmap_results_table.c.result)
+                               .where((nmap_results_table.c.scan_id == scan_id) & ours)).scalar()
+        if current is not None:
+            # The stored record has the latest shards; the payload also has the earlier runs' raw output
+            previous = dict(payload["previous"] or {}, **current)
+            previous.update(status="queued", handoff=handoff_id)
+            claimed = conn.execute(nmap_results_table.update()
+                                   .where((nmap_results_table.c.scan_id == scan_id) & ours)
+                                   .values(result=previous)).rowcount
+    if current is None or not claimed:
+        logger.info("Nmap scan %s is no longer interrupted; not resuming it", scan_id)
+        return None
+    return submit_scan_job(_run_nmap_job, scan_id, tenant, _remaining_request(payload["scan_request"], previous),
+                           previous, handoff=False)
+
+SHARD_FIELDS = ("index", "targets", "status", "attempts", "error")
+# Sharding settings of a scan, kept in its result record so retries and handoffs plan the same way
+SHARD_PARAMS = ("shard_size", "workers", "shard_timeout")
+
+def _run_nmap_job(scan_id: str, tenant: str, scan_request: dict, previous: Optional[dict] = None,
+                  timeout: int = NMAP_JOB_TIMEOUT, handoff: bool = True) -> dict:
+    """
+    Runs the nmap container in streaming mode. Each finished shard's findings are
+    committed and the job record updated immediately, so partial results are
+    visible while the scan runs. `previous` is the record of an earlier run whose
+    completed shards are kept (used when retrying failed shards). With
+    handoff=False an interrupted scan is left to the caller to resume.
+    """
+    previous = previous or {}
+    shards = {s["index"]: s for s in previous.get("shards", [])}
+    findings_count = previous.get("findings", 0)
+    params = {k: scan_request[k] for k in SHARD_PARAMS if k in scan_request}
+    # Set on a resumed scan, so its handoff can take it over if this instance dies
+    handoff_id = previous.get("handoff")
+    db = SessionLocal()
+
+    def update(result):
+        result["params"] = params
+        if handoff_id:
+            result["handoff"] = handoff_id
+        db.execute(nmap_results_table.update().where(nmap_results_table.c.scan_id == scan_id).values(result=result))
+        db.commit()
+        live_hub.publish(tenant, "scans", {"module": "nmap", "scan_id": scan_id, "status": result.get("status"),
+                                           "findings": result.get("findings")})
 
     try:
-        result = subprocess.run(
-            ["docker", "run", "--rm", "nmap-module", scan_input],
-            capture_output=True, text=True, timeout=180, check=True
-        )
-        output = json.loads(result.stdout)
-    except (subprocess.CalledProcessError, json.JSONDecodeError, FileNotFoundError) as e:
-        logger.error(f"Nmap scan failed for tenant {tenant}: {e}")
-        output = {"error": str(e)}
+        final, log_lines, reports, timed_out = {}, [], [], threading.Event()
+        with lifecycle.job("nmap_scan", scan_id=scan_id, tenant=tenant), SCANS_IN_FLIGHT.labels("nmap").track_inprogress(), \
+                upstream_timer("docker", "nmap_scan"), lifecycle.popen(
+                    ["docker", "run", "--rm", *docker_env_args(inject_env()), "nmap-module", json.dumps(dict(scan_request, stream=True))],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) as proc:
+            def kill():
+                timed_out.set()
+                proc.kill()
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+            try:
+                for line in proc.stdout:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        log_lines.append(line)
+                        continue
+                    if event.get("event") != "shard":
+                        final = event
+                        continue
+                    if event["status"] == "done":
+                        findings, _ = normalize_output("nmap", event)
+                        _insert_findings(db, "nmap", scan_id, tenant, ",".join(event["targets"]), findings)
+                        findings_count += len(findings)
+                        reports.append(event.get("stdout"))
+                    shards[event["index"]] = {k: event.get(k) for k in SHARD_FIELDS}
+                    update({"status": "running", "findings": findings_count,
+                            "shards": sorted(shards.values(), key=lambda s: s["index"])})
+                proc.wait()
+            finally:
+                timer.cancel()
+        if not final and lifecycle.interrupted:
+            raise Interrupted("nmap container stopped: shutting down")
+        if not final and timed_out.is_set():
+            raise RuntimeError(f"nmap scan timed out after {timeout}s")
+        if not final:
+            raise RuntimeError(f"nmap container exited with {proc.returncode}: {''.join(log_lines)[-2000:]}")
+        if final.get("error"):
+            raise RuntimeError(final["error"])
+        _record_container_trace("nmap", final)
+        # The module streams one report per shard; the raw output is their merge (plus earlier runs' hosts)
+        earlier = (load_raw_output(tenant, "nmap", scan_id) or {}) if previous.get("raw_blob") else {}
+        final["stdout"] = merge_nmap_xml([earlier.get("stdout"), *reports])
+        blob_path = store_raw_output(tenant, "nmap", scan_id, final)
+        ordered = sorted(shards.values(), key=lambda s: s["index"])
+        result = summarize_output(final, findings_count, blob_path)
+        result.update(shards=ordered, status="completed" if all(s["status"] == "done" for s in ordered) else "partial",
+                      findings_digest=_scan_digest(db, scan_id))
+    except Interrupted:
+        # Completed shards' findings are committed; another instance scans the rest
+        result = {"status": "interrupted", "findings": findings_count,
+                  "shards": sorted(shards.values(), key=lambda s: s["index"])}
+        update(result)
+        if handoff:
+            handoff_nmap_job(scan_id, tenant, scan_request, dict(previous, **result))
+        db.close()
+        return result
+    except Exception as e:
+        logger.error("Nmap scan %s failed for tenant %s: %s", scan_id, tenant, e)
+        result = {"status": "failed", "error": str(e), "findings": findings_count,
+                  "shards": sorted(shards.values(), key=lambda s: s["index"])}
+    try:
+        event_bus.publish(db, tenant, "scan.completed", {
+            "module": "nmap", "scan_id": scan_id, "status": result["status"], "findings": result.get("findings"),
+            "findings_digest": result.get("findings_digest")
+        })
+        update(result)
+    finally:
+        db.close()
+    return result
 
+def create_nmap_scan(db: Session, tenant: str, scan_request: dict) -> str:
+    """Records a queued scan with its shard settings; _run_nmap_job then runs it."""
+    scan_id = str(uuid.uuid4())
+    params = {k: scan_request[k] for k in SHARD_PARAMS if k in scan_request}
     db.execute(nmap_results_table.insert().values(
-        scan_id=scan_id, tenant_id=tenant, targets=req.targets,
-        options=req.options, result=output, timestamp=datetime.utcnow().isoformat()
+        scan_id=scan_id, tenant_id=tenant, targets=scan_request["targets"], options=scan_request["options"],
+        result={"status": "queued", "params": params}, timestamp=datetime.utcnow().isoformat()
     ))
     db.commit()
-    return {"scan_id": scan_id, "result": output}
+    return scan_id
+
+# --- Nmap Module Endpoints ---
+@app.post("/modules/nmap/scan", summary="Trigger Nmap scan", tags=["Nmap"], dependencies=[Depends(accepting_work)])
+def trigger_nmap_scan(req: NmapScanRequest, request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """Triggers an Nmap scan via a Docker container; large target lists are sharded across parallel nmap processes."""
+    tenant = get_tenant(request)
+    scan_request = {"targets": req.targets, "options": req.options}
+    scan_request.update({k: v for k, v in (("shard_size", req.shard_size), ("workers", req.workers),
+                                           ("shard_timeout", req.shard_timeout)) if v is not None})
+    scan_id = create_nmap_scan(db, tenant, scan_request)
+    if req.background:
+        submit_scan_job(_run_nmap_job, scan_id, tenant, scan_request)
+        return {"scan_id": scan_id, "result": {"status": "queued"}}
+    return {"scan_id": scan_id, "result": _run_nmap_job(scan_id, tenant, scan_request, None, NMAP_SYNC_TIMEOUT)}
+
+@app.post("/modules/nmap/results/{scan_id}/retry", summary="Retry failed Nmap shards", tags=["Nmap"], dependencies=[Depends(accepting_work)])
+def retry_nmap_scan(scan_id: str, request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """
+    Re-runs only the shards of a scan that failed or timed out, keeping completed shards' findings.
+    An interrupted scan (e.g. one that ran as an orchestration step) is continued after its completed shards.
+    """
+    tenant = get_tenant(request)
+    row = db.execute(nmap_results_table.select().where(
+        (nmap_results_table.c.scan_id == scan_id) & (nmap_results_table.c.tenant_id == tenant)
+    )).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Nmap scan result not found")
+    previous = row.result or {}
+    shards = previous.get("shards", [])
+    failed = [{"index": s["index"], "targets": s["targets"]} for s in shards if s["status"] != "done"]
+    interrupted = previous.get("status") == "interrupted"
+    if previous.get("status") not in ("failed", "partial", "completed", "interrupted"):
+        raise HTTPException(status_code=409, detail="Scan is still running")
+    if not failed and not interrupted:
+        return {"scan_id": scan_id, "result": previous, "info": "No failed shards to retry"}
+    # Claim the scan only if no other retry (or handoff) got there first, so two never run the same shards
+    queued = dict(previous, status="queued", retrying_shards=[s["index"] for s in failed])
+    claimed = db.execute(nmap_results_table.update().where(
+        (nmap_results_table.c.scan_id == scan_id) & (nmap_results_table.c.tenant_id == tenant) &
+        nmap_results_table.c.result["status"].as_string().in_(("failed", "partial", "interrupted"))
+    ).values(result=queued))
+    db.commit()
+    if claimed.rowcount != 1:
+        raise HTTPException(status_code=409, detail="Scan is still running")
+    if interrupted:
+        # Shards that never started are not listed yet: plan the scan again and skip the completed ones
+        scan_request = dict(previous.get("params") or {}, targets=row.targets, options=row.options,
+                            skip_shards=[s["index"] for s in shards if s["status"] == "done"])
+    else:
+        scan_request = dict(previous.get("params") or {}, targets=[], options=row.options, shards=failed)
+    submit_scan_job(_run_nmap_job, scan_id, tenant, scan_request, previous)
+    return {"scan_id": scan_id, "result": {"status": "queued", "retrying_shards": queued["retrying_shards"]}}
 
 @app.get("/modules/nmap/results", summary="List Nmap scan results", tags=["Nmap"])
 def list_nmap_results(request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
@@ -410,30 +1132,63 @@ def get_nmap_result(scan_id: str, request: Request, db: Session = Depends(get_db
         raise HTTPException(status_code=404, detail="Nmap scan result not found")
     return dict(row)
 
+@app.get("/modules/nmap/results/{scan_id}/raw", summary="Get raw Nmap output", tags=["Nmap"])
+def get_nmap_raw_output(scan_id: str, request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    return _raw_output(db, "nmap", get_tenant(request), scan_id)
+
+@app.get("/modules/nmap/results/{scan_id}/diff", summary="Diff two Nmap scans", tags=["Nmap"])
+def diff_nmap_results(scan_id: str, against: str, request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """Ports and hosts that appeared, disappeared or changed state/service since the `against` scan."""
+    return _diff_scans(db, "nmap", get_tenant(request), scan_id, against)
+
 # --- Semgrep Module Endpoints ---
-@app.post("/modules/semgrep/scan", summary="Trigger Semgrep scan", tags=["Semgrep"])
+@app.post("/modules/semgrep/scan", summary="Trigger Semgrep scan", tags=["Semgrep"], dependencies=[Depends(accepting_work)])
 def trigger_semgrep_scan(req: SemgrepScanRequest, request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     """Triggers a Semgrep scan via a Docker container."""
     tenant = get_tenant(request)
     scan_id = str(uuid.uuid4())
-    scan_input = json.dumps({"target": req.target, "rules": req.rules})
+    try:
+        summary = run_semgrep_scan(db, scan_id, tenant, req.target, req.rules, req.incremental)
+    except Interrupted:
+        # With incremental=true the retry only rescans files whose results were not cached yet
+        raise interrupted_error(db, tenant, user.get("sub"), "semgrep_scan", {"scan_id": scan_id, "target": req.target})
+    return {"scan_id": scan_id, "result": summary}
+
+def run_semgrep_scan(db: Session, scan_id: str, tenant: str, target: str, rules: str, incremental: bool = False) -> dict:
+    """Runs the semgrep container and stores its findings; returns the result summary."""
+    scan_request = {"target": target, "rules": rules}
+    volume_args = []
+    if incremental:
+        # Per-tenant result cache on a shared volume, keyed by file content and ruleset hashes
+        scan_request.update(incremental=True, cache_dir=f"/cache/{tenant}")
+        volume_args = ["-v", f"{SEMGREP_CACHE_VOLUME}:/cache"]
+    scan_input = json.dumps(scan_request)
 
     try:
-        result = subprocess.run(
-            ["docker", "run", "--rm", "semgrep-module", scan_input],
-            capture_output=True, text=True, timeout=180, check=True
-        )
+        with lifecycle.job("semgrep_scan", scan_id=scan_id, tenant=tenant), SCANS_IN_FLIGHT.labels("semgrep").track_inprogress(), \
+                upstream_timer("docker", "semgrep_scan"):
+            result = lifecycle.run(
+                ["docker", "run", "--rm", *volume_args, *docker_env_args(inject_env()), "semgrep-module", scan_input],
+                timeout=180
+            )
         output = json.loads(result.stdout)
+        _record_container_trace("semgrep", output)
     except (subprocess.CalledProcessError, json.JSONDecodeError, FileNotFoundError) as e:
-        logger.error(f"Semgrep scan failed for tenant {tenant}: {e}")
+        logger.error("Semgrep scan failed for tenant %s: %s", tenant, e)
         output = {"error": str(e)}
 
+    summary = _store_scan_findings(db, "semgrep", scan_id, tenant, target, output)
     db.execute(semgrep_results_table.insert().values(
-        scan_id=scan_id, tenant_id=tenant, target=req.target,
-        rules=req.rules, result=output, timestamp=datetime.utcnow().isoformat()
+        scan_id=scan_id, tenant_id=tenant, target=target,
+        rules=rules, result=summary, timestamp=datetime.utcnow().isoformat()
     ))
+    event_bus.publish(db, tenant, "scan.completed", {
+        "module": "semgrep", "scan_id": scan_id, "target": target, "status": "failed" if "error" in output else "completed",
+        "findings": summary.get("findings"), "findings_digest": summary.get("findings_digest")
+    })
     db.commit()
-    return {"scan_id": scan_id, "result": output}
+    live_hub.publish(tenant, "scans", {"module": "semgrep", "scan_id": scan_id, "target": target, "result": summary}, "created")
+    return summary
 
 @app.get("/modules/semgrep/results", summary="List Semgrep scan results", tags=["Semgrep"])
 def list_semgrep_results(request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
@@ -451,6 +1206,165 @@ def get_semgrep_result(scan_id: str, request: Request, db: Session = Depends(get
         raise HTTPException(status_code=404, detail="Semgrep scan result not found")
     return dict(row)
 
+@app.get("/modules/semgrep/results/{scan_id}/raw", summary="Get raw Semgrep output", tags=["Semgrep"])
+def get_semgrep_raw_output(scan_id: str, request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    return _raw_output(db, "semgrep", get_tenant(request), scan_id)
+
+@app.get("/modules/semgrep/results/{scan_id}/diff", summary="Diff two Semgrep scans", tags=["Semgrep"])
+def diff_semgrep_results(scan_id: str, against: str, request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """Findings introduced, fixed or changed since the `against` scan."""
+    return _diff_scans(db, "semgrep", get_tenant(request), scan_id, against)
+
+# --- Scan Diff & Retention ---
+SCAN_RESULT_TABLES = {"nmap": nmap_results_table, "semgrep": semgrep_results_table}
+
+def _resolve_scan(db: Session, module: str, tenant: str, scan_id: str) -> str:
+    """Returns the scan whose findings represent scan_id (itself, or the scan it was compacted into)."""
+    table = SCAN_RESULT_TABLES[module]
+    row = db.execute(select(table.c.result).where((table.c.scan_id == scan_id) & (table.c.tenant_id == tenant))).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail=f"{module.capitalize()} scan result {scan_id} not found")
+    return (row.result or {}).get("compacted_into") or scan_id
+
+def _raw_output(db: Session, module: str, tenant: str, scan_id: str) -> dict:
+    """
+    Raw output of one of the tenant's scans; the result row is checked first, so ids
+    never reach the blob store unchecked. A compacted scan's blob was deleted, so the
+    output of the scan it was compacted into (which found the same) is returned.
+    """
+    source = _resolve_scan(db, module, tenant, scan_id)
+    try:
+        raw = load_raw_output(tenant, module, source)
+    except ValueError:
+        raw = None
+    if raw is None:
+        raise HTTPException(status_code=404, detail=f"Raw {module.capitalize()} output not found")
+    return raw if source == scan_id else dict(raw, compacted_into=source)
+
+def _diff_scans(db: Session, module: str, tenant: str, scan_id: str, against: str) -> dict:
+    """Compares two scans by their indexed fingerprints; raw outputs are never re-parsed."""
+    current, baseline = _resolve_scan(db, module, tenant, scan_id), _resolve_scan(db, module, tenant, against)
+    fields = FINDING_FIELDS[:-1]  # content_hash is only compared, not returned
+    new, old = scan_findings_table, scan_findings_table.alias("baseline")
+    diff = {"scan_id": scan_id, "against": against, "added": [], "removed": [], "changed": []}
+    if current == baseline:
+        diff["unchanged"] = db.execute(select(func.count()).where(new.c.scan_id == current)).scalar()
+        return diff
+
+    def only_in(table, scan, other_scan):
+        other = scan_findings_table.alias("other")
+        rows = db.execute(select(*[table.c[c] for c in fields]).where(
+            (table.c.scan_id == scan) & (table.c.tenant_id == tenant)
+            & ~exists().where((other.c.scan_id == other_scan) & (other.c.fingerprint == table.c.fingerprint))
+        )).fetchall()
+        return [dict(r) for r in rows]
+
+    matched = db.execute(
+        select(*[new.c[c] for c in FINDING_FIELDS], *[old.c[c].label(f"before_{c}") for c in FINDING_FIELDS])
+        .select_from(new.join(old, (old.c.fingerprint == new.c.fingerprint) & (old.c.scan_id == baseline)))
+        .where((new.c.scan_id == current) & (new.c.tenant_id == tenant))
+    ).fetchall()
+    unchanged = 0
+    for r in map(dict, matched):
+        if r["content_hash"] == r["before_content_hash"]:
+            unchanged += 1
+            continue
+        diff["changed"].append({
+            "fingerprint": r["fingerprint"],
+            "before": {c: r[f"before_{c}"] for c in fields if r[f"before_{c}"] != r[c]},
+            "after": {c: r[c] for c in fields if r[f"before_{c}"] != r[c]},
+        })
+    diff.update(added=only_in(new, current, baseline), removed=only_in(old, baseline, current), unchanged=unchanged)
+    return diff
+
+def _scan_complete(module: str, result: dict) -> bool:
+    if module == "nmap":
+        return result.get("status") == "completed"
+    return "error" not in result and not result.get("parse_error")
+
+def compact_scan_history(db: Session, tenant: str, module: str, retention_days: int = SCAN_RETENTION_DAYS) -> int:
+    """
+    Collapses runs of identical scans of the same target: a completed scan older
+    than the retention window whose findings digest equals the previous kept scan
+    of that target loses its finding rows and raw blob and keeps only a
+    `compacted_into` reference. Storage then grows with change, not scan count.
+    """
+    table = SCAN_RESULT_TABLES[module]
+    key_columns = (table.c.targets, table.c.options) if module == "nmap" else (table.c.target, table.c.rules)
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).isoformat()
+    rows = db.execute(select(table.c.scan_id, table.c.result, table.c.timestamp, *key_columns)
+                      .where(table.c.tenant_id == tenant).order_by(table.c.timestamp)).fetchall()
+    kept, compacted = {}, []
+    for row in rows:
+        result = row.result or {}
+        if result.get("compacted_into") or not _scan_complete(module, result):
+            continue
+        key = json.dumps([row[c.name] for c in key_columns], sort_keys=True)
+        digest = result.get("findings_digest") or _scan_digest(db, row.scan_id)
+        base = kept.get(key)
+        if base and base[1] == digest and row.timestamp < cutoff:
+            db.execute(scan_findings_table.delete().where(scan_findings_table.c.scan_id == row.scan_id))
+            db.execute(table.update().where(table.c.scan_id == row.scan_id).values(
+                result=dict(result, compacted_into=base[0], raw_blob=None)))
+            compacted.append(row.scan_id)
+        else:
+            kept[key] = (row.scan_id, digest)
+    db.commit()
+    for scan_id in compacted:
+        delete_raw_output(tenant, module, scan_id)
+    return len(compacted)
+
+@app.post("/findings/compact", summary="Compact unchanged scan history", tags=["Findings"])
+def compact_findings(retention_days: int = Query(SCAN_RETENTION_DAYS, ge=1), tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(require_admin)):
+    """
+    Replaces scans older than `retention_days` that found exactly what the previous scan of the same target found with references to it.
+    Their finding rows and raw output are deleted for good, so this is for platform admins only.
+    """
+    compacted = {module: compact_scan_history(db, tenant, module, retention_days) for module in SCAN_RESULT_TABLES}
+    log_audit_event(db, tenant, user.get("sub"), "compact_scan_history", {"retention_days": retention_days, "compacted": compacted})
+    return {"compacted": compacted}
+
+# --- Scan Findings Endpoints ---
+FINDING_GROUP_COLUMNS = ("module", "target", "host", "port", "service", "state", "rule_id", "severity", "path", "scan_id")
+
+def _findings_filter(tenant: str, filters: dict):
+    condition = scan_findings_table.c.tenant_id == tenant
+    for column, value in filters.items():
+        if value is not None:
+            condition &= scan_findings_table.c[column] == value
+    return condition
+
+@app.get("/findings", summary="Query scan findings", tags=["Findings"])
+def list_findings(module: Optional[str] = None, scan_id: Optional[str] = None, target: Optional[str] = None,
+                  host: Optional[str] = None, port: Optional[int] = None, state: Optional[str] = None,
+                  service: Optional[str] = None, rule_id: Optional[str] = None, severity: Optional[str] = None,
+                  path: Optional[str] = None, limit: int = 500, offset: int = 0,
+                  tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """Filters findings across scans, e.g. `?module=nmap&port=22&state=open` for hosts with SSH open."""
+    condition = _findings_filter(tenant, dict(module=module, scan_id=scan_id, target=target, host=host, port=port,
+                                              state=state, service=service, rule_id=rule_id, severity=severity, path=path))
+    rows = db.execute(scan_findings_table.select().where(condition)
+                      .order_by(scan_findings_table.c.timestamp.desc())
+                      .limit(min(limit, 5000)).offset(offset)).fetchall()
+    return [dict(r) for r in rows]
+
+@app.get("/findings/aggregate", summary="Aggregate scan findings", tags=["Findings"])
+def aggregate_findings(group_by: str, module: Optional[str] = None, scan_id: Optional[str] = None,
+                       target: Optional[str] = None, port: Optional[int] = None, state: Optional[str] = None,
+                       rule_id: Optional[str] = None, severity: Optional[str] = None,
+                       tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """Counts findings per value of one or more columns, e.g. `?module=semgrep&severity=error&group_by=target`."""
+    columns = group_by.split(",")
+    if any(c not in FINDING_GROUP_COLUMNS for c in columns):
+        raise HTTPException(status_code=400, detail=f"group_by must be among {', '.join(FINDING_GROUP_COLUMNS)}")
+    condition = _findings_filter(tenant, dict(module=module, scan_id=scan_id, target=target, port=port,
+                                              state=state, rule_id=rule_id, severity=severity))
+    group_columns = [scan_findings_table.c[c] for c in columns]
+    count = func.count().label("count")
+    rows = db.execute(select(*group_columns, count)
+                      .where(condition).group_by(*group_columns).order_by(count.desc())).fetchall()
+    return [dict(r) for r in rows]
+
 # --- N8N Workflow Endpoints ---
 @app.get("/workflows", summary="List N8N workflows", tags=["Workflows"])
 def list_workflows(request: Request, user: dict = Depends(get_current_user)):
@@ -458,12 +1372,13 @@ def list_workflows(request: Request, user: dict = Depends(get_current_user)):
     tenant = get_tenant(request)
     try:
         # N8N does not support tenant-scoping out-of-the-box via API, so we prepend tenant to workflow names.
-        response = requests.get(f"{N8N_URL}/api/v1/workflows", timeout=10)
+        with upstream_timer("n8n", "list_workflows"):
+            response = requests.get(f"{N8N_URL}/api/v1/workflows", timeout=10)
         response.raise_for_status()
         workflows = [w for w in response.json() if w.get('name', '').startswith(f"{tenant}_")]
         return workflows
     except requests.RequestException as e:
-        logger.error(f"Could not fetch N8N workflows for tenant {tenant}: {e}")
+        logger.error("Could not fetch N8N workflows for tenant %s: %s", tenant, e)
         raise HTTPException(status_code=502, detail="Could not connect to workflow service.")
 
 @app.post("/workflows", summary="Create N8N workflow", tags=["Workflows"])
@@ -477,11 +1392,12 @@ def create_workflow(req: WorkflowCreateRequest, request: Request, user: dict = D
         "active": False
     }
     try:
-        response = requests.post(f"{N8N_URL}/api/v1/workflows", json=workflow_data, timeout=10)
+        with upstream_timer("n8n", "create_workflow"):
+            response = requests.post(f"{N8N_URL}/api/v1/workflows", json=workflow_data, timeout=10)
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
-        logger.error(f"Could not create N8N workflow for tenant {tenant}: {e}")
+        logger.error("Could not create N8N workflow for tenant %s: %s", tenant, e)
         raise HTTPException(status_code=502, detail="Could not connect to workflow service.")
 
 @app.post("/workflows/{workflow_id}/trigger", summary="Trigger N8N workflow", tags=["Workflows"])
@@ -490,16 +1406,227 @@ def trigger_workflow(workflow_id: str, request: Request, user: dict = Depends(ge
     tenant = get_tenant(request)
     # Note: Add logic here to ensure the user's tenant owns the workflow_id
     try:
-        response = requests.post(f"{N8N_URL}/api/v1/workflows/{workflow_id}/activate", timeout=10)
+        with upstream_timer("n8n", "activate_workflow"):
+            response = requests.post(f"{N8N_URL}/api/v1/workflows/{workflow_id}/activate", timeout=10)
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
-        logger.error(f"Could not trigger N8N workflow {workflow_id} for tenant {tenant}: {e}")
+        logger.error("Could not trigger N8N workflow %s for tenant %s: %s", workflow_id, tenant, e)
         raise HTTPException(status_code=502, detail="Could not connect to workflow service.")
 
+# --- Orchestration Runs ---
+step_cache = StepCache()
+_image_digests = {}
+
+def image_digest(image: str) -> Optional[str]:
+    """Local image id (sha256 of its config) of a module image; None when it has not been pulled yet."""
+    cached = _image_digests.get(image)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    try:
+        with upstream_timer("docker", "images.get"):
+            digest = docker.from_env().images.get(image).id
+    except docker.errors.ImageNotFound:
+        return None
+    _image_digests[image] = (digest, time.monotonic() + IMAGE_DIGEST_TTL)
+    return digest
+
+def _nmap_step(db: Session, tenant: str, config: dict, step_input) -> dict:
+    """Scans config["targets"] (or the previous step's "targets") like POST /modules/nmap/scan."""
+    targets = config.get("targets") or (step_input.get("targets") if isinstance(step_input, dict) else None)
+    if not targets:
+        raise ValueError("nmap step needs targets in its config or input")
+    scan_request = {"targets": targets, "options": config.get("options", "-sV")}
+    scan_request.update({k: config[k] for k in SHARD_PARAMS if k in config})
+    scan_id = create_nmap_scan(db, tenant, scan_request)
+    # The orchestration run is handed off as a whole, so the scan is not handed off on its own
+    result = _run_nmap_job(scan_id, tenant, scan_request, None, ORCHESTRATION_STEP_TIMEOUT, handoff=False)
+    if result["status"] == "interrupted":
+        raise Interrupted("nmap step stopped: shutting down")
+    if result["status"] == "failed":
+        raise RuntimeError(f"nmap scan {scan_id} failed: {result.get('error')}")
+    return {"scan_id": scan_id, "status": result["status"], "targets": targets, "findings": result.get("findings"),
+            "findings_digest": result.get("findings_digest")}
+
+def _semgrep_step(db: Session, tenant: str, config: dict, step_input) -> dict:
+    """Scans config["target"] (or the previous step's "target") like POST /modules/semgrep/scan."""
+    target = config.get("target") or (step_input.get("target") if isinstance(step_input, dict) else None)
+    if not target:
+        raise ValueError("semgrep step needs a target in its config or input")
+    scan_id = str(uuid.uuid4())
+    summary = run_semgrep_scan(db, scan_id, tenant, target, config.get("rules", "auto"), config.get("incremental", False))
+    if "error" in summary:
+        raise RuntimeError(f"semgrep scan {scan_id} failed: {summary['error']}")
+    return {"scan_id": scan_id, "target": target, "findings": summary.get("findings"),
+            "findings_digest": summary.get("findings_digest")}
+
+# Built-in scan modules run through the same code as their scan endpoints; their output is a scan reference
+SCAN_STEPS = {"nmap": _nmap_step, "semgrep": _semgrep_step}
+
+def run_step(db: Session, tenant: str, module_name: str, config: dict, step_input) -> dict:
+    """
+    Runs one pipeline step. Scan modules run like their scan endpoints; any other
+    module is called on the service its activated container serves:
+    POST {"config", "input"} to MODULE_STEP_URL, answered with the step output as JSON.
+    """
+    if module_name in SCAN_STEPS:
+        return SCAN_STEPS[module_name](db, tenant, config, step_input)
+    url = MODULE_STEP_URL.format(container=f"{tenant}-{module_name}", tenant=tenant, module=module_name)
+    with upstream_timer("module", "orchestration_step"):
+        response = requests.post(url, json={"config": config, "input": step_input}, headers=inject_headers(),
+                                 timeout=ORCHESTRATION_STEP_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def run_pipeline(db: Session, tenant: str, orchestration_id: str, pipeline: list, step_input, use_cache: bool = True,
+                 refresh: bool = False, previous: Optional[list] = None, on_step=None) -> dict:
+    """
+    Runs the steps in order, each on the previous step's output. A step whose
+    (image digest, config, input) was seen before returns the stored output
+    instead of running; a step with "cache": false (the default for scan
+    modules) always runs. Completed steps in `previous` (the results of an
+    interrupted run) are kept as they are. Each finished step is published as
+    an orchestration.step_completed event and passed to on_step(results).
+    """
+    registry = {m["name"]: m for m in get_registry()}
+    previous = previous or []
+    results = []
+    counts = {"hit": 0, "miss": 0, "bypass": 0, "uncacheable": 0}
+    failed = False
+    for index, step in enumerate(pipeline):
+        module_name = step.get("module")
+        config = step.get("config", {})
+        if failed:
+            results.append({"module": module_name, "status": "not_run"})
+            continue
+        if index < len(previous) and previous[index].get("status") == "completed":
+            results.append(previous[index])
+            step_input = previous[index]["output"]
+            continue
+        if lifecycle.interrupted:
+            raise Interrupted("orchestration stopped: shutting down")
+        image = registry.get(module_name, {}).get("image")
+        with span("orchestration.step", module=module_name, step=index, orchestration_id=orchestration_id):
+            digest = image_digest(image) if image else None
+            key = step_key(tenant, digest, config, step_input) if digest else None
+            cacheable = key is not None and use_cache and step.get("cache", module_name not in SCAN_STEPS)
+            output = step_cache.get(key) if cacheable and not refresh else None
+            outcome = "hit" if output is not None else "miss" if cacheable else "bypass" if digest else "uncacheable"
+            if output is None:
+                try:
+                    if not image:
+                        # Deregistered since the pipeline was saved (or the run handed off)
+                        raise ValueError(f"module {module_name} is not registered")
+                    output = run_step(db, tenant, module_name, config, step_input)
+                except (requests.RequestException, ValueError, RuntimeError) as e:
+                    logger.error("Step %d (%s) of orchestration %s failed for tenant %s: %s",
+                                 index, module_name, orchestration_id, tenant, e)
+                    ORCHESTRATION_STEPS.labels("failed").inc()
+                    results.append({"module": module_name, "status": "failed", "error": str(e)})
+                    event_bus.publish(db, tenant, "orchestration.step_completed", {
+                        "orchestration_id": orchestration_id, "step": index, "module": module_name, "status": "failed",
+                        "error": str(e)
+                    })
+                    db.commit()
+                    failed = True
+                    if on_step:
+                        on_step(results)
+                    continue
+                if cacheable:
+                    step_cache.put(key, output)
+        ORCHESTRATION_STEPS.labels(outcome).inc()
+        counts[outcome] += 1
+        results.append({"module": module_name, "status": "completed", "cache": outcome, "cache_key": key, "output": output})
+        event_bus.publish(db, tenant, "orchestration.step_completed", {
+            "orchestration_id": orchestration_id, "step": index, "module": module_name, "status": "completed",
+            "cache": outcome, "output": output
+        })
+        db.commit()
+        live_hub.publish(tenant, "orchestrations", {"id": orchestration_id, "step": index, "module": module_name,
+                                                    "status": "completed", "cache": outcome}, "step")
+        if on_step:
+            on_step(results)
+        step_input = output
+    return {"status": "failed" if failed else "completed", "results": results, "cache": counts}
+
+def _run_orchestration(run_id: str, tenant: str, orchestration_id: str, pipeline: list, step_input, options: dict):
+    """
+    Runs a queued orchestration run on the scan pool, storing its results after
+    every step. A resumed run keeps the steps it had completed before.
+    """
+    db = SessionLocal()
+    previous = db.execute(select(orchestration_runs_table.c.results)
+                          .where(orchestration_runs_table.c.id == run_id)).scalar()
+
+    def update(status=None, **values):
+        if status:
+            values["status"] = status
+        db.execute(orchestration_runs_table.update().where(orchestration_runs_table.c.id == run_id)
+                   .values(updated_at=datetime.utcnow(), **values))
+        db.commit()
+        if status:
+            live_hub.publish(tenant, "orchestrations", {"id": orchestration_id, "run_id": run_id, "status": status}, "run")
+
+    try:
+        update("running")
+        with lifecycle.job("orchestration_run", run_id=run_id, orchestration_id=orchestration_id, tenant=tenant):
+            run = run_pipeline(db, tenant, orchestration_id, pipeline, step_input, previous=previous,
+                               on_step=lambda results: update(results=results), **options)
+    except Interrupted:
+        # Completed steps are stored with the run, so another instance only runs the remaining ones
+        logger.info("Orchestration run %s interrupted; handing it off", run_id)
+        update("interrupted")
+        handoff_orchestration_run(run_id, tenant, orchestration_id, pipeline, step_input, options)
+        db.close()
+        return
+    except Exception as e:
+        logger.error("Orchestration run %s failed for tenant %s: %s", run_id, tenant, e)
+        update("failed", error="The orchestration run failed unexpectedly")
+        db.close()
+        return
+    try:
+        update(run["status"], results=run["results"], cache=run["cache"])
+        event_bus.publish(db, tenant, "orchestration.completed", {
+            "orchestration_id": orchestration_id, "run_id": run_id, "status": run["status"], "cache": run["cache"],
+            "output": run["results"][-1].get("output") if run["results"] else None
+        })
+        record_usage(db, tenant, "orchestration_run", {
+            "orchestration_id": orchestration_id, "run_id": run_id, "status": run["status"], "steps": len(pipeline),
+            "cache": run["cache"]
+        })
+    finally:
+        db.close()
+
+def handoff_orchestration_run(run_id: str, tenant: str, orchestration_id: str, pipeline: list, step_input, options: dict):
+    with engine.begin() as conn:
+        # A run that never left the queue is still marked queued; resuming it needs it interrupted
+        conn.execute(orchestration_runs_table.update().where(
+            (orchestration_runs_table.c.id == run_id) & (orchestration_runs_table.c.status == "queued")
+        ).values(status="interrupted", updated_at=datetime.utcnow()))
+    handoffs.put("orchestration_run", tenant, {"run_id": run_id, "orchestration_id": orchestration_id, "pipeline": pipeline,
+                                               "input": step_input, "options": options})
+
+def resume_orchestration_run(handoff_id: str, tenant: str, payload: dict):
+    """
+    Resumes a handed-off run unless another handoff of it got there first. A run this
+    handoff resumed before is still queued or running with its id when the instance
+    running it died; it is taken over after the steps that instance completed.
+    """
+    runs = orchestration_runs_table
+    ours = (runs.c.status == "interrupted") | (runs.c.status.in_(("queued", "running")) & (runs.c.handoff_id == handoff_id))
+    with engine.begin() as conn:
+        claimed = conn.execute(runs.update().where((runs.c.id == payload["run_id"]) & ours)
+                               .values(status="queued", handoff_id=handoff_id, updated_at=datetime.utcnow())).rowcount
+    if not claimed:
+        logger.info("Orchestration run %s is no longer interrupted; not resuming it", payload["run_id"])
+        return None
+    return submit_scan_job(_run_orchestration, payload["run_id"], tenant, payload["orchestration_id"], payload["pipeline"],
+                           payload["input"], payload["options"], handoff=False)
+
 # --- Module Orchestration Endpoints ---
 @app.post("/orchestrations", summary="Create a module orchestration", tags=["Orchestrations"])
 def create_orchestration(req: OrchestrationCreateRequest, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    check_pipeline(req.pipeline)
     orchestration_id = str(uuid.uuid4())
     db.execute(module_orchestrations_table.insert().values(
         id=orchestration_id,
@@ -508,6 +1635,7 @@ def create_orchestration(req: OrchestrationCreateRequest, tenant: str = Depends(
         pipeline=req.pipeline
     ))
     db.commit()
+    live_hub.publish(tenant, "orchestrations", {"id": orchestration_id, "name": req.name, "pipeline": req.pipeline}, "created")
     return {"id": orchestration_id, "name": req.name, "pipeline": req.pipeline}
 
 @app.get("/orchestrations", summary="List module orchestrations", tags=["Orchestrations"])
@@ -515,6 +1643,28 @@ def list_orchestrations(tenant: str = Depends(get_tenant), db: Session = Depends
     rows = db.execute(module_orchestrations_table.select().where(module_orchestrations_table.c.tenant_id == tenant)).fetchall()
     return [dict(r) for r in rows]
 
+@app.post("/orchestrations/validate", summary="Validate all orchestrations against current module schemas", tags=["Orchestrations"])
+def validate_orchestrations(tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """Re-checks every stored pipeline of the tenant, e.g. after a module schema changed; lists the ones that no longer validate."""
+    registry = {m["name"]: m for m in get_registry()}
+    rows = db.execute(select(module_orchestrations_table.c.id, module_orchestrations_table.c.name,
+                             module_orchestrations_table.c.pipeline)
+                      .where(module_orchestrations_table.c.tenant_id == tenant)).fetchall()
+    invalid = []
+    for row in rows:
+        try:
+            errors = pipeline_errors(row.pipeline, registry, config_validators)
+        except InvalidSchema as e:
+            errors = [{"step": None, "module": None, "path": "", "message": f"Invalid config_schema: {e}"}]
+        if errors:
+            invalid.append({"id": row.id, "name": row.name, "errors": errors})
+    return {"checked": len(rows), "invalid": invalid}
+
+@app.get("/orchestrations/step-cache", summary="Step cache usage", tags=["Orchestrations"])
+def get_step_cache_stats(user: dict = Depends(require_admin)):
+    """Usage of the step cache shared by every tenant; for platform admins."""
+    return step_cache.stats()
+
 @app.get("/orchestrations/{orchestration_id}", summary="Get a module orchestration", tags=["Orchestrations"])
 def get_orchestration(orchestration_id: str, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     row = db.execute(module_orchestrations_table.select().where(
@@ -526,10 +1676,12 @@ def get_orchestration(orchestration_id: str, tenant: str = Depends(get_tenant),
 
 @app.put("/orchestrations/{orchestration_id}", summary="Update a module orchestration", tags=["Orchestrations"])
 def update_orchestration(orchestration_id: str, req: OrchestrationCreateRequest, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    check_pipeline(req.pipeline)
     db.execute(module_orchestrations_table.update().where(
         (module_orchestrations_table.c.id == orchestration_id) & (module_orchestrations_table.c.tenant_id == tenant)
     ).values(name=req.name, pipeline=req.pipeline))
     db.commit()
+    live_hub.publish(tenant, "orchestrations", {"id": orchestration_id, "name": req.name, "pipeline": req.pipeline})
     return {"id": orchestration_id, "status": "updated"}
 
 @app.delete("/orchestrations/{orchestration_id}", summary="Delete a module orchestration", tags=["Orchestrations"])
@@ -538,48 +1690,124 @@ def delete_orchestration(orchestration_id: str, tenant: str = Depends(get_tenant
         (module_orchestrations_table.c.id == orchestration_id) & (module_orchestrations_table.c.tenant_id == tenant)
     ))
     db.commit()
+    live_hub.publish(tenant, "orchestrations", {"id": orchestration_id}, "deleted")
     return {"id": orchestration_id, "status": "deleted"}
 
-@app.post("/orchestrations/{orchestration_id}/trigger", summary="Trigger a module orchestration", tags=["Orchestrations"])
-async def trigger_orchestration(orchestration_id: str, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+@app.post("/orchestrations/{orchestration_id}/trigger", summary="Trigger a module orchestration", tags=["Orchestrations"],
+          dependencies=[Depends(accepting_work)])
+def trigger_orchestration(orchestration_id: str, req: Optional[OrchestrationTriggerRequest] = None, tenant: str = Depends(get_tenant),
+                          db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """
+    Queues a run of the pipeline and returns its id; poll
+    GET /orchestrations/{id}/runs/{run_id} (or watch the "orchestrations" live
+    topic) for its steps. Steps whose module image, config and input are
+    unchanged since an earlier run are served from the step cache.
+    """
+    req = req or OrchestrationTriggerRequest()
     row = db.execute(module_orchestrations_table.select().where(
         (module_orchestrations_table.c.id == orchestration_id) & (module_orchestrations_table.c.tenant_id == tenant)
     )).fetchone()
     if not row:
         raise HTTPException(status_code=404, detail="Orchestration not found")
 
-    pipeline = row.pipeline
-    results = []
-    for step in pipeline:
-        module_name = step.get("module")
-        config = step.get("config", {})
-        # This is a simplified trigger, a real implementation would be more robust
-        # and handle different module types and configs.
-        logger.info(f"Triggering module {module_name} with config {config} for tenant {tenant}")
-        # Placeholder for actual module execution logic
-        results.append({"module": module_name, "status": "triggered", "result": "placeholder"})
+    # Schemas may have changed since the pipeline was saved
+    check_pipeline(row.pipeline)
+    run_id = str(uuid.uuid4())
+    options = {"use_cache": req.use_cache, "refresh": req.refresh}
+    now = datetime.utcnow()
+    db.execute(orchestration_runs_table.insert().values(
+        id=run_id, tenant_id=tenant, orchestration_id=orchestration_id, status="queued", input=req.input or {},
+        options=options, results=[], created_at=now, updated_at=now
+    ))
+    db.commit()
+    submit_scan_job(_run_orchestration, run_id, tenant, orchestration_id, row.pipeline, req.input or {}, options)
+    return {"orchestration_id": orchestration_id, "run_id": run_id, "status": "queued"}
+
+@app.get("/orchestrations/{orchestration_id}/runs", summary="List runs of a module orchestration", tags=["Orchestrations"])
+def list_orchestration_runs(orchestration_id: str, limit: int = 20, tenant: str = Depends(get_tenant), db: Session = Depends(get_db),
+                            user: dict = Depends(get_current_user)):
+    rows = db.execute(orchestration_runs_table.select().where(
+        (orchestration_runs_table.c.orchestration_id == orchestration_id) & (orchestration_runs_table.c.tenant_id == tenant)
+    ).order_by(orchestration_runs_table.c.created_at.desc()).limit(min(max(limit, 1), 100))).fetchall()
+    return [dict(r) for r in rows]
 
-    return {"orchestration_id": orchestration_id, "status": "triggered", "results": results}
+@app.get("/orchestrations/{orchestration_id}/runs/{run_id}", summary="Get a module orchestration run", tags=["Orchestrations"])
+def get_orchestration_run(orchestration_id: str, run_id: str, tenant: str = Depends(get_tenant), db: Session = Depends(get_db),
+                          user: dict = Depends(get_current_user)):
+    row = db.execute(orchestration_runs_table.select().where(
+        (orchestration_runs_table.c.id == run_id) & (orchestration_runs_table.c.orchestration_id == orchestration_id) &
+        (orchestration_runs_table.c.tenant_id == tenant)
+    )).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Orchestration run not found")
+    return dict(row)
 
 # --- Provider Integration Endpoints ---
+def provider_config(db: Session, tenant: str, row) -> dict:
+    """
+    Decrypts a provider row's config. Configs from before envelope encryption
+    (single-key Fernet, or only in Vault KV) are read the old way once and
+    stored envelope-encrypted.
+    """
+    if key_version(row.encrypted_config) is not None:
+        return envelope.decrypt(tenant, row.encrypted_config)
+    if row.encrypted_config:
+        config = decrypt_data(row.encrypted_config)
+    else:
+        try:
+            with upstream_timer("vault", "read_secret"):
+                config = vault_client.secrets.kv.v2.read_secret_version(
+                    path=f"secret/data/{tenant}/providers/{row.name}")['data']['data']
+        except hvac.exceptions.InvalidPath:
+            return {}
+    db.execute(providers_table.update().where(providers_table.c.id == row.id)
+               .values(encrypted_config=envelope.encrypt(tenant, config)))
+    db.commit()
+    return config
+
 @app.post("/providers", summary="Create a provider integration", tags=["Providers"])
 def create_provider(req: ProviderCreateRequest, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     provider_id = str(uuid.uuid4())
-    vault_path = f"secret/data/{tenant}/providers/{req.name}"
-    vault_client.secrets.kv.v2.create_or_update_secret(path=vault_path, secret=req.config)
     db.execute(providers_table.insert().values(
         id=provider_id,
         tenant_id=tenant,
-        name=req.name
+        name=req.name,
+        encrypted_config=envelope.encrypt(tenant, req.config)
     ))
     db.commit()
+    _cloud_routes.pop(tenant, None)
     return {"id": provider_id, "name": req.name}
 
 @app.get("/providers", summary="List provider integrations", tags=["Providers"])
 def list_providers(tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
-    rows = db.execute(providers_table.select().where(providers_table.c.tenant_id == tenant)).fetchall()
+    rows = db.execute(select(providers_table.c.id, providers_table.c.tenant_id, providers_table.c.name)
+                      .where(providers_table.c.tenant_id == tenant)).fetchall()
     return [dict(r) for r in rows]
 
+@app.get("/providers/encryption", summary="Provider config encryption status", tags=["Providers"])
+def get_provider_encryption(tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """Active data key version and how many provider configs are encrypted with each version (null: not migrated yet)."""
+    rows = db.execute(select(providers_table.c.encrypted_config).where(providers_table.c.tenant_id == tenant)).fetchall()
+    by_version = {}
+    for row in rows:
+        version = key_version(row.encrypted_config)
+        by_version[version] = by_version.get(version, 0) + 1
+    return {"active_version": envelope.active_version(tenant), "configs_by_version": by_version}
+
+@app.post("/providers/rotate-key", summary="Rotate the tenant's data key", tags=["Providers"])
+def rotate_provider_key(tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """New configs use the new key at once; existing ones are re-encrypted in background batches."""
+    version = envelope.rotate_tenant_key(tenant)
+
+    def reencrypt():
+        try:
+            envelope.reencrypt(providers_table, providers_table.c.encrypted_config, tenant)
+        except Exception as e:
+            logger.error("Re-encrypting provider configs of tenant %s failed: %s", tenant, e)
+    threading.Thread(target=reencrypt, name=f"reencrypt-{tenant}", daemon=True).start()
+    log_audit_event(db, tenant, user.get("sub"), "rotate_data_key", {"version": version})
+    return {"active_version": version, "status": "re-encrypting"}
+
 @app.get("/providers/{provider_id}", summary="Get a provider integration", tags=["Providers"])
 def get_provider(provider_id: str, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     row = db.execute(providers_table.select().where(
@@ -587,22 +1815,15 @@ def get_provider(provider_id: str, tenant: str = Depends(get_tenant), db: Sessio
     )).fetchone()
     if not row:
         raise HTTPException(status_code=404, detail="Provider not found")
-    vault_path = f"secret/data/{tenant}/providers/{row.name}"
-    try:
-        secret = vault_client.secrets.kv.v2.read_secret_version(path=vault_path)
-        config = secret['data']['data']
-    except hvac.exceptions.InvalidPath:
-        config = {}
-    return {"id": row.id, "name": row.name, "config": config}
+    return {"id": row.id, "name": row.name, "config": provider_config(db, tenant, row)}
 
 @app.put("/providers/{provider_id}", summary="Update a provider integration", tags=["Providers"])
 def update_provider(provider_id: str, req: ProviderCreateRequest, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
-    vault_path = f"secret/data/{tenant}/providers/{req.name}"
-    vault_client.secrets.kv.v2.create_or_update_secret(path=vault_path, secret=req.config)
     db.execute(providers_table.update().where(
         (providers_table.c.id == provider_id) & (providers_table.c.tenant_id == tenant)
-    ).values(name=req.name))
+    ).values(name=req.name, encrypted_config=envelope.encrypt(tenant, req.config)))
     db.commit()
+    _cloud_routes.pop(tenant, None)
     return {"id": provider_id, "status": "updated"}
 
 @app.delete("/providers/{provider_id}", summary="Delete a provider integration", tags=["Providers"])
@@ -611,80 +1832,567 @@ def delete_provider(provider_id: str, tenant: str = Depends(get_tenant), db: Ses
         (providers_table.c.id == provider_id) & (providers_table.c.tenant_id == tenant)
     ))
     db.commit()
+    _cloud_routes.pop(tenant, None)
     log_audit_event(db, tenant, user.get("sub"), "delete_provider", {"provider_id": provider_id})
     return {"id": provider_id, "status": "deleted"}
 
+# --- Webhook Endpoints ---
+@app.post("/webhooks", summary="Subscribe to platform events", tags=["Webhooks"])
+def create_webhook(req: WebhookCreateRequest, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """
+    Events are POSTed in batches to `url` (or to the n8n webhook path for kind "n8n").
+    The signing secret is only returned here; verify `X-Webhook-Signature` with it.
+    URLs resolving to private, loopback or link-local addresses are refused.
+    """
+    if req.kind not in (WEBHOOK, N8N):
+        raise HTTPException(status_code=422, detail=f"kind must be {WEBHOOK!r} or {N8N!r}")
+    try:
+        if req.kind == WEBHOOK:
+            check_url(req.url)
+        else:
+            check_n8n_path(req.url)
+    except UnsafeDestination as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    unknown = sorted(set(req.event_types or []) - set(EVENT_TYPES))
+    if unknown:
+        raise HTTPException(status_code=422, detail={"message": "Unknown event types", "unknown": unknown, "known": EVENT_TYPES})
+    webhook_id = str(uuid.uuid4())
+    secret = secrets.token_urlsafe(32)
+    db.execute(webhook_subscriptions_table.insert().values(
+        id=webhook_id, tenant_id=tenant, kind=req.kind, url=req.url, event_types=req.event_types,
+        encrypted_secret=cipher_suite.encrypt(secret.encode()).decode(), created_at=datetime.utcnow()
+    ))
+    db.commit()
+    event_bus.invalidate(tenant)
+    log_audit_event(db, tenant, user.get("sub"), "create_webhook", {"webhook_id": webhook_id, "kind": req.kind, "url": req.url})
+    return {"id": webhook_id, "kind": req.kind, "url": req.url, "event_types": req.event_types, "secret": secret}
+
+@app.get("/webhooks", summary="List event subscriptions", tags=["Webhooks"])
+def list_webhooks(tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    t = webhook_subscriptions_table
+    rows = db.execute(select(t.c.id, t.c.kind, t.c.url, t.c.event_types, t.c.created_at).where(t.c.tenant_id == tenant)).fetchall()
+    return [dict(r) for r in rows]
+
+@app.get("/webhooks/{webhook_id}/deliveries", summary="Recent deliveries of a subscription", tags=["Webhooks"])
+def list_webhook_deliveries(webhook_id: str, status: Optional[str] = None, limit: int = 100, tenant: str = Depends(get_tenant),
+                            db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """Newest first; `status` is pending, delivered or dead."""
+    t = event_outbox_table
+    condition = (t.c.tenant_id == tenant) & (t.c.subscription_id == webhook_id)
+    if status:
+        condition &= t.c.status == status
+    rows = db.execute(select(t.c.event_id, t.c.event_type, t.c.created_at, t.c.status, t.c.attempts, t.c.next_attempt_at,
+                             t.c.delivered_at, t.c.last_error)
+                      .where(condition).order_by(t.c.created_at.desc()).limit(min(max(limit, 1), 1000))).fetchall()
+    return [dict(r, last_error=public_error(r.last_error)) for r in rows]
+
+@app.delete("/webhooks/{webhook_id}", summary="Delete an event subscription", tags=["Webhooks"])
+def delete_webhook(webhook_id: str, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    db.execute(webhook_subscriptions_table.delete().where(
+        (webhook_subscriptions_table.c.id == webhook_id) & (webhook_subscriptions_table.c.tenant_id == tenant)
+    ))
+    # Undelivered events of the subscription are dropped with it
+    db.execute(event_outbox_table.delete().where(
+        (event_outbox_table.c.subscription_id == webhook_id) & (event_outbox_table.c.tenant_id == tenant)
+    ))
+    db.commit()
+    event_bus.invalidate(tenant)
+    log_audit_event(db, tenant, user.get("sub"), "delete_webhook", {"webhook_id": webhook_id})
+    return {"id": webhook_id, "status": "deleted"}
+
+# --- Live Update Endpoints ---
+# Browsers cannot set headers on WebSocket or EventSource connections and tokens in URLs get logged, so they
+# authenticate with a one-time ticket: in the Sec-WebSocket-Protocol header ("ticket.<ticket>", next to
+# LIVE_SUBPROTOCOL) or in the live_ticket cookie for SSE. Other clients may send their bearer token.
+LIVE_SUBPROTOCOL = "live"
+LIVE_TICKET_COOKIE = "live_ticket"
+
+def _live_topics(topics: Optional[str]):
+    return [t for t in topics.split(",") if t] if topics else None
+
+async def _live_session(headers, ticket: Optional[str]):
+    """(claims, tenant) of a live connection; raises HTTPException(401) when neither the ticket nor the token is valid."""
+    if ticket:
+        session = await run_in_threadpool(live_hub.redeem_ticket, ticket)
+        if session is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired live ticket")
+        return session["claims"], session["tenant"]
+    token = headers.get("authorization", "").removeprefix("Bearer ").strip()
+    claims = await run_in_threadpool(get_current_user, token)
+    return claims, headers.get("x-tenant-id", "default")
+
+@app.post("/live/ticket", summary="Ticket for opening a live update connection", tags=["Live Updates"])
+def create_live_ticket(request: Request, response: Response, tenant: str = Depends(get_tenant),
+                       user: dict = Depends(get_current_user)):
+    """
+    Valid once, for LIVE_TICKET_TTL seconds. Open /live/ws with the subprotocols
+    ["live", "ticket.<ticket>"]; for /live/events the ticket is also set as a
+    cookie scoped to /live.
+    """
+    try:
+        ticket = live_hub.issue_ticket(user, tenant)
+    except Exception as e:
+        logger.error("Could not issue a live ticket for tenant %s: %s", tenant, e)
+        raise HTTPException(status_code=503, detail="Live updates are unavailable")
+    response.set_cookie(LIVE_TICKET_COOKIE, ticket, max_age=LIVE_TICKET_TTL, path="/live", httponly=True,
+                        samesite="strict", secure=request.url.scheme == "https")
+    return {"ticket": ticket, "expires_in": LIVE_TICKET_TTL}
+
+@app.websocket("/live/ws")
+async def live_websocket(websocket: WebSocket, topics: Optional[str] = None, last_id: Optional[str] = None):
+    """
+    One multiplexed feed of the tenant's changes: `{"id", "topic", "op", "data", "ts"}` per event.
+    Send `{"topics": [...]}` to change the subscription; reconnect with `last_id` to receive what was missed.
+    """
+    protocols = [p.strip() for p in websocket.headers.get("sec-websocket-protocol", "").split(",")]
+    ticket = next((p.removeprefix("ticket.") for p in protocols if p.startswith("ticket.")), None)
+    try:
+        _, tenant = await _live_session(websocket.headers, ticket)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    # Browsers drop the connection unless the server picks one of the offered subprotocols
+    await websocket.accept(subprotocol=LIVE_SUBPROTOCOL if LIVE_SUBPROTOCOL in protocols else None)
+    subscription = live_hub.subscribe(tenant, _live_topics(topics), asyncio.get_running_loop())
+
+    async def receive():
+        while True:
+            message = await websocket.receive_json()
+            if isinstance(message, dict) and isinstance(message.get("topics"), list):
+                subscription.topics = set(message["topics"])
+
+    receiver = asyncio.create_task(receive())
+    try:
+        if last_id:
+            backlog = await run_in_threadpool(live_hub.backlog, tenant, last_id)
+            if backlog is None:
+                await websocket.send_json({"type": "reset", "reason": "offset expired"})
+            for event in backlog or ():
+                subscription.sent(event["id"])
+                if event["topic"] in subscription.topics:
+                    await websocket.send_text(json.dumps(event, default=str))
+        while True:
+            getter = asyncio.ensure_future(subscription.next(LIVE_HEARTBEAT))
+            await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver.done():  # client went away
+                getter.cancel()
+                break
+            await websocket.send_text(json.dumps(getter.result() or {"type": "ping"}, default=str))
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        receiver.cancel()
+        live_hub.unsubscribe(subscription)
+
+@app.get("/live/events", summary="Live change feed (Server-Sent Events)", tags=["Live Updates"])
+async def live_events(request: Request, topics: Optional[str] = None, last_id: Optional[str] = None):
+    """
+    SSE fallback for /live/ws with the same events. The ticket cookie is used up
+    by the connection, so reconnects fetch a new ticket first and pass `last_id`.
+    """
+    _, tenant = await _live_session(request.headers, request.cookies.get(LIVE_TICKET_COOKIE))
+    last_id = request.headers.get("last-event-id") or last_id
+    subscription = live_hub.subscribe(tenant, _live_topics(topics), asyncio.get_running_loop())
+
+    def frame(event):
+        event_id = f"id: {event['id']}\n" if "id" in event else ""
+        return f"{event_id}data: {json.dumps(event, default=str)}\n\n"
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            if last_id:
+                backlog = await run_in_threadpool(live_hub.backlog, tenant, last_id)
+                if backlog is None:
+                    yield frame({"type": "reset", "reason": "offset expired"})
+                for event in backlog or ():
+                    subscription.sent(event["id"])
+                    if event["topic"] in subscription.topics:
+                        yield frame(event)
+            while not await request.is_disconnected():
+                event = await subscription.next(LIVE_HEARTBEAT)
+                yield frame(event) if event else ": ping\n\n"
+        finally:
+            live_hub.unsubscribe(subscription)
+
+    response = StreamingResponse(stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.delete_cookie(LIVE_TICKET_COOKIE, path="/live")
+    return response
+
 # --- Audit Log Endpoints ---
 @app.get("/audit-log", summary="Get audit log for tenant", tags=["Audit Log"])
-def get_audit_log(tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
-    rows = db.execute(audit_log_table.select().where(audit_log_table.c.tenant_id == tenant).order_by(audit_log_table.c.timestamp.desc())).fetchall()
+def get_audit_log(action: Optional[str] = None, user_id: Optional[str] = None, since: Optional[datetime] = None,
+                  until: Optional[datetime] = None, limit: int = 100,
+                  tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """
+    Newest first, at most `limit` (<= 1000) events. `since` is inclusive and `until` exclusive:
+    pass the last event's timestamp as `until` for the next page. A time range also lets
+    Postgres skip the monthly partitions outside it.
+    """
+    condition = audit_log_table.c.tenant_id == tenant
+    if action:
+        condition &= audit_log_table.c.action == action
+    if user_id:
+        condition &= audit_log_table.c.user_id == user_id
+    if since:
+        condition &= audit_log_table.c.timestamp >= since
+    if until:
+        condition &= audit_log_table.c.timestamp < until
+    rows = db.execute(audit_log_table.select().where(condition).order_by(audit_log_table.c.timestamp.desc())
+                      .limit(min(max(limit, 1), 1000))).fetchall()
     return [dict(r) for r in rows]
 
-# --- Document Management Endpoints ---
-@app.post("/documents/upload", summary="Upload a document", tags=["Documents"])
-async def upload_document(file: UploadFile, module_id: str = Form(...), tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
-    document_id = str(uuid.uuid4())
-    file_path = f"/app/uploads/{tenant}/{module_id}/{file.filename}"
+# --- Document Ingestion Pipeline ---
+# Parsing runs in a process pool (see document_parsing.py) and streams pages
+# through a bounded queue; this embedding stage splits each page and writes
+# chunks to Chroma in batches. A slow embedding stage back-pressures the parsers.
+def ingest_documents(documents: list, tenant: str, module_id: str) -> dict:
+    """Parses, splits and embeds [(document_id, path), ...]; returns per-document page counts or errors."""
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    collection_name = f"{tenant}_{module_id}"
+    stats = {document_id: {"pages": 0, "chunks": 0, "error": None} for document_id, _ in documents}
+    batch_texts, batch_metadatas = [], []
+
+    def flush():
+        if batch_texts:
+            # Embedded once, also while a migration writes the records to two shards
+            with upstream_timer("ollama", "embed"):
+                vectors = embeddings.embed_documents(batch_texts)
+            chroma_router.upsert(tenant, collection_name, [str(uuid.uuid4()) for _ in batch_texts], vectors,
+                                 list(batch_texts), list(batch_metadatas))
+            batch_texts.clear()
+            batch_metadatas.clear()
+
+    for doc_index, page_no, payload in stream_pages([path for _, path in documents]):
+        if lifecycle.interrupted:
+            for document_stats in stats.values():
+                document_stats["error"] = document_stats["error"] or "interrupted by a server restart"
+            break
+        document_id = documents[doc_index][0]
+        if page_no is None:
+            stats[document_id]["error"] = payload
+            continue
+        stats[document_id]["pages"] += 1
+        for chunk in text_splitter.split_text(payload):
+            batch_texts.append(chunk)
+            batch_metadatas.append({"document_id": document_id, "page": page_no})
+            stats[document_id]["chunks"] += 1
+            if len(batch_texts) >= EMBED_BATCH_SIZE:
+                flush()
+    flush()
+    return stats
+
+def _save_upload(file: UploadFile, tenant: str, module_id: str) -> str:
+    file_path = os.path.join(UPLOAD_DIR, tenant, module_id, os.path.basename(file.filename))
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
     with open(file_path, "wb") as buffer:
         shutil.copyfileobj(file.file, buffer)
+    return file_path
 
-    db.execute(documents_table.insert().values(
-        id=document_id,
-        tenant_id=tenant,
-        module_id=module_id,
-        name=file.filename,
-        path=file_path,
-        timestamp=datetime.utcnow().isoformat()
-    ))
+def _store_documents(files: list, module_id: str, tenant: str, db: Session) -> list:
+    try:
+        for file in files:
+            document_format(file.filename)
+    except UnsupportedDocumentFormat as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    saved = [(str(uuid.uuid4()), file.filename, _save_upload(file, tenant, module_id)) for file in files]
+    for document_id, filename, file_path in saved:
+        db.execute(documents_table.insert().values(
+            id=document_id,
+            tenant_id=tenant,
+            module_id=module_id,
+            name=filename,
+            path=file_path,
+            timestamp=datetime.utcnow().isoformat()
+        ))
     db.commit()
-    log_audit_event(db, tenant, user.get("sub"), "upload_document", {"document_id": document_id, "filename": file.filename})
-    return {"id": document_id, "filename": file.filename}
+    for document_id, filename, _ in saved:
+        live_hub.publish(tenant, "documents", {"id": document_id, "module_id": module_id, "name": filename}, "created")
+    return saved
+
+# --- Document Management Endpoints ---
+@app.post("/documents/upload", summary="Upload a document", tags=["Documents"], dependencies=[Depends(accepting_work)])
+async def upload_document(file: UploadFile, module_id: str = Form(...), tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    [(document_id, filename, file_path)] = _store_documents([file], module_id, tenant, db)
+    with llm_priority(BATCH, tenant), lifecycle.job("document_ingest", tenant=tenant, documents=1):
+        stats = await run_in_threadpool(ingest_documents, [(document_id, file_path)], tenant, module_id)
+    event_bus.publish(db, tenant, "document.ingested", {"module_id": module_id, "documents": [
+        {"id": document_id, "filename": filename, **stats[document_id]}
+    ]})
+    log_audit_event(db, tenant, user.get("sub"), "upload_document", {"document_id": document_id, "filename": filename})
+    return {"id": document_id, "filename": filename, **stats[document_id]}
+
+@app.post("/documents/upload/batch", summary="Upload and ingest a batch of documents", tags=["Documents"],
+          dependencies=[Depends(accepting_work)])
+async def upload_documents_batch(files: list[UploadFile], module_id: str = Form(...), tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """Bulk onboarding: all documents are parsed in parallel and embedded as their pages arrive."""
+    saved = _store_documents(files, module_id, tenant, db)
+    with llm_priority(BATCH, tenant), lifecycle.job("document_ingest", tenant=tenant, documents=len(saved)):
+        stats = await run_in_threadpool(ingest_documents, [(d, p) for d, _, p in saved], tenant, module_id)
+    event_bus.publish(db, tenant, "document.ingested", {"module_id": module_id, "documents": [
+        {"id": d, "filename": name, **stats[d]} for d, name, _ in saved
+    ]})
+    log_audit_event(db, tenant, user.get("sub"), "upload_documents_batch", {"document_ids": [d for d, _, _ in saved]})
+    return [{"id": d, "filename": name, **stats[d]} for d, name, _ in saved]
 
 @app.get("/documents", summary="List documents", tags=["Documents"])
 def list_documents(module_id: str, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     rows = db.execute(documents_table.select().where(
         (documents_table.c.tenant_id == tenant) & (documents_table.c.module_id == module_id)
     )).fetchall()
-    # Process and store the document in ChromaDB
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-    with open(file_path, "r") as f:
-        text = f.read()
-    texts = text_splitter.split_text(text)
-    collection_name = f"{tenant}_{module_id}"
-    Chroma.from_texts(
-        texts=texts,
-        embedding=embeddings,
-        collection_name=collection_name,
-        client=chroma_client
-    )
     return [dict(r) for r in rows]
 
+# --- Cloud LLM Routing ---
+# Provider integrations the MCP server can route to; a tenant's entry named after one of these
+# (any case, e.g. "OpenAI" or "Google AI") supplies the api_key and model, otherwise the MCP
+# server's own key for openai is used.
+CLOUD_PROVIDERS = ("openai", "anthropic", "google")
+
+def cloud_provider_type(name: str) -> Optional[str]:
+    """The CLOUD_PROVIDERS entry a provider integration's display name refers to, if any."""
+    words = (name or "").strip().lower().split()
+    return next((p for p in CLOUD_PROVIDERS if words and p in (words[0], "".join(words))), None)
+# One keep-alive connection pool to the MCP server instead of a new connection per call
+mcp_session = requests.Session()
+mcp_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=32))
+# tenant -> (route, expires_at). Holds API keys, so it stays in process rather than in Redis;
+# other workers pick up provider changes within CLOUD_ROUTE_TTL.
+_cloud_routes = {}
+
+def get_cloud_route(db, tenant):
+    cached = _cloud_routes.get(tenant)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    rows = {}
+    for r in db.execute(select(providers_table.c.id, providers_table.c.name, providers_table.c.encrypted_config)
+                        .where(providers_table.c.tenant_id == tenant).order_by(providers_table.c.name)).fetchall():
+        rows.setdefault(cloud_provider_type(r.name), r)
+    route = None
+    # With several cloud integrations, the one marked "default": true wins, else the first in CLOUD_PROVIDERS order
+    for name in (n for n in CLOUD_PROVIDERS if n in rows):
+        config = provider_config(db, tenant, rows[name])
+        candidate = {"provider": name, **{k: config[k] for k in ("api_key", "model") if config.get(k)}}
+        if route is None or config.get("default"):
+            route = candidate
+        if config.get("default"):
+            break
+    route = route or {"provider": "openai"}
+    _cloud_routes[tenant] = (route, time.monotonic() + CLOUD_ROUTE_TTL)
+    return route
+
+def ask_mcp(db, tenant, prompt):
+    """Generates through the MCP server with the tenant's cloud provider; returns its JSON response."""
+    return mcp_generate(get_cloud_route(db, tenant), prompt)
+
+def mcp_generate(route, prompt):
+    with upstream_timer("mcp", route["provider"]):
+        response = mcp_session.post(f"{MCP_SERVER_URL}/generate", json={"prompt": prompt, **route},
+                                    headers=inject_headers(), timeout=MCP_TIMEOUT)
+        response.raise_for_status()
+    return response.json()
+
+# --- Adaptive LLM Routing ---
+LLM_USAGE_METRICS = ("local_llm_request", "cloud_llm_request")
+_routing_policies = {}  # tenant -> (policy, expires_at)
+_cloud_spend = {}       # tenant -> [month, usd, expires_at]
+
+def get_routing_policy(db, tenant):
+    cached = _routing_policies.get(tenant)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    policy = {"latency_slo_ms": LLM_LATENCY_SLO_MS, "monthly_cloud_budget_usd": LLM_MONTHLY_CLOUD_BUDGET_USD,
+              "hedging": LLM_HEDGING}
+    row = db.execute(llm_routing_policies_table.select().where(llm_routing_policies_table.c.tenant_id == tenant)).fetchone()
+    if row:
+        policy.update({k: v for k, v in dict(row).items() if k != "tenant_id" and v is not None})
+    _routing_policies[tenant] = (policy, time.monotonic() + LLM_POLICY_TTL)
+    return policy
+
+def cloud_spend(db, tenant):
+    """
+    Estimated cloud LLM spend (USD) of the tenant this calendar month, summed from
+    usage_metrics. Re-read every LLM_POLICY_TTL so spend recorded by other workers
+    and replicas counts; this process's own spend is added as it happens.
+    """
+    month = datetime.utcnow().strftime("%Y-%m")
+    entry = _cloud_spend.get(tenant)
+    if entry and entry[0] == month and entry[2] > time.monotonic():
+        return entry[1]
+    rows = db.execute(select(usage_metrics_table.c.value).where(
+        (usage_metrics_table.c.tenant_id == tenant) & usage_metrics_table.c.metric_name.in_(LLM_USAGE_METRICS)
+        & (usage_metrics_table.c.timestamp >= f"{month}-01")
+    )).fetchall()
+    total = sum((r.value or {}).get("cost_usd", 0) for r in rows)
+    _cloud_spend[tenant] = [month, total, time.monotonic() + LLM_POLICY_TTL]
+    return total
+
+def _generate_local(prompt):
+    with local_model.track(), upstream_timer("ollama", "generate"):
+        return llm.invoke(prompt)
+
+def _generate_cloud(route, prompt):
+    with cloud_model.track():
+        return mcp_generate(route, prompt)["choices"][0]["text"]
+
+def _discard_result(task):
+    # Losing hedges finish in the background; retrieve their outcome so failures are not reported as unhandled
+    if not task.cancelled():
+        task.exception()
+
+async def route_generation(prompt, route, hedge_after, cloud_route):
+    """
+    Runs the routed generation and returns (answer, answered_by, cloud_called).
+    Local is tried first unless the route is cloud. Cloud (when cloud_route is
+    given) starts after hedge_after seconds without a local answer, or as soon
+    as local fails; a cloud-routed generation falls back to local when cloud
+    fails. The first successful answer wins; a local call still waiting for a
+    scheduler slot then gives up its place in the queue.
+    """
+    tasks, scopes = {}, {}
+
+    def start_local():
+        with cancel_scope() as scopes["local"]:
+            tasks["local"] = asyncio.ensure_future(run_in_threadpool(_generate_local, prompt))
+
+    if route != CLOUD or cloud_route is None:
+        start_local()
+        await asyncio.wait([tasks["local"]], timeout=hedge_after)
+    local_answered = "local" in tasks and tasks["local"].done() and tasks["local"].exception() is None
+    if cloud_route is not None and not local_answered:
+        if "local" in tasks and tasks["local"].done():
+            logger.warning("Local LLM failed: %s. Falling back to cloud AI.", tasks["local"].exception())
+        tasks["cloud"] = asyncio.ensure_future(run_in_threadpool(_generate_cloud, cloud_route, prompt))
+    pending, errors = set(tasks.values()), []
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for source, task in tasks.items():
+            if task in done and task.exception() is None:
+                for other in pending:
+                    other.add_done_callback(_discard_result)
+                for scope in scopes.values():
+                    scope.cancel()
+                return task.result(), source, "cloud" in tasks
+            if task in done:
+                errors.append(f"{source}: {task.exception()}")
+        if "local" not in tasks and tasks["cloud"].done():
+            logger.warning("Cloud AI failed: %s. Falling back to local LLM.", tasks["cloud"].exception())
+            start_local()
+            pending.add(tasks["local"])
+    logger.error("AI generation failed: %s", "; ".join(errors))
+    raise HTTPException(status_code=503, detail="All AI services are currently unavailable.")
+
+# --- Vector Store Endpoints ---
+@app.get("/vector-store/shards", summary="Chroma shard health and size", tags=["Vector Store"])
+def get_vector_shards(user: dict = Depends(require_admin)):
+    """Also lists placements on shards that are no longer configured (`stale_placements`)."""
+    return chroma_router.stats()
+
+@app.get("/vector-store/placement", summary="Chroma shard holding the tenant's collections", tags=["Vector Store"])
+def get_vector_placement(tenant: str = Depends(get_tenant), user: dict = Depends(get_current_user)):
+    """The placement this worker routes the tenant's requests by (cached for up to PLACEMENT_TTL)."""
+    row = chroma_router.placement(tenant)
+    return {"tenant_id": tenant, "shard": chroma_router.shard_for(tenant), "pinned": row is not None,
+            "migrating_to": row.migrating_to if row else None}
+
+@app.put("/vector-store/placements/{tenant_id}", summary="Move a tenant's collections to another Chroma shard", tags=["Vector Store"])
+def move_vector_placement(tenant_id: str, req: VectorPlacementRequest, db: Session = Depends(get_db), user: dict = Depends(require_admin)):
+    """
+    Online: the tenant keeps answering from the old shard while its collections are copied,
+    then switches over. Repeating the call resumes a migration a restart interrupted.
+    A tenant placed on a shard that is no longer configured is re-pinned without copying.
+    """
+    try:
+        source = chroma_router.start_migration(tenant_id, req.shard)
+    except UnknownShard as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if source == req.shard:
+        return {"tenant_id": tenant_id, "shard": source, "status": "placed"}
+    if source not in chroma_router.shards:
+        log_audit_event(db, tenant_id, user.get("sub"), "move_vector_placement", {"from": source, "to": req.shard, "copied": False})
+        return {"tenant_id": tenant_id, "shard": req.shard, "previous_shard": source, "status": "repinned"}
+    modules = [r.module_id for r in db.execute(select(documents_table.c.module_id).distinct()
+                                                .where(documents_table.c.tenant_id == tenant_id)).fetchall()]
+
+    def migrate():
+        try:
+            chroma_router.migrate(tenant_id, [f"{tenant_id}_{m}" for m in modules])
+        except Exception as e:
+            logger.error("Moving tenant %s to Chroma shard %s failed: %s", tenant_id, req.shard, e)
+    threading.Thread(target=migrate, name=f"chroma-migrate-{tenant_id}", daemon=True).start()
+    log_audit_event(db, tenant_id, user.get("sub"), "move_vector_placement", {"from": source, "to": req.shard})
+    return {"tenant_id": tenant_id, "shard": source, "migrating_to": req.shard, "status": "migrating"}
+
 # --- AI Endpoints ---
+def _routing_inputs(db, tenant):
+    """The tenant's routing policy, the cloud budget left this month and its cloud route (None without budget)."""
+    policy = get_routing_policy(db, tenant)
+    budget_left = policy["monthly_cloud_budget_usd"] - cloud_spend(db, tenant)
+    return policy, budget_left, get_cloud_route(db, tenant) if budget_left > 0 else None
+
 @app.post("/ai/ask", summary="Ask a question to the AI", tags=["AI"])
-async def ask_ai(question: str, module_id: str, tenant: str = Depends(get_tenant), user: dict = Depends(get_current_user)):
+async def ask_ai(question: str, module_id: str, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    """
+    Answers from the tenant's documents. Generation goes to local Ollama unless its
+    predicted latency misses the tenant's SLO, and is hedged to the cloud provider
+    when local runs late, both only while the tenant's monthly cloud budget lasts.
+    """
     collection_name = f"{tenant}_{module_id}"
-    vectorstore = Chroma(client=chroma_client, collection_name=collection_name, embedding_function=embeddings)
+    # Placement lookup, policy, spend, cloud route (Vault, decryption) and usage all hit the database: off the event loop
+    reader = await run_in_threadpool(chroma_router.reader, tenant)
+    vectorstore = Chroma(client=reader, collection_name=collection_name, embedding_function=embeddings)
     retriever = vectorstore.as_retriever()
-    docs = retriever.get_relevant_documents(question)
+    # Retrieval embeds the question via Ollama, then queries Chroma
+    with llm_priority(INTERACTIVE, tenant), span("rag.retrieve", collection=collection_name), upstream_timer("chroma", "retrieve"):
+        docs = await run_in_threadpool(retriever.get_relevant_documents, question)
     context = "\n".join([doc.page_content for doc in docs])
     prompt = f"Context: {context}\n\nQuestion: {question}\n\nAnswer:"
-    try:
-        # Try local LLM first
-        response = llm.invoke(prompt)
-        record_usage(db, tenant, "local_llm_request", {"question": question})
-        return {"answer": response, "context": context, "source": "local"}
-    except Exception as e:
-        logger.warning(f"Local LLM failed: {e}. Falling back to cloud AI.")
-        try:
-            # Fallback to cloud AI
-            response = requests.post(f"{MCP_SERVER_URL}/openai", json={"prompt": prompt})
-            response.raise_for_status()
-            record_usage(db, tenant, "cloud_llm_request", {"question": question})
-            return {"answer": response.json()["choices"][0]["text"], "context": context, "source": "cloud"}
-        except requests.RequestException as e:
-            logger.error(f"Cloud AI fallback failed: {e}")
-            raise HTTPException(status_code=503, detail="All AI services are currently unavailable.")
+
+    policy, budget_left, cloud_route = await run_in_threadpool(_routing_inputs, db, tenant)
+    route, reason, predicted, hedge_after = decide(policy["latency_slo_ms"] / 1000, budget_left, policy["hedging"])
+    started = time.perf_counter()
+    with llm_priority(INTERACTIVE, tenant):
+        answer, source, cloud_called = await route_generation(prompt, route, hedge_after, cloud_route)
+    elapsed = time.perf_counter() - started
+
+    # A hedged cloud call is billed even when local answered first
+    cost = estimate_cost(cloud_route["provider"], prompt, answer) if cloud_called else 0.0
+    if cost and tenant in _cloud_spend:
+        _cloud_spend[tenant][1] += cost
+    record_llm_usage(source, prompt, answer, elapsed)
+    LLM_ROUTING_DECISIONS.labels(route, reason, source).inc()
+    await run_in_threadpool(record_usage, db, tenant, f"{source}_llm_request", {
+        "question": question, "route": route, "reason": reason, "answered_by": source,
+        "provider": cloud_route["provider"] if source == "cloud" else None,
+        "predicted_local_ms": round(predicted * 1000), "latency_ms": round(elapsed * 1000), "cost_usd": cost
+    })
+    return {"answer": answer, "context": context, "source": source, "route": route,
+            "provider": cloud_route["provider"] if source == "cloud" else None}
+
+@app.get("/ai/routing-policy", summary="Get the tenant's LLM routing policy", tags=["AI"])
+def get_llm_routing_policy(tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    return {**get_routing_policy(db, tenant), "cloud_spend_usd": round(cloud_spend(db, tenant), 4),
+            "local_predicted_ms": round(local_model.predict() * 1000), "local_in_flight": local_model.in_flight}
+
+@app.get("/ai/scheduler", summary="Local LLM scheduler slots and queue depth per priority class", tags=["AI"])
+def get_llm_scheduler(user: dict = Depends(get_current_user)):
+    return scheduler.snapshot()
+
+@app.put("/ai/routing-policy", summary="Set the tenant's LLM routing policy", tags=["AI"])
+def set_llm_routing_policy(req: RoutingPolicyRequest, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+    values = {k: v for k, v in req.dict().items() if v is not None}
+    exists_row = db.execute(select(llm_routing_policies_table.c.tenant_id).where(
+        llm_routing_policies_table.c.tenant_id == tenant)).fetchone()
+    if exists_row:
+        if values:
+            db.execute(llm_routing_policies_table.update().where(
+                llm_routing_policies_table.c.tenant_id == tenant).values(**values))
+    else:
+        db.execute(llm_routing_policies_table.insert().values(tenant_id=tenant, **values))
+    db.commit()
+    _routing_policies.pop(tenant, None)
+    log_audit_event(db, tenant, user.get("sub"), "set_llm_routing_policy", values)
+    return get_routing_policy(db, tenant)
 
 # --- Usage Metrics Endpoints ---
 @app.get("/usage-metrics", summary="Get usage metrics for tenant", tags=["Usage Metrics"])
@@ -692,8 +2400,8 @@ def get_usage_metrics(tenant: str = Depends(get_tenant), db: Session = Depends(g
     rows = db.execute(usage_metrics_table.select().where(usage_metrics_table.c.tenant_id == tenant).order_by(usage_metrics_table.c.timestamp.desc())).fetchall()
     return [dict(r) for r in rows]
 
-@app.post("/ai/agent/execute", summary="Execute a task with an AI agent", tags=["AI"])
-async def execute_agent_task(task_description: str, tenant: str = Depends(get_tenant), user: dict = Depends(get_current_user)):
+@app.post("/ai/agent/execute", summary="Execute a task with an AI agent", tags=["AI"], dependencies=[Depends(accepting_work)])
+async def execute_agent_task(task_description: str, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     # Define a simple researcher agent
     researcher = Agent(
         role='Researcher',
@@ -717,15 +2425,19 @@ async def execute_agent_task(task_description: str, tenant: str = Depends(get_te
         process=Process.sequential
     )
 
-    result = crew.kickoff()
+    # Agent generations queue behind interactive questions; kickoff blocks, so it runs off the event loop
+    with llm_priority(AGENT, tenant), AGENT_JOBS_IN_FLIGHT.track_inprogress(), upstream_timer("ollama", "agent_kickoff"), \
+            lifecycle.job("agent_run", tenant=tenant):
+        try:
+            result = await lifecycle.race(run_in_threadpool(crew.kickoff))
+        except Interrupted:
+            raise interrupted_error(db, tenant, user.get("sub"), "agent_run", {"task": task_description[:200]})
     return {"result": result}
 
 @app.post("/ai/cloud/ask", summary="Ask a question to a cloud AI service", tags=["AI"])
-async def ask_cloud_ai(prompt: str, tenant: str = Depends(get_tenant), user: dict = Depends(get_current_user)):
+def ask_cloud_ai(prompt: str, tenant: str = Depends(get_tenant), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     try:
-        response = requests.post(f"{MCP_SERVER_URL}/openai", json={"prompt": prompt})
-        response.raise_for_status()
-        return response.json()
+        return ask_mcp(db, tenant, prompt)
     except requests.RequestException as e:
-        logger.error(f"Could not connect to MCP-Server: {e}")
+        logger.error("Could not connect to MCP-Server: %s", e)
         raise HTTPException(status_code=502, detail="Could not connect to AI service.")
\ No newline at end of file
@@ -0,0 +1,167 @@
+"""
+Prometheus instrumentation for the backend.
+
+Exposes request latency by route template and tenant tier, upstream call
+timings, in-flight job gauges, LLM throughput and routing, and SQLAlchemy pool stats.
+Labeled children are cached so the request path does not rebuild label sets.
+Under gunicorn, PROMETHEUS_MULTIPROC_DIR switches to prometheus_client's
+multiprocess mode so /metrics aggregates every worker.
+"""
+
+import os
+import json
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    Counter, Gauge, Histogram, REGISTRY, CollectorRegistry, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from tracing import span
+
+# --- Configuration ---
+# JSON map of tenant id -> tier, e.g. {"acme": "enterprise"}; unknown tenants get the default tier.
+TENANT_TIERS = json.loads(os.environ.get("TENANT_TIERS", "{}"))
+DEFAULT_TENANT_TIER = os.environ.get("DEFAULT_TENANT_TIER", "standard")
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+# --- Metric Definitions ---
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency",
+    ["method", "route", "tenant_tier", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+)
+# In-flight gauges are summed over live worker processes in multiprocess mode
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being served", multiprocess_mode="livesum")
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds", "Latency of calls to external services",
+    ["service", "operation", "outcome"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+)
+SCANS_IN_FLIGHT = Gauge("scans_in_flight", "Module scans currently running", ["module"], multiprocess_mode="livesum")
+AGENT_JOBS_IN_FLIGHT = Gauge("agent_jobs_in_flight", "AI agent jobs currently running", multiprocess_mode="livesum")
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Estimated LLM tokens processed (4 characters per token)", ["source", "direction"]
+)
+LLM_GENERATION_SECONDS = Counter("llm_generation_seconds_total", "Time spent in LLM generation", ["source"])
+OLLAMA_QUEUE_DEPTH = Gauge("ollama_requests_in_flight", "Generations sent to Ollama and not yet answered",
+                           multiprocess_mode="livesum")
+LLM_ROUTING_DECISIONS = Counter(
+    "llm_routing_decisions_total", "How /ai/ask requests were routed and which backend answered", ["route", "reason", "answered_by"]
+)
+LLM_QUEUE_WAIT = Histogram(
+    "llm_queue_wait_seconds", "Time Ollama calls waited for a scheduler slot", ["priority"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180, 600)
+)
+LLM_QUEUE_DEPTH = Gauge("llm_queue_depth", "Ollama calls waiting for a scheduler slot", ["priority"], multiprocess_mode="livesum")
+# tokens/sec per class: rate(ollama_generated_tokens_total) / rate(ollama_generation_eval_seconds_total)
+OLLAMA_TOKENS = Counter("ollama_generated_tokens_total", "Tokens generated by Ollama", ["priority"])
+OLLAMA_EVAL_SECONDS = Counter("ollama_generation_eval_seconds_total", "Ollama time spent generating tokens", ["priority"])
+MODULE_CACHE_LOOKUPS = Counter("module_cache_lookups_total", "Module cache lookups by the tier that answered", ["tier"])
+ORCHESTRATION_STEPS = Counter("orchestration_steps_total", "Orchestration steps by outcome (hit, miss, bypass, uncacheable, failed)", ["result"])
+WEBHOOK_DELIVERIES = Counter("webhook_events_total", "Outbox events by delivery attempt outcome (delivered, failed, dropped)", ["result"])
+
+_request_children = {}
+_upstream_children = {}
+
+
+def tenant_tier(tenant_id):
+    return TENANT_TIERS.get(tenant_id, DEFAULT_TENANT_TIER)
+
+
+def _child(cache, metric, key):
+    child = cache.get(key)
+    if child is None:
+        child = cache[key] = metric.labels(*key)
+    return child
+
+
+# --- Upstream Timing Helper ---
+@contextmanager
+def upstream_timer(service, operation):
+    """Times a call to an external service: `with upstream_timer("ollama", "generate"): ...`.
+    The call is also traced as a `<service>.<operation>` span."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        with span(f"{service}.{operation}", **{"peer.service": service}):
+            yield
+        outcome = "ok"
+    finally:
+        _child(_upstream_children, UPSTREAM_LATENCY, (service, operation, outcome)).observe(time.perf_counter() - start)
+
+
+def record_llm_usage(source, prompt, completion, seconds):
+    LLM_TOKENS.labels(source, "prompt").inc(len(prompt) // 4)
+    LLM_TOKENS.labels(source, "completion").inc(len(str(completion)) // 4)
+    LLM_GENERATION_SECONDS.labels(source).inc(seconds)
+
+
+# --- DB Pool Collector ---
+class DBPoolCollector:
+    """Reports SQLAlchemy QueuePool statistics at scrape time (in multiprocess mode: of the worker that answers)."""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def collect(self):
+        pool = self.engine.pool
+        for name, doc, fn in (
+            ("db_pool_size", "Configured pool size", "size"),
+            ("db_pool_checked_out", "Connections currently checked out", "checkedout"),
+            ("db_pool_checked_in", "Idle connections in the pool", "checkedin"),
+            ("db_pool_overflow", "Connections above pool size", "overflow"),
+        ):
+            if hasattr(pool, fn):
+                yield GaugeMetricFamily(name, doc, value=getattr(pool, fn)())
+
+
+_db_pool_collector = None
+
+
+def register_db_pool_collector(engine):
+    global _db_pool_collector
+    _db_pool_collector = DBPoolCollector(engine)
+    REGISTRY.register(_db_pool_collector)
+
+
+# --- ASGI Middleware ---
+class PrometheusMiddleware:
+    """Records request latency labeled by the matched route template, not the raw path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            route = scope.get("route")
+            tenant = next((v for k, v in scope["headers"] if k == b"x-tenant-id"), b"default").decode()
+            key = (scope["method"], route.path if route else "unmatched", tenant_tier(tenant), f"{status_code // 100}xx")
+            _child(_request_children, REQUEST_LATENCY, key).observe(time.perf_counter() - start)
+
+
+def metrics_response_body():
+    if not MULTIPROCESS:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    if _db_pool_collector is not None:
+        registry.register(_db_pool_collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,197 @@
+"""
+Two-level cache for the module registry and per-tenant activation state.
+
+Reads go process-local dict -> Redis -> Postgres. Writers call invalidate(),
+which bumps the key's generation in Redis and broadcasts it on a pub/sub
+channel so every replica drops its local copy. Values are stored in Redis
+under their generation, so a reader that loaded from Postgres before a write
+can never publish its stale copy as current. The local TTL bounds staleness
+when Redis is unreachable or a pub/sub message is missed.
+"""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import threading
+
+import redis
+
+from metrics import MODULE_CACHE_LOOKUPS
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+REDIS_URL = os.environ.get("REDIS_URL", "")
+MODULE_CACHE_LOCAL_TTL = float(os.environ.get("MODULE_CACHE_LOCAL_TTL", "30"))
+MODULE_CACHE_SHARED_TTL = int(os.environ.get("MODULE_CACHE_SHARED_TTL", "3600"))
+# Single-flight loads share a fixed set of locks, so one per tenant ever seen is never kept
+MODULE_CACHE_LOAD_LOCKS = int(os.environ.get("MODULE_CACHE_LOAD_LOCKS", "64"))
+KEY_PREFIX = "module-cache"
+INVALIDATION_CHANNEL = f"{KEY_PREFIX}:invalidate"
+
+REGISTRY_KEY = "registry"
+
+
+def tenant_key(tenant_id):
+    return f"tenant:{tenant_id}"
+
+
+def etag_for(value):
+    return '"' + hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest() + '"'
+
+
+class ModuleCache:
+    def __init__(self, redis_url=REDIS_URL, local_ttl=MODULE_CACHE_LOCAL_TTL, shared_ttl=MODULE_CACHE_SHARED_TTL,
+                 load_locks=MODULE_CACHE_LOAD_LOCKS):
+        self.local_ttl = local_ttl
+        self.shared_ttl = shared_ttl
+        self.redis_url = redis_url
+        self.redis = redis.Redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5) if redis_url else None
+        self._local = {}          # key -> (value, etag, expires_at)
+        self._generations = {}    # key -> local invalidation count, guards loads racing an invalidation
+        self._load_locks = [threading.Lock() for _ in range(max(1, load_locks))]
+        self._lock = threading.Lock()
+        self._subscriber = None
+
+    # --- Reads ---
+    def get(self, key, loader):
+        """Returns (value, etag) for key, calling loader() only when neither tier has it."""
+        entry = self._local.get(key)
+        if entry and entry[2] > time.monotonic():
+            MODULE_CACHE_LOOKUPS.labels("local").inc()
+            return entry[0], entry[1]
+        # One loader per key (stripe) and process; concurrent misses wait for it instead of stampeding Postgres
+        with self._load_lock(key):
+            entry = self._local.get(key)
+            if entry and entry[2] > time.monotonic():
+                MODULE_CACHE_LOOKUPS.labels("local").inc()
+                return entry[0], entry[1]
+            local_generation = self._generations.get(key, 0)
+            shared_generation, cached = self._shared_get(key)
+            if cached is not None:
+                MODULE_CACHE_LOOKUPS.labels("redis").inc()
+                value, etag = cached["value"], cached["etag"]
+            else:
+                MODULE_CACHE_LOOKUPS.labels("db").inc()
+                value = loader()
+                etag = etag_for(value)
+                self._shared_set(key, shared_generation, value, etag)
+            self._local_set(key, value, etag, local_generation)
+            return value, etag
+
+    def _load_lock(self, key):
+        # Keys hashing to the same stripe load one after another; the stripe count bounds memory, not correctness
+        return self._load_locks[zlib.crc32(key.encode()) % len(self._load_locks)]
+
+    def _local_set(self, key, value, etag, generation):
+        with self._lock:
+            if self._generations.get(key, 0) == generation:
+                self._local[key] = (value, etag, time.monotonic() + self.local_ttl)
+
+    def _shared_get(self, key):
+        if self.redis is None:
+            return None, None
+        try:
+            generation = int(self.redis.get(f"{KEY_PREFIX}:gen:{key}") or 0)
+            raw = self.redis.get(f"{KEY_PREFIX}:{key}:{generation}")
+            return generation, json.loads(raw) if raw else None
+        except redis.RedisError as e:
+            logger.warning("Module cache: Redis read failed for %s: %s", key, e)
+            return None, None
+
+    def _shared_set(self, key, generation, value, etag):
+        if self.redis is None or generation is None:
+            return
+        try:
+            self.redis.set(f"{KEY_PREFIX}:{key}:{generation}", json.dumps({"value": value, "etag": etag}, default=str),
+                           ex=self.shared_ttl)
+        except redis.RedisError as e:
+            logger.warning("Module cache: Redis write failed for %s: %s", key, e)
+
+    # --- Writes ---
+    def invalidate(self, *keys):
+        """Drops keys in this process, moves Redis to a new generation and tells the other replicas."""
+        self._drop_local(keys)
+        if self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            for key in keys:
+                pipe.incr(f"{KEY_PREFIX}:gen:{key}")
+            pipe.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Module cache: invalidation of %s not broadcast (%s); replicas converge within %ss",
+                           keys, e, self.local_ttl)
+
+    def _drop_local(self, keys):
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def _drop_all_local(self):
+        with self._lock:
+            for key in self._local:
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._local.clear()
+
+    # --- Warmup ---
+    def warm(self, keys, load):
+        """
+        Fills both tiers for keys from a single bulk load(keys) -> {key: value}.
+        Generations are read before loading, so an invalidation that lands
+        during the load wins over the warmed value.
+        """
+        keys = list(keys)
+        with self._lock:
+            local_generations = {k: self._generations.get(k, 0) for k in keys}
+        shared_generations = None
+        if self.redis is not None:
+            try:
+                shared_generations = [int(g or 0) for g in self.redis.mget([f"{KEY_PREFIX}:gen:{k}" for k in keys])]
+            except redis.RedisError as e:
+                logger.warning("Module cache: Redis unavailable during warmup: %s", e)
+        values = load(keys)
+        pipe = self.redis.pipeline() if shared_generations is not None else None
+        for i, key in enumerate(keys):
+            value = values.get(key, [])
+            etag = etag_for(value)
+            self._local_set(key, value, etag, local_generations[key])
+            if pipe is not None:
+                pipe.set(f"{KEY_PREFIX}:{key}:{shared_generations[i]}",
+                         json.dumps({"value": value, "etag": etag}, default=str), nx=True, ex=self.shared_ttl)
+        if pipe is not None:
+            try:
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.warning("Module cache: warmup write to Redis failed: %s", e)
+        return len(keys)
+
+    # --- Invalidation Listener ---
+    def start(self):
+        if self.redis is None or self._subscriber is not None:
+            return
+        self._subscriber = threading.Thread(target=self._listen, name="module-cache-invalidation", daemon=True)
+        self._subscriber.start()
+
+    def _listen(self):
+        backoff = 0.5
+        while True:
+            try:
+                # Own connection without a read timeout: the channel is idle most of the time
+                listener = redis.Redis.from_url(self.redis_url, socket_connect_timeout=5, health_check_interval=30)
+                pubsub = listener.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Invalidations sent while we were disconnected are lost, so start from an empty local tier
+                self._drop_all_local()
+                backoff = 0.5
+                for message in pubsub.listen():
+                    self._drop_local(json.loads(message["data"]))
+            except (redis.RedisError, ValueError) as e:
+                logger.warning("Module cache: invalidation listener reconnecting in %ss: %s", backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
@@ -0,0 +1,393 @@
+"""
+Opt-in request profiling and slow-request capture.
+
+A sampling profiler: while a profiled request is in flight, a background
+thread reads the stacks of the threads running it every PROFILE_INTERVAL_MS
+(sys._current_frames()), so the request itself runs uninstrumented. A sample
+belongs to a request when the event loop is running its task, or when a
+threadpool worker (sync endpoints and dependencies) runs a call from its
+context. SQL statements are timed per request with SQLAlchemy cursor events.
+
+A request is profiled from the start when:
+- its route template is in PROFILE_ROUTES ("GET /documents,/modules/activate")
+  or its tenant in PROFILE_TENANTS, for a PROFILE_SAMPLE_RATE share of them;
+- it carries the PROFILE_HEADER header and a token with the PROFILE_ADMIN_ROLE
+  realm role. The response then has an X-Profile-Id header.
+With SLOW_REQUEST_MS set, every request is watched: its SQL timings are kept,
+and sampling starts once it has run for half the threshold. Requests that end
+up slower than the threshold are captured with what was sampled by then.
+Streams are not watched, since they are slow by design: paths starting with
+one of SLOW_REQUEST_EXCLUDE, and responses that turn out to be
+text/event-stream. WebSockets never go through the middleware. Each request
+is sampled for at most PROFILE_MAX_SAMPLE_MS; a capture of a longer one holds
+the stacks of its first PROFILE_MAX_SAMPLE_MS and says so (sampling_capped).
+
+Captures are kept in a ring buffer of the last PROFILE_BUFFER_SIZE: a Redis
+list shared by every worker and replica, or an in-process deque without
+REDIS_URL. With nothing configured, the middleware only looks for the header.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import Counter, deque
+from datetime import datetime
+
+import redis
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+PROFILE_ROUTES = os.environ.get("PROFILE_ROUTES", "")
+PROFILE_TENANTS = os.environ.get("PROFILE_TENANTS", "")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.05"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+# 0 disables slow-request capture
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "0"))
+# Path prefixes of long-lived responses (comma-separated) that are never watched
+SLOW_REQUEST_EXCLUDE = os.environ.get("SLOW_REQUEST_EXCLUDE", "/live/events,/live/ws")
+PROFILE_MAX_SAMPLE_MS = float(os.environ.get("PROFILE_MAX_SAMPLE_MS", "10000"))
+PROFILE_BUFFER_SIZE = int(os.environ.get("PROFILE_BUFFER_SIZE", "100"))
+PROFILE_HEADER = os.environ.get("PROFILE_HEADER", "X-Profile")
+PROFILE_ADMIN_ROLE = os.environ.get("PROFILE_ADMIN_ROLE", "platform-admin")
+REDIS_URL = os.environ.get("REDIS_URL", "")
+PROFILE_KEY = "profiles"
+PROFILE_TOP = 30  # stacks and functions kept per capture
+PROFILE_MAX_STATEMENTS = 200  # distinct SQL statements timed per request
+MAX_STACK_DEPTH = 128
+
+_current = contextvars.ContextVar("profile_capture", default=None)
+_labels = {}  # code object -> "function (file:line)"
+
+
+def is_admin(claims):
+    """Whether decoded token claims carry the PROFILE_ADMIN_ROLE realm role."""
+    return PROFILE_ADMIN_ROLE in (claims.get("realm_access") or {}).get("roles", [])
+
+
+def parse_routes(spec):
+    """{(method or None, route template)} from "GET /documents,/modules/activate"."""
+    routes = set()
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        method, _, path = entry.rpartition(" ")
+        routes.add((method.strip().upper() or None, path))
+    return routes
+
+
+def _boundary_codes():
+    """Code objects where a sampled stack stops: below them is the event loop or the threadpool, not the request."""
+    from asyncio.events import Handle
+    loop_code = Handle._run.__code__
+    try:
+        from anyio._backends._asyncio import WorkerThread
+        worker_code = WorkerThread.run.__code__
+    except (ImportError, AttributeError):
+        logger.warning("anyio worker threads not recognised; sync endpoints are not sampled")
+        worker_code = None
+    return loop_code, worker_code
+
+
+def _label(code):
+    label = _labels.get(code)
+    if label is None:
+        name = getattr(code, "co_qualname", code.co_name)
+        label = _labels[code] = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+class Capture:
+    """One profiled or watched request: its samples and SQL timings."""
+
+    def __init__(self, scope, trigger, sample_from, max_sample):
+        self.id = uuid.uuid4().hex
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.tenant = next((v for k, v in scope["headers"] if k == b"x-tenant-id"), b"default").decode()
+        self.trigger = trigger
+        self.started = time.perf_counter()
+        self.sample_from = sample_from
+        self.sample_until = sample_from + max_sample
+        self.sampling = sample_from <= self.started
+        self.streaming = False  # set when the response turns out to be a stream
+        self.task = asyncio.current_task()
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        self.stacks = Counter()  # tuple of code objects, leaf first -> samples
+        self.sql = {}  # statement -> [count, total_s, max_s]
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+    def record_sql(self, statement, seconds):
+        self.statements += 1
+        self.sql_seconds += seconds
+        entry = self.sql.get(statement)
+        if entry is None:
+            if len(self.sql) >= PROFILE_MAX_STATEMENTS:
+                statement = "(other statements)"
+            entry = self.sql.setdefault(statement, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+    def to_dict(self, status_code, route, duration, interval):
+        samples = sum(self.stacks.values())
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[0]] += count
+            for code in set(stack):
+                total[code] += count
+        ms = interval * 1000
+        return {
+            "id": self.id, "ts": datetime.utcnow().isoformat(), "host": socket.gethostname(), "pid": os.getpid(),
+            "method": self.method, "path": self.path, "route": route, "tenant": self.tenant, "status": status_code,
+            "trigger": self.trigger, "duration_ms": round(duration * 1000, 1),
+            "samples": samples, "interval_ms": ms, "profiled_ms": round(samples * ms, 1),
+            "sampling_capped": self.started + duration > self.sample_until,
+            # Folded stacks (root;...;leaf), ready for flamegraph tools
+            "stacks": [{"stack": ";".join(_label(code) for code in reversed(stack)), "ms": round(count * ms, 1)}
+                       for stack, count in self.stacks.most_common(PROFILE_TOP)],
+            "functions": [{"function": _label(code), "self_ms": round(own[code] * ms, 1), "total_ms": round(total[code] * ms, 1)}
+                          for code in sorted(total, key=lambda c: (own[c], total[c]), reverse=True)[:PROFILE_TOP]],
+            "sql": {
+                "statements": self.statements, "total_ms": round(self.sql_seconds * 1000, 1),
+                "top": [{"statement": statement, "count": count, "total_ms": round(seconds * 1000, 1),
+                         "max_ms": round(slowest * 1000, 1)}
+                        for statement, (count, seconds, slowest) in sorted(self.sql.items(), key=lambda i: -i[1][1])[:PROFILE_TOP]],
+            },
+        }
+
+
+class Profiler:
+    def __init__(self, routes=PROFILE_ROUTES, tenants=PROFILE_TENANTS, sample_rate=PROFILE_SAMPLE_RATE,
+                 slow_ms=SLOW_REQUEST_MS, slow_exclude=SLOW_REQUEST_EXCLUDE, interval_ms=PROFILE_INTERVAL_MS,
+                 max_sample_ms=PROFILE_MAX_SAMPLE_MS, header=PROFILE_HEADER, redis_url=REDIS_URL,
+                 buffer_size=PROFILE_BUFFER_SIZE):
+        self.routes = parse_routes(routes)
+        self.tenants = {t.strip() for t in tenants.split(",") if t.strip()}
+        self.sample_rate = sample_rate
+        self.slow = slow_ms / 1000
+        self.slow_exclude = tuple(p.strip() for p in slow_exclude.split(",") if p.strip())
+        self.interval = interval_ms / 1000
+        self.max_sample = max_sample_ms / 1000
+        self.header = header.lower().encode()
+        self.authorize = None  # token -> bool, set once authentication is configured
+        self.buffer_size = buffer_size
+        self.redis = redis.Redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5) if redis_url else None
+        self._local = deque(maxlen=buffer_size)  # captures (no Redis)
+        self._active = {}  # capture id -> Capture
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._next_wake = float("inf")  # when the sampler wakes up next by itself
+        self._boundaries = None
+
+    # --- SQL timing ---
+    def instrument(self, engine):
+        """Times the statements of profiled requests on engine."""
+        @event.listens_for(engine, "before_cursor_execute")
+        def before(conn, cursor, statement, parameters, context, executemany):
+            if _current.get() is not None:
+                conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after(conn, cursor, statement, parameters, context, executemany):
+            capture = _current.get()
+            started = conn.info.get("profile_started")
+            if capture is not None and started:
+                capture.record_sql(statement, time.perf_counter() - started.pop())
+
+    # --- Requests ---
+    async def start(self, scope):
+        """A Capture for the request when it is profiled or watched, otherwise None."""
+        trigger = None
+        if self.authorize is not None and self.header:
+            for name, value in scope["headers"]:
+                if name == self.header and value:
+                    if await run_in_threadpool(self._authorized, scope["headers"]):
+                        trigger = "header"
+                    break
+        if trigger is None and (self.routes or self.tenants) and random.random() < self.sample_rate:
+            trigger = self._match(scope)
+        if trigger is None and (not self.slow or scope["path"].startswith(self.slow_exclude)):
+            return None
+        now = time.perf_counter()
+        capture = Capture(scope, trigger, now if trigger else now + self.slow / 2, self.max_sample)
+        with self._lock:
+            self._active[capture.id] = capture
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+            # The sampler sleeps until the earliest sample_from it knows of, or indefinitely when there is none
+            wake = capture.sample_from < self._next_wake
+        if wake:
+            self._wake.set()
+        return capture
+
+    def _authorized(self, headers):
+        token = next((v for k, v in headers if k == b"authorization"), b"").decode()
+        if not token.lower().startswith("bearer "):
+            return False
+        try:
+            return self.authorize(token[7:])
+        except Exception:
+            return False
+
+    def _match(self, scope):
+        tenant = next((v for k, v in scope["headers"] if k == b"x-tenant-id"), b"default").decode()
+        if tenant in self.tenants:
+            return "tenant"
+        if not self.routes:
+            return None
+        # Routing has not happened yet at this point; find the template the router will pick
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                if (None, route.path) in self.routes or (scope["method"], route.path) in self.routes:
+                    return "route"
+                return None
+        return None
+
+    def stream_started(self, capture):
+        """Stops watching a request whose response is a stream; profiled ones run on until the sampling cap."""
+        if capture.trigger is None:
+            capture.streaming = True
+            with self._lock:
+                self._active.pop(capture.id, None)
+
+    def finish(self, capture, status_code, route):
+        """Ends the capture; keeps it when it was profiled on purpose or turned out slow."""
+        duration = time.perf_counter() - capture.started
+        with self._lock:
+            self._active.pop(capture.id, None)
+        if capture.trigger is None:
+            if duration < self.slow or capture.streaming:
+                return
+            capture.trigger = "slow"
+        path = route.path if route else "unmatched"
+        asyncio.get_running_loop().run_in_executor(None, self._store, capture, status_code, path, duration)
+
+    # --- Sampling ---
+    def _run(self):
+        self._boundaries = self._boundaries or _boundary_codes()
+        while True:
+            now = time.perf_counter()
+            with self._lock:
+                captures = list(self._active.values())
+                for capture in captures:
+                    capture.sampling = capture.sample_from <= now < capture.sample_until
+                pending = [c.sample_from for c in captures if c.sample_from > now]
+                sampling = any(c.sampling for c in captures)
+                if sampling:
+                    wait = self.interval
+                elif pending:
+                    wait = max(min(pending) - now, self.interval)
+                else:
+                    wait = None  # idle, or only requests past their sampling cap
+                self._next_wake = now + wait if wait is not None else float("inf")
+            if sampling:
+                self._sample()
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def _sample(self):
+        loop_code, worker_code = self._boundaries
+        own = threading.get_ident()
+        with self._lock:
+            tasks = {c.task: c for c in self._active.values() if c.sampling}
+            loops = {c.thread: c.loop for c in tasks.values()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack, capture = [], None
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    if code is loop_code:
+                        loop = loops.get(thread_id)
+                        capture = tasks.get(asyncio.current_task(loop)) if loop else None
+                        break
+                    if code is worker_code:
+                        # WorkerThread.run holds the context of the call it is running
+                        context = frame.f_locals.get("context")
+                        capture = context.get(_current) if context is not None else None
+                        break
+                    stack.append(code)
+                    frame = frame.f_back
+                if capture is not None and capture.sampling and stack and capture.id in self._active:
+                    capture.stacks[tuple(stack)] += 1
+
+    # --- Ring buffer ---
+    def _store(self, capture, status_code, route, duration):
+        record = capture.to_dict(status_code, route, duration, self.interval)
+        logger.info("Captured %s profile %s of %s %s: %.0f ms, %d samples, %d SQL statements",
+                    record["trigger"], record["id"], record["method"], route, record["duration_ms"],
+                    record["samples"], record["sql"]["statements"])
+        if self.redis is None:
+            self._local.appendleft(record)
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.lpush(PROFILE_KEY, json.dumps(record, default=str))
+            pipe.ltrim(PROFILE_KEY, 0, self.buffer_size - 1)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Profile %s not stored: %s", record["id"], e)
+
+    def captures(self):
+        """Stored captures, newest first."""
+        if self.redis is None:
+            return list(self._local)
+        try:
+            return [json.loads(raw) for raw in self.redis.lrange(PROFILE_KEY, 0, -1)]
+        except redis.RedisError as e:
+            logger.warning("Profiles not read: %s", e)
+            return []
+
+    def get(self, capture_id):
+        return next((c for c in self.captures() if c["id"] == capture_id), None)
+
+
+# --- ASGI Middleware ---
+class ProfilingMiddleware:
+    """Profiles the requests the Profiler picks; the rest pass straight through."""
+
+    def __init__(self, app, profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        capture = await self.profiler.start(scope)
+        if capture is None:
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                content_type = next((v for k, v in message.get("headers", []) if k == b"content-type"), b"")
+                if content_type.startswith(b"text/event-stream"):
+                    self.profiler.stream_started(capture)
+                if capture.trigger == "header":
+                    message.setdefault("headers", []).append((b"x-profile-id", capture.id.encode()))
+            await send(message)
+
+        token = _current.set(capture)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            self.profiler.finish(capture, status_code, scope.get("route"))
@@ -0,0 +1,186 @@
+"""
+Scan output normalization.
+
+Parses nmap XML (`-oX -`) and semgrep JSON into flat finding rows for the
+`scan_findings` table, and moves the raw scanner output to gzip-compressed
+blobs that are only read back on demand. Every finding carries a stable
+`fingerprint` (what it is) and a `content_hash` (what was observed), which is
+what scan diffs and history compaction compare.
+"""
+
+import os
+import re
+import gzip
+import json
+import uuid
+import hashlib
+import xml.etree.ElementTree as ET
+
+# --- Configuration ---
+SCAN_BLOB_DIR = os.environ.get("SCAN_BLOB_DIR", "/app/scan-blobs")
+
+
+# --- Parsers ---
+def parse_nmap_xml(xml_text):
+    """Returns one finding per scanned port (or per host when no ports were reported)."""
+    findings = []
+    if not xml_text or not xml_text.lstrip().startswith("<"):
+        return findings
+    root = ET.fromstring(xml_text)
+    for host in root.iter("host"):
+        address = next((a.get("addr") for a in host.findall("address") if a.get("addrtype") in ("ipv4", "ipv6")), None)
+        hostname_el = host.find("hostnames/hostname")
+        host_state = host.find("status")
+        ports = host.findall("ports/port")
+        base = {
+            "host": address,
+            "hostname": hostname_el.get("name") if hostname_el is not None else None,
+        }
+        if not ports:
+            findings.append(dict(base, state=host_state.get("state") if host_state is not None else None))
+            continue
+        for port in ports:
+            state = port.find("state")
+            service = port.find("service")
+            findings.append(dict(
+                base,
+                port=int(port.get("portid")),
+                protocol=port.get("protocol"),
+                state=state.get("state") if state is not None else None,
+                service=service.get("name") if service is not None else None,
+                message=" ".join(filter(None, (service.get("product"), service.get("version"))))
+                if service is not None else None,
+            ))
+    return findings
+
+
+def parse_semgrep_json(json_text):
+    """Returns one finding per semgrep result."""
+    if not json_text:
+        return []
+    data = json.loads(json_text)
+    findings = []
+    for r in data.get("results", []):
+        extra = r.get("extra", {})
+        line = r.get("start", {}).get("line")
+        code = extra.get("lines") or ""
+        findings.append({
+            "rule_id": r.get("check_id"),
+            "severity": (extra.get("severity") or "").lower() or None,
+            "path": r.get("path"),
+            "line": line,
+            "message": extra.get("message"),
+            # Matched code identifies the finding even when edits above it shift the line number
+            "anchor": " ".join(code.split()) if code and code != "requires login" else line,
+        })
+    return findings
+
+
+def merge_nmap_xml(documents):
+    """Merges the <host> elements of several nmap XML reports (e.g. a scan and its shard retries)."""
+    merged = None
+    for doc in documents:
+        if not doc:
+            continue
+        root = ET.fromstring(doc)
+        if merged is None:
+            merged = ET.Element("nmaprun", root.attrib)
+        merged.extend(root.findall("host"))
+    return '<?xml version="1.0"?>\n' + ET.tostring(merged, encoding="unicode") if merged is not None else ""
+
+
+PARSERS = {"nmap": parse_nmap_xml, "semgrep": parse_semgrep_json}
+
+
+# --- Fingerprints ---
+# Fields that identify a finding across runs; everything else is observed content.
+IDENTITY_FIELDS = {"nmap": ("host", "port", "protocol"), "semgrep": ("rule_id", "path", "anchor")}
+
+
+def _sha1(value):
+    return hashlib.sha1(json.dumps(value, default=str).encode()).hexdigest()
+
+
+def fingerprint_findings(module, findings):
+    """
+    Adds `fingerprint` and `content_hash` to each finding. Findings with the same
+    identity within one scan (e.g. the same rule matching identical code twice in
+    a file) are numbered in order of appearance so they stay distinct.
+    """
+    seen = {}
+    for f in findings:
+        identity = [module] + [f.pop("anchor", None) if k == "anchor" else f.get(k) for k in IDENTITY_FIELDS[module]]
+        key = _sha1(identity)
+        occurrence = seen[key] = seen.get(key, -1) + 1
+        f["fingerprint"] = _sha1(identity + [occurrence]) if occurrence else key
+        f["content_hash"] = _sha1(sorted((k, v) for k, v in f.items() if k != "fingerprint"))
+    return findings
+
+
+def findings_digest(pairs):
+    """Order-independent digest of a scan's (fingerprint, content_hash) pairs; equal digests mean identical findings."""
+    return _sha1(sorted(map(list, pairs)))
+
+
+def normalize_output(module, output):
+    """Parses a scanner's stdout into fingerprinted findings; returns (findings, parse_error)."""
+    if not isinstance(output, dict) or "stdout" not in output:
+        return [], None
+    try:
+        return fingerprint_findings(module, PARSERS[module](output["stdout"])), None
+    except (ET.ParseError, ValueError) as e:
+        return [], f"{type(e).__name__}: {e}"
+
+
+# --- Raw Blob Storage ---
+# Tenant ids come from the X-Tenant-ID header and scan ids from the URL; neither may name a path
+_SAFE_TENANT = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,127}")
+
+
+def _blob_path(tenant_id, module, scan_id):
+    """Where a scan's raw output lives; ValueError for ids that are not a tenant slug and a UUID."""
+    if not _SAFE_TENANT.fullmatch(tenant_id or "") or module not in PARSERS:
+        raise ValueError(f"Invalid tenant or module for a scan blob: {tenant_id!r}, {module!r}")
+    try:
+        scan_id = str(uuid.UUID(scan_id))
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError(f"Invalid scan id: {scan_id!r}")
+    root = os.path.realpath(SCAN_BLOB_DIR)
+    path = os.path.realpath(os.path.join(root, tenant_id, module, f"{scan_id}.json.gz"))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Scan blob path escapes {SCAN_BLOB_DIR}")
+    return path
+
+
+def store_raw_output(tenant_id, module, scan_id, output):
+    path = _blob_path(tenant_id, module, scan_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wt", compresslevel=6) as f:
+        json.dump(output, f)
+    return path
+
+
+def load_raw_output(tenant_id, module, scan_id):
+    path = _blob_path(tenant_id, module, scan_id)
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, "rt") as f:
+        return json.load(f)
+
+
+def delete_raw_output(tenant_id, module, scan_id):
+    try:
+        os.remove(_blob_path(tenant_id, module, scan_id))
+    except FileNotFoundError:
+        pass
+
+
+def summarize_output(output, findings_count, blob_path, parse_error=None):
+    """What stays in the scan result row: everything but the raw stdout."""
+    summary = {k: v for k, v in output.items() if k not in ("stdout", "stderr")} if isinstance(output, dict) else {}
+    summary.update(findings=findings_count, raw_blob=blob_path)
+    if isinstance(output, dict) and output.get("stderr"):
+        summary["stderr"] = output["stderr"][-2000:]
+    if parse_error:
+        summary["parse_error"] = parse_error
+    return summary
@@ -0,0 +1,123 @@
+"""
+Memoization of orchestration steps.
+
+A step's output is determined by the module image, the step config and the
+step input (the previous step's output, or the trigger input for the first
+step). The cache key is a sha256 over the tenant, the image digest and the
+content hashes of config and input, so rerunning a pipeline after changing
+one step's config reruns that step and, only if its output changed, the
+ones after it.
+
+Outputs are stored content-addressed as gzip JSON under STEP_CACHE_DIR
+(`<key[:2]>/<key>.json.gz`), which worker processes share. The store is
+bounded by STEP_CACHE_MAX_BYTES: a hit refreshes the entry's mtime, and when
+a write pushes the total over the limit the least recently used entries are
+removed until it is back under STEP_CACHE_EVICT_TO of it.
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+STEP_CACHE_DIR = os.environ.get("STEP_CACHE_DIR", "/app/step-cache")
+STEP_CACHE_MAX_BYTES = int(os.environ.get("STEP_CACHE_MAX_BYTES", str(1 << 30)))
+STEP_CACHE_EVICT_TO = 0.9
+
+
+def content_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(",", ":"), default=str).encode()).hexdigest()
+
+
+def step_key(tenant, image_digest, config, step_input):
+    return hashlib.sha256(
+        "|".join((tenant, image_digest, content_hash(config or {}), content_hash(step_input))).encode()
+    ).hexdigest()
+
+
+class StepCache:
+    def __init__(self, root=STEP_CACHE_DIR, max_bytes=STEP_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._size = None  # bytes on disk as seen by this process; recounted on every eviction
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.json.gz")
+
+    def get(self, key):
+        """The stored output for key, or None."""
+        path = self._path(key)
+        try:
+            with gzip.open(path, "rt") as f:
+                output = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Discarding unreadable step cache entry %s: %s", key, e)
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return output
+
+    def put(self, key, output):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp, "wt", compresslevel=6) as f:
+            json.dump(output, f)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += os.path.getsize(path)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        """[(path, size, mtime)] of every stored entry."""
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".json.gz"):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue  # evicted by another worker
+                    entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * STEP_CACHE_EVICT_TO
+        removed = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        self._size = total
+        logger.info("Step cache evicted %d entries (%d bytes left)", removed, total)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        entries = self._entries()
+        return {"entries": len(entries), "bytes": sum(size for _, size, _ in entries), "max_bytes": self.max_bytes}
@@ -0,0 +1,89 @@
+import os
+import sys
+import socket
+import tempfile
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(HERE, "..", "..", "benchmarks", "api")
+# backend modules, the setup scripts at the repository root and the benchmark stand-ins
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", ".."))
+sys.path.insert(0, BENCH_DIR)
+
+
+def _free_port_range(count, start=21000):
+    for base in range(start, 40000, 10):
+        sockets = []
+        try:
+            for port in range(base, base + count):
+                s = socket.socket()
+                sockets.append(s)
+                s.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for s in sockets:
+                s.close()
+    raise RuntimeError("no free port range for the stand-ins")
+
+
+# Backend modules read their configuration at import, so it is set before any test imports them
+WORKDIR = tempfile.mkdtemp(prefix="backend-tests-")
+BASE_PORT = _free_port_range(7)
+URLS = {name: f"http://127.0.0.1:{BASE_PORT + i}"
+        for i, name in enumerate(("keycloak", "ollama", "chroma", "n8n", "vault", "mcp", "docker"))}
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{WORKDIR}/backend.db",
+    KEYCLOAK_URL=URLS["keycloak"] + "/",
+    OLLAMA_URL=URLS["ollama"],
+    CHROMA_URL=URLS["chroma"],
+    N8N_URL=URLS["n8n"],
+    VAULT_URL=URLS["vault"],
+    MCP_SERVER_URL=URLS["mcp"],
+    DOCKER_HOST=URLS["docker"].replace("http://", "tcp://"),
+    PATH=os.path.join(BENCH_DIR, "bin") + os.pathsep + os.environ.get("PATH", ""),
+    ENCRYPTION_KEY="bm90LWEtcmVhbC1rZXktYnV0LTMyLWJ5dGVzLWxvbmc=",
+    UPLOAD_DIR=os.path.join(WORKDIR, "uploads"),
+    SCAN_BLOB_DIR=os.path.join(WORKDIR, "scan-blobs"),
+    AUDIT_ARCHIVE_DIR=os.path.join(WORKDIR, "audit-archive"),
+    DRAIN_FILE=os.path.join(WORKDIR, "draining"),
+    REDIS_URL="",
+    LOGSTASH_HOST="",
+    OTEL_TRACES_EXPORTER="none",
+    OLLAMA_PRELOAD="false",
+    ANONYMIZED_TELEMETRY="False",
+)
+os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+
+
+@pytest.fixture(scope="session")
+def main():
+    """backend/main.py against the benchmark stand-ins, on a SQLite database."""
+    import standins
+    standins.start(BASE_PORT)
+    import main
+    return main
+
+
+@pytest.fixture(scope="session")
+def session_client(main):
+    from fastapi.testclient import TestClient
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def user(main):
+    """Claims every request is authenticated as; tests change them (e.g. add realm roles)."""
+    claims = {"sub": "user-1", "preferred_username": "tester"}
+    main.app.dependency_overrides[main.get_current_user] = lambda: claims
+    yield claims
+    main.app.dependency_overrides.pop(main.get_current_user, None)
+
+
+@pytest.fixture
+def client(session_client, user):
+    return session_client
@@ -0,0 +1,52 @@
+import os
+import sys
+import json
+import subprocess
+
+import api_bench
+from conftest import BENCH_DIR
+
+BASELINE = {"scenarios": {"auth_reads": {"p95_ms": 100.0, "throughput_rps": 100.0, "error_rate": 0.0}}}
+
+
+def _result(**overrides):
+    return {"auth_reads": dict({"p95_ms": 100.0, "throughput_rps": 100.0, "error_rate": 0.0}, **overrides)}
+
+
+def test_summary_counts_failures_and_percentiles():
+    samples = [("GET /documents", 0.010 * i, i != 3) for i in range(1, 11)]
+    summary = api_bench.summarize(samples, elapsed=2.0)
+    assert summary["errors"] == 1 and summary["error_rate"] == 0.1 and summary["throughput_rps"] == 5.0
+    assert (summary["p50_ms"], summary["p95_ms"]) == (50.0, 100.0)
+    assert api_bench.summarize([], elapsed=0)["p95_ms"] is None
+
+
+def test_results_within_tolerance_do_not_regress():
+    assert api_bench.compare(_result(p95_ms=109.0, throughput_rps=91.0, error_rate=0.005), BASELINE, 0.1) == []
+
+
+def test_each_metric_regresses_on_its_own():
+    assert api_bench.compare(_result(p95_ms=111.0), BASELINE, 0.1) == [("auth_reads", "p95_ms")]
+    assert api_bench.compare(_result(throughput_rps=89.0), BASELINE, 0.1) == [("auth_reads", "throughput_rps")]
+    assert api_bench.compare(_result(error_rate=0.02), BASELINE, 0.1) == [("auth_reads", "error_rate")]
+
+
+def test_scenarios_missing_from_the_baseline_or_without_latencies_are_not_regressions():
+    assert api_bench.compare({"new_scenario": {"p95_ms": 1e6}}, BASELINE, 0.1) == []
+    assert api_bench.compare(_result(p95_ms=None), BASELINE, 0.1) == []
+
+
+def test_stand_in_docker_rejects_unsupported_commands():
+    proc = subprocess.run([sys.executable, os.path.join(BENCH_DIR, "bin", "docker"), "pull", "nmap-module"],
+                          capture_output=True, text=True)
+    assert proc.returncode == 125 and "unsupported command" in proc.stderr
+
+
+def test_stand_in_docker_streams_nmap_shards(monkeypatch):
+    monkeypatch.setenv("BENCH_SCAN_LATENCY", "0")
+    request = {"targets": ["10.0.0.1", "10.0.0.2"], "shard_size": 1, "stream": True}
+    proc = subprocess.run([sys.executable, os.path.join(BENCH_DIR, "bin", "docker"), "run", "--rm", "-e", "X=1",
+                           "nmap-module", json.dumps(request)], capture_output=True, text=True, check=True)
+    events = [json.loads(line) for line in proc.stdout.splitlines()]
+    assert [e.get("event") for e in events] == ["shard", "shard", "done"]
+    assert all('addr="10.0.0.' in e["stdout"] for e in events[:2])
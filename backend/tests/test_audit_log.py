@@ -0,0 +1,78 @@
+import gzip
+import json
+import uuid
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import create_engine
+
+import audit_log
+
+
+def test_month_arithmetic_crosses_years():
+    assert audit_log.add_months(date(2026, 11, 1), 2) == date(2027, 1, 1)
+    assert audit_log.add_months(date(2026, 1, 1), -13) == date(2024, 12, 1)
+    assert audit_log.month_start(datetime(2026, 10, 19, 18, 30)) == date(2026, 10, 1)
+
+
+def test_partition_names_sort_by_month(main):
+    assert audit_log.partition_name(main.audit_log_table, date(2026, 3, 1)) == "audit_log_p202603"
+
+
+def _event(tenant, action, timestamp, user_id="user-1"):
+    return {"id": str(uuid.uuid4()), "tenant_id": tenant, "user_id": user_id, "action": action,
+            "details": {"n": 1}, "timestamp": timestamp}
+
+
+def test_expired_months_are_archived_then_deleted(main, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/audit.db")
+    table = main.audit_log_table
+    audit_log.prepare(engine, table)
+    now = datetime.utcnow()
+    old = datetime(2020, 1, 15)
+    with engine.begin() as conn:
+        conn.execute(table.insert(), [_event("acme", "login", old), _event("acme", "login", datetime(2020, 3, 2)),
+                                      _event("acme", "login", now)])
+    archived = audit_log.expire(engine, table, retention_months=1, archive_dir=str(tmp_path / "archive"))
+    assert [(a["month"], a["rows"]) for a in archived] == [("2020-01-01", 1), ("2020-03-01", 1)]
+    with gzip.open(archived[0]["path"], "rt") as f:
+        rows = [json.loads(line) for line in f]
+    assert rows[0]["timestamp"] == old.isoformat() and rows[0]["details"] == {"n": 1}
+    with engine.connect() as conn:
+        assert [r.timestamp for r in conn.execute(table.select())] == [now]
+    # Months without rows leave no empty archive files behind
+    assert sorted(p.name for p in (tmp_path / "archive").iterdir()) == ["audit_log_202001.jsonl.gz", "audit_log_202003.jsonl.gz"]
+
+
+def test_search_is_tenant_scoped_filtered_and_paged(client, main):
+    tenant = f"audit-{uuid.uuid4().hex[:8]}"
+    with main.engine.begin() as conn:
+        conn.execute(main.audit_log_table.insert(), [
+            _event(tenant, "login", datetime(2026, 1, day), user_id="alice") for day in range(1, 6)
+        ] + [_event(tenant, "logout", datetime(2026, 1, 6), user_id="bob"), _event("other", "login", datetime(2026, 1, 3))])
+    headers = {"X-Tenant-ID": tenant}
+    assert len(client.get("/audit-log", headers=headers).json()) == 6
+    assert [e["user_id"] for e in client.get("/audit-log?action=logout", headers=headers).json()] == ["bob"]
+    page = client.get("/audit-log?user_id=alice&limit=2", headers=headers).json()
+    assert [e["timestamp"][:10] for e in page] == ["2026-01-05", "2026-01-04"]
+    following = client.get(f"/audit-log?user_id=alice&limit=2&until={page[-1]['timestamp']}", headers=headers).json()
+    assert [e["timestamp"][:10] for e in following] == ["2026-01-03", "2026-01-02"]
+    ranged = client.get("/audit-log?since=2026-01-02T00:00:00&until=2026-01-04T00:00:00", headers=headers).json()
+    assert {e["tenant_id"] for e in ranged} == {tenant} and len(ranged) == 2
+    assert len(client.get("/audit-log?limit=0", headers=headers).json()) == 1
+
+
+def test_a_failed_export_keeps_the_rows(main, tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path}/audit.db")
+    table = main.audit_log_table
+    audit_log.prepare(engine, table)
+    with engine.begin() as conn:
+        conn.execute(table.insert(), [_event("acme", "login", datetime(2020, 1, 15))])
+
+    def disk_full(*args, **kwargs):
+        raise OSError("No space left on device")
+    monkeypatch.setattr(audit_log.gzip, "open", disk_full)
+    with pytest.raises(OSError):
+        audit_log.expire(engine, table, retention_months=1, archive_dir=str(tmp_path / "archive"))
+    with engine.connect() as conn:
+        assert len(conn.execute(table.select()).fetchall()) == 1
@@ -0,0 +1,188 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import requests
+from fastapi import HTTPException
+
+import demo_tenant_setup
+from llm_router import LOCAL, CLOUD
+from tenant_provisioning import stable_id, write_provider_secrets
+
+
+@pytest.mark.parametrize("name, provider", [
+    ("OpenAI", "openai"), ("openai", "openai"), ("Anthropic", "anthropic"), ("Google AI", "google"),
+    (" GOOGLE ", "google"), ("Open AI", "openai"), ("Azure OpenAI", None), ("Slack", None), ("", None),
+])
+def test_display_names_map_to_cloud_providers(main, name, provider):
+    assert main.cloud_provider_type(name) == provider
+
+
+@pytest.fixture
+def demo_tenant(main):
+    """The providers of the demo tenant as demo_tenant_setup.py provisions them: rows by name, configs in Vault."""
+    manifest = demo_tenant_setup.demo_manifest()
+    tenant = manifest["tenant_id"]
+    with main.engine.begin() as conn:
+        conn.execute(main.providers_table.delete().where(main.providers_table.c.tenant_id == tenant))
+        conn.execute(main.providers_table.insert(), [
+            {"id": stable_id(tenant, "provider", p["name"]), "tenant_id": tenant, "name": p["name"]}
+            for p in manifest["providers"]])
+    written, failed = write_provider_secrets([manifest])
+    assert failed == []
+    main._cloud_routes.pop(tenant, None)
+    yield tenant
+    main._cloud_routes.pop(tenant, None)
+
+
+def test_demo_tenant_routes_to_its_own_provider_config(main, demo_tenant):
+    db = main.SessionLocal()
+    try:
+        route = main.get_cloud_route(db, demo_tenant)
+    finally:
+        db.close()
+    assert route == {"provider": "openai", "api_key": "demo-openai-key", "model": "gpt-3.5-turbo"}
+
+
+def test_default_provider_is_found_by_display_name(main, demo_tenant):
+    db = main.SessionLocal()
+    try:
+        row = db.execute(main.providers_table.select().where(
+            (main.providers_table.c.tenant_id == demo_tenant) & (main.providers_table.c.name == "Google AI"))).fetchone()
+        db.execute(main.providers_table.update().where(main.providers_table.c.id == row.id).values(
+            encrypted_config=main.envelope.encrypt(demo_tenant, {"api_key": "g-key", "model": "gemini-pro", "default": True})))
+        db.commit()
+        route = main.get_cloud_route(db, demo_tenant)
+    finally:
+        db.close()
+    assert route == {"provider": "google", "api_key": "g-key", "model": "gemini-pro"}
+
+
+# --- Routed generation ---
+ROUTE = {"provider": "openai"}
+
+
+@pytest.fixture
+def generators(main, monkeypatch):
+    """Outcome per source: a string answers, an exception fails; calls records which ran."""
+    outcomes, calls = {}, []
+
+    def generate(source):
+        def run(*args):
+            calls.append(source)
+            if isinstance(outcomes[source], Exception):
+                raise outcomes[source]
+            return outcomes[source]
+        return run
+    monkeypatch.setattr(main, "_generate_local", generate("local"))
+    monkeypatch.setattr(main, "_generate_cloud", generate("cloud"))
+    return outcomes, calls
+
+
+def _route(main, route, cloud_route=ROUTE):
+    return asyncio.run(main.route_generation("prompt", route, 5, cloud_route))
+
+
+def test_cloud_route_falls_back_to_local_when_cloud_fails(main, generators):
+    outcomes, calls = generators
+    outcomes.update(cloud=RuntimeError("provider down"), local="local answer")
+    assert _route(main, CLOUD) == ("local answer", "local", True)
+    assert calls == ["cloud", "local"]
+
+
+def test_local_route_falls_back_to_cloud_when_local_fails(main, generators):
+    outcomes, calls = generators
+    outcomes.update(local=RuntimeError("ollama down"), cloud="cloud answer")
+    assert _route(main, LOCAL) == ("cloud answer", "cloud", True)
+
+
+def test_cloud_route_without_a_cloud_provider_runs_locally(main, generators):
+    outcomes, calls = generators
+    outcomes.update(local="local answer")
+    assert _route(main, CLOUD, cloud_route=None) == ("local answer", "local", False)
+
+
+def test_both_failing_is_a_503(main, generators):
+    outcomes, calls = generators
+    outcomes.update(cloud=RuntimeError("provider down"), local=RuntimeError("ollama down"))
+    with pytest.raises(HTTPException) as raised:
+        _route(main, CLOUD)
+    assert raised.value.status_code == 503 and calls == ["cloud", "local"]
+
+
+# --- MCP server ---
+MCP_TENANT = {"X-Tenant-ID": "mcp-routing"}
+
+
+class _Response:
+    def __init__(self, status, body=None):
+        self.status_code, self.body = status, body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} from mcp-server")
+
+    def json(self):
+        return self.body
+
+
+@pytest.fixture
+def mcp(main, monkeypatch):
+    """Stands in for the MCP server: records each /generate body and answers with outcome (a _Response or exception)."""
+    server = {"outcome": _Response(200, {"choices": [{"text": "hi"}], "provider": "openai"}), "calls": []}
+
+    def post(url, json=None, **kwargs):
+        server["calls"].append(json)
+        if isinstance(server["outcome"], Exception):
+            raise server["outcome"]
+        return server["outcome"]
+    monkeypatch.setattr(main.mcp_session, "post", post)
+    with main.engine.begin() as conn:
+        conn.execute(main.providers_table.delete().where(main.providers_table.c.tenant_id == "mcp-routing"))
+    main._cloud_routes.pop("mcp-routing", None)
+    return server
+
+
+@pytest.mark.parametrize("outcome", [requests.ConnectionError("refused"), _Response(503), _Response(429)])
+def test_mcp_server_failures_are_a_502(client, mcp, outcome):
+    mcp["outcome"] = outcome
+    response = client.post("/ai/cloud/ask", params={"prompt": "hi"}, headers=MCP_TENANT)
+    assert response.status_code == 502 and response.json()["detail"] == "Could not connect to AI service."
+
+
+def test_routes_are_cached_until_the_providers_change(client, mcp):
+    client.post("/ai/cloud/ask", params={"prompt": "hi"}, headers=MCP_TENANT)
+    created = client.post("/providers", headers=MCP_TENANT,
+                          json={"name": "Anthropic", "config": {"api_key": "a-key", "model": "claude"}}).json()
+    client.post("/ai/cloud/ask", params={"prompt": "hi"}, headers=MCP_TENANT)
+    client.delete(f"/providers/{created['id']}", headers=MCP_TENANT)
+    client.post("/ai/cloud/ask", params={"prompt": "hi"}, headers=MCP_TENANT)
+    assert [call.get("provider") for call in mcp["calls"]] == ["openai", "anthropic", "openai"]
+    assert mcp["calls"][1]["api_key"] == "a-key" and "api_key" not in mcp["calls"][2]
+
+
+def test_ask_does_its_database_work_off_the_event_loop(client, main, monkeypatch):
+    on_loop = {}
+
+    def off_loop(name, fn):
+        def call(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                on_loop[name] = True
+            except RuntimeError:
+                on_loop[name] = False
+            return fn(*args, **kwargs)
+        return call
+    for name in ("get_routing_policy", "cloud_spend", "get_cloud_route", "record_usage"):
+        monkeypatch.setattr(main, name, off_loop(name, getattr(main, name)))
+    monkeypatch.setattr(main.chroma_router, "reader", off_loop("reader", lambda tenant: None))
+    retriever = SimpleNamespace(get_relevant_documents=lambda question: [SimpleNamespace(page_content="doc")])
+    monkeypatch.setattr(main, "Chroma", lambda **kwargs: SimpleNamespace(as_retriever=lambda: retriever))
+
+    async def route_generation(prompt, route, hedge_after, cloud_route):
+        return "answer", "local", False
+    monkeypatch.setattr(main, "route_generation", route_generation)
+    response = client.post("/ai/ask", params={"question": "q", "module_id": "docs"}, headers=MCP_TENANT)
+    assert response.status_code == 200 and response.json()["answer"] == "answer"
+    assert on_loop == {"reader": False, "get_routing_policy": False, "cloud_spend": False, "get_cloud_route": False,
+                       "record_usage": False}
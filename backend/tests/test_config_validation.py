@@ -0,0 +1,69 @@
+import uuid
+
+import pytest
+
+from config_validation import ConfigValidators, InvalidSchema, compile_schema, pipeline_errors, MAX_ERRORS
+
+SCHEMA = {"type": "object", "properties": {"depth": {"type": "integer", "minimum": 1}, "mode": {"enum": ["fast", "deep"]}},
+          "required": ["depth"], "additionalProperties": False}
+
+
+def test_malformed_schemas_are_rejected_with_their_location():
+    with pytest.raises(InvalidSchema, match="properties/depth"):
+        compile_schema({"type": "object", "properties": {"depth": {"type": "integr"}}})
+
+
+def test_errors_name_the_offending_path():
+    errors = ConfigValidators().errors("scanner", SCHEMA, {"depth": 0, "mode": "slow"})
+    assert [e["path"] for e in errors] == ["/depth", "/mode"]
+    assert ConfigValidators().errors("scanner", SCHEMA, {"depth": 2}) == []
+    assert ConfigValidators().errors("scanner", None, {"anything": True}) == []
+
+
+def test_error_lists_are_capped():
+    schema = {"type": "object", "additionalProperties": {"type": "integer"}}
+    config = {f"k{i}": "x" for i in range(MAX_ERRORS + 5)}
+    assert len(ConfigValidators().errors("many", schema, config)) == MAX_ERRORS
+
+
+def test_validators_are_compiled_once_per_schema_version(monkeypatch):
+    import config_validation
+    compiled = []
+    monkeypatch.setattr(config_validation, "compile_schema", lambda schema: compiled.append(schema) or compile_schema(schema))
+    checker = ConfigValidators()
+    checker.errors("scanner", SCHEMA, {"depth": 1})
+    checker.errors("scanner", dict(SCHEMA), {"depth": 1})  # equal content, new object: rehashed, not recompiled
+    assert len(compiled) == 1
+    changed = dict(SCHEMA, required=["depth", "mode"])
+    assert checker.errors("scanner", changed, {"depth": 1})[0]["message"] == "'mode' is a required property"
+    assert len(compiled) == 2
+
+
+def test_pipeline_errors_report_unknown_modules_and_bad_steps():
+    registry = {"scanner": {"config_schema": SCHEMA}}
+    errors = pipeline_errors([{"module": "scanner", "config": {"depth": 1}}, {"module": "missing"}, {},
+                              {"module": "scanner", "config": {}}], registry, ConfigValidators())
+    assert [(e["step"], e["path"], e["message"]) for e in errors] == [
+        (1, "/module", "Unknown module"), (2, "/module", "Step has no module"),
+        (3, "/", "'depth' is a required property")]
+
+
+# --- Endpoints ---
+def test_registering_a_malformed_schema_is_a_422(client):
+    response = client.post("/modules/register", json={"name": f"bad-{uuid.uuid4().hex[:8]}", "image": "bad:latest",
+                                                      "config_schema": {"type": "nothing"}})
+    assert response.status_code == 422 and "Invalid config_schema" in response.json()["detail"]
+
+
+def test_orchestrations_with_invalid_step_configs_are_rejected(client):
+    name = f"scanner-{uuid.uuid4().hex[:8]}"
+    assert client.post("/modules/register", json={"name": name, "image": f"{name}:latest",
+                                                  "config_schema": SCHEMA}).status_code == 200
+    response = client.post("/orchestrations", headers={"X-Tenant-ID": "acme"},
+                           json={"name": "p", "pipeline": [{"module": name, "config": {"depth": "deep"}}]})
+    assert response.status_code == 422
+    assert response.json()["detail"]["errors"] == [{"step": 0, "module": name, "path": "/depth",
+                                                    "message": "'deep' is not of type 'integer'"}]
+    valid = client.post("/orchestrations", headers={"X-Tenant-ID": "acme"},
+                        json={"name": "p", "pipeline": [{"module": name, "config": {"depth": 3}}]})
+    assert valid.status_code == 200
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+import document_parsing
+from document_parsing import stream_pages, document_format, UnsupportedDocumentFormat
+
+
+def _crash(path):
+    os._exit(1)
+    yield  # pragma: no cover
+
+
+def _fail(path):
+    yield 1, "first page"
+    raise ValueError("corrupt page 2")
+
+
+@pytest.fixture
+def fresh_pool(monkeypatch):
+    # Workers are forked on first use, so extractors patched before that are seen by them
+    document_parsing.shutdown_parse_pool()
+    monkeypatch.setattr(document_parsing, "PAGE_POLL_INTERVAL", 0.1)
+    monkeypatch.setitem(document_parsing.PAGE_EXTRACTORS, "crash", _crash)
+    monkeypatch.setitem(document_parsing.PAGE_EXTRACTORS, "fail", _fail)
+    yield
+    document_parsing.shutdown_parse_pool()
+
+
+def _write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def test_unsupported_format_is_rejected():
+    with pytest.raises(UnsupportedDocumentFormat):
+        document_format("notes.xlsx")
+
+
+def test_txt_pages_stream_in_order(fresh_pool, tmp_path, monkeypatch):
+    monkeypatch.setattr(document_parsing, "TXT_PAGE_CHARS", 10)
+    path = _write(tmp_path, "a.txt", "0123456789\n" * 3)
+    items = list(stream_pages([path]))
+    assert [page for _, page, _ in items] == [1, 2, 3, None]
+    assert items[-1] == (0, None, None)
+
+
+def test_extractor_error_ends_the_document_with_a_message(fresh_pool, tmp_path):
+    items = list(stream_pages([_write(tmp_path, "a.fail", "x"), _write(tmp_path, "b.txt", "hello")]))
+    ends = {doc: error for doc, page, error in items if page is None}
+    assert ends[0] == "ValueError: corrupt page 2"
+    assert ends[1] is None
+    assert (0, 1, "first page") in items
+
+
+def test_worker_dying_before_its_end_marker_does_not_hang(fresh_pool, tmp_path):
+    items = list(stream_pages([_write(tmp_path, "a.crash", "x")]))
+    assert len(items) == 1
+    doc, page, error = items[0]
+    assert (doc, page) == (0, None) and error.startswith("BrokenProcessPool")
+    # The broken pool is replaced, so later documents still parse
+    assert list(stream_pages([_write(tmp_path, "b.txt", "hello")]))[-1] == (0, None, None)
+
+
+def test_crash_ends_every_document_of_the_broken_pool(fresh_pool, tmp_path):
+    paths = [_write(tmp_path, "a.crash", "x")] + [_write(tmp_path, f"{i}.txt", "hello") for i in range(3)]
+    ends = [item for item in stream_pages(paths) if item[1] is None]
+    assert sorted(doc for doc, _, _ in ends) == [0, 1, 2, 3]
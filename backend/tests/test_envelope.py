@@ -0,0 +1,163 @@
+import uuid
+
+import hvac
+import pytest
+from cryptography.fernet import InvalidToken
+from sqlalchemy import MetaData, Table, Column, String, Text, create_engine, select
+
+import envelope
+from envelope import EnvelopeCipher, key_version
+
+
+@pytest.fixture
+def store(main, tmp_path):
+    """Data keys and a table of encrypted values on their own database, wrapped by a fresh transit key of the Vault stand-in."""
+    engine = create_engine(f"sqlite:///{tmp_path}/keys.db")
+    metadata = MetaData()
+    keys = main.tenant_data_keys_table.to_metadata(metadata)
+    values = Table("secrets", metadata, Column("id", String, primary_key=True), Column("tenant_id", String),
+                   Column("value", Text))
+    metadata.create_all(engine)
+    key_name = f"test-{uuid.uuid4().hex[:8]}"
+
+    def cipher(**kwargs):
+        return EnvelopeCipher(engine, keys, main.vault_client, key_name=key_name, **kwargs)
+    return {"engine": engine, "keys": keys, "values": values, "cipher": cipher, "vault": main.vault_client,
+            "key_name": key_name}
+
+
+@pytest.fixture
+def unwraps(monkeypatch):
+    """Counts the Vault transit decrypt calls of every cipher."""
+    calls = []
+    original = EnvelopeCipher._unwrap
+
+    def counting(self, wrapped):
+        calls.append(wrapped)
+        return original(self, wrapped)
+    monkeypatch.setattr(EnvelopeCipher, "_unwrap", counting)
+    return calls
+
+
+def _insert(store, cipher, tenant, data):
+    row_id = str(uuid.uuid4())
+    with store["engine"].begin() as conn:
+        conn.execute(store["values"].insert().values(id=row_id, tenant_id=tenant, value=cipher.encrypt(tenant, data)))
+    return row_id
+
+
+def _values(store):
+    with store["engine"].connect() as conn:
+        return {r.id: r.value for r in conn.execute(select(store["values"])).fetchall()}
+
+
+def test_values_round_trip_and_the_first_key_is_created_on_demand(store):
+    cipher = store["cipher"]()
+    value = cipher.encrypt("acme", {"api_key": "sk-1"})
+    assert value.startswith("env1:1:") and "sk-1" not in value
+    assert cipher.decrypt("acme", value) == {"api_key": "sk-1"}
+    assert store["vault"].secrets.transit.read_key(name=store["key_name"])["data"]["latest_version"] == 1
+
+
+def test_tenants_get_their_own_keys(store):
+    cipher = store["cipher"]()
+    value = cipher.encrypt("acme", {"k": 1})
+    cipher.encrypt("globex", {"k": 2})
+    with pytest.raises(InvalidToken):
+        cipher.decrypt("globex", value)
+
+
+def test_unwrapped_keys_are_cached_until_the_ttl_passes(store, unwraps):
+    value = store["cipher"]().encrypt("acme", {"k": 1})
+    other_worker = store["cipher"]()
+    for _ in range(3):
+        assert other_worker.decrypt("acme", value) == {"k": 1}
+    assert len(unwraps) == 1
+    expiring = store["cipher"](ttl=0)
+    expiring.decrypt("acme", value)
+    expiring.decrypt("acme", value)
+    assert len(unwraps) == 3
+
+
+def test_a_failing_vault_is_not_cached(store, monkeypatch):
+    value = store["cipher"]().encrypt("acme", {"k": 1})
+    cipher = store["cipher"]()
+
+    def unavailable(*args, **kwargs):
+        raise hvac.exceptions.VaultDown("sealed")
+    monkeypatch.setattr(cipher.vault.secrets.transit, "decrypt_data", unavailable)
+    with pytest.raises(hvac.exceptions.VaultDown):
+        cipher.decrypt("acme", value)
+    assert cipher._data_keys == {}
+    monkeypatch.undo()
+    assert cipher.decrypt("acme", value) == {"k": 1}
+
+
+def test_unknown_versions_and_tampered_values_are_refused(store):
+    cipher = store["cipher"]()
+    value = cipher.encrypt("acme", {"k": 1})
+    with pytest.raises(KeyError, match="version 7"):
+        cipher.decrypt("acme", value.replace("env1:1:", "env1:7:"))
+    with pytest.raises(InvalidToken):
+        cipher.decrypt("acme", value[:-4] + "AAAA")
+
+
+@pytest.mark.parametrize("value, version", [(None, None), ("", None), ("gAAAAAB-legacy-fernet", None), ("env1:3:token", 3)])
+def test_key_version_only_recognizes_envelope_values(value, version):
+    assert key_version(value) == version
+
+
+def test_rotation_moves_every_value_to_the_new_key_in_batches(store, monkeypatch):
+    monkeypatch.setattr(envelope, "KEY_ROTATION_BATCH", 2)
+    cipher = store["cipher"]()
+    ids = [_insert(store, cipher, "acme", {"n": n}) for n in range(5)]
+    other = _insert(store, cipher, "globex", {"n": "other"})
+    assert cipher.rotate_tenant_key("acme") == 2
+    # Old values stay readable and new ones use the new version at once
+    assert cipher.decrypt("acme", _values(store)[ids[0]]) == {"n": 0}
+    assert cipher.encrypt("acme", {"n": "new"}).startswith("env1:2:")
+    assert cipher.reencrypt(store["values"], store["values"].c.value, "acme") == 5
+    values = _values(store)
+    assert [key_version(values[i]) for i in ids] == [2] * 5 and key_version(values[other]) == 1
+    assert [cipher.decrypt("acme", values[i]) for i in ids] == [{"n": n} for n in range(5)]
+    assert cipher.reencrypt(store["values"], store["values"].c.value, "acme") == 0
+
+
+def test_other_workers_pick_up_a_rotation_after_the_ttl(store):
+    cipher, other_worker = store["cipher"](), store["cipher"](ttl=0)
+    cipher.encrypt("acme", {"k": 1})
+    other_worker.active_version("acme")
+    cipher.rotate_tenant_key("acme")
+    assert other_worker.active_version("acme") == 2
+
+
+def test_data_keys_are_rewrapped_after_the_transit_key_rotates(store):
+    cipher = store["cipher"]()
+    value = cipher.encrypt("acme", {"k": 1})
+    cipher.encrypt("globex", {"k": 2})
+    assert cipher.rewrap_stale() == 0
+    store["vault"].secrets.transit.rotate_key(name=store["key_name"])
+    assert cipher.rewrap_stale() == 2
+    with store["engine"].connect() as conn:
+        assert all(w.startswith("vault:v2:") for w in conn.execute(select(store["keys"].c.wrapped_key)).scalars())
+    assert store["cipher"]().decrypt("acme", value) == {"k": 1}
+
+
+def test_a_rotation_during_reencryption_does_not_restart_it(store, monkeypatch):
+    monkeypatch.setattr(envelope, "KEY_ROTATION_BATCH", 2)
+    cipher = store["cipher"](ttl=0)  # no cached active version: every lookup sees the other worker's rotation
+    ids = [_insert(store, cipher, "acme", {"n": n}) for n in range(5)]
+    cipher.rotate_tenant_key("acme")
+    decrypts = []
+    original = EnvelopeCipher.decrypt
+
+    def decrypt(self, tenant, value):
+        decrypts.append(value)
+        assert len(decrypts) <= 10, "rows rewritten over and over"
+        if len(decrypts) == 1:
+            store["cipher"]().rotate_tenant_key("acme")  # another worker rotates again mid-run
+        return original(self, tenant, value)
+    monkeypatch.setattr(EnvelopeCipher, "decrypt", decrypt)
+    assert cipher.reencrypt(store["values"], store["values"].c.value, "acme") == 5
+    values = _values(store)
+    assert [key_version(values[i]) for i in ids] == [2] * 5
@@ -0,0 +1,111 @@
+import time
+import itertools
+import threading
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+import keycloak_setup
+import mock_keycloak_server
+
+
+class Response:
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self._body = body or {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._body
+
+
+@pytest.fixture
+def issued(monkeypatch):
+    """Token endpoint stand-in handing out token-1, token-2, ..."""
+    counter = itertools.count(1)
+    issued = []
+
+    def post(url, data):
+        issued.append(f"token-{next(counter)}")
+        return Response(body={"access_token": issued[-1], "expires_in": 300})
+    monkeypatch.setattr(keycloak_setup.session, "post", post)
+    monkeypatch.setattr(keycloak_setup.time, "sleep", lambda s: None)
+    return issued
+
+
+def test_invalidate_forces_a_refresh(issued):
+    token = keycloak_setup.AdminToken()
+    assert token.get() == "token-1"
+    token.invalidate("token-1")
+    assert token.get() == "token-2"
+
+
+def test_invalidating_a_token_already_replaced_keeps_the_new_one(issued):
+    token = keycloak_setup.AdminToken()
+    token.get()
+    token.invalidate("token-1")
+    token.get()
+    token.invalidate("token-1")  # a second thread's late 401 for the old token
+    assert token.get() == "token-2"
+    assert issued == ["token-1", "token-2"]
+
+
+def test_admin_request_retries_a_401_with_a_fresh_token(issued, monkeypatch):
+    sent = []
+
+    def request(method, url, headers, timeout, **kwargs):
+        sent.append(headers["Authorization"])
+        return Response(401 if len(sent) == 1 else 201)
+    monkeypatch.setattr(keycloak_setup.session, "request", request)
+    token = keycloak_setup.AdminToken()
+    assert keycloak_setup.admin_request(token, "POST", "/realm/users", json={}).status_code == 201
+    assert sent == ["Bearer token-1", "Bearer token-2"]
+
+
+# --- Against the mock Keycloak server ---
+@pytest.fixture
+def mock_keycloak(monkeypatch):
+    """mock_keycloak_server.py on a free port, with one-second admin tokens and 10% of admin calls failing."""
+    monkeypatch.setattr(mock_keycloak_server, "STATE", {"realms": {}, "tokens": {}, "refresh_tokens": {}, "requests": 0})
+    monkeypatch.setattr(mock_keycloak_server, "CONFIG", {"token_ttl": 1, "fail_rate": 0.1})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), mock_keycloak_server.Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(keycloak_setup, "KEYCLOAK_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(keycloak_setup, "TOKEN_REFRESH_MARGIN", 0)
+    # No backoff between retries; the token expiry still follows the real clock
+    monkeypatch.setattr(keycloak_setup, "time", SimpleNamespace(monotonic=time.monotonic, sleep=lambda s: None))
+    yield mock_keycloak_server.STATE
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("mode", ["partial-import", "concurrent"])
+def test_bulk_import_survives_expiring_tokens_and_resumes_from_the_checkpoint(mock_keycloak, tmp_path, mode):
+    users = [{"username": f"user-{i}", "tenant_id": "acme", "password": "pw"} for i in range(40)]
+    checkpoint = str(tmp_path / "imported.txt")
+    token = keycloak_setup.get_admin_token()
+    keycloak_setup.create_realm(token)
+    keycloak_setup.create_client(token)
+    # The first run stops after 25 users
+    imported, failed = keycloak_setup.bulk_import_users(token, users[:25], mode=mode, batch_size=10, concurrency=4,
+                                                        checkpoint_path=checkpoint)
+    assert (imported, failed) == (25, [])
+
+    # Meanwhile the access token expired, and the server forgot every access token it issued
+    time.sleep(1.1)
+    mock_keycloak["tokens"].clear()
+    requests_before = mock_keycloak["requests"]
+    imported, failed = keycloak_setup.bulk_import_users(token, users, mode=mode, batch_size=10, concurrency=4,
+                                                        checkpoint_path=checkpoint)
+    assert (imported, failed) == (15, [])
+    realm = mock_keycloak["realms"][keycloak_setup.REALM]
+    assert sorted(realm["users"]) == sorted(u["username"] for u in users)
+    assert realm["users"]["user-0"]["attributes"] == {"tenant_id": ["acme"]}
+    # Only the 15 remaining users were sent again (plus retries and token calls)
+    assert mock_keycloak["requests"] - requests_before < (15 if mode == "concurrent" else 2) * 3
+    with open(checkpoint) as f:
+        assert sorted(f.read().split()) == sorted(u["username"] for u in users)
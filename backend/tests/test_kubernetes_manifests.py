@@ -0,0 +1,38 @@
+import os
+import glob
+
+import pytest
+
+yaml = pytest.importorskip("yaml")
+
+KUBERNETES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "kubernetes")
+
+
+def _documents(pattern):
+    for path in glob.glob(os.path.join(KUBERNETES_DIR, pattern)):
+        with open(path) as f:
+            yield from (doc for doc in yaml.safe_load_all(f) if doc)
+
+
+def _secret_refs(value):
+    if isinstance(value, dict):
+        if "secretKeyRef" in value:
+            yield value["secretKeyRef"]["name"], value["secretKeyRef"]["key"]
+        for item in value.values():
+            yield from _secret_refs(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _secret_refs(item)
+
+
+def test_every_referenced_secret_key_has_a_manifest_or_template():
+    defined = {(doc["metadata"]["name"], key)
+               for pattern in ("*.yaml", "*.yaml.example") for doc in _documents(pattern) if doc.get("kind") == "Secret"
+               for key in {**doc.get("data", {}), **doc.get("stringData", {})}}
+    referenced = set(_secret_refs(list(_documents("*.yaml"))))
+    assert referenced and referenced <= defined
+
+
+def test_secret_templates_hold_no_real_values():
+    for doc in _documents("*.yaml.example"):
+        assert not any({**doc.get("data", {}), **doc.get("stringData", {})}.values())
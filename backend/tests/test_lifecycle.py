@@ -0,0 +1,125 @@
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import MetaData, create_engine, select
+
+import lifecycle
+from lifecycle import HandoffQueue, Lifecycle, DEAD, PENDING
+
+
+@pytest.fixture
+def queue(main, tmp_path):
+    """A HandoffQueue on its own database, so the app's handoff poller never sees these rows."""
+    engine = create_engine(f"sqlite:///{tmp_path}/handoffs.db")
+    metadata = MetaData()
+    table = main.job_handoffs_table.to_metadata(metadata)
+    metadata.create_all(engine)
+    queue = HandoffQueue(engine, table, Lifecycle(drain_file=str(tmp_path / "draining")), max_attempts=3)
+
+    def rows():
+        with engine.connect() as conn:
+            return conn.execute(select(table)).fetchall()
+    queue.rows = rows
+    return queue
+
+
+def _failing(calls):
+    def handler(row_id, tenant, payload):
+        calls.append(payload)
+        raise RuntimeError("module image missing")
+    return handler
+
+
+def _stale(queue):
+    with queue.engine.begin() as conn:
+        conn.execute(queue.table.update().values(claimed_at=datetime.utcnow() - timedelta(seconds=120)))
+
+
+def test_jobs_with_nothing_left_to_resume_are_removed(queue):
+    seen = []
+    queue.put("nmap_scan", "acme", {"scan_id": "1"})
+    assert queue.resume_once({"nmap_scan": lambda row_id, tenant, payload: seen.append((tenant, payload))}) == 1
+    assert seen == [("acme", {"scan_id": "1"})] and queue.rows() == []
+
+
+def test_resumed_jobs_stay_claimed_until_they_finish(queue):
+    job = Future()
+    queue.put("nmap_scan", "acme", {"scan_id": "1"})
+    assert queue.resume_once({"nmap_scan": lambda row_id, tenant, payload: job}) == 1
+    _stale(queue)
+    queue.heartbeat()
+    (row,) = queue.rows()
+    assert row.claimed_at > datetime.utcnow() - timedelta(seconds=60) and queue.claim() == []
+    job.set_result({"status": "completed"})
+    assert queue.rows() == [] and queue._running == {}
+
+
+def test_resumed_jobs_that_fail_are_retried(queue):
+    job = Future()
+    queue.put("nmap_scan", "acme", {"scan_id": "1"})
+    queue.resume_once({"nmap_scan": lambda row_id, tenant, payload: job})
+    job.set_exception(RuntimeError("database went away"))
+    (row,) = queue.rows()
+    assert row.status == PENDING and row.claimed_at is None and row.last_error == "database went away"
+
+
+def test_resumed_jobs_that_never_started_are_released(queue):
+    job = Future()
+    queue.put("nmap_scan", "acme", {"scan_id": "1"})
+    queue.resume_once({"nmap_scan": lambda row_id, tenant, payload: job})
+    job.cancel()
+    (row,) = queue.rows()
+    assert row.status == PENDING and row.claimed_at is None and row.last_error is None
+
+
+def test_jobs_whose_instance_died_while_resuming_them_are_taken_over(queue, monkeypatch):
+    monkeypatch.setattr(lifecycle, "HANDOFF_CLAIM_TIMEOUT", 60)
+    resumed = []
+
+    def resume(row_id, tenant, payload):
+        resumed.append(row_id)
+        return Future()  # the job never finishes: its instance dies with it
+    queue.put("nmap_scan", "acme", {"scan_id": "1"})
+    for attempt in range(1, 4):
+        queue._running.clear()  # a new instance, with nothing running yet
+        assert queue.resume_once({"nmap_scan": resume}) == 1
+        queue.heartbeat()
+        assert queue.resume_once({"nmap_scan": resume}) == 0
+        _stale(queue)
+    (row,) = queue.rows()
+    assert len(resumed) == 3 and len(set(resumed)) == 1 and row.attempts == 3
+    assert queue.claim() == [] and queue.rows()[0].status == DEAD
+
+
+def test_failed_resumes_are_retried_until_the_last_attempt(queue):
+    calls = []
+    queue.put("nmap_scan", "acme", {"scan_id": "1"})
+    assert queue.resume_once({"nmap_scan": _failing(calls)}) == 0
+    (row,) = queue.rows()
+    assert row.status == PENDING and row.attempts == 1 and row.claimed_at is None
+    assert row.last_error == "module image missing"
+    for _ in range(4):
+        queue.resume_once({"nmap_scan": _failing(calls)})
+    (row,) = queue.rows()
+    assert len(calls) == 3 and row.status == DEAD and row.attempts == 3
+
+
+def test_unknown_kinds_count_as_failed_attempts(queue):
+    queue.put("retired_job", "acme", {})
+    queue.resume_once({})
+    (row,) = queue.rows()
+    assert row.attempts == 1 and "retired_job" in row.last_error
+
+
+def test_abandoned_claims_are_taken_over_and_given_up_after_the_last_attempt(queue, monkeypatch):
+    monkeypatch.setattr(lifecycle, "HANDOFF_CLAIM_TIMEOUT", 60)
+    queue.put("nmap_scan", "acme", {"scan_id": "1"})
+    for attempt in range(1, 4):
+        (row,) = queue.claim()
+        assert row.attempts == attempt - 1
+        assert queue.claim() == []  # still claimed by the instance that stopped responding
+        _stale(queue)
+    assert queue.claim() == []
+    (row,) = queue.rows()
+    assert row.status == DEAD and row.last_error == "claimed instance stopped responding"
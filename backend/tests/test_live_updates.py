@@ -0,0 +1,62 @@
+import fakeredis
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from live_updates import LiveHub
+
+TENANT = {"X-Tenant-ID": "acme"}
+
+
+@pytest.fixture(params=["memory", "redis"])
+def hub(request):
+    hub = LiveHub(redis_url="")
+    if request.param == "redis":
+        hub.redis = fakeredis.FakeRedis()
+    return hub
+
+
+def test_tickets_are_redeemed_once(hub):
+    ticket = hub.issue_ticket({"sub": "user-1"}, "acme")
+    assert hub.redeem_ticket(ticket) == {"claims": {"sub": "user-1"}, "tenant": "acme"}
+    assert hub.redeem_ticket(ticket) is None
+    assert hub.redeem_ticket("made-up") is None
+
+
+def test_expired_tickets_are_refused():
+    hub = LiveHub(redis_url="")
+    assert hub.redeem_ticket(hub.issue_ticket({"sub": "user-1"}, "acme", ttl=0)) is None
+    hub.issue_ticket({"sub": "user-1"}, "acme")
+    assert len(hub._tickets) == 1  # the expired one was pruned
+
+
+# --- Endpoints ---
+def _ticket(client):
+    response = client.post("/live/ticket", headers=TENANT)
+    assert response.status_code == 200 and response.cookies.get("live_ticket") == response.json()["ticket"]
+    return response.json()["ticket"]
+
+
+def test_websocket_accepts_a_ticket_once(client):
+    ticket = _ticket(client)
+    with client.websocket_connect("/live/ws", subprotocols=["live", f"ticket.{ticket}"]) as ws:
+        assert ws.accepted_subprotocol == "live"
+    with pytest.raises(WebSocketDisconnect) as refused:
+        with client.websocket_connect("/live/ws", subprotocols=["live", f"ticket.{ticket}"]):
+            pass
+    assert refused.value.code == 4401
+
+
+def test_tokens_in_the_query_string_are_ignored(client):
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/live/ws?access_token=anything&tenant=acme"):
+            pass
+
+
+def test_sse_needs_a_valid_ticket_cookie(client):
+    client.cookies.clear()
+    assert client.get("/live/events?access_token=anything").status_code == 401
+    client.cookies.set("live_ticket", "made-up", path="/live")
+    try:
+        assert client.get("/live/events").status_code == 401
+    finally:
+        client.cookies.clear()
@@ -0,0 +1,113 @@
+import time
+import asyncio
+import threading
+import contextvars
+
+import pytest
+
+from llm_router import LOCAL
+from llm_scheduler import LLMScheduler, LLMCallCancelled, cancel_scope, llm_priority, INTERACTIVE, BATCH
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.01)
+
+
+def _queued(scheduler):
+    return sum(scheduler.snapshot()["queued"].values())
+
+
+def _in_thread(fn):
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = fn()
+        except Exception as e:
+            outcome["error"] = e
+    # Like run_in_threadpool, the thread runs in a copy of the caller's context (priority, cancel scope)
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(run,))
+    thread.start()
+    return thread, outcome
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    scheduler = LLMScheduler(max_in_flight=1)
+    with scheduler.slot():
+        with cancel_scope() as scope:
+            def wait():
+                with scheduler.slot():
+                    return "ran"
+            thread, outcome = _in_thread(wait)
+        _wait_for(lambda: _queued(scheduler) == 1)
+        scope.cancel()
+        thread.join(5)
+        assert isinstance(outcome.get("error"), LLMCallCancelled)
+        assert _queued(scheduler) == 0
+    assert scheduler.snapshot()["in_flight"] == 0
+
+
+def test_cancelled_scope_never_takes_a_free_slot():
+    scheduler = LLMScheduler(max_in_flight=1)
+    with cancel_scope() as scope:
+        scope.cancel()
+        with pytest.raises(LLMCallCancelled):
+            with scheduler.slot():
+                pass
+    assert scheduler.snapshot()["in_flight"] == 0
+
+
+def test_slot_granted_as_the_scope_is_cancelled_is_handed_on():
+    scheduler = LLMScheduler(max_in_flight=1)
+    holder = scheduler.slot()
+    holder.__enter__()
+    with cancel_scope() as scope:
+        def wait():
+            with scheduler.slot():
+                return "ran"
+        cancelled, outcome = _in_thread(wait)
+    _wait_for(lambda: _queued(scheduler) == 1)
+    next_slot = scheduler.slot()
+    next_waiter, next_outcome = _in_thread(next_slot.__enter__)
+    _wait_for(lambda: _queued(scheduler) == 2)
+    # The slot passes to the cancelled waiter first; it must hand it to the next one
+    with scheduler._lock:
+        scope.cancelled = True
+    holder.__exit__(None, None, None)
+    cancelled.join(5)
+    next_waiter.join(5)
+    assert isinstance(outcome.get("error"), LLMCallCancelled) and "error" not in next_outcome
+    assert scheduler.snapshot()["in_flight"] == 1 and _queued(scheduler) == 0
+
+
+def test_interactive_calls_go_first():
+    scheduler = LLMScheduler(max_in_flight=1)
+    order = []
+
+    def call(priority):
+        with llm_priority(priority, "acme"), scheduler.slot():
+            order.append(priority)
+    with scheduler.slot():
+        batch, _ = _in_thread(lambda: call(BATCH))
+        _wait_for(lambda: _queued(scheduler) == 1)
+        interactive, _ = _in_thread(lambda: call(INTERACTIVE))
+        _wait_for(lambda: _queued(scheduler) == 2)
+    batch.join(5)
+    interactive.join(5)
+    assert order == [INTERACTIVE, BATCH]
+
+
+def test_losing_local_hedge_gives_up_its_place_in_the_queue(main, monkeypatch):
+    def generate_local(prompt):
+        with main.scheduler.slot():
+            return "local answer"
+    monkeypatch.setattr(main, "_generate_local", generate_local)
+    monkeypatch.setattr(main, "_generate_cloud", lambda route, prompt: "cloud answer")
+    with main.scheduler.slot():
+        answer = asyncio.run(main.route_generation("prompt", LOCAL, 0.05, {"provider": "openai"}))
+        assert answer == ("cloud answer", "cloud", True)
+        _wait_for(lambda: _queued(main.scheduler) == 0)
+    assert main.scheduler.snapshot()["in_flight"] == 0
@@ -0,0 +1,106 @@
+import json
+import socket
+import logging
+import threading
+
+import pytest
+
+from log_shipping import LogstashHandler, request_context
+
+
+@pytest.fixture
+def logstash():
+    """A json_lines TCP listener collecting the documents it receives."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    received, done = [], threading.Event()
+
+    def serve():
+        conn, _ = server.accept()
+        buf = b""
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            buf += data
+        received.extend(json.loads(line) for line in buf.decode().splitlines())
+        done.set()
+    threading.Thread(target=serve, daemon=True).start()
+    yield server.getsockname(), received, done
+    server.close()
+
+
+def make_logger(handler):
+    logger = logging.getLogger(f"test-{id(handler)}")
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def test_records_are_formatted_when_logged(logstash):
+    address, received, done = logstash
+    handler = LogstashHandler(*address, batch_size=100)
+    logger = make_logger(handler)
+    token = request_context.set({"tenant_id": "acme", "request_id": "r1"})
+    items = ["a"]
+    logger.info("items %s", items)
+    items.append("b")  # changed after logging; the shipped message must not see it
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("failed")
+    request_context.reset(token)
+    handler.close()
+    assert done.wait(5)
+    first, second = received
+    assert first["message"] == "items ['a']"
+    assert first["tenant_id"] == "acme" and first["request_id"] == "r1"
+    assert second["level"] == "ERROR" and "ValueError: boom" in second["exception"]
+
+
+def test_overflow_is_counted_and_reported(logstash):
+    address, received, done = logstash
+    handler = LogstashHandler(*address, buffer_size=2, batch_size=100)
+    handler._wakeup.wait = lambda timeout=None: True  # hold the batch until close()
+    logger = make_logger(handler)
+    for i in range(5):
+        logger.info("record %d", i)
+    assert handler.dropped >= 1
+    handler.close()
+    assert done.wait(5)
+    messages = [d["message"] for d in received]
+    assert "record 4" in messages
+    assert any(m.startswith("dropped ") for m in messages)
+
+
+def test_dropped_counter_is_consistent_across_threads():
+    handler = LogstashHandler("127.0.0.1", 9, buffer_size=1, batch_size=10 ** 6)
+    # Stop the shipper first: then every append past the first drops one
+    handler._stopping.set()
+    handler._wakeup.set()
+    handler._thread.join(5)
+    logger = make_logger(handler)
+    threads = [threading.Thread(target=lambda: [logger.info("x") for _ in range(500)]) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert handler.dropped == 8 * 500 - 1
+
+
+def test_a_forked_worker_ships_with_its_own_thread(logstash):
+    address, received, done = logstash
+    handler = LogstashHandler(*address, batch_size=100)
+    handler._wakeup.wait = lambda timeout=None: True  # hold the batch until close()
+    logger = make_logger(handler)
+    logger.info("parent record")
+    parent_thread = handler._thread
+    handler._pid = -1  # as seen from a child forked after the record was buffered
+    logger.info("child record")
+    assert handler._thread is not parent_thread and handler._thread.is_alive()
+    handler.close()
+    assert done.wait(5)
+    # The parent ships its own buffered records; the child only its own
+    assert [d["message"] for d in received] == ["child record"]
@@ -0,0 +1,60 @@
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+import metrics
+from metrics import PrometheusMiddleware, upstream_timer, tenant_tier
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.add_middleware(PrometheusMiddleware)
+
+    @app.get("/items/{item_id}")
+    def item(item_id: str):
+        if item_id == "missing":
+            raise HTTPException(status_code=404)
+        return {"id": item_id}
+    return TestClient(app)
+
+
+def test_requests_are_labeled_by_route_template_and_tier(client, monkeypatch):
+    monkeypatch.setitem(metrics.TENANT_TIERS, "acme", "enterprise")
+    labels = {"method": "GET", "route": "/items/{item_id}", "tenant_tier": "enterprise", "status": "2xx"}
+    before = sample("http_request_duration_seconds_count", **labels)
+    client.get("/items/1", headers={"X-Tenant-ID": "acme"})
+    client.get("/items/2", headers={"X-Tenant-ID": "acme"})
+    assert sample("http_request_duration_seconds_count", **labels) == before + 2
+
+
+def test_errors_and_unmatched_paths_are_counted(client):
+    not_found = {"method": "GET", "route": "/items/{item_id}", "tenant_tier": "standard", "status": "4xx"}
+    unmatched = {"method": "GET", "route": "unmatched", "tenant_tier": "standard", "status": "4xx"}
+    before = sample("http_request_duration_seconds_count", **not_found), sample("http_request_duration_seconds_count", **unmatched)
+    client.get("/items/missing")
+    client.get("/nowhere")
+    assert (sample("http_request_duration_seconds_count", **not_found),
+            sample("http_request_duration_seconds_count", **unmatched)) == (before[0] + 1, before[1] + 1)
+
+
+def test_upstream_timer_records_the_outcome():
+    ok = {"service": "test", "operation": "op", "outcome": "ok"}
+    error = {"service": "test", "operation": "op", "outcome": "error"}
+    before = sample("upstream_request_duration_seconds_count", **ok), sample("upstream_request_duration_seconds_count", **error)
+    with upstream_timer("test", "op"):
+        pass
+    with pytest.raises(RuntimeError):
+        with upstream_timer("test", "op"):
+            raise RuntimeError("upstream down")
+    assert sample("upstream_request_duration_seconds_count", **ok) == before[0] + 1
+    assert sample("upstream_request_duration_seconds_count", **error) == before[1] + 1
+
+
+def test_unknown_tenants_get_the_default_tier():
+    assert tenant_tier("nobody") == metrics.DEFAULT_TENANT_TIER
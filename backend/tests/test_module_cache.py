@@ -0,0 +1,83 @@
+import uuid
+import threading
+
+import fakeredis
+import redis
+
+from module_cache import ModuleCache, REGISTRY_KEY, tenant_key
+
+
+class _DownRedis:
+    """Every Redis call fails as if the server were unreachable."""
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            raise redis.ConnectionError("Connection refused")
+        return call
+
+
+def test_load_locks_stay_bounded():
+    cache = ModuleCache(redis_url="", load_locks=8)
+    for i in range(1000):
+        cache.get(tenant_key(f"tenant-{i}"), list)
+    assert len(cache._load_locks) == 8
+
+
+def test_concurrent_misses_load_once():
+    cache = ModuleCache(redis_url="", load_locks=4)
+    loads, release = [], threading.Event()
+
+    def loader():
+        loads.append(1)
+        release.wait(5)
+        return ["nmap"]
+    threads = [threading.Thread(target=cache.get, args=(tenant_key("acme"), loader)) for _ in range(5)]
+    for t in threads:
+        t.start()
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert loads == [1]
+    assert cache.get(tenant_key("acme"), loader)[0] == ["nmap"]
+
+
+def test_an_unreachable_redis_falls_back_to_the_loader():
+    cache = ModuleCache(redis_url="")
+    cache.redis = _DownRedis()
+    loads = []
+    assert cache.get(tenant_key("acme"), lambda: loads.append(1) or ["nmap"])[0] == ["nmap"]
+    cache.invalidate(tenant_key("acme"))  # logged, not raised: replicas converge within the local TTL
+    assert cache.get(tenant_key("acme"), lambda: loads.append(1) or ["semgrep"])[0] == ["semgrep"]
+    assert cache.warm([tenant_key("acme")], lambda keys: {k: ["nmap"] for k in keys}) == 1
+    assert loads == [1, 1]
+
+
+def test_a_load_racing_an_invalidation_is_not_kept():
+    cache = ModuleCache(redis_url="")
+    cache.redis = fakeredis.FakeRedis()
+
+    def stale_loader():
+        cache.invalidate(tenant_key("acme"))  # a write lands while the old state is being read
+        return ["nmap"]
+    assert cache.get(tenant_key("acme"), stale_loader)[0] == ["nmap"]
+    assert cache.get(tenant_key("acme"), lambda: ["semgrep"])[0] == ["semgrep"]
+    # Another replica reads the new generation, not the value loaded before the write
+    other = ModuleCache(redis_url="")
+    other.redis = cache.redis
+    assert other.get(tenant_key("acme"), lambda: ["other"])[0] == ["semgrep"]
+
+
+def test_pipeline_steps_run_whether_or_not_the_module_is_active(main, monkeypatch):
+    name = f"echo-{uuid.uuid4().hex[:8]}"
+    with main.engine.begin() as conn:
+        conn.execute(main.modules_table.insert().values(name=name, image=f"{name}:latest"))
+    main.module_cache.invalidate(REGISTRY_KEY)
+    monkeypatch.setattr(main, "image_digest", lambda image: None)
+    monkeypatch.setattr(main, "run_step", lambda db, tenant, module_name, config, step_input: {"echo": step_input})
+    db = main.SessionLocal()
+    try:
+        run = main.run_pipeline(db, "acme", str(uuid.uuid4()), [{"module": name, "config": {}}], "hello")
+    finally:
+        db.close()
+    assert run["status"] == "completed"
+    assert run["results"][0]["status"] == "completed" and run["results"][0]["output"] == {"echo": "hello"}
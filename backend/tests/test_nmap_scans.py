@@ -0,0 +1,157 @@
+import os
+import sys
+import uuid
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "nmap"))
+import nmap_scan  # noqa: E402
+
+TENANT = {"X-Tenant-ID": "acme"}
+
+
+# --- Shard planning (module container) ---
+def test_large_networks_are_split_into_subnets():
+    shards = nmap_scan.plan_shards(["10.0.0.0/23", "scanme.nmap.org"], shard_size=256)
+    assert [s["targets"] for s in shards] == [["10.0.0.0/24"], ["10.0.1.0/24"], ["scanme.nmap.org"]]
+
+
+@pytest.mark.parametrize("shard_size", [0, -1])
+def test_shard_size_must_be_positive(shard_size):
+    with pytest.raises(ValueError):
+        nmap_scan.plan_shards(["10.0.0.1"], shard_size)
+
+
+def test_workers_are_clamped_in_the_container(monkeypatch):
+    pools = []
+    real = nmap_scan.ThreadPoolExecutor
+    monkeypatch.setattr(nmap_scan, "ThreadPoolExecutor", lambda max_workers: pools.append(max_workers) or real(max_workers))
+    monkeypatch.setattr(nmap_scan, "run_shard", lambda shard, *args: {"index": shard["index"], "status": "done", "stdout": ""})
+    nmap_scan.run_scan({"targets": ["10.0.0.0/22"], "shard_size": 1, "workers": 10 ** 6})
+    assert pools == [nmap_scan.MAX_WORKERS]
+
+
+def test_huge_networks_are_refused_instead_of_expanded():
+    with pytest.raises(ValueError, match="addresses"):
+        nmap_scan.plan_shards(["2001:db8::/64"], shard_size=256)
+    assert "error" in nmap_scan.run_scan({"targets": ["10.0.0.0/8"], "shard_size": 256})
+
+
+# --- Endpoints ---
+def _add_scan(main, result, tenant="acme"):
+    scan_id = str(uuid.uuid4())
+    with main.engine.begin() as conn:
+        conn.execute(main.nmap_results_table.insert().values(
+            scan_id=scan_id, tenant_id=tenant, targets=["10.0.0.1", "10.0.0.2"], options="-sV",
+            result=result, timestamp=datetime.utcnow().isoformat()))
+    return scan_id
+
+
+@pytest.fixture
+def submitted(main, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "submit_scan_job", lambda fn, *args, **kwargs: calls.append(args))
+    return calls
+
+
+def test_shard_reports_are_merged_and_params_kept(client):
+    response = client.post("/modules/nmap/scan", headers=TENANT,
+                           json={"targets": ["10.0.0.1", "10.0.0.2"], "shard_size": 1, "workers": 2})
+    body = response.json()
+    assert response.status_code == 200 and body["result"]["status"] == "completed"
+    assert body["result"]["params"] == {"shard_size": 1, "workers": 2}
+    raw = client.get(f"/modules/nmap/results/{body['scan_id']}/raw", headers=TENANT).json()
+    assert 'addr="10.0.0.1"' in raw["stdout"] and 'addr="10.0.0.2"' in raw["stdout"]
+
+
+@pytest.mark.parametrize("field", ["shard_size", "workers", "shard_timeout"])
+def test_non_positive_shard_settings_are_rejected(client, field):
+    response = client.post("/modules/nmap/scan", headers=TENANT, json={"targets": ["10.0.0.1"], field: 0})
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize("field, value", [("shard_size", 65537), ("workers", 65), ("shard_timeout", 10 ** 6)])
+def test_oversized_shard_settings_are_rejected(client, field, value):
+    response = client.post("/modules/nmap/scan", headers=TENANT, json={"targets": ["10.0.0.1"], field: value})
+    assert response.status_code == 422
+
+
+def test_synchronous_scans_use_the_short_timeout(client, main, monkeypatch):
+    monkeypatch.setattr(main, "NMAP_SYNC_TIMEOUT", 0.1)
+    result = client.post("/modules/nmap/scan", headers=TENANT, json={"targets": ["10.0.0.1"]}).json()["result"]
+    assert result["status"] == "failed" and "timed out" in result["error"]
+
+
+def test_retry_reuses_the_original_shard_settings(client, main, submitted):
+    scan_id = _add_scan(main, {"status": "partial", "params": {"shard_size": 1, "shard_timeout": 30}, "shards": [
+        {"index": 0, "targets": ["10.0.0.1"], "status": "done"},
+        {"index": 1, "targets": ["10.0.0.2"], "status": "failed"}]})
+    response = client.post(f"/modules/nmap/results/{scan_id}/retry", headers=TENANT)
+    assert response.json()["result"] == {"status": "queued", "retrying_shards": [1]}
+    (_, _, scan_request, previous), = submitted
+    assert scan_request["shard_size"] == 1 and scan_request["shard_timeout"] == 30
+    assert scan_request["shards"] == [{"index": 1, "targets": ["10.0.0.2"]}] and previous["status"] == "partial"
+
+
+def test_a_scan_is_retried_only_once_at_a_time(client, main, submitted):
+    scan_id = _add_scan(main, {"status": "failed", "shards": [{"index": 0, "targets": ["10.0.0.1"], "status": "failed"}]})
+    assert client.post(f"/modules/nmap/results/{scan_id}/retry", headers=TENANT).status_code == 200
+    assert client.post(f"/modules/nmap/results/{scan_id}/retry", headers=TENANT).status_code == 409
+    assert len(submitted) == 1
+
+
+@pytest.mark.parametrize("status", ["queued", "running"])
+def test_running_scans_are_not_retried(client, main, submitted, status):
+    scan_id = _add_scan(main, {"status": status, "shards": [{"index": 0, "targets": ["10.0.0.1"], "status": "failed"}]})
+    assert client.post(f"/modules/nmap/results/{scan_id}/retry", headers=TENANT).status_code == 409
+    assert submitted == []
+
+
+def test_interrupted_scans_continue_after_their_completed_shards(client, main, submitted):
+    scan_id = _add_scan(main, {"status": "interrupted", "params": {"shard_size": 1}, "shards": [
+        {"index": 0, "targets": ["10.0.0.1"], "status": "done"}]})
+    response = client.post(f"/modules/nmap/results/{scan_id}/retry", headers=TENANT)
+    assert response.status_code == 200 and response.json()["result"]["status"] == "queued"
+    (_, _, scan_request, previous), = submitted
+    assert scan_request["targets"] == ["10.0.0.1", "10.0.0.2"] and scan_request["skip_shards"] == [0]
+    assert scan_request["shard_size"] == 1 and previous["shards"][0]["status"] == "done"
+
+
+def test_a_handed_off_scan_is_not_resumed_after_a_manual_retry(client, main, submitted):
+    scan_id = _add_scan(main, {"status": "interrupted", "shards": []})
+    payload = {"scan_id": scan_id, "scan_request": {"targets": ["10.0.0.1"]}, "previous": {"status": "interrupted"}}
+    assert client.post(f"/modules/nmap/results/{scan_id}/retry", headers=TENANT).status_code == 200
+    main.resume_nmap_job("handoff-1", "acme", payload)
+    assert len(submitted) == 1
+
+
+def test_queued_scans_handed_off_at_shutdown_can_be_resumed(main, submitted, monkeypatch):
+    scan_id = _add_scan(main, {"status": "queued", "params": {"workers": 2}})
+    handed_off = []
+    monkeypatch.setattr(main.handoffs, "put", lambda kind, tenant, payload: handed_off.append(payload))
+    main.handoff_nmap_job(scan_id, "acme", {"targets": ["10.0.0.1"], "workers": 2})
+    (payload,) = handed_off
+    main.resume_nmap_job("handoff-1", "acme", payload)
+    (resumed_id, _, scan_request, _), = submitted
+    assert resumed_id == scan_id and scan_request["workers"] == 2
+
+
+def test_a_scan_whose_resuming_instance_died_is_taken_over_by_its_handoff(main, submitted):
+    payload = {"scan_id": None, "scan_request": {"targets": ["10.0.0.1", "10.0.0.2"], "skip_shards": [0]},
+               "previous": {"status": "interrupted", "raw_blob": "acme/nmap/1"}}
+    scan_id = payload["scan_id"] = _add_scan(main, {"status": "interrupted", "shards": [
+        {"index": 0, "targets": ["10.0.0.1"], "status": "done"}]})
+    main.resume_nmap_job("handoff-1", "acme", payload)
+    # The instance running it finished shard 1, then died
+    with main.engine.begin() as conn:
+        conn.execute(main.nmap_results_table.update().where(main.nmap_results_table.c.scan_id == scan_id).values(
+            result={"status": "running", "handoff": "handoff-1", "findings": 2, "shards": [
+                {"index": 0, "targets": ["10.0.0.1"], "status": "done"},
+                {"index": 1, "targets": ["10.0.0.2"], "status": "done"}]}))
+    main.resume_nmap_job("handoff-2", "acme", payload)  # another handoff of the same scan
+    main.resume_nmap_job("handoff-1", "acme", payload)
+    assert len(submitted) == 2
+    (_, _, scan_request, previous) = submitted[1]
+    assert scan_request["skip_shards"] == [0, 1] and previous["findings"] == 2 and previous["raw_blob"] == "acme/nmap/1"
+    assert previous["status"] == "queued" and previous["handoff"] == "handoff-1"
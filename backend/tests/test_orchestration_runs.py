@@ -0,0 +1,205 @@
+import uuid
+
+import pytest
+import requests
+
+from module_cache import REGISTRY_KEY
+
+TENANT = {"X-Tenant-ID": "acme"}
+
+
+class _Response:
+    def __init__(self, body, status=200):
+        self.body, self.status_code = body, status
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} from module")
+
+    def json(self):
+        return self.body
+
+
+def _register(main, name=None):
+    name = name or f"echo-{uuid.uuid4().hex[:8]}"
+    with main.engine.begin() as conn:
+        if not conn.execute(main.modules_table.select().where(main.modules_table.c.name == name)).fetchone():
+            conn.execute(main.modules_table.insert().values(name=name, image=f"{name}-module"))
+    main.module_cache.invalidate(REGISTRY_KEY)
+    return name
+
+
+def _orchestration(client, *modules, **configs):
+    pipeline = [{"module": m, "config": configs.get(m.split("-")[0], {})} for m in modules]
+    return client.post("/orchestrations", headers=TENANT, json={"name": "p", "pipeline": pipeline}).json()["id"]
+
+
+@pytest.fixture
+def inline(main, monkeypatch):
+    """Runs background jobs right away instead of on the scan pool."""
+    monkeypatch.setattr(main, "submit_scan_job", lambda fn, *args, **kwargs: fn(*args))
+    monkeypatch.setattr(main, "image_digest", lambda image: None)
+
+
+@pytest.fixture
+def module_service(main, monkeypatch):
+    """Stands in for activated module containers: records each call and answers with handler(url, body)."""
+    calls = []
+    service = {"handler": lambda url, body: {"seen": body["input"]}}
+
+    def post(url, json=None, **kwargs):
+        calls.append((url, json))
+        return service["handler"](url, json)
+    monkeypatch.setattr(main.requests, "post", post)
+    service["calls"] = calls
+    return service
+
+
+def _run(client, orchestration_id, **body):
+    started = client.post(f"/orchestrations/{orchestration_id}/trigger", headers=TENANT, json=body).json()
+    assert started["status"] == "queued"
+    return client.get(f"/orchestrations/{orchestration_id}/runs/{started['run_id']}", headers=TENANT).json()
+
+
+def test_steps_call_the_module_service_and_the_run_is_polled(client, main, inline, module_service):
+    first, second = _register(main), _register(main)
+    module_service["handler"] = lambda url, body: _Response({"step": url, "seen": body["input"]})
+    run = _run(client, _orchestration(client, first, second), input={"hosts": 2})
+    assert run["status"] == "completed"
+    assert [url for url, _ in module_service["calls"]] == [f"http://acme-{first}:8000/run", f"http://acme-{second}:8000/run"]
+    assert module_service["calls"][1][1]["input"] == {"step": f"http://acme-{first}:8000/run", "seen": {"hosts": 2}}
+    assert [s["status"] for s in run["results"]] == ["completed", "completed"]
+
+
+def test_an_unreachable_module_fails_its_step_and_skips_the_rest(client, main, inline, module_service):
+    first, second = _register(main), _register(main)
+
+    def handler(url, body):
+        raise requests.ConnectionError(f"cannot reach {url}")
+    module_service["handler"] = handler
+    run = _run(client, _orchestration(client, first, second))
+    assert run["status"] == "failed"
+    assert run["results"][0]["status"] == "failed" and "cannot reach" in run["results"][0]["error"]
+    assert run["results"][1] == {"module": second, "status": "not_run"}
+
+
+def test_a_module_error_response_fails_the_step(client, main, inline, module_service):
+    module_service["handler"] = lambda url, body: _Response({"detail": "boom"}, status=500)
+    run = _run(client, _orchestration(client, _register(main)))
+    assert run["status"] == "failed" and "500" in run["results"][0]["error"]
+
+
+def test_scan_steps_need_targets(client, main, inline, module_service):
+    _register(main, "nmap")
+    run = _run(client, _orchestration(client, "nmap"))
+    assert run["status"] == "failed" and "needs targets" in run["results"][0]["error"]
+    assert module_service["calls"] == []
+
+
+def test_nmap_steps_run_like_the_scan_endpoint(client, main, inline, module_service):
+    _register(main, "nmap")
+    run = _run(client, _orchestration(client, "nmap", nmap={"targets": ["10.0.0.1"]}))
+    assert run["status"] == "completed"
+    output = run["results"][0]["output"]
+    assert output["status"] == "completed" and output["targets"] == ["10.0.0.1"]
+    assert client.get(f"/modules/nmap/results/{output['scan_id']}", headers=TENANT).json()["result"]["status"] == "completed"
+    assert module_service["calls"] == []
+
+
+def test_an_interrupted_run_is_handed_off_and_resumes_after_its_completed_steps(client, main, inline, monkeypatch):
+    first, second = _register(main), _register(main)
+    ran, handed_off = [], []
+
+    def run_step(db, tenant, module_name, config, step_input):
+        ran.append(module_name)
+        if module_name == second and len(ran) == 2:
+            raise main.Interrupted("shutting down")
+        return {"after": module_name}
+    monkeypatch.setattr(main, "run_step", run_step)
+    monkeypatch.setattr(main.handoffs, "put", lambda kind, tenant, payload: handed_off.append((kind, tenant, payload)))
+    orchestration_id = _orchestration(client, first, second)
+    run = _run(client, orchestration_id, input={"x": 1})
+    assert run["status"] == "interrupted" and [s["status"] for s in run["results"]] == ["completed"]
+    (kind, tenant, payload), = handed_off
+    assert kind == "orchestration_run" and payload["run_id"] == run["id"] and payload["input"] == {"x": 1}
+
+    main.resume_orchestration_run("handoff-1", tenant, payload)
+    resumed = client.get(f"/orchestrations/{orchestration_id}/runs/{run['id']}", headers=TENANT).json()
+    assert resumed["status"] == "completed" and ran == [first, second, second]
+    assert resumed["results"][1]["output"] == {"after": second}
+
+
+def _add_run(main, status, **values):
+    run_id = str(uuid.uuid4())
+    now = main.datetime.utcnow()
+    with main.engine.begin() as conn:
+        conn.execute(main.orchestration_runs_table.insert().values(
+            id=run_id, tenant_id="acme", orchestration_id="orch-1", status=status, input={}, options={}, results=[],
+            created_at=now, updated_at=now, **values))
+    return run_id
+
+
+def test_a_handed_off_run_is_resumed_by_one_handoff_only(main, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(main, "submit_scan_job", lambda fn, *args, **kwargs: submitted.append(args))
+    run_id = _add_run(main, "queued")
+    monkeypatch.setattr(main.handoffs, "put", lambda kind, tenant, payload: None)
+    main.handoff_orchestration_run(run_id, "acme", "orch-1", [], {}, {})
+    payload = {"run_id": run_id, "orchestration_id": "orch-1", "pipeline": [], "input": {}, "options": {}}
+    main.resume_orchestration_run("handoff-1", "acme", payload)
+    main.resume_orchestration_run("handoff-2", "acme", payload)
+    assert len(submitted) == 1
+
+
+def test_a_run_whose_resuming_instance_died_is_taken_over_by_its_handoff(main, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(main, "submit_scan_job", lambda fn, *args, **kwargs: submitted.append(args))
+    run_id = _add_run(main, "running", handoff_id="handoff-1")
+    payload = {"run_id": run_id, "orchestration_id": "orch-1", "pipeline": [], "input": {}, "options": {}}
+    main.resume_orchestration_run("handoff-2", "acme", payload)
+    assert submitted == []
+    main.resume_orchestration_run("handoff-1", "acme", payload)
+    assert [args[0] for args in submitted] == [run_id]
+
+
+def test_steps_of_modules_deregistered_since_the_run_was_queued_fail(main, module_service):
+    kept, gone = _register(main), f"gone-{uuid.uuid4().hex[:8]}"
+    db = main.SessionLocal()
+    try:
+        run = main.run_pipeline(db, "acme", "orch-1", [{"module": gone}, {"module": kept}], {})
+    finally:
+        db.close()
+    assert run["status"] == "failed" and [r["status"] for r in run["results"]] == ["failed", "not_run"]
+    assert run["results"][0]["error"] == f"module {gone} is not registered" and module_service["calls"] == []
+
+
+def test_queued_runs_are_handed_off_at_shutdown(main, monkeypatch):
+    handed_off = []
+    monkeypatch.setattr(main, "handoff_orchestration_run", lambda *args: handed_off.append(args))
+    monkeypatch.setattr(main, "_queued_scan_jobs", {})
+    gate = main.threading.Event()
+    busy = [main.scan_executor.submit(gate.wait, 5) for _ in range(main.SCAN_JOB_WORKERS)]
+    try:
+        queued = main.submit_scan_job(main._run_orchestration, "run-1", "acme", "orch-1", [], {}, {})
+        (handoff, args), = main._queued_scan_jobs.values()
+        handoff(*args)
+        assert handed_off == [("run-1", "acme", "orch-1", [], {}, {})]
+        assert queued.cancel()
+    finally:
+        gate.set()
+        for future in busy:
+            future.result(5)
+
+
+def test_runs_of_other_tenants_are_not_found(client, main, inline, module_service):
+    orchestration_id = _orchestration(client, _register(main))
+    run_id = client.post(f"/orchestrations/{orchestration_id}/trigger", headers=TENANT).json()["run_id"]
+    assert client.get(f"/orchestrations/{orchestration_id}/runs/{run_id}", headers={"X-Tenant-ID": "other"}).status_code == 404
+    assert client.get(f"/orchestrations/{orchestration_id}/runs", headers={"X-Tenant-ID": "other"}).json() == []
+    assert [r["id"] for r in client.get(f"/orchestrations/{orchestration_id}/runs", headers=TENANT).json()] == [run_id]
+
+
+def test_step_cache_stats_are_admin_only(client, user):
+    assert client.get("/orchestrations/step-cache").status_code == 403
+    user["realm_access"] = {"roles": ["platform-admin"]}
+    assert client.get("/orchestrations/step-cache").status_code == 200
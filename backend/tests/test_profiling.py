@@ -0,0 +1,91 @@
+import time
+
+import pytest
+from fastapi import FastAPI, WebSocket
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from profiling import Profiler, ProfilingMiddleware
+
+
+def _app(**settings):
+    """An app of its own with slow-request watching, so the captures are only these tests'."""
+    settings = dict({"slow_ms": 50, "interval_ms": 1, "redis_url": ""}, **settings)
+    profiler = Profiler(**settings)
+    app = FastAPI()
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
+    @app.get("/slow")
+    @app.get("/exports/slow")
+    def slow(seconds: float = 0.1):
+        time.sleep(seconds)
+        return {}
+
+    @app.get("/fast")
+    def fast():
+        return {}
+
+    @app.get("/live/events")
+    @app.get("/stream")
+    def stream():
+        def events():
+            time.sleep(0.1)
+            yield "data: {}\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.websocket("/live/ws")
+    async def ws(websocket: WebSocket):
+        await websocket.accept()
+        time.sleep(0.1)
+        await websocket.close()
+    return profiler, TestClient(app)
+
+
+def _captures(profiler, expected):
+    """Captures are stored off the event loop; waits for (at least) the expected number of them."""
+    deadline = time.monotonic() + 2
+    while len(profiler.captures()) < expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return profiler.captures()
+
+
+def test_only_slow_requests_are_captured():
+    profiler, client = _app()
+    client.get("/fast")
+    client.get("/slow")
+    capture, = _captures(profiler, 1)
+    assert capture["trigger"] == "slow" and capture["route"] == "/slow" and capture["samples"] > 0
+    assert not capture["sampling_capped"]
+
+
+@pytest.mark.parametrize("path", ["/live/events", "/stream"])
+def test_event_streams_are_not_watched(path):
+    profiler, client = _app()
+    assert client.get(path).headers["content-type"].startswith("text/event-stream")
+    client.get("/slow")
+    assert [c["route"] for c in _captures(profiler, 1)] == ["/slow"]
+    assert profiler._active == {}
+
+
+def test_excluded_paths_are_not_watched_at_all():
+    profiler, client = _app(slow_exclude="/exports/")
+    client.get("/exports/slow")
+    client.get("/slow")
+    assert [c["path"] for c in _captures(profiler, 1)] == ["/slow"] and profiler._active == {}
+
+
+def test_websockets_pass_through():
+    profiler, client = _app()
+    with client.websocket_connect("/live/ws"):
+        pass
+    client.get("/slow")
+    assert [c["path"] for c in _captures(profiler, 1)] == ["/slow"]
+
+
+def test_sampling_stops_at_the_cap():
+    profiler, client = _app(slow_ms=10, max_sample_ms=20)
+    client.get("/slow", params={"seconds": 0.3})
+    capture, = _captures(profiler, 1)
+    assert capture["sampling_capped"] and 0 < capture["samples"] <= 25
+    # The sampler went back to sleep instead of polling the finished window
+    assert profiler._next_wake == float("inf")
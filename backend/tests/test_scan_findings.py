@@ -0,0 +1,140 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+import scan_findings
+from scan_findings import normalize_output, parse_nmap_xml, load_raw_output, store_raw_output
+
+NMAP_XML = """<?xml version="1.0"?>
+<nmaprun><host><status state="up"/><address addr="10.0.0.5" addrtype="ipv4"/>
+<ports><port protocol="tcp" portid="22"><state state="open"/><service name="ssh" product="OpenSSH" version="9.6"/></port>
+<port protocol="tcp" portid="80"><state state="closed"/></port></ports></host></nmaprun>"""
+
+
+@pytest.fixture
+def blob_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(scan_findings, "SCAN_BLOB_DIR", str(tmp_path / "blobs"))
+    return tmp_path / "blobs"
+
+
+def test_nmap_ports_become_findings():
+    findings = parse_nmap_xml(NMAP_XML)
+    assert [(f["host"], f["port"], f["state"]) for f in findings] == [("10.0.0.5", 22, "open"), ("10.0.0.5", 80, "closed")]
+    assert findings[0]["message"] == "OpenSSH 9.6"
+
+
+def test_fingerprints_are_stable_and_content_hashes_track_changes():
+    first, _ = normalize_output("nmap", {"stdout": NMAP_XML})
+    again, _ = normalize_output("nmap", {"stdout": NMAP_XML})
+    changed, _ = normalize_output("nmap", {"stdout": NMAP_XML.replace('state="closed"', 'state="open"')})
+    assert [f["fingerprint"] for f in first] == [f["fingerprint"] for f in again] == [f["fingerprint"] for f in changed]
+    assert first[1]["content_hash"] != changed[1]["content_hash"]
+
+
+def test_unparseable_output_is_reported_not_raised():
+    findings, error = normalize_output("nmap", {"stdout": "<nmaprun><host>"})
+    assert findings == [] and error.startswith("ParseError")
+
+
+def test_raw_output_round_trips(blob_dir):
+    scan_id = str(uuid.uuid4())
+    path = store_raw_output("acme", "nmap", scan_id, {"stdout": NMAP_XML})
+    assert path.startswith(str(blob_dir))
+    assert load_raw_output("acme", "nmap", scan_id) == {"stdout": NMAP_XML}
+
+
+@pytest.mark.parametrize("tenant, module, scan_id", [
+    ("..", "nmap", str(uuid.uuid4())),
+    ("../../etc", "nmap", str(uuid.uuid4())),
+    ("acme/other", "nmap", str(uuid.uuid4())),
+    ("acme", "../nmap", str(uuid.uuid4())),
+    ("acme", "nmap", "../../other/nmap/x"),
+    ("acme", "nmap", "not-a-uuid"),
+])
+def test_blob_paths_cannot_leave_the_blob_dir(blob_dir, tenant, module, scan_id):
+    with pytest.raises(ValueError):
+        load_raw_output(tenant, module, scan_id)
+    with pytest.raises(ValueError):
+        store_raw_output(tenant, module, scan_id, {"stdout": ""})
+
+
+# --- /raw endpoints ---
+def _add_scan(main, tenant, output):
+    scan_id = str(uuid.uuid4())
+    with main.engine.begin() as conn:
+        conn.execute(main.nmap_results_table.insert().values(
+            scan_id=scan_id, tenant_id=tenant, targets=["10.0.0.5"], options="-sV",
+            result={"status": "completed"}, timestamp=datetime.utcnow().isoformat()))
+    store_raw_output(tenant, "nmap", scan_id, output)
+    return scan_id
+
+
+def test_raw_output_is_served_to_the_owning_tenant(client, main):
+    scan_id = _add_scan(main, "acme", {"stdout": NMAP_XML})
+    response = client.get(f"/modules/nmap/results/{scan_id}/raw", headers={"X-Tenant-ID": "acme"})
+    assert response.status_code == 200 and response.json()["stdout"] == NMAP_XML
+
+
+def test_raw_output_of_another_tenant_is_not_found(client, main):
+    scan_id = _add_scan(main, "acme", {"stdout": NMAP_XML})
+    assert client.get(f"/modules/nmap/results/{scan_id}/raw", headers={"X-Tenant-ID": "globex"}).status_code == 404
+
+
+def test_traversal_through_the_tenant_header_is_not_found(client, main):
+    scan_id = _add_scan(main, "acme", {"stdout": NMAP_XML})
+    response = client.get(f"/modules/nmap/results/{scan_id}/raw", headers={"X-Tenant-ID": "globex/../acme"})
+    assert response.status_code == 404
+
+
+def test_raw_output_of_a_compacted_scan_comes_from_the_kept_scan(client, main, user):
+    user["realm_access"] = {"roles": ["platform-admin"]}
+    headers = {"X-Tenant-ID": "initech"}
+    kept, compacted = _add_scan(main, "initech", {"stdout": NMAP_XML}), _add_scan(main, "initech", {"stdout": NMAP_XML})
+    with main.engine.begin() as conn:
+        for scan_id, day in ((kept, 1), (compacted, 2)):
+            conn.execute(main.nmap_results_table.update().where(main.nmap_results_table.c.scan_id == scan_id).values(
+                timestamp=datetime(2020, 1, day).isoformat()))
+    assert client.post("/findings/compact?retention_days=1", headers=headers).json()["compacted"]["nmap"] == 1
+    assert load_raw_output("initech", "nmap", compacted) is None
+    raw = client.get(f"/modules/nmap/results/{compacted}/raw", headers=headers).json()
+    assert raw == {"stdout": NMAP_XML, "compacted_into": kept}
+    assert "compacted_into" not in client.get(f"/modules/nmap/results/{kept}/raw", headers=headers).json()
+
+
+def test_compaction_is_admin_only_and_keeps_at_least_a_day(client, user):
+    assert client.post("/findings/compact", headers={"X-Tenant-ID": "initech"}).status_code == 403
+    user["realm_access"] = {"roles": ["platform-admin"]}
+    for days in (0, -1):
+        assert client.post(f"/findings/compact?retention_days={days}", headers={"X-Tenant-ID": "initech"}).status_code == 422
+
+
+# --- Diffs ---
+def _add_scan_with_findings(main, tenant, xml):
+    scan_id = _add_scan(main, tenant, {"stdout": xml})
+    findings, _ = normalize_output("nmap", {"stdout": xml})
+    db = main.SessionLocal()
+    try:
+        main._insert_findings(db, "nmap", scan_id, tenant, "10.0.0.5", findings)
+        db.commit()
+    finally:
+        db.close()
+    return scan_id
+
+
+def test_diffs_report_added_removed_and_changed_findings(client, main):
+    before = _add_scan_with_findings(main, "acme", NMAP_XML)
+    after = _add_scan_with_findings(main, "acme", NMAP_XML.replace('version="9.6"', 'version="9.7"').replace(
+        'portid="80"', 'portid="443"'))
+    diff = client.get(f"/modules/nmap/results/{after}/diff", params={"against": before}, headers={"X-Tenant-ID": "acme"}).json()
+    assert [f["port"] for f in diff["added"]] == [443] and [f["port"] for f in diff["removed"]] == [80]
+    (changed,) = diff["changed"]
+    assert changed["before"] == {"message": "OpenSSH 9.6"} and changed["after"] == {"message": "OpenSSH 9.7"}
+
+
+def test_diffs_against_scans_of_other_tenants_or_unknown_scans_are_not_found(client, main):
+    ours, theirs = _add_scan_with_findings(main, "acme", NMAP_XML), _add_scan_with_findings(main, "globex", NMAP_XML)
+    for against in (theirs, "no-such-scan"):
+        response = client.get(f"/modules/nmap/results/{ours}/diff", params={"against": against}, headers={"X-Tenant-ID": "acme"})
+        assert response.status_code == 404 and against in response.json()["detail"]
+    assert client.get(f"/modules/nmap/results/{ours}/diff", headers={"X-Tenant-ID": "acme"}).status_code == 422
@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "semgrep"))
+import semgrep_scan  # noqa: E402
+
+
+@pytest.fixture
+def semgrep(monkeypatch):
+    """Stands in for the semgrep CLI: one finding per scanned file, with its path in nested fields too."""
+    runs = []
+
+    def run(cmd, **kwargs):
+        runs.append(cmd)
+        files = cmd[cmd.index("--config") + 2:]
+        results = [{"check_id": "rule", "path": path, "start": {"line": 1},
+                    "extra": {"dataflow_trace": {"taint_source": {"location": {"path": path}}}}} for path in files]
+        return subprocess.CompletedProcess(cmd, 0, json.dumps({"results": results, "errors": []}), "")
+    monkeypatch.setattr(semgrep_scan.subprocess, "run", run)
+    monkeypatch.setattr(semgrep_scan, "RULES_DIR", "/nonexistent")
+    return runs
+
+
+def _scan(target, cache_dir, rules="p/default"):
+    output = semgrep_scan.incremental_scan(str(target), rules, str(cache_dir))
+    return json.loads(output["stdout"])
+
+
+def _scanned(runs):
+    return sorted(os.path.basename(p) for cmd in runs for p in cmd[cmd.index("--config") + 2:])
+
+
+def test_same_content_under_another_name_is_scanned(tmp_path, semgrep):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.py").write_text("eval(x)\n")
+    _scan(src, tmp_path / "cache")
+    (src / "a.js").write_text("eval(x)\n")
+    report = _scan(src, tmp_path / "cache")
+    assert _scanned(semgrep[1:]) == ["a.js"]
+    assert sorted(r["path"] for r in report["results"]) == [str(src / "a.js"), str(src / "a.py")]
+
+
+def test_cached_findings_get_the_current_path_everywhere(tmp_path, semgrep):
+    first, second = tmp_path / "checkout-1", tmp_path / "checkout-2"
+    for checkout in (first, second):
+        (checkout / "pkg").mkdir(parents=True)
+        (checkout / "pkg" / "app.py").write_text("eval(x)\n")
+    _scan(first, tmp_path / "cache")
+    report = _scan(second, tmp_path / "cache")
+    assert report["incremental"]["cached"] == 1 and len(semgrep) == 1
+    result, = report["results"]
+    path = str(second / "pkg" / "app.py")
+    assert result["path"] == path
+    assert result["extra"]["dataflow_trace"]["taint_source"]["location"]["path"] == path
+
+
+def test_files_semgrep_failed_on_are_rescanned_next_time(tmp_path, semgrep, monkeypatch):
+    src = tmp_path / "src"
+    src.mkdir()
+    for name in ("ok.py", "broken.py", "other.py"):
+        (src / name).write_text(f"# {name}\n")
+    broken = str(src / "broken.py")
+
+    def run(cmd, **kwargs):
+        semgrep.append(cmd)
+        files = cmd[cmd.index("--config") + 2:]
+        if str(src / "other.py") in files:
+            return subprocess.CompletedProcess(cmd, 2, "Traceback (most recent call last)", "crashed")
+        report = {"results": [], "errors": [{"path": broken, "message": "Syntax error"}] if broken in files else []}
+        return subprocess.CompletedProcess(cmd, 1 if broken in files else 0, json.dumps(report), "")
+    monkeypatch.setattr(semgrep_scan.subprocess, "run", run)
+    monkeypatch.setattr(semgrep_scan, "FILES_PER_RUN", 2)
+    output = semgrep_scan.incremental_scan(str(src), "p/default", str(tmp_path / "cache"))
+    assert output["returncode"] == 2 and json.loads(output["stdout"])["errors"][0]["path"] == broken
+    semgrep.clear()
+    _scan(src, tmp_path / "cache")
+    # ok.py was cached; the file with an error and the batch whose output could not be read were not
+    assert _scanned(semgrep) == ["broken.py", "other.py"]
+
+
+def test_a_changed_ruleset_rescans_everything(tmp_path, semgrep):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.py").write_text("eval(x)\n")
+    _scan(src, tmp_path / "cache", rules="p/default")
+    report = _scan(src, tmp_path / "cache", rules="p/secrets")
+    assert report["incremental"]["cached"] == 0 and len(semgrep) == 2
+
+
+def test_semgrepignore_is_applied_to_listed_files(tmp_path):
+    (tmp_path / "tests").mkdir()
+    (tmp_path / "src" / "gen").mkdir(parents=True)
+    for name in ("tests/test_a.py", "src/app.py", "src/app.min.js", "src/gen/out.py", "src/keep.min.js", ".gitignore"):
+        (tmp_path / name).write_text("x\n")
+    (tmp_path / ".gitignore").write_text("src/gen/\n")
+    (tmp_path / ".semgrepignore").write_text("# comment\ntests/\n*.min.js\n!keep.min.js\n:include .gitignore\n")
+    listed = [os.path.relpath(p, tmp_path) for p in semgrep_scan.list_files(str(tmp_path))]
+    assert sorted(listed) == [".gitignore", ".semgrepignore", "src/app.py", "src/keep.min.js"]
+
+
+@pytest.mark.parametrize("rules, metrics_off", [("auto", False), ("p/default", True), ("/rules/custom.yml", True)])
+def test_metrics_are_only_disabled_when_semgrep_allows_it(rules, metrics_off):
+    assert ("--metrics=off" in semgrep_scan.semgrep_command(rules, ["/src"])) == metrics_off
@@ -0,0 +1,125 @@
+import pytest
+
+import tenant_provisioning
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    conn = FakeConnection()
+    monkeypatch.setattr(tenant_provisioning, "execute_values",
+                        lambda cur, sql, rows: cur.statements.append((" ".join(sql.split()), rows)))
+    return conn
+
+
+def rows_for(conn, table):
+    return [rows for sql, rows in conn.statements if sql.startswith(f"INSERT INTO {table} ")]
+
+
+MANIFEST = {
+    "tenant_id": "acme",
+    "modules": [{"name": "nmap", "config": {"a": 1}}, {"name": "nmap", "config": {"a": 2}}],
+    "providers": [{"name": "OpenAI"}, {"name": "OpenAI"}],
+    "orchestrations": [{"name": "p", "pipeline": []}, {"name": "p", "pipeline": [{"module": "nmap"}]}],
+    "usage_metrics": [{"metric_name": "api_requests", "value": 1}, {"metric_name": "api_requests", "value": 2}],
+    "audit_events": [{"user_id": "admin", "action": "seed", "details": {}}] * 2,
+}
+
+
+def test_duplicate_names_in_a_batch_are_collapsed_to_the_last(conn):
+    tenant_provisioning.apply_manifest(conn, MANIFEST)
+    [modules] = rows_for(conn, "tenant_modules")
+    assert len(modules) == 1 and modules[0][2].adapted == {"a": 2}
+    for table in ("providers", "module_orchestrations", "usage_metrics"):
+        [rows] = rows_for(conn, table)
+        assert len(rows) == 1, table
+    [metrics] = rows_for(conn, "usage_metrics")
+    assert metrics[0][3].adapted == 2
+    [events] = rows_for(conn, "audit_log")
+    assert [e[3] for e in events] == ["seed", "tenant_provisioned"]
+
+
+def test_rerunning_a_manifest_writes_the_same_ids(conn):
+    tenant_provisioning.apply_manifest(conn, MANIFEST)
+    tenant_provisioning.apply_manifest(conn, MANIFEST)
+    for table in ("providers", "module_orchestrations", "usage_metrics", "audit_log"):
+        first, second = rows_for(conn, table)
+        assert [r[0] for r in first] == [r[0] for r in second], table
+
+
+def test_audit_events_skip_ids_already_logged(conn):
+    tenant_provisioning.apply_manifest(conn, MANIFEST)
+    [sql] = [sql for sql, _ in conn.statements if sql.startswith("INSERT INTO audit_log ")]
+    assert "WHERE NOT EXISTS (SELECT 1 FROM audit_log a WHERE a.id = v.id)" in sql
+
+
+def test_ids_differ_per_tenant():
+    assert tenant_provisioning.stable_id("a", "provider", "x") != tenant_provisioning.stable_id("b", "provider", "x")
+
+
+class FakePool:
+    def __init__(self, *args):
+        self.connections = []
+
+    def getconn(self):
+        conn = FakeConnection()
+        conn.rolled_back = False
+        conn.rollback = lambda: setattr(conn, "rolled_back", True)
+        self.connections.append(conn)
+        return conn
+
+    def putconn(self, conn):
+        pass
+
+    def closeall(self):
+        pass
+
+
+def test_a_failing_tenant_is_rolled_back_and_reported_without_stopping_the_others(monkeypatch):
+    pools, written = [], []
+
+    def apply(conn, manifest):
+        conn.tenant = manifest["tenant_id"]
+        if manifest["tenant_id"] == "broken":
+            raise ValueError("duplicate key")
+    monkeypatch.setattr(tenant_provisioning.psycopg2, "connect", lambda url: FakeConnection())
+    monkeypatch.setattr(tenant_provisioning, "ThreadedConnectionPool", lambda *args: pools.append(FakePool()) or pools[-1])
+    monkeypatch.setattr(tenant_provisioning, "upsert_module_registry", lambda conn, manifests: None)
+    monkeypatch.setattr(tenant_provisioning, "apply_manifest", apply)
+    monkeypatch.setattr(tenant_provisioning, "_write_secret", lambda path, secret: written.append(path))
+    manifests = [{"tenant_id": t, "providers": [{"name": "OpenAI", "config": {"api_key": "k"}}]} for t in ("acme", "broken")]
+    results = tenant_provisioning.provision_tenants(manifests, workers=2, progress=lambda line: None)
+    assert results == {"acme": None, "broken": "duplicate key"}
+    assert [c.rolled_back for c in sorted(pools[0].connections, key=lambda c: c.tenant)] == [False, True]
+    # Secrets are only written for tenants whose rows exist
+    assert written == [tenant_provisioning.provider_secret_path("acme", "OpenAI")]
+
+
+def test_vault_failures_are_reported_per_secret(monkeypatch):
+    def write(path, secret):
+        if "globex" in path:
+            raise RuntimeError("permission denied")
+    monkeypatch.setattr(tenant_provisioning, "_write_secret", write)
+    manifests = [{"tenant_id": t, "providers": [{"name": "OpenAI", "config": {"api_key": "k"}}, {"name": "Slack"}]}
+                 for t in ("acme", "globex")]
+    written, failed = tenant_provisioning.write_provider_secrets(manifests)
+    assert written == 1 and failed == [(tenant_provisioning.provider_secret_path("globex", "OpenAI"), "permission denied")]
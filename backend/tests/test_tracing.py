@@ -0,0 +1,88 @@
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import StatusCode
+
+import tracing
+from tracing import JsonLinesFileExporter, TracingMiddleware, docker_env_args, inject_env, span
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    """Finished spans of tracing's tracer, recorded in memory."""
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, "tracer", provider.get_tracer("test"))
+    return exporter.get_finished_spans
+
+
+def test_docker_env_args():
+    assert docker_env_args({"A": "1", "B": "x=y"}) == ["-e", "A=1", "-e", "B=x=y"]
+
+
+def test_inject_env_carries_the_current_trace():
+    provider = TracerProvider()
+    with provider.get_tracer("test").start_as_current_span("parent") as parent:
+        env = inject_env()
+    trace_id = format(parent.get_span_context().trace_id, "032x")
+    assert env["TRACEPARENT"].split("-")[1] == trace_id
+
+
+def test_inject_env_without_a_span_is_empty():
+    assert inject_env() == {}
+
+
+def test_file_exporter_writes_one_json_line_per_span(tmp_path):
+    path = tmp_path / "traces" / "spans.jsonl"
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(JsonLinesFileExporter(str(path))))
+    tracer = provider.get_tracer("test")
+    with tracer.start_as_current_span("parent"):
+        with tracer.start_as_current_span("child", attributes={"peer.service": "ollama"}):
+            pass
+    provider.shutdown()
+    spans = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [s["name"] for s in spans] == ["child", "parent"]
+    assert spans[0]["parent_id"] == spans[1]["span_id"]
+    assert spans[0]["attributes"] == {"peer.service": "ollama"}
+    assert spans[0]["service"] == tracing.OTEL_SERVICE_NAME
+
+
+def test_failing_work_marks_its_span_and_still_raises(spans):
+    with pytest.raises(ValueError):
+        with span("vault.read", path="secret/x"):
+            raise ValueError("sealed")
+    finished, = spans()
+    assert finished.status.status_code == StatusCode.ERROR
+    assert finished.events[0].name == "exception"
+
+
+def _traced_app():
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+
+    @app.get("/items/{item_id}")
+    def item(item_id: str):
+        if item_id == "broken":
+            raise RuntimeError("boom")
+        return {}
+    return TestClient(app, raise_server_exceptions=False)
+
+
+def test_server_errors_mark_the_request_span(spans):
+    assert _traced_app().get("/items/broken").status_code == 500
+    server, = spans()
+    assert server.name == "GET /items/{item_id}" and server.status.status_code == StatusCode.ERROR
+    assert server.attributes["http.status_code"] == 500
+
+
+def test_a_malformed_traceparent_starts_a_new_trace(spans):
+    _traced_app().get("/items/1", headers={"traceparent": "00-not-a-trace-01"})
+    server, = spans()
+    assert server.parent is None and server.status.status_code == StatusCode.UNSET
@@ -0,0 +1,104 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import MetaData, create_engine, select
+
+from vector_shards import ChromaRouter, UnknownShard
+
+OLD_URL = "http://chromadb:8000"
+SHARDS = {"a": OLD_URL, "b": "http://chroma-b:8000", "c": "http://chroma-c:8000"}
+
+
+@pytest.fixture
+def placements(main, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/placements.db")
+    metadata = MetaData()
+    table = main.vector_placements_table.to_metadata(metadata)
+    metadata.create_all(engine)
+
+    def router(shards=SHARDS):
+        return ChromaRouter(engine, table, shards=dict(shards), dedicated="", default_url=OLD_URL)
+
+    def place(tenant, shard, migrating_to=None):
+        with engine.begin() as conn:
+            conn.execute(table.insert().values(tenant_id=tenant, shard=shard, migrating_to=migrating_to,
+                                               updated_at=datetime.utcnow()))
+
+    def rows():
+        with engine.connect() as conn:
+            return {r.tenant_id: r.shard for r in conn.execute(select(table)).fetchall()}
+    return router, place, rows
+
+
+def test_existing_tenants_stay_on_the_instance_that_has_their_data(placements):
+    router, place, rows = placements
+    r = router()
+    tenants = [f"tenant-{i}" for i in range(20)]
+    assert any(r.ring.shard(t) != "a" for t in tenants)  # the ring alone would move some of them away
+    place("tenant-0", "c")
+    place("early", "default")  # pinned by an ingest before CHROMA_SHARDS was set
+    assert r.backfill(tenants) == 20
+    placed = rows()
+    assert placed["tenant-0"] == "c" and placed["early"] == "a"
+    assert all(placed[t] == "a" for t in tenants[1:])
+    assert all(r.shard_for(t) == "a" for t in tenants[1:])
+    assert r.backfill(tenants) == 0
+
+
+def test_backfill_needs_the_old_instance_among_the_shards(placements):
+    router, place, rows = placements
+    assert router({"b": "http://chroma-b:8000"}).backfill(["acme"]) == 0
+    assert rows() == {}
+
+
+def test_backfill_does_nothing_without_sharding(placements):
+    router, place, rows = placements
+    assert router({"default": OLD_URL}).backfill(["acme"]) == 0
+    assert rows() == {}
+
+
+def test_stale_placements_fail_clearly_and_are_reported(placements):
+    router, place, rows = placements
+    r = router()
+    place("acme", "default")
+    place("globex", "a", migrating_to="old-b")
+    with pytest.raises(UnknownShard, match="'default' is not configured"):
+        r.reader("acme")
+    assert r.stale_placements() == {"default": ["acme"], "old-b": ["globex"]}
+
+
+def test_stale_tenants_are_repinned_without_copying(placements):
+    router, place, rows = placements
+    r = router()
+    place("acme", "default")
+    assert r.start_migration("acme", "b") == "default"
+    assert rows()["acme"] == "b" and r.placement("acme").migrating_to is None
+    assert r.stale_placements() == {}
+
+
+def test_migrations_to_unknown_shards_are_refused(placements):
+    router, place, rows = placements
+    with pytest.raises(UnknownShard, match="configured: a, b, c"):
+        router().start_migration("acme", "z")
+    assert rows() == {}
+
+
+# --- Endpoints ---
+def test_shard_stats_and_moves_are_admin_only(client):
+    assert client.get("/vector-store/shards").status_code == 403
+    assert client.put("/vector-store/placements/acme", json={"shard": "default"}).status_code == 403
+
+
+def test_moving_to_an_unknown_shard_is_a_422(client, user):
+    user["realm_access"] = {"roles": ["platform-admin"]}
+    response = client.put("/vector-store/placements/acme", json={"shard": "nowhere"})
+    assert response.status_code == 422 and "nowhere" in response.json()["detail"]
+
+
+def test_reading_the_placement_keeps_the_cached_entry(client, main, monkeypatch):
+    placed = {}
+    monkeypatch.setattr(main.chroma_router, "_placed", placed)
+    client.get("/vector-store/placement", headers={"X-Tenant-ID": "acme"})
+    cached = placed["acme"]
+    client.get("/vector-store/placement", headers={"X-Tenant-ID": "acme"})
+    assert placed["acme"] is cached
@@ -0,0 +1,161 @@
+import socket
+import threading
+from datetime import datetime
+
+import pytest
+import requests
+from sqlalchemy import MetaData, create_engine, select
+
+import events
+from events import EventBus, UnsafeDestination, check_url, check_n8n_path, public_error, DEAD, PENDING
+
+TENANT = {"X-Tenant-ID": "acme"}
+
+
+class _Response:
+    def __init__(self, status=200, location=None):
+        self.status_code = status
+        self.is_redirect = location is not None
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            response = requests.Response()
+            response.status_code = self.status_code
+            raise requests.HTTPError(f"{self.status_code} Server Error: secret internals", response=response)
+
+
+@pytest.fixture
+def resolve(monkeypatch):
+    """Host name -> address the stand-in DNS answers with."""
+    names = {}
+    real = socket.getaddrinfo
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        if host in names:
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (names[host], port))]
+        return real(host, port, *args, **kwargs)
+    monkeypatch.setattr(events.socket, "getaddrinfo", getaddrinfo)
+    return names
+
+
+@pytest.fixture
+def bus(main, tmp_path):
+    """An EventBus on its own database, so the app's dispatcher thread never sees these rows."""
+    engine = create_engine(f"sqlite:///{tmp_path}/events.db")
+    metadata = MetaData()
+    outbox = main.event_outbox_table.to_metadata(metadata)
+    subscriptions = main.webhook_subscriptions_table.to_metadata(metadata)
+    metadata.create_all(engine)
+    bus = EventBus(engine, outbox, subscriptions, lambda secret: secret, "http://n8n:5678")
+    bus.posted = []
+
+    def subscribe(url, kind=events.WEBHOOK):
+        subscription_id = f"sub-{len(bus.posted)}-{url}"
+        with engine.begin() as conn:
+            conn.execute(subscriptions.insert().values(id=subscription_id, tenant_id="acme", kind=kind, url=url,
+                                                       encrypted_secret="s", created_at=datetime.utcnow()))
+        bus.invalidate("acme")
+        return subscription_id
+
+    def publish():
+        with engine.begin() as conn:
+            bus.publish(conn, "acme", "scan.completed", {"scan_id": "1"})
+
+    def rows():
+        with engine.connect() as conn:
+            return {r.subscription_id: r for r in conn.execute(select(outbox)).fetchall()}
+    bus.subscribe, bus.publish_one, bus.rows = subscribe, publish, rows
+    bus.session.post = lambda url, **kwargs: bus.posted.append(url) or _Response()
+    return bus
+
+
+# --- Destination checks ---
+@pytest.mark.parametrize("url", ["http://127.0.0.1/hook", "http://10.1.2.3/hook", "http://169.254.169.254/latest/meta-data",
+                                 "http://[::1]/hook", "http://[fe80::1]/hook", "http://0.0.0.0/", "ftp://example.com/x",
+                                 "http:///nohost"])
+def test_private_and_malformed_urls_are_refused(url):
+    with pytest.raises(UnsafeDestination):
+        check_url(url)
+
+
+def test_names_are_resolved_before_they_are_trusted(resolve):
+    resolve["hooks.example.com"] = "93.184.216.34"
+    check_url("https://hooks.example.com/in")
+    resolve["hooks.example.com"] = "192.168.0.10"
+    with pytest.raises(UnsafeDestination, match="non-public"):
+        check_url("https://hooks.example.com/in")
+
+
+@pytest.mark.parametrize("path", ["../rest/workflows", "a//b", "/scan", "scan?x=1", "scan%2F..", ""])
+def test_n8n_paths_are_plain_segments(path):
+    with pytest.raises(UnsafeDestination):
+        check_n8n_path(path)
+    check_n8n_path("scan-finished/acme_1")
+
+
+def test_unsafe_subscriptions_are_rejected(client):
+    response = client.post("/webhooks", headers=TENANT, json={"url": "http://169.254.169.254/latest/meta-data"})
+    assert response.status_code == 422
+    response = client.post("/webhooks", headers=TENANT, json={"url": "../rest/workflows", "kind": "n8n"})
+    assert response.status_code == 422
+
+
+# --- Delivery ---
+def test_repointed_names_are_refused_at_delivery(bus, resolve):
+    resolve["hooks.example.com"] = "93.184.216.34"
+    subscription_id = bus.subscribe("https://hooks.example.com/in")
+    resolve["hooks.example.com"] = "127.0.0.1"
+    bus.publish_one()
+    assert bus.dispatch_once() == 0 and bus.posted == []
+    row = bus.rows()[subscription_id]
+    assert row.status == PENDING and row.last_error == "destination not allowed"
+
+
+def test_redirects_are_not_followed(bus, resolve):
+    resolve["hooks.example.com"] = "93.184.216.34"
+    subscription_id = bus.subscribe("https://hooks.example.com/in")
+    bus.session.post = lambda url, **kwargs: _Response(302, location="http://127.0.0.1/")
+    bus.publish_one()
+    assert bus.dispatch_once() == 0
+    assert bus.rows()[subscription_id].last_error == "destination not allowed"
+
+
+def test_receiver_errors_are_stored_as_categories(bus, resolve):
+    resolve["hooks.example.com"] = "93.184.216.34"
+    subscription_id = bus.subscribe("https://hooks.example.com/in")
+    bus.session.post = lambda url, **kwargs: _Response(500)
+    bus.publish_one()
+    bus.dispatch_once()
+    assert bus.rows()[subscription_id].last_error == "HTTP 500"
+    assert public_error("HTTPConnectionPool(host='10.0.0.7', port=80): Max retries exceeded") == "delivery failed"
+
+
+def test_rows_of_deleted_subscriptions_go_dead_at_once(bus, resolve):
+    resolve["hooks.example.com"] = "93.184.216.34"
+    subscription_id = bus.subscribe("https://hooks.example.com/in")
+    bus.publish_one()
+    with bus.engine.begin() as conn:
+        conn.execute(bus.subscriptions.delete())
+    bus.dispatch_once()
+    row = bus.rows()[subscription_id]
+    assert row.status == DEAD and row.attempts == 1 and row.last_error == "subscription deleted"
+
+
+def test_n8n_subscriptions_are_called_on_n8n(bus):
+    bus.subscribe("scan-finished", kind=events.N8N)
+    bus.publish_one()
+    assert bus.dispatch_once() == 1 and bus.posted == ["http://n8n:5678/webhook/scan-finished"]
+
+
+def test_a_slow_receiver_does_not_hold_up_the_others(bus, resolve):
+    resolve["slow.example.com"], resolve["fast.example.com"] = "93.184.216.34", "93.184.216.35"
+    bus.subscribe("https://slow.example.com/in")
+    bus.subscribe("https://fast.example.com/in")
+    both_in_flight = threading.Barrier(2, timeout=5)
+
+    def post(url, **kwargs):
+        both_in_flight.wait()  # raises BrokenBarrierError if the deliveries ran one after the other
+        return _Response()
+    bus.session.post = post
+    bus.publish_one()
+    assert bus.dispatch_once() == 2
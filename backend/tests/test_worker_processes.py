@@ -0,0 +1,23 @@
+import os
+import sys
+import subprocess
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def test_workers_refuse_to_start_without_a_shared_encryption_key():
+    env = {k: v for k, v in os.environ.items() if k != "ENCRYPTION_KEY"}
+    # A fresh interpreter: main reads its configuration at import
+    result = subprocess.run([sys.executable, "-c", "import main"], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode != 0
+    assert "RuntimeError: ENCRYPTION_KEY is not set" in result.stderr
+
+
+def test_a_preloaded_worker_gets_its_own_connections(main, monkeypatch):
+    disposed, resets = [], []
+    monkeypatch.setattr(main.engine, "dispose", lambda close=True: disposed.append(close))
+    monkeypatch.setattr(main.chroma_router, "reset", lambda: resets.append(True))
+    main.init_worker_process()
+    # The parent's pooled connections are left open for the parent, not closed from the child
+    assert disposed == [False] and resets == [True]
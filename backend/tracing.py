@@ -0,0 +1,153 @@
+"""
+OpenTelemetry tracing for the backend.
+
+Spans are sampled head-based (parent-based trace-id ratio, OTEL_TRACES_SAMPLER_ARG)
+and exported in batches to an OTLP collector or a JSON-lines file. Trace context
+is propagated to scan containers through TRACEPARENT/TRACESTATE env variables and
+to the MCP server through W3C trace headers.
+"""
+
+import os
+import json
+import threading
+from contextlib import contextmanager
+
+from opentelemetry import trace, propagate
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+# --- Configuration ---
+OTEL_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "saas-backend")
+# otlp | file | none
+OTEL_TRACES_EXPORTER = os.environ.get("OTEL_TRACES_EXPORTER", "none")
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "http://otel-collector:4318")
+OTEL_TRACES_FILE = os.environ.get("OTEL_TRACES_FILE", "/app/traces/spans.jsonl")
+OTEL_TRACES_SAMPLER_ARG = float(os.environ.get("OTEL_TRACES_SAMPLER_ARG", "0.05"))
+
+
+class JsonLinesFileExporter(SpanExporter):
+    """Appends finished spans to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = []
+        for s in spans:
+            ctx = s.get_span_context()
+            lines.append(json.dumps({
+                "name": s.name,
+                "trace_id": format(ctx.trace_id, "032x"),
+                "span_id": format(ctx.span_id, "016x"),
+                "parent_id": format(s.parent.span_id, "016x") if s.parent else None,
+                "start_ns": s.start_time,
+                "end_ns": s.end_time,
+                "status": s.status.status_code.name,
+                "attributes": dict(s.attributes or {}),
+                "service": OTEL_SERVICE_NAME,
+            }, default=str) + "\n")
+        with self._lock:
+            self._file.writelines(lines)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        self._file.close()
+
+
+def _build_provider():
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": OTEL_SERVICE_NAME}),
+        sampler=ParentBased(TraceIdRatioBased(OTEL_TRACES_SAMPLER_ARG)),
+    )
+    if OTEL_TRACES_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        provider.add_span_processor(BatchSpanProcessor(
+            OTLPSpanExporter(endpoint=f"{OTEL_EXPORTER_OTLP_ENDPOINT}/v1/traces")))
+    elif OTEL_TRACES_EXPORTER == "file":
+        provider.add_span_processor(BatchSpanProcessor(JsonLinesFileExporter(OTEL_TRACES_FILE)))
+    return provider
+
+
+tracer_provider = _build_provider()
+trace.set_tracer_provider(tracer_provider)
+tracer = trace.get_tracer("saas-backend")
+
+
+# --- Helpers ---
+@contextmanager
+def span(name, **attributes):
+    """Starts a child span of the current context; exceptions are recorded and re-raised."""
+    with tracer.start_as_current_span(name, attributes=attributes or None) as current:
+        yield current
+
+
+def inject_headers(headers=None):
+    """Returns headers carrying the current trace context (traceparent/tracestate)."""
+    headers = dict(headers or {})
+    propagate.inject(headers)
+    return headers
+
+
+def inject_env():
+    """Returns the current trace context as TRACEPARENT/TRACESTATE environment variables."""
+    return {k.upper(): v for k, v in inject_headers().items()}
+
+
+def docker_env_args(env):
+    """Turns an env dict into `docker run` -e arguments."""
+    return [arg for k, v in env.items() for arg in ("-e", f"{k}={v}")]
+
+
+def record_child_timing(name, start_ns, end_ns, **attributes):
+    """Records a span for work timed elsewhere (e.g. inside a scan container)."""
+    child = tracer.start_span(name, start_time=start_ns, attributes=attributes or None)
+    child.end(end_time=end_ns)
+
+
+def shutdown_tracing():
+    tracer_provider.shutdown()
+
+
+# --- ASGI Middleware ---
+class TracingMiddleware:
+    """Starts a server span per request, continuing any incoming W3C trace context."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            return await self.app(scope, receive, send)
+
+        carrier = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]
+                   if k in (b"traceparent", b"tracestate")}
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        with tracer.start_as_current_span(
+            f"{scope['method']} {scope['path']}", context=propagate.extract(carrier), kind=SpanKind.SERVER
+        ) as server_span:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                if server_span.is_recording():
+                    route = scope.get("route")
+                    if route:
+                        server_span.update_name(f"{scope['method']} {route.path}")
+                        server_span.set_attribute("http.route", route.path)
+                    server_span.set_attribute("http.method", scope["method"])
+                    server_span.set_attribute("http.status_code", status_code)
+                    tenant = next((v for k, v in scope["headers"] if k == b"x-tenant-id"), b"default")
+                    server_span.set_attribute("tenant.id", tenant.decode())
+                    if status_code >= 500:
+                        server_span.set_status(Status(StatusCode.ERROR))
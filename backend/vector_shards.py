@@ -0,0 +1,313 @@
+"""
+Placement of tenants' Chroma collections on several Chroma instances.
+
+CHROMA_SHARDS names the instances ("a=http://chroma-a:8000,b=http://chroma-b:8000");
+without it there is one shard, "default", on CHROMA_URL. All collections of a
+tenant ({tenant}_{module}) live on one shard, taken from:
+- the tenant's `vector_placements` row. It is written on the tenant's first
+  ingest, so adding a shard later does not move existing tenants, and when
+  an operator moves the tenant;
+- otherwise the tenant's position on a consistent-hash ring over the shards
+  not listed in CHROMA_DEDICATED_SHARDS. Dedicated shards only get tenants
+  that were moved there explicitly.
+
+Placements are cached per process for PLACEMENT_TTL. migrate() moves a
+tenant online:
+1. the placement gets `migrating_to`: reads stay on the old shard, writes go
+   to both;
+2. after PLACEMENT_TTL (every worker now writes to both) the collections are
+   copied in batches of CHROMA_MIGRATION_BATCH with their ids and embeddings,
+   so nothing is re-embedded. Copies are upserts, so records written to both
+   shards meanwhile are not duplicated;
+3. once the target holds as many records as the source, reads switch to it;
+4. after another PLACEMENT_TTL the old collections are dropped.
+A migration interrupted by a restart resumes when it is started again.
+
+When CHROMA_SHARDS is first set, every existing collection is still on the
+instance at CHROMA_URL. backfill() (run at startup) therefore pins tenants
+that have documents but no placement to the shard with that URL, and moves
+placements on the implicit "default" shard there too, so no tenant is
+hashed away from its data. Keep CHROMA_URL pointing at that instance.
+Placements naming a shard that is no longer configured raise UnknownShard
+and are listed by stats() until the tenant is moved to a configured shard.
+"""
+
+import os
+import time
+import bisect
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+import chromadb
+from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError
+
+from metrics import upstream_timer
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- Configuration ---
+CHROMA_URL = os.environ.get("CHROMA_URL", "http://chromadb:8000")
+CHROMA_SHARDS = os.environ.get("CHROMA_SHARDS", "")
+CHROMA_DEDICATED_SHARDS = os.environ.get("CHROMA_DEDICATED_SHARDS", "")
+PLACEMENT_TTL = float(os.environ.get("PLACEMENT_TTL", "30"))
+CHROMA_MIGRATION_BATCH = int(os.environ.get("CHROMA_MIGRATION_BATCH", "500"))
+CHROMA_STATS_TTL = float(os.environ.get("CHROMA_STATS_TTL", "60"))
+RING_POINTS = 64  # virtual nodes per shard
+DEFAULT_SHARD = "default"
+
+
+class UnknownShard(KeyError):
+    """A shard name that is not in CHROMA_SHARDS, e.g. a placement left over from before a shard was renamed."""
+
+    def __str__(self):
+        return self.args[0]
+
+
+def parse_shards(spec, default_url=CHROMA_URL):
+    """{"name": url} from "name=url,name=url"; a single "default" shard on default_url when spec is empty."""
+    shards = {}
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        name, _, url = entry.partition("=")
+        if not url:
+            raise ValueError(f"CHROMA_SHARDS entry {entry!r} is not name=url")
+        shards[name.strip()] = url.strip()
+    return shards or {DEFAULT_SHARD: default_url}
+
+
+def _point(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing: adding or removing a shard only moves the tenants in its share of the ring."""
+
+    def __init__(self, shards, points=RING_POINTS):
+        self._ring = sorted((_point(f"{shard}#{i}"), shard) for shard in shards for i in range(points))
+        self._keys = [point for point, _ in self._ring]
+
+    def shard(self, key):
+        if not self._ring:
+            raise LookupError("No shards on the hash ring; every shard is dedicated")
+        return self._ring[bisect.bisect(self._keys, _point(key)) % len(self._ring)][1]
+
+
+class ChromaRouter:
+    def __init__(self, engine, placements, shards=None, dedicated=None, default_url=CHROMA_URL):
+        self.engine = engine
+        self.placements = placements
+        self.shards = shards or parse_shards(CHROMA_SHARDS, default_url)
+        self.default_url = default_url
+        dedicated = CHROMA_DEDICATED_SHARDS if dedicated is None else dedicated
+        self.dedicated = {s.strip() for s in dedicated.split(",") if s.strip()} & set(self.shards)
+        self.ring = HashRing([s for s in self.shards if s not in self.dedicated])
+        self._clients = {}
+        self._placed = {}  # tenant -> (placement row or None, expires_at)
+        self._stats = (None, 0.0)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Drops clients (and their sockets), e.g. in a freshly forked worker."""
+        self._clients = {}
+
+    def client(self, shard):
+        if shard not in self.shards:
+            raise UnknownShard(f"Chroma shard {shard!r} is not configured (CHROMA_SHARDS has {', '.join(self.shards)})")
+        client = self._clients.get(shard)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(shard)
+                if client is None:
+                    client = self._clients[shard] = chromadb.HttpClient(host=self.shards[shard], port=8000)
+        return client
+
+    # --- Placement ---
+    def placement(self, tenant):
+        cached = self._placed.get(tenant)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        with self.engine.connect() as conn:
+            row = conn.execute(select(self.placements).where(self.placements.c.tenant_id == tenant)).fetchone()
+        self._placed[tenant] = (row, time.monotonic() + PLACEMENT_TTL)
+        return row
+
+    def invalidate(self, tenant):
+        self._placed.pop(tenant, None)
+
+    def shard_for(self, tenant):
+        """The shard the tenant's collections are read from."""
+        row = self.placement(tenant)
+        return row.shard if row else self.ring.shard(tenant)
+
+    def reader(self, tenant):
+        return self.client(self.shard_for(tenant))
+
+    def write_shards(self, tenant):
+        """Shards every write goes to: the placement's, plus the target of a running migration. Pins new tenants."""
+        row = self.placement(tenant)
+        if row is None:
+            row = self._pin(tenant)
+        return [row.shard] + ([row.migrating_to] if row.migrating_to else [])
+
+    def _pin(self, tenant):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(self.placements.insert().values(tenant_id=tenant, shard=self.ring.shard(tenant),
+                                                             updated_at=datetime.utcnow()))
+        except IntegrityError:
+            pass  # pinned by another worker
+        self.invalidate(tenant)
+        return self.placement(tenant)
+
+    def upsert(self, tenant, collection_name, ids, embeddings, documents, metadatas):
+        """Writes records to the collection on every write shard of the tenant."""
+        for shard in self.write_shards(tenant):
+            with upstream_timer("chroma", "upsert"):
+                collection = self.client(shard).get_or_create_collection(name=collection_name, embedding_function=None)
+                collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    # --- Migration ---
+    def _set(self, tenant, **values):
+        with self.engine.begin() as conn:
+            conn.execute(self.placements.update().where(self.placements.c.tenant_id == tenant)
+                         .values(updated_at=datetime.utcnow(), **values))
+        self.invalidate(tenant)
+
+    def start_migration(self, tenant, target):
+        """
+        Marks the tenant as moving to target (writes go to both from now on); returns the source shard.
+        A tenant placed on a shard that is no longer configured is re-pinned to target straight away,
+        as there is nothing to copy from.
+        """
+        if target not in self.shards:
+            raise UnknownShard(f"Unknown Chroma shard {target!r}; configured: {', '.join(self.shards)}")
+        source = self.write_shards(tenant)[0]
+        if source not in self.shards:
+            self._set(tenant, shard=target, migrating_to=None)
+        elif source != target:
+            self._set(tenant, migrating_to=target)
+        return source
+
+    def migrate(self, tenant, collection_names, settle=PLACEMENT_TTL):
+        """Copies the tenant's collections to the shard given to start_migration() and switches it over; returns records copied."""
+        self.invalidate(tenant)
+        row = self.placement(tenant)
+        if row is None or not row.migrating_to:
+            return 0
+        source, target = self.client(row.shard), self.client(row.migrating_to)
+        time.sleep(settle)
+        copied = 0
+        for name in collection_names:
+            try:
+                old = source.get_collection(name=name, embedding_function=None)
+            except Exception:
+                continue  # never written on the source
+            new = target.get_or_create_collection(name=name, metadata=old.metadata, embedding_function=None)
+            offset = 0
+            while True:
+                with upstream_timer("chroma", "migrate_read"):
+                    batch = old.get(include=["embeddings", "documents", "metadatas"],
+                                    limit=CHROMA_MIGRATION_BATCH, offset=offset)
+                if not batch["ids"]:
+                    break
+                with upstream_timer("chroma", "migrate_write"):
+                    new.upsert(ids=batch["ids"], embeddings=batch["embeddings"], documents=batch["documents"],
+                               metadatas=batch["metadatas"])
+                copied += len(batch["ids"])
+                offset += len(batch["ids"])
+            if new.count() < old.count():
+                raise RuntimeError(f"Collection {name} has {new.count()} of {old.count()} records on {row.migrating_to}")
+        self._set(tenant, shard=row.migrating_to, migrating_to=None)
+        logger.info("Moved %d vectors of tenant %s from Chroma shard %s to %s", copied, tenant, row.shard, row.migrating_to)
+        # Workers that still read the old placement keep using the old collections until their cache expires
+        time.sleep(settle)
+        for name in collection_names:
+            try:
+                source.delete_collection(name=name)
+            except Exception as e:
+                logger.warning("Old collection %s on shard %s not dropped: %s", name, row.shard, e)
+        return copied
+
+    # --- Enabling sharding ---
+    def legacy_shard(self):
+        """The shard on CHROMA_URL, which held every collection before CHROMA_SHARDS was set; None if none has that URL."""
+        return next((name for name, url in self.shards.items() if url.rstrip("/") == self.default_url.rstrip("/")), None)
+
+    def backfill(self, tenants):
+        """
+        Pins tenants without a placement to the legacy shard and moves placements on the
+        implicit "default" shard there; returns the placements written. A no-op without CHROMA_SHARDS.
+        """
+        if list(self.shards) == [DEFAULT_SHARD]:
+            return 0
+        legacy = self.legacy_shard()
+        if legacy is None:
+            logger.error("No Chroma shard has the URL %s (CHROMA_URL); existing tenants were not pinned to it",
+                         self.default_url)
+            return 0
+        with self.engine.connect() as conn:
+            placed = set(conn.execute(select(self.placements.c.tenant_id)).scalars())
+        written = 0
+        for tenant in sorted(set(tenants) - placed):
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(self.placements.insert().values(tenant_id=tenant, shard=legacy, updated_at=datetime.utcnow()))
+                written += 1
+            except IntegrityError:
+                pass  # pinned by another worker
+        if DEFAULT_SHARD not in self.shards:
+            with self.engine.begin() as conn:
+                written += conn.execute(self.placements.update().where(self.placements.c.shard == DEFAULT_SHARD)
+                                        .values(shard=legacy, updated_at=datetime.utcnow())).rowcount
+        self._placed.clear()
+        if written:
+            logger.info("Pinned %d tenants to Chroma shard %s, which holds their existing collections", written, legacy)
+        return written
+
+    def stale_placements(self):
+        """{shard: [tenants]} of placements (or migration targets) on shards that are not configured."""
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(self.placements.c.tenant_id, self.placements.c.shard, self.placements.c.migrating_to)
+                                .where(self.placements.c.shard.notin_(list(self.shards)) |
+                                       self.placements.c.migrating_to.notin_(list(self.shards)))).fetchall()
+        stale = {}
+        for tenant, shard, migrating_to in rows:
+            for name in (shard, migrating_to):
+                if name is not None and name not in self.shards:
+                    stale.setdefault(name, []).append(tenant)
+        return stale
+
+    # --- Stats ---
+    def stats(self):
+        """Per shard: reachability, heartbeat latency, collections, records and placed tenants (cached CHROMA_STATS_TTL)."""
+        cached, expires_at = self._stats
+        if cached is not None and expires_at > time.monotonic():
+            return cached
+        with self.engine.connect() as conn:
+            placed = dict(conn.execute(select(self.placements.c.shard, func.count())
+                                       .group_by(self.placements.c.shard)).fetchall())
+            migrating = dict(conn.execute(select(self.placements.c.migrating_to, func.count())
+                                          .where(self.placements.c.migrating_to.isnot(None))
+                                          .group_by(self.placements.c.migrating_to)).fetchall())
+        shards = {}
+        for name, url in self.shards.items():
+            entry = {"url": url, "dedicated": name in self.dedicated, "tenants": placed.get(name, 0),
+                     "incoming_migrations": migrating.get(name, 0)}
+            started = time.perf_counter()
+            try:
+                client = self.client(name)
+                client.heartbeat()
+                entry["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                collections = client.list_collections()
+                entry.update(healthy=True, collections=len(collections), records=sum(c.count() for c in collections))
+            except Exception as e:
+                entry.update(healthy=False, error=str(e))
+            shards[name] = entry
+        healthy = [s for s in shards.values() if s["healthy"]]
+        result = {"shards": shards, "healthy": len(healthy), "total": len(shards),
+                  "collections": sum(s["collections"] for s in healthy), "records": sum(s["records"] for s in healthy),
+                  "stale_placements": self.stale_placements()}
+        self._stats = (result, time.monotonic() + CHROMA_STATS_TTL)
+        return result
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Backend API Benchmark
+Starts the local stand-ins (standins.py, bin/docker) and the backend under
+uvicorn, then drives closed-loop scenarios against it and reports
+throughput, p50/p95/p99 latency and error rate per scenario and endpoint.
+Everything runs on 127.0.0.1; no network access or Docker is needed.
+
+Results are compared with baseline.json next to this script; a scenario
+regresses when its p95 grows or its throughput drops by more than
+--tolerance, or its error rate rises by more than one percentage point.
+
+Usage:
+  python3 benchmarks/api/api_bench.py                                  # all scenarios vs baseline
+  python3 benchmarks/api/api_bench.py --scenario rag_qa --duration 30 --concurrency 16
+  python3 benchmarks/api/api_bench.py --write-baseline                 # refresh baseline.json
+  python3 benchmarks/api/api_bench.py --backend-url http://127.0.0.1:9000 --keycloak-url http://127.0.0.1:18080
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(HERE, "..", "..", "backend")
+BASELINE_PATH = os.path.join(HERE, "baseline.json")
+REALM = "saas-platform"
+DOC_MODULE = "docs"
+LOREM = ("Tenant onboarding requires the security questionnaire, the network inventory and the "
+         "asset owner list before the scanner modules are activated. ") * 40
+
+
+# --- Scenarios ---
+# Each scenario picks the next request for a worker: (endpoint label, method, path, requests kwargs)
+def auth_reads(rng):
+    return rng.choice((
+        ("GET /usage-metrics", "GET", "/usage-metrics", {}),
+        ("GET /modules", "GET", "/modules", {}),
+        ("GET /modules/active", "GET", "/modules/active", {}),
+        ("GET /findings", "GET", "/findings", {"params": {"module": "nmap", "port": 22, "limit": 50}}),
+        ("GET /documents", "GET", "/documents", {"params": {"module_id": DOC_MODULE}}),
+    ))
+
+
+def scan_burst(rng):
+    if rng.random() < 0.5:
+        return ("POST /modules/semgrep/scan", "POST", "/modules/semgrep/scan",
+                {"json": {"target": f"/src/repo-{rng.randrange(20)}"}})
+    return ("POST /modules/nmap/scan", "POST", "/modules/nmap/scan",
+            {"json": {"targets": [f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"]}})
+
+
+def document_ingestion(rng):
+    name = f"runbook-{rng.randrange(10 ** 6)}.txt"
+    return ("POST /documents/upload", "POST", "/documents/upload",
+            {"files": {"file": (name, LOREM.encode(), "text/plain")}, "data": {"module_id": DOC_MODULE}})
+
+
+def rag_qa(rng):
+    question = rng.choice(("Which modules need the network inventory?", "What is required before onboarding?",
+                           "Who owns the asset list?"))
+    return "POST /ai/ask", "POST", "/ai/ask", {"params": {"question": question, "module_id": DOC_MODULE}}
+
+
+def mixed(rng):
+    roll = rng.random()
+    scenario = auth_reads if roll < 0.6 else rag_qa if roll < 0.8 else scan_burst if roll < 0.9 else document_ingestion
+    return scenario(rng)
+
+
+SCENARIOS = {
+    "auth_reads": auth_reads,
+    "scan_burst": scan_burst,
+    "document_ingestion": document_ingestion,
+    "rag_qa": rag_qa,
+    "mixed": mixed,
+}
+
+
+# --- Load Generator ---
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return round(sorted_values[index] * 1000, 2)
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(s[1] for s in samples)
+    errors = sum(1 for s in samples if not s[2])
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def run_scenario(name, base_url, tokens, concurrency, duration, warmup, seed):
+    """Closed loop: each worker sends its next request as soon as the previous one completes."""
+    pick = SCENARIOS[name]
+    samples, failures = [], defaultdict(int)
+    lock = threading.Lock()
+    start = time.perf_counter()
+    measure_from, stop_at = start + warmup, start + warmup + duration
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        session = requests.Session()
+        tenants = list(tokens)
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                return
+            tenant = tenants[rng.randrange(len(tenants))] if name == "mixed" else tenants[index % len(tenants)]
+            label, method, path, kwargs = pick(rng)
+            headers = {"Authorization": f"Bearer {tokens[tenant]}", "X-Tenant-ID": tenant}
+            sent = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, headers=headers, timeout=120, **kwargs)
+                ok, reason = response.status_code < 400, response.status_code
+            except requests.RequestException as e:
+                ok, reason = False, type(e).__name__
+            finished = time.perf_counter()
+            if sent >= measure_from:
+                with lock:
+                    samples.append((label, finished - sent, ok))
+                    if not ok:
+                        failures[f"{label} -> {reason}"] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = max(time.perf_counter(), stop_at) - measure_from
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint[sample[0]].append(sample)
+    result = summarize(samples, elapsed)
+    result.update(concurrency=concurrency, duration_s=duration,
+                  endpoints={label: summarize(s, elapsed) for label, s in sorted(by_endpoint.items())})
+    if failures:
+        result["failures"] = dict(failures)
+    return result
+
+
+# --- Environment ---
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def free_port_range(count, start=18080):
+    """First base port from which `count` consecutive ports can be bound (one per stand-in)."""
+    for base in range(start, 30000, 10):
+        sockets = []
+        try:
+            for port in range(base, base + count):
+                s = socket.socket()
+                sockets.append(s)
+                s.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for s in sockets:
+                s.close()
+    raise RuntimeError("no free port range for the stand-ins")
+
+
+def start_backend(urls, port, workdir, database_url, log_path, workers=0):
+    """Runs uvicorn (workers=0) or gunicorn with that many uvicorn worker processes."""
+    from cryptography.fernet import Fernet
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        KEYCLOAK_URL=urls["keycloak"] + "/",
+        KEYCLOAK_REALM=REALM,
+        OLLAMA_URL=urls["ollama"],
+        CHROMA_URL=urls["chroma"],
+        N8N_URL=urls["n8n"],
+        VAULT_URL=urls["vault"],
+        MCP_SERVER_URL=urls["mcp"],
+        DOCKER_HOST=urls["docker"].replace("http://", "tcp://"),
+        PATH=os.path.join(HERE, "bin") + os.pathsep + os.environ.get("PATH", ""),
+        ENCRYPTION_KEY=Fernet.generate_key().decode(),
+        UPLOAD_DIR=os.path.join(workdir, "uploads"),
+        SCAN_BLOB_DIR=os.path.join(workdir, "scan-blobs"),
+        REDIS_URL="",
+        LOGSTASH_HOST="",
+        OTEL_TRACES_EXPORTER="none",
+        ANONYMIZED_TELEMETRY="False",
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, "prometheus"),
+    )
+    if workers:
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app", "--workers", str(workers),
+               "--bind", f"127.0.0.1:{port}", "--access-logfile", "/dev/null", "--log-level", "warning"]
+    else:
+        env.pop("PROMETHEUS_MULTIPROC_DIR")
+        cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    log = open(log_path, "w")
+    proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 180
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"backend exited with {proc.returncode}; see {log_path}")
+        try:
+            if requests.get(base_url + "/metrics", timeout=2).status_code == 200:
+                return proc, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError(f"backend did not become ready in 180s; see {log_path}")
+
+
+def issue_tokens(keycloak_url, tenants):
+    tokens = {}
+    for tenant in tenants:
+        response = requests.post(f"{keycloak_url}/realms/{REALM}/protocol/openid-connect/token",
+                                 data={"username": f"bench-{tenant}", "tenant": tenant}, timeout=10)
+        response.raise_for_status()
+        tokens[tenant] = response.json()["access_token"]
+    return tokens
+
+
+def seed(base_url, tokens):
+    """Registers modules, activates them per tenant and ingests one document per tenant for RAG."""
+    first = next(iter(tokens.values()))
+    for name in ("nmap", "semgrep", DOC_MODULE):
+        requests.post(f"{base_url}/modules/register", headers={"Authorization": f"Bearer {first}"},
+                      json={"name": name, "image": f"{name}-module", "description": "benchmark"}, timeout=30)
+    for tenant, token in tokens.items():
+        headers = {"Authorization": f"Bearer {token}", "X-Tenant-ID": tenant}
+        for name in ("nmap", "semgrep", DOC_MODULE):
+            requests.post(f"{base_url}/modules/activate", headers=headers, json={"module_name": name}, timeout=30)
+        response = requests.post(f"{base_url}/documents/upload", headers=headers, timeout=120,
+                                 files={"file": ("onboarding.txt", LOREM.encode(), "text/plain")},
+                                 data={"module_id": DOC_MODULE})
+        response.raise_for_status()
+        requests.post(f"{base_url}/modules/nmap/scan", headers=headers, json={"targets": ["10.0.0.1"]}, timeout=120)
+
+
+# --- Baseline Comparison ---
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        checks = (
+            ("p95_ms", current["p95_ms"] is not None and previous["p95_ms"] is not None
+             and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance)),
+            ("throughput_rps", current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance)),
+            ("error_rate", current["error_rate"] > previous["error_rate"] + 0.01),
+        )
+        for metric, regressed in checks:
+            line = f"{name:20} {metric:15} {previous[metric]!s:>10} -> {current[metric]!s:>10}"
+            print(("REGRESSION " if regressed else "           ") + line)
+            if regressed:
+                regressions.append((name, metric))
+    return regressions
+
+
+def print_table(results):
+    print(f"\n{'scenario':20} {'req':>7} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, r in results.items():
+        print(f"{name:20} {r['requests']:>7} {r['throughput_rps']:>8} {r['p50_ms']!s:>9} {r['p95_ms']!s:>9} "
+              f"{r['p99_ms']!s:>9} {r['error_rate']:>7.2%}")
+        for label, e in r["endpoints"].items():
+            print(f"  {label:30} {e['requests']:>5} {e['p50_ms']!s:>9} {e['p95_ms']!s:>9} {e['p99_ms']!s:>9} {e['error_rate']:>7.2%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=20, help="Measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=3, help="Unmeasured seconds before each scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--tenants", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--llm-parallel", type=int, default=0, help="Generations the Ollama stand-in runs at once (0: unlimited)")
+    parser.add_argument("--scan-latency", type=float, default=0.5)
+    parser.add_argument("--workers", type=int, default=0, help="Serve with gunicorn and this many worker processes")
+    parser.add_argument("--database-url", help="Defaults to a fresh SQLite file in a temp directory")
+    parser.add_argument("--backend-url", help="Benchmark an already running backend instead of starting one")
+    parser.add_argument("--keycloak-url", help="Token issuer for --backend-url (a running standins.py)")
+    parser.add_argument("--output", help="Write results JSON here")
+    parser.add_argument("--backend-log", help="Keep the backend's log here (default: discarded with the temp dir)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--write-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    sys.path.insert(0, HERE)
+    import standins
+
+    tenants = [f"bench-tenant-{i}" for i in range(args.tenants)]
+    backend = None
+    with tempfile.TemporaryDirectory(prefix="api-bench-") as workdir:
+        if args.backend_url:
+            base_url, keycloak_url = args.backend_url.rstrip("/"), args.keycloak_url.rstrip("/")
+        else:
+            standins.CONFIG.update(llm_latency=args.llm_latency, llm_parallel=args.llm_parallel)
+            # The backend's scheduler admits as many generations as the stand-in runs at once
+            os.environ["OLLAMA_NUM_PARALLEL"] = str(args.llm_parallel or 64)
+            os.environ["BENCH_SCAN_LATENCY"] = str(args.scan_latency)
+            urls = standins.start(free_port_range(len(standins.SERVICES)))
+            keycloak_url = urls["keycloak"]
+            backend, base_url = start_backend(urls, free_port(), workdir,
+                                              args.database_url or f"sqlite:///{workdir}/bench.db",
+                                              args.backend_log or os.path.join(workdir, "backend.log"), args.workers)
+        try:
+            tokens = issue_tokens(keycloak_url, tenants)
+            seed(base_url, tokens)
+            results = {}
+            for name in args.scenario:
+                print(f"running {name} ({args.concurrency} clients, {args.duration}s)...", flush=True)
+                results[name] = run_scenario(name, base_url, tokens, args.concurrency, args.duration, args.warmup, args.seed)
+        finally:
+            if backend is not None:
+                backend.terminate()
+                backend.wait(timeout=30)
+                if backend.returncode not in (0, -15):
+                    with open(args.backend_log or os.path.join(workdir, "backend.log")) as f:
+                        print(f.read()[-4000:], file=sys.stderr)
+
+    report = {
+        "environment": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                        "concurrency": args.concurrency, "tenants": args.tenants, "workers": args.workers,
+                        "llm_latency_s": args.llm_latency, "llm_parallel": args.llm_parallel,
+                        "scan_latency_s": args.scan_latency},
+        "scenarios": results,
+    }
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.write_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"\nbaseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\ncompared with {args.baseline} (tolerance {args.tolerance:.0%}):")
+        if compare(results, baseline, args.tolerance) and args.fail_on_regression:
+            sys.exit(1)
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Local Stand-ins for Backend Dependencies
+In-memory HTTP servers that answer the calls backend/main.py makes to
+Keycloak (realm public key + RS256 token issuer), Ollama, Chroma, n8n, Vault,
+the MCP server and the Docker Engine API, with configurable latencies so
+benchmark runs measure the backend rather than the network.
+
+Usage:
+  python3 benchmarks/api/standins.py --base-port 18080 --llm-latency 0.2
+  curl -d 'username=bench&tenant=t1' http://127.0.0.1:18080/realms/saas-platform/protocol/openid-connect/token
+"""
+
+import os
+import re
+import json
+import math
+import time
+import uuid
+import base64
+import contextlib
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+
+# Offsets from --base-port, in the order the services are started
+SERVICES = ("keycloak", "ollama", "chroma", "n8n", "vault", "mcp", "docker")
+CONFIG = {"llm_latency": 0.2, "llm_parallel": 0, "embed_latency": 0.005, "upstream_latency": 0.002, "token_ttl": 3600, "embed_dim": 64}
+LOCK = threading.Lock()
+
+
+# --- Keycloak: RS256 issuer ---
+SIGNING_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+PUBLIC_KEY_B64 = base64.b64encode(SIGNING_KEY.public_key().public_bytes(
+    serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)).decode()
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def issue_jwt(username, tenant, realm):
+    now = int(time.time())
+    header = {"alg": "RS256", "typ": "JWT", "kid": "bench"}
+    claims = {"sub": str(uuid.uuid5(uuid.NAMESPACE_URL, f"{tenant}/{username}")), "preferred_username": username,
+              "tenant_id": tenant, "iss": f"http://standin/realms/{realm}", "iat": now, "exp": now + CONFIG["token_ttl"]}
+    signing_input = f"{_b64url(json.dumps(header).encode())}.{_b64url(json.dumps(claims).encode())}"
+    signature = SIGNING_KEY.sign(signing_input.encode(), padding.PKCS1v15(), hashes.SHA256())
+    return f"{signing_input}.{_b64url(signature)}"
+
+
+# --- Ollama: deterministic embeddings ---
+def embed(text):
+    """Hash-seeded unit vector, so equal texts embed equally and retrieval is stable across runs."""
+    values = []
+    seed = hashlib.sha256(text.encode()).digest()
+    while len(values) < CONFIG["embed_dim"]:
+        seed = hashlib.sha256(seed).digest()
+        values.extend(b / 127.5 - 1 for b in seed)
+    values = values[:CONFIG["embed_dim"]]
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    routes = ()
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status, body=None, content_type="application/json"):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            return {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+        return json.loads(raw) if raw else {}
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                body = self._body() if method in ("POST", "PUT") else {}
+                time.sleep(CONFIG["upstream_latency"])
+                # Handlers return (status, body) or (status, body, content_type)
+                return self._send(*handler(self, body, parse_qs(url.query), *match.groups()))
+        self._send(404, {"error": f"no stand-in route for {method} {url.path}"})
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+class KeycloakHandler(Handler):
+    routes = (
+        ("GET", r"/realms/([^/]+)/?", lambda h, b, q, realm: (200, {"realm": realm, "public_key": PUBLIC_KEY_B64})),
+        ("POST", r"/realms/([^/]+)/protocol/openid-connect/token",
+         lambda h, b, q, realm: (200, {"access_token": issue_jwt(b.get("username", "bench"), b.get("tenant", "default"), realm),
+                                       "token_type": "Bearer", "expires_in": CONFIG["token_ttl"]})),
+    )
+
+
+_llm_slots = {}
+_llm_slots_lock = threading.Lock()
+
+
+def llm_slot():
+    """One of CONFIG["llm_parallel"] generation slots, queueing like Ollama's OLLAMA_NUM_PARALLEL (0: unlimited)."""
+    parallel = CONFIG["llm_parallel"]
+    if not parallel:
+        return contextlib.nullcontext()
+    with _llm_slots_lock:
+        return _llm_slots.setdefault(parallel, threading.BoundedSemaphore(parallel))
+
+
+class OllamaHandler(Handler):
+    def generate(self, body, query):
+        with llm_slot():
+            time.sleep(CONFIG["llm_latency"])
+        answer = f"Stand-in answer to a {len(body.get('prompt', ''))}-character prompt."
+        if body.get("stream", True):
+            # Newline-delimited chunks, like the real streaming API
+            lines = [{"model": body.get("model"), "response": word + " ", "done": False} for word in answer.split()]
+            lines.append({"model": body.get("model"), "response": "", "done": True, "eval_count": len(lines)})
+            return 200, "".join(json.dumps(line) + "\n" for line in lines).encode(), "application/x-ndjson"
+        return 200, {"model": body.get("model"), "response": answer, "done": True}
+
+    def embeddings(self, body, query):
+        time.sleep(CONFIG["embed_latency"])
+        return 200, {"embedding": embed(body.get("prompt", ""))}
+
+    def embed_batch(self, body, query):
+        inputs = body.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        time.sleep(CONFIG["embed_latency"] * max(1, len(inputs)))
+        return 200, {"embeddings": [embed(text) for text in inputs]}
+
+    routes = (
+        ("POST", r"/api/generate", lambda h, b, q: h.generate(b, q)),
+        ("POST", r"/api/embeddings", lambda h, b, q: h.embeddings(b, q)),
+        ("POST", r"/api/embed", lambda h, b, q: h.embed_batch(b, q)),
+        ("GET", r"/api/tags", lambda h, b, q: (200, {"models": [{"name": "llama2"}]})),
+    )
+
+
+class ChromaHandler(Handler):
+    """The subset of the Chroma v2 HTTP API used by chromadb.HttpClient and the LangChain vector store."""
+
+    @property
+    def collections(self):
+        # Per server, so several stand-ins can act as separate shards (start_chroma)
+        # id -> {"model": {...}, "ids": [], "embeddings": [], "documents": [], "metadatas": []}
+        return self.server.__dict__.setdefault("collections", {})
+
+    def create_collection(self, body, query, tenant, database):
+        with LOCK:
+            existing = next((c for c in self.collections.values()
+                             if c["model"]["name"] == body["name"] and c["model"]["tenant"] == tenant), None)
+            if existing is None:
+                model = {"id": str(uuid.uuid4()), "name": body["name"], "metadata": body.get("metadata"),
+                         "configuration_json": body.get("configuration") or {}, "tenant": tenant, "database": database}
+                existing = self.collections[model["id"]] = {"model": model, "ids": [], "embeddings": [],
+                                                            "documents": [], "metadatas": []}
+            elif not body.get("get_or_create"):
+                return 409, {"error": "UniqueConstraintError", "message": f"Collection {body['name']} already exists"}
+        return 200, existing["model"]
+
+    def get_collection(self, body, query, tenant, database, name):
+        collection = next((c for c in self.collections.values() if c["model"]["name"] == name), None)
+        return (200, collection["model"]) if collection else (404, {"error": "NotFoundError"})
+
+    def add(self, body, query, tenant, database, collection_id):
+        collection = self.collections[collection_id]
+        with LOCK:
+            for i, item_id in enumerate(body["ids"]):
+                values = {"embeddings": body["embeddings"][i],
+                          "documents": (body.get("documents") or [None] * len(body["ids"]))[i],
+                          "metadatas": (body.get("metadatas") or [None] * len(body["ids"]))[i]}
+                if item_id in collection["ids"]:
+                    index = collection["ids"].index(item_id)
+                    for field, value in values.items():
+                        collection[field][index] = value
+                    continue
+                collection["ids"].append(item_id)
+                for field, value in values.items():
+                    collection[field].append(value)
+        return 201, True
+
+    def get(self, body, query, tenant, database, collection_id):
+        collection = self.collections.get(collection_id, {"ids": []})
+        offset = body.get("offset") or 0
+        end = offset + body["limit"] if body.get("limit") else None
+        result = {"ids": collection["ids"][offset:end], "include": body.get("include", [])}
+        for field in ("embeddings", "documents", "metadatas"):
+            result[field] = collection[field][offset:end] if field in result["include"] else None
+        return 200, result
+
+    def delete_collection(self, name):
+        with LOCK:
+            for collection_id, collection in list(self.collections.items()):
+                if collection["model"]["name"] == name:
+                    del self.collections[collection_id]
+                    return 200, {}
+        return 404, {"error": "NotFoundError"}
+
+    def query(self, body, query, tenant, database, collection_id):
+        collection = self.collections.get(collection_id)
+        n = body.get("n_results", 10)
+        result = {k: [] for k in ("ids", "documents", "metadatas", "distances", "embeddings")}
+        result.update(include=body.get("include", []), uris=None, data=None)
+        for q in body["query_embeddings"]:
+            scored = sorted(((1 - sum(a * b for a, b in zip(q, e)), i)
+                             for i, e in enumerate(collection["embeddings"] if collection else [])))[:n]
+            result["ids"].append([collection["ids"][i] for _, i in scored])
+            result["documents"].append([collection["documents"][i] for _, i in scored])
+            result["metadatas"].append([collection["metadatas"][i] for _, i in scored])
+            result["distances"].append([d for d, _ in scored])
+            result["embeddings"] = None
+        return 200, result
+
+    collection_path = r"/api/v2/tenants/([^/]+)/databases/([^/]+)/collections"
+    routes = (
+        ("GET", r"/api/v2/heartbeat", lambda h, b, q: (200, {"nanosecond heartbeat": time.time_ns()})),
+        ("GET", r"/api/v2/version", lambda h, b, q: (200, "1.0.0")),
+        ("GET", r"/api/v2/pre-flight-checks", lambda h, b, q: (200, {"max_batch_size": 5000, "supports_base64_encoding": False})),
+        ("GET", r"/api/v2/auth/identity",
+         lambda h, b, q: (200, {"user_id": "bench", "tenant": "default_tenant", "databases": ["default_database"]})),
+        ("GET", r"/api/v2/tenants/([^/]+)", lambda h, b, q, t: (200, {"name": t})),
+        ("GET", r"/api/v2/tenants/([^/]+)/databases/([^/]+)",
+         lambda h, b, q, t, d: (200, {"id": str(uuid.uuid5(uuid.NAMESPACE_DNS, d)), "name": d, "tenant": t})),
+        ("GET", collection_path, lambda h, b, q, t, d: (200, [c["model"] for c in h.collections.values()])),
+        ("POST", collection_path, lambda h, b, q, t, d: h.create_collection(b, q, t, d)),
+        ("DELETE", collection_path + r"/([^/]+)", lambda h, b, q, t, d, name: h.delete_collection(name)),
+        ("GET", collection_path + r"/([^/]+)", lambda h, b, q, t, d, name: h.get_collection(b, q, t, d, name)),
+        ("POST", collection_path + r"/([^/]+)/(?:add|upsert)", lambda h, b, q, t, d, c: h.add(b, q, t, d, c)),
+        ("POST", collection_path + r"/([^/]+)/query", lambda h, b, q, t, d, c: h.query(b, q, t, d, c)),
+        ("POST", collection_path + r"/([^/]+)/get", lambda h, b, q, t, d, c: h.get(b, q, t, d, c)),
+        ("GET", collection_path + r"/([^/]+)/count",
+         lambda h, b, q, t, d, c: (200, len(h.collections.get(c, {}).get("ids", [])))),
+    )
+
+
+class N8nHandler(Handler):
+    workflows = {}
+
+    def create(self, body, query):
+        workflow = dict(body, id=uuid.uuid4().hex[:16], active=False)
+        self.workflows[workflow["id"]] = workflow
+        return 200, workflow
+
+    routes = (
+        ("GET", r"/api/v1/workflows", lambda h, b, q: (200, {"data": list(h.workflows.values())[:100]})),
+        ("POST", r"/api/v1/workflows", lambda h, b, q: h.create(b, q)),
+        ("POST", r"/api/v1/workflows/([^/]+)/activate",
+         lambda h, b, q, wid: (200, dict(h.workflows.get(wid, {"id": wid}), active=True))),
+    )
+
+
+class VaultHandler(Handler):
+    secrets = {}
+
+    def write(self, body, query, path):
+        with LOCK:
+            version = self.secrets.get(path, {}).get("version", 0) + 1
+            self.secrets[path] = {"data": body.get("data", {}), "version": version}
+        return 200, {"data": {"version": version, "created_time": time.strftime("%Y-%m-%dT%H:%M:%SZ")}}
+
+    def read(self, body, query, path):
+        secret = self.secrets.get(path)
+        if secret is None:
+            return 404, {"errors": []}
+        return 200, {"data": {"data": secret["data"], "metadata": {"version": secret["version"]}}}
+
+    # Transit: "wrapping" only tags the base64 plaintext with the key version; enough to exercise the key flows
+    transit_keys = {}
+
+    def transit_key(self, name):
+        if name not in self.transit_keys:
+            return 404, {"errors": []}
+        return 200, {"data": {"name": name, "latest_version": self.transit_keys[name]}}
+
+    def transit_create(self, name):
+        with LOCK:
+            self.transit_keys.setdefault(name, 1)
+        return 204, None
+
+    def transit_rotate(self, name):
+        with LOCK:
+            self.transit_keys[name] += 1
+        return 204, None
+
+    def transit_datakey(self, name):
+        if name not in self.transit_keys:
+            return 400, {"errors": ["encryption key not found"]}
+        plaintext = base64.b64encode(os.urandom(32)).decode()
+        return 200, {"data": {"plaintext": plaintext, "ciphertext": f"vault:v{self.transit_keys[name]}:{plaintext}"}}
+
+    def transit_decrypt(self, body, name):
+        return 200, {"data": {"plaintext": body["ciphertext"].split(":", 2)[2]}}
+
+    def transit_rewrap(self, body, name):
+        plaintext = body["ciphertext"].split(":", 2)[2]
+        return 200, {"data": {"ciphertext": f"vault:v{self.transit_keys[name]}:{plaintext}"}}
+
+    routes = (
+        ("POST", r"/v1/secret/data/(.+)", lambda h, b, q, path: h.write(b, q, path)),
+        ("PUT", r"/v1/secret/data/(.+)", lambda h, b, q, path: h.write(b, q, path)),
+        ("GET", r"/v1/secret/data/(.+)", lambda h, b, q, path: h.read(b, q, path)),
+        ("POST", r"/v1/sys/mounts/(.+)", lambda h, b, q, path: (204, None)),
+        ("GET", r"/v1/transit/keys/([^/]+)", lambda h, b, q, name: h.transit_key(name)),
+        ("POST", r"/v1/transit/keys/([^/]+)", lambda h, b, q, name: h.transit_create(name)),
+        ("POST", r"/v1/transit/keys/([^/]+)/rotate", lambda h, b, q, name: h.transit_rotate(name)),
+        ("POST", r"/v1/transit/datakey/plaintext/([^/]+)", lambda h, b, q, name: h.transit_datakey(name)),
+        ("POST", r"/v1/transit/decrypt/([^/]+)", lambda h, b, q, name: h.transit_decrypt(b, name)),
+        ("POST", r"/v1/transit/rewrap/([^/]+)", lambda h, b, q, name: h.transit_rewrap(b, name)),
+    )
+
+
+class McpHandler(Handler):
+    def complete(self, body, query):
+        time.sleep(CONFIG["llm_latency"])
+        text = f"Stand-in cloud answer to a {len(body.get('prompt', ''))}-character prompt."
+        return 200, {"provider": body.get("provider", "openai"), "text": text, "choices": [{"text": text}]}
+
+    routes = (
+        ("POST", r"/generate", lambda h, b, q: h.complete(b, q)),
+        ("POST", r"/openai", lambda h, b, q: h.complete(b, q)),
+        ("POST", r"/gemini", lambda h, b, q: h.complete(b, q)),
+    )
+
+
+class DockerHandler(Handler):
+    """Docker Engine API calls made by the docker SDK for module activation (DOCKER_HOST=tcp://...)."""
+    containers = {}
+
+    def create(self, body, query):
+        container_id = uuid.uuid4().hex
+        name = query.get("name", [container_id[:12]])[0]
+        with LOCK:
+            if any(c["Name"] == "/" + name for c in self.containers.values()):
+                return 409, {"message": f"Conflict. The container name \"/{name}\" is already in use"}
+            self.containers[container_id] = {"Id": container_id, "Name": "/" + name, "Config": body,
+                                             "State": {"Status": "created", "Running": False}}
+        return 201, {"Id": container_id, "Warnings": []}
+
+    def find(self, ref):
+        return next((c for cid, c in self.containers.items() if cid.startswith(ref) or c["Name"] == "/" + ref), None)
+
+    def set_state(self, ref, status):
+        container = self.find(ref)
+        if container is None:
+            return 404, {"message": f"No such container: {ref}"}
+        container["State"] = {"Status": status, "Running": status == "running"}
+        return 204, None
+
+    def remove(self, ref):
+        container = self.find(ref)
+        if container is None:
+            return 404, {"message": f"No such container: {ref}"}
+        with LOCK:
+            self.containers.pop(container["Id"], None)
+        return 204, None
+
+    def inspect(self, ref):
+        container = self.find(ref)
+        return (200, container) if container else (404, {"message": f"No such container: {ref}"})
+
+    api = r"(?:/v[\d.]+)?"
+    routes = (
+        ("GET", api + r"/_ping", lambda h, b, q: (200, "OK")),
+        ("GET", api + r"/version", lambda h, b, q: (200, {"ApiVersion": "1.43", "Version": "24.0.0-standin"})),
+        ("POST", api + r"/containers/create", lambda h, b, q: h.create(b, q)),
+        ("POST", api + r"/containers/([^/]+)/start", lambda h, b, q, ref: h.set_state(ref, "running")),
+        ("POST", api + r"/containers/([^/]+)/stop", lambda h, b, q, ref: h.set_state(ref, "exited")),
+        ("GET", api + r"/containers/([^/]+)/json", lambda h, b, q, ref: h.inspect(ref)),
+        ("DELETE", api + r"/containers/([^/]+)", lambda h, b, q, ref: h.remove(ref)),
+    )
+
+
+HANDLERS = {"keycloak": KeycloakHandler, "ollama": OllamaHandler, "chroma": ChromaHandler, "n8n": N8nHandler,
+            "vault": VaultHandler, "mcp": McpHandler, "docker": DockerHandler}
+
+
+def start_chroma(port, host="127.0.0.1"):
+    """One more Chroma stand-in with its own collections, e.g. a second CHROMA_SHARDS entry; returns its url."""
+    server = ThreadingHTTPServer((host, port), ChromaHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=f"standin-chroma-{port}", daemon=True).start()
+    return f"http://{host}:{port}"
+
+
+def start(base_port, host="127.0.0.1"):
+    """Starts every stand-in on consecutive ports; returns {service: url}."""
+    urls = {}
+    for offset, name in enumerate(SERVICES):
+        server = ThreadingHTTPServer((host, base_port + offset), HANDLERS[name])
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name=f"standin-{name}", daemon=True).start()
+        urls[name] = f"http://{host}:{base_port + offset}"
+    return urls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-port", type=int, default=18080)
+    parser.add_argument("--llm-latency", type=float, default=CONFIG["llm_latency"], help="Seconds per generation")
+    parser.add_argument("--llm-parallel", type=int, default=0, help="Concurrent generations; more are queued (0: unlimited)")
+    parser.add_argument("--embed-latency", type=float, default=CONFIG["embed_latency"], help="Seconds per embedded text")
+    parser.add_argument("--upstream-latency", type=float, default=CONFIG["upstream_latency"], help="Added to every call")
+    args = parser.parse_args()
+    CONFIG.update(llm_latency=args.llm_latency, llm_parallel=args.llm_parallel, embed_latency=args.embed_latency, upstream_latency=args.upstream_latency)
+
+    for service, url in start(args.base_port).items():
+        print(f"{service:9} {url}", flush=True)
+    threading.Event().wait()
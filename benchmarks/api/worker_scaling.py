@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Worker Scaling Benchmark
+Runs one api_bench.py scenario against gunicorn with increasing worker counts
+on the same box and reports throughput and p95 per count, plus the speed-up
+over a single worker. Scaling is bounded by the CPUs available to the pod.
+
+Usage: python3 benchmarks/api/worker_scaling.py --workers 1 2 4 --scenario auth_reads --concurrency 32
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--scenario", default="auth_reads")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--output", help="Write the scaling table as JSON here")
+    args = parser.parse_args()
+
+    rows = []
+    for workers in args.workers:
+        with tempfile.NamedTemporaryFile(suffix=".json") as out:
+            subprocess.run([sys.executable, os.path.join(HERE, "api_bench.py"), "--scenario", args.scenario,
+                            "--workers", str(workers), "--concurrency", str(args.concurrency),
+                            "--duration", str(args.duration), "--output", out.name, "--baseline", out.name + ".none"],
+                           check=True, stdout=subprocess.DEVNULL)
+            result = json.load(open(out.name))["scenarios"][args.scenario]
+        rows.append({"workers": workers, "throughput_rps": result["throughput_rps"], "p95_ms": result["p95_ms"],
+                     "error_rate": result["error_rate"]})
+        print(json.dumps(rows[-1]), flush=True)
+
+    base = rows[0]["throughput_rps"] or 1
+    print(f"\n{'workers':>7} {'rps':>9} {'speed-up':>9} {'p95 ms':>9} {'errors':>7}   (cpus: {os.cpu_count()})")
+    for row in rows:
+        row["speedup"] = round(row["throughput_rps"] / base, 2)
+        print(f"{row['workers']:>7} {row['throughput_rps']:>9} {row['speedup']:>8}x {row['p95_ms']!s:>9} {row['error_rate']:>7.2%}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"scenario": args.scenario, "cpus": os.cpu_count(), "concurrency": args.concurrency, "rows": rows}, f, indent=2)
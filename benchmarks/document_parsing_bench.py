@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Document Parsing Benchmark
+Measures pages/sec of the ingestion parsing stage on a generated corpus of
+mixed PDF/DOCX/TXT documents, for one or more worker counts.
+
+Usage: python3 benchmarks/document_parsing_bench.py --docs 60 --pages 20 --workers 1 2 4
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import importlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+LOREM = ("The quick brown fox jumps over the lazy dog while the tenant archive is "
+         "onboarded into the document processor module. ") * 12
+
+
+def write_txt(path, pages):
+    with open(path, "w") as f:
+        for i in range(pages):
+            f.write(f"Page {i + 1}\n")
+            # ~4000 characters per page, matching the default TXT_PAGE_CHARS
+            for _ in range(4):
+                f.write(LOREM + "\n")
+
+
+def write_docx(path, pages):
+    import docx
+    document = docx.Document()
+    for i in range(pages * 40):
+        document.add_paragraph(f"Paragraph {i + 1}. {LOREM[:200]}")
+    document.save(path)
+
+
+def write_pdf(path, pages):
+    """Writes a minimal multi-page PDF with one text line per page (no extra dependencies)."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for i in range(pages):
+        text = f"Page {i + 1} {LOREM[:180]}".replace("(", "").replace(")", "")
+        stream = f"BT /F1 10 Tf 20 700 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        content_ref = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_ref} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for n, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for off in offsets:
+        out += f"{off:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+WRITERS = {"txt": write_txt, "docx": write_docx, "pdf": write_pdf}
+
+
+def build_corpus(directory, docs, pages):
+    paths = []
+    formats = list(WRITERS)
+    for i in range(docs):
+        fmt = formats[i % len(formats)]
+        path = os.path.join(directory, f"doc_{i}.{fmt}")
+        WRITERS[fmt](path, pages)
+        paths.append(path)
+    return paths
+
+
+def run(paths, workers):
+    os.environ["DOCUMENT_PARSE_WORKERS"] = str(workers)
+    import document_parsing
+    document_parsing = importlib.reload(document_parsing)
+    document_parsing.get_parse_pool()  # exclude pool start-up from the measurement
+    pages, chars, failed = 0, 0, 0
+    start = time.perf_counter()
+    for _, page_no, payload in document_parsing.stream_pages(paths):
+        if page_no is None:
+            failed += payload is not None
+            continue
+        pages += 1
+        chars += len(payload)
+    elapsed = time.perf_counter() - start
+    document_parsing.shutdown_parse_pool()
+    return {"workers": workers, "documents": len(paths), "pages": pages, "failed_documents": failed,
+            "seconds": round(elapsed, 3), "pages_per_sec": round(pages / elapsed, 1), "chars": chars}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=60)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        corpus = build_corpus(corpus_dir, args.docs, args.pages)
+        for w in args.workers:
+            print(json.dumps(run(corpus, w)))
@@ -1,4 +1,5 @@
 import React, { useState, useEffect } from 'react';
+import { useLiveUpdates } from './liveUpdates';
 
 function AuditLog({ tenantId, token }) {
   const [auditLog, setAuditLog] = useState([]);
@@ -28,6 +29,12 @@ function AuditLog({ tenantId, token }) {
     fetchAuditLog();
   }, [tenantId, token]);
 
+  // New entries are pushed by the backend instead of refetching the whole log
+  useLiveUpdates(tenantId, token, ['audit_log'], event => {
+    if (event.type === 'reset') fetchAuditLog();
+    else setAuditLog(entries => [event.data, ...entries]);
+  });
+
   return (
     <div>
       <h2>Audit Log</h2>
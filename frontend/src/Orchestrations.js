@@ -5,6 +5,8 @@ function Orchestrations({ tenantId, token }) {
   const [loading, setLoading] = useState(false);
   const [newOrchestrationName, setNewOrchestrationName] = useState('');
   const [pipeline, setPipeline] = useState([{ module: '', config: '' }]);
+  // Latest run per orchestration, polled until it is no longer queued or running
+  const [runs, setRuns] = useState({});
 
   const fetchOrchestrations = () => {
     if (!token) return;
@@ -70,17 +72,39 @@ function Orchestrations({ tenantId, token }) {
     fetchOrchestrations();
   };
 
+  const pollRun = (orchestrationId, runId) => {
+    fetch(`/orchestrations/${orchestrationId}/runs/${runId}`, {
+      headers: {
+        'X-Tenant-ID': tenantId,
+        'Authorization': `Bearer ${token}`
+      }
+    })
+      .then(res => res.json())
+      .then(run => {
+        setRuns(current => ({ ...current, [orchestrationId]: run }));
+        if (run.status === 'queued' || run.status === 'running') {
+          setTimeout(() => pollRun(orchestrationId, runId), 2000);
+        }
+      })
+      .catch(err => console.error("Error fetching orchestration run:", err));
+  };
+
   const triggerOrchestration = async (orchestrationId) => {
     if (!token) return;
     setLoading(true);
-    await fetch(`/orchestrations/${orchestrationId}/trigger`, {
+    const res = await fetch(`/orchestrations/${orchestrationId}/trigger`, {
       method: 'POST',
       headers: {
         'X-Tenant-ID': tenantId,
         'Authorization': `Bearer ${token}`
       }
     });
-    fetchOrchestrations();
+    const run = await res.json();
+    setLoading(false);
+    if (run.run_id) {
+      setRuns(current => ({ ...current, [orchestrationId]: run }));
+      pollRun(orchestrationId, run.run_id);
+    }
   };
 
   return (
@@ -121,6 +145,14 @@ function Orchestrations({ tenantId, token }) {
           <li key={orch.id}>
             {orch.name}
             <button onClick={() => triggerOrchestration(orch.id)} disabled={loading}>Trigger</button>
+            {runs[orch.id] && (
+              <span>
+                {' '}Last run: {runs[orch.id].status}
+                {(runs[orch.id].results || []).map((step, index) => (
+                  <span key={index}> [{step.module}: {step.status}{step.error ? ` - ${step.error}` : ''}]</span>
+                ))}
+              </span>
+            )}
           </li>
         ))}
       </ul>
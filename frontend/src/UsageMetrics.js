@@ -1,4 +1,5 @@
 import React, { useState, useEffect } from 'react';
+import { useLiveUpdates } from './liveUpdates';
 
 function UsageMetrics({ tenantId, token }) {
   const [metrics, setMetrics] = useState([]);
@@ -28,6 +29,11 @@ function UsageMetrics({ tenantId, token }) {
     fetchMetrics();
   }, [tenantId, token]);
 
+  useLiveUpdates(tenantId, token, ['usage_metrics'], event => {
+    if (event.type === 'reset') fetchMetrics();
+    else setMetrics(entries => [...entries, event.data]);
+  });
+
   return (
     <div>
       <h2>Usage Metrics</h2>
@@ -1,5 +1,6 @@
 import React, { useState, useEffect, useCallback } from 'react';
 import keycloak from '../../../keycloak';
+import { useLiveUpdates } from '../../../liveUpdates';
 
 const ModuleManagement = () => {
   const [modules, setModules] = useState([]);
@@ -49,6 +50,16 @@ const ModuleManagement = () => {
     fetchModules();
   }, [fetchModules]);
 
+  // Activations from other sessions (or other users of the tenant) show up without a reload
+  useLiveUpdates(getTenantId(), keycloak.token, ['modules'], event => {
+    if (event.type === 'reset') {
+      fetchModules();
+    } else {
+      const { module, active } = event.data;
+      setActiveModules(names => active ? [...new Set([...names, module])] : names.filter(name => name !== module));
+    }
+  });
+
   const handleToggleModule = async (moduleName, isActive) => {
     try {
       const tenantId = getTenantId();
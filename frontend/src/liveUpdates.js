@@ -0,0 +1,141 @@
+import { useEffect, useRef } from 'react';
+
+// One live connection per tenant and token, shared by every component that listens.
+// Uses the backend's /live/ws WebSocket and falls back to /live/events (SSE) when the
+// WebSocket cannot be opened. Reconnects resume from the last event id received.
+// Every connect first fetches a one-time ticket from /live/ticket (the token never goes
+// into a URL): the WebSocket sends it as a subprotocol, SSE gets it as a cookie.
+const connections = {};
+
+const RECONNECT_MIN_MS = 1000;
+const RECONNECT_MAX_MS = 30000;
+
+function createConnection(tenantId, token) {
+  const listeners = new Set();
+  let lastId = null;
+  let socket = null;
+  let source = null;
+  let useSse = typeof WebSocket === 'undefined';
+  let delay = RECONNECT_MIN_MS;
+  let timer = null;
+  let closed = false;
+
+  const dispatch = (event) => {
+    if (event.type === 'ping') return;
+    if (event.id) lastId = event.id;
+    listeners.forEach(listener => listener(event));
+  };
+
+  const query = () => {
+    const params = new URLSearchParams();
+    if (lastId) params.set('last_id', lastId);
+    return params.toString();
+  };
+
+  const fetchTicket = async () => {
+    const res = await fetch('/live/ticket', {
+      method: 'POST',
+      credentials: 'same-origin',
+      headers: {
+        'X-Tenant-ID': tenantId,
+        'Authorization': `Bearer ${token}`
+      }
+    });
+    if (!res.ok) throw new Error(`live ticket: ${res.status}`);
+    return (await res.json()).ticket;
+  };
+
+  const scheduleReconnect = () => {
+    if (closed || timer) return;
+    timer = setTimeout(() => {
+      timer = null;
+      open();
+    }, delay);
+    delay = Math.min(delay * 2, RECONNECT_MAX_MS);
+  };
+
+  const openSse = () => {
+    // The ticket cookie is used up by this connection, so EventSource's own reconnect would be refused:
+    // close it on error and reconnect with a new ticket and last_id instead
+    source = new EventSource(`/live/events?${query()}`, { withCredentials: true });
+    source.onopen = () => { delay = RECONNECT_MIN_MS; };
+    source.onmessage = (message) => dispatch(JSON.parse(message.data));
+    source.onerror = () => {
+      source.close();
+      source = null;
+      scheduleReconnect();
+    };
+  };
+
+  const openWebSocket = (ticket) => {
+    const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+    let opened = false;
+    socket = new WebSocket(`${scheme}://${window.location.host}/live/ws?${query()}`, ['live', `ticket.${ticket}`]);
+    socket.onopen = () => {
+      opened = true;
+      delay = RECONNECT_MIN_MS;
+    };
+    socket.onmessage = (message) => dispatch(JSON.parse(message.data));
+    socket.onclose = () => {
+      socket = null;
+      // Never got through (blocked by a proxy): use SSE from now on
+      if (!opened) useSse = true;
+      scheduleReconnect();
+    };
+  };
+
+  const open = async () => {
+    if (closed) return;
+    let ticket;
+    try {
+      // Also sets the ticket cookie that /live/events reads
+      ticket = await fetchTicket();
+    } catch (err) {
+      console.error("Error opening live updates:", err);
+      scheduleReconnect();
+      return;
+    }
+    if (closed) return;
+    if (useSse) openSse();
+    else openWebSocket(ticket);
+  };
+
+  open();
+
+  return {
+    listeners,
+    close() {
+      closed = true;
+      clearTimeout(timer);
+      if (socket) socket.close();
+      if (source) source.close();
+    },
+  };
+}
+
+// Calls onEvent(event) for every change of the tenant in one of `topics`
+// ({id, topic, op, data}) and with {type: 'reset'} when events were missed
+// and the caller should refetch.
+export function useLiveUpdates(tenantId, token, topics, onEvent) {
+  const handler = useRef(onEvent);
+  handler.current = onEvent;
+  const topicKey = topics.join(',');
+
+  useEffect(() => {
+    if (!tenantId || !token) return undefined;
+    const key = `${tenantId}:${token}`;
+    const connection = connections[key] || (connections[key] = createConnection(tenantId, token));
+    const wanted = new Set(topicKey.split(','));
+    const listener = (event) => {
+      if (event.type === 'reset' || wanted.has(event.topic)) handler.current(event);
+    };
+    connection.listeners.add(listener);
+    return () => {
+      connection.listeners.delete(listener);
+      if (connection.listeners.size === 0) {
+        connection.close();
+        delete connections[key];
+      }
+    };
+  }, [tenantId, token, topicKey]);
+}
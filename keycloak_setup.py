@@ -1,35 +1,113 @@
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
 
-KEYCLOAK_URL = "http://localhost:8080"
-ADMIN_USER = "admin"
-ADMIN_PASS = "admin"
-REALM = "saas-platform"
+KEYCLOAK_URL = os.environ.get("KEYCLOAK_URL", "http://localhost:8080")
+ADMIN_USER = os.environ.get("KEYCLOAK_ADMIN", "admin")
+ADMIN_PASS = os.environ.get("KEYCLOAK_ADMIN_PASSWORD", "admin")
+REALM = os.environ.get("KEYCLOAK_REALM", "saas-platform")
 CLIENT_ID = "saas-frontend"
 USER_NAME = "testuser"
 USER_PASS = "testpass"
 
+# Bulk import tuning
+HTTP_POOL_SIZE = 32
+TOKEN_REFRESH_MARGIN = 30  # seconds before expiry at which the admin token is refreshed
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Shared keep-alive session for every admin call
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+
 # 1. Get admin access token
+class AdminToken:
+    """Admin token that refreshes itself shortly before it expires (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._refresh_token = None
+        self._expires_at = 0
+        self._refresh_expires_at = 0
+
+    def _request(self, data):
+        url = f"{KEYCLOAK_URL}/realms/master/protocol/openid-connect/token"
+        resp = session.post(url, data=dict(data, client_id="admin-cli"))
+        resp.raise_for_status()
+        body = resp.json()
+        now = time.monotonic()
+        self._access_token = body["access_token"]
+        self._refresh_token = body.get("refresh_token")
+        self._expires_at = now + body.get("expires_in", 60)
+        self._refresh_expires_at = now + body.get("refresh_expires_in", 0)
+
+    def get(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._access_token and now < self._expires_at - TOKEN_REFRESH_MARGIN:
+                return self._access_token
+            if self._refresh_token and now < self._refresh_expires_at - TOKEN_REFRESH_MARGIN:
+                try:
+                    self._request({"grant_type": "refresh_token", "refresh_token": self._refresh_token})
+                    return self._access_token
+                except requests.RequestException:
+                    pass
+            self._request({"grant_type": "password", "username": ADMIN_USER, "password": ADMIN_PASS})
+            return self._access_token
+
+    def invalidate(self, rejected):
+        """Forces a refresh on the next get(), unless another thread already replaced the rejected token."""
+        with self._lock:
+            if self._access_token == rejected:
+                self._expires_at = 0
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.get()}", "Content-Type": "application/json"}
+
+
 def get_admin_token():
-    url = f"{KEYCLOAK_URL}/realms/master/protocol/openid-connect/token"
-    data = {
-        "grant_type": "password",
-        "client_id": "admin-cli",
-        "username": ADMIN_USER,
-        "password": ADMIN_PASS
-    }
-    resp = requests.post(url, data=data)
-    resp.raise_for_status()
-    return resp.json()["access_token"]
+    return AdminToken()
+
+
+def admin_request(token, method, path, **kwargs):
+    """Admin API call with retry and exponential backoff on 429/5xx and connection errors."""
+    url = f"{KEYCLOAK_URL}/admin/realms{path}"
+    for attempt in range(MAX_RETRIES):
+        try:
+            headers = token.headers()
+            resp = session.request(method, url, headers=headers, timeout=30, **kwargs)
+            if resp.status_code == 401 and attempt == 0:
+                # Token revoked or clock skew; force a refresh and retry
+                token.invalidate(headers["Authorization"][len("Bearer "):])
+                continue
+            if resp.status_code not in RETRY_STATUSES:
+                return resp
+        except requests.ConnectionError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+        time.sleep(min(10, 0.2 * 2 ** attempt) * (0.5 + random.random()))
+    return resp
+
 
 # 2. Create realm
 def create_realm(token):
-    url = f"{KEYCLOAK_URL}/admin/realms"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     data = {
         "realm": REALM,
         "enabled": True
     }
-    resp = requests.post(url, json=data, headers=headers)
+    resp = admin_request(token, "POST", "", json=data)
     if resp.status_code == 409:
         print(f"Realm '{REALM}' already exists.")
     else:
@@ -38,8 +116,6 @@ def create_realm(token):
 
 # 3. Create client
 def create_client(token):
-    url = f"{KEYCLOAK_URL}/admin/realms/{REALM}/clients"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     data = {
         "clientId": CLIENT_ID,
         "enabled": True,
@@ -48,7 +124,7 @@ def create_client(token):
         "webOrigins": ["http://localhost:3000"],
         "protocol": "openid-connect"
     }
-    resp = requests.post(url, json=data, headers=headers)
+    resp = admin_request(token, "POST", f"/{REALM}/clients", json=data)
     if resp.status_code == 409:
         print(f"Client '{CLIENT_ID}' already exists.")
     else:
@@ -57,35 +133,139 @@ def create_client(token):
 
 # 4. Create user
 def create_user(token):
-    url = f"{KEYCLOAK_URL}/admin/realms/{REALM}/users"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     data = {
         "username": USER_NAME,
         "enabled": True
     }
-    resp = requests.post(url, json=data, headers=headers)
+    resp = admin_request(token, "POST", f"/{REALM}/users", json=data)
     if resp.status_code == 409:
         print(f"User '{USER_NAME}' already exists.")
     else:
         resp.raise_for_status()
         print(f"User '{USER_NAME}' created.")
     # Get user ID
-    resp = requests.get(url, headers=headers, params={"username": USER_NAME})
+    resp = admin_request(token, "GET", f"/{REALM}/users", params={"username": USER_NAME, "exact": "true"})
     user_id = resp.json()[0]["id"]
     # Set password
-    url_pw = f"{KEYCLOAK_URL}/admin/realms/{REALM}/users/{user_id}/reset-password"
     pw_data = {
         "type": "password",
         "value": USER_PASS,
         "temporary": False
     }
-    resp = requests.put(url_pw, json=pw_data, headers=headers)
+    resp = admin_request(token, "PUT", f"/{REALM}/users/{user_id}/reset-password", json=pw_data)
     resp.raise_for_status()
     print(f"Password set for user '{USER_NAME}'.")
 
+
+# 5. Bulk user import
+def load_users(path):
+    """Reads users from a JSON list or a CSV with at least a 'username' column."""
+    with open(path) as f:
+        if path.endswith(".csv"):
+            return list(csv.DictReader(f))
+        return json.load(f)
+
+
+def user_representation(user):
+    rep = {
+        "username": user["username"],
+        "enabled": True,
+        "email": user.get("email") or None,
+        "firstName": user.get("firstName") or None,
+        "lastName": user.get("lastName") or None,
+        "attributes": {"tenant_id": [user["tenant_id"]]} if user.get("tenant_id") else None,
+    }
+    if user.get("password"):
+        rep["credentials"] = [{"type": "password", "value": user["password"], "temporary": False}]
+    return {k: v for k, v in rep.items() if v is not None}
+
+
+class Checkpoint:
+    """Append-only file of imported usernames so an interrupted import resumes where it stopped."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.strip() for line in f if line.strip()}
+
+    def record(self, usernames):
+        if not self.path:
+            return
+        with self._lock, open(self.path, "a") as f:
+            f.writelines(f"{u}\n" for u in usernames)
+            self.done.update(usernames)
+
+
+def partial_import_users(token, users, checkpoint, batch_size=500):
+    """Imports users in batches via the realm partialImport endpoint (existing users are skipped)."""
+    imported = 0
+    for i in range(0, len(users), batch_size):
+        batch = users[i:i + batch_size]
+        resp = admin_request(token, "POST", f"/{REALM}/partialImport", json={
+            "ifResourceExists": "SKIP",
+            "users": [user_representation(u) for u in batch]
+        })
+        resp.raise_for_status()
+        checkpoint.record([u["username"] for u in batch])
+        imported += len(batch)
+        print(f"Imported {imported}/{len(users)} users.")
+    return imported, []
+
+
+def concurrent_create_users(token, users, checkpoint, concurrency=8):
+    """Creates users one request each with bounded concurrency; 409 counts as already imported."""
+    def create(user):
+        resp = admin_request(token, "POST", f"/{REALM}/users", json=user_representation(user))
+        if resp.status_code != 409:
+            resp.raise_for_status()
+        checkpoint.record([user["username"]])
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(create, u): u["username"] for u in users}
+        for done, future in enumerate(as_completed(futures), start=1):
+            if future.exception():
+                failed.append((futures[future], str(future.exception())))
+            if done % 100 == 0 or done == len(users):
+                print(f"Processed {done}/{len(users)} users ({len(failed)} failed).")
+    return len(users) - len(failed), failed
+
+
+def bulk_import_users(token, users, mode="partial-import", batch_size=500, concurrency=8, checkpoint_path=None):
+    checkpoint = Checkpoint(checkpoint_path)
+    pending = [u for u in users if u["username"] not in checkpoint.done]
+    if len(pending) < len(users):
+        print(f"Resuming: {len(users) - len(pending)} users already imported, {len(pending)} remaining.")
+    if mode == "partial-import":
+        return partial_import_users(token, pending, checkpoint, batch_size)
+    return concurrent_create_users(token, pending, checkpoint, concurrency)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keycloak realm, client and user setup")
+    parser.add_argument("--users-file", help="JSON or CSV file of users to bulk import")
+    parser.add_argument("--mode", choices=["partial-import", "concurrent"], default="partial-import")
+    parser.add_argument("--batch-size", type=int, default=500, help="Users per partialImport request")
+    parser.add_argument("--concurrency", type=int, default=8, help="Parallel user creations in concurrent mode")
+    parser.add_argument("--checkpoint", help="File recording imported usernames, used to resume")
+    args = parser.parse_args()
+
     token = get_admin_token()
     create_realm(token)
     create_client(token)
-    create_user(token)
+    if args.users_file:
+        imported, failed = bulk_import_users(
+            token, load_users(args.users_file), mode=args.mode, batch_size=args.batch_size,
+            concurrency=args.concurrency, checkpoint_path=args.checkpoint
+        )
+        for username, error in failed:
+            print(f"Failed to import '{username}': {error}")
+        print(f"Bulk import complete: {imported} imported, {len(failed)} failed.")
+        if failed:
+            sys.exit(1)
+    else:
+        create_user(token)
     print("Keycloak setup complete.")
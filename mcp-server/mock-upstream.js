@@ -0,0 +1,85 @@
+// Local stand-in for the OpenAI, Anthropic and Google APIs, for exercising the
+// MCP server without keys or network access. Point the server at it with
+// OPENAI_BASE_URL / ANTHROPIC_BASE_URL / GOOGLE_BASE_URL=http://localhost:3099
+// and any API key.
+//
+//   MOCK_LATENCY_MS=200 node mock-upstream.js
+//
+// GET /stats reports requests per provider, peak concurrency and the number of
+// distinct TCP connections seen, which shows keep-alive reuse, coalescing and
+// the concurrency limits at work. POST /stats/reset clears them. A prompt
+// containing "[429]" or "[500]" makes the mock answer with that status.
+const http = require('http');
+
+const port = parseInt(process.env.MOCK_PORT || '3099', 10);
+const latencyMs = parseInt(process.env.MOCK_LATENCY_MS || '200', 10);
+
+let stats;
+function resetStats() {
+  stats = { requests: { openai: 0, anthropic: 0, google: 0 }, active: 0, peak_active: 0, connections: 0 };
+}
+resetStats();
+
+function reply(prompt) {
+  return `mock answer to: ${prompt.slice(-80)}`;
+}
+
+const routes = [
+  ['openai', /^\/v1\/chat\/completions$/, (body) => ({
+    id: 'chatcmpl-mock', model: body.model,
+    choices: [{ index: 0, message: { role: 'assistant', content: reply(body.messages.at(-1).content) }, finish_reason: 'stop' }],
+    usage: { prompt_tokens: 10, completion_tokens: 8 }
+  }), (body) => body.messages.at(-1).content],
+  ['anthropic', /^\/v1\/messages$/, (body) => ({
+    id: 'msg-mock', model: body.model, role: 'assistant',
+    content: [{ type: 'text', text: reply(body.messages.at(-1).content) }],
+    usage: { input_tokens: 10, output_tokens: 8 }
+  }), (body) => body.messages.at(-1).content],
+  ['google', /^\/v1beta\/models\/[^/]+:generateContent$/, (body) => ({
+    candidates: [{ content: { role: 'model', parts: [{ text: reply(body.contents.at(-1).parts[0].text) }] } }],
+    usageMetadata: { promptTokenCount: 10, candidatesTokenCount: 8 }
+  }), (body) => body.contents.at(-1).parts[0].text]
+];
+
+function send(res, status, body) {
+  res.writeHead(status, { 'Content-Type': 'application/json' });
+  res.end(JSON.stringify(body));
+}
+
+const server = http.createServer((req, res) => {
+  let raw = '';
+  req.on('data', (chunk) => { raw += chunk; });
+  req.on('end', () => {
+    if (req.url === '/stats') {
+      return send(res, 200, stats);
+    }
+    if (req.url === '/stats/reset') {
+      resetStats();
+      return send(res, 200, stats);
+    }
+    const route = routes.find(([, pattern]) => pattern.test(req.url.split('?')[0]));
+    if (!route || req.method !== 'POST') {
+      return send(res, 404, { error: 'not found' });
+    }
+    const [name, , respond, promptOf] = route;
+    const body = JSON.parse(raw || '{}');
+    stats.requests[name] += 1;
+    stats.active += 1;
+    stats.peak_active = Math.max(stats.peak_active, stats.active);
+    setTimeout(() => {
+      stats.active -= 1;
+      const forced = /\[(429|500)\]/.exec(promptOf(body));
+      if (forced) {
+        res.setHeader('Retry-After', '2');
+        return send(res, parseInt(forced[1], 10), { error: { message: `mock ${forced[1]}` } });
+      }
+      send(res, 200, respond(body));
+    }, latencyMs);
+  });
+});
+
+server.on('connection', () => { stats.connections += 1; });
+
+server.listen(port, () => {
+  console.log(`Mock upstream listening at http://localhost:${port} (latency ${latencyMs}ms)`);
+});
@@ -0,0 +1,190 @@
+// Cloud LLM providers behind the MCP server. Each provider gets one axios
+// instance with keep-alive agents (connections are reused across requests
+// instead of a TLS handshake per call), a concurrency limit with a bounded
+// FIFO queue, and an adapter that maps the provider's API onto a common
+// { text, model, usage } result.
+const http = require('http');
+const https = require('https');
+const crypto = require('crypto');
+const axios = require('axios');
+
+const QUEUE_LIMIT = parseInt(process.env.PROVIDER_QUEUE_LIMIT || '256', 10);
+const QUEUE_TIMEOUT_MS = parseInt(process.env.PROVIDER_QUEUE_TIMEOUT_MS || '30000', 10);
+const UPSTREAM_TIMEOUT_MS = parseInt(process.env.UPSTREAM_TIMEOUT_MS || '120000', 10);
+const DEFAULT_MAX_TOKENS = 512;
+
+const ADAPTERS = {
+  openai: {
+    baseUrl: process.env.OPENAI_BASE_URL || 'https://api.openai.com',
+    apiKey: process.env.OPENAI_API_KEY,
+    model: process.env.OPENAI_MODEL || 'gpt-4o-mini',
+    request: ({ prompt, model, maxTokens, apiKey }) => ({
+      path: '/v1/chat/completions',
+      headers: { Authorization: `Bearer ${apiKey}` },
+      body: { model, messages: [{ role: 'user', content: prompt }], max_tokens: maxTokens }
+    }),
+    parse: (data) => ({
+      text: data.choices[0].message.content,
+      usage: { prompt_tokens: data.usage?.prompt_tokens, completion_tokens: data.usage?.completion_tokens }
+    })
+  },
+  anthropic: {
+    baseUrl: process.env.ANTHROPIC_BASE_URL || 'https://api.anthropic.com',
+    apiKey: process.env.ANTHROPIC_API_KEY,
+    model: process.env.ANTHROPIC_MODEL || 'claude-3-5-haiku-latest',
+    request: ({ prompt, model, maxTokens, apiKey }) => ({
+      path: '/v1/messages',
+      headers: { 'x-api-key': apiKey, 'anthropic-version': '2023-06-01' },
+      body: { model, messages: [{ role: 'user', content: prompt }], max_tokens: maxTokens }
+    }),
+    parse: (data) => ({
+      text: data.content.filter((block) => block.type === 'text').map((block) => block.text).join(''),
+      usage: { prompt_tokens: data.usage?.input_tokens, completion_tokens: data.usage?.output_tokens }
+    })
+  },
+  google: {
+    baseUrl: process.env.GOOGLE_BASE_URL || 'https://generativelanguage.googleapis.com',
+    apiKey: process.env.GOOGLE_API_KEY,
+    model: process.env.GOOGLE_MODEL || 'gemini-1.5-flash',
+    request: ({ prompt, model, maxTokens, apiKey }) => ({
+      path: `/v1beta/models/${encodeURIComponent(model)}:generateContent`,
+      headers: { 'x-goog-api-key': apiKey },
+      body: { contents: [{ role: 'user', parts: [{ text: prompt }] }], generationConfig: { maxOutputTokens: maxTokens } }
+    }),
+    parse: (data) => ({
+      text: (data.candidates?.[0]?.content?.parts || []).map((part) => part.text || '').join(''),
+      usage: { prompt_tokens: data.usageMetadata?.promptTokenCount, completion_tokens: data.usageMetadata?.candidatesTokenCount }
+    })
+  }
+};
+
+class ProviderError extends Error {
+  constructor(status, message, retryAfter) {
+    super(message);
+    this.status = status;
+    this.retryAfter = retryAfter;
+  }
+}
+
+// Counting semaphore with a bounded FIFO queue. Rejects instead of queueing
+// without bound, so an upstream slowdown turns into fast 503s for callers
+// rather than unbounded memory and latency in this process.
+class Limiter {
+  constructor(limit) {
+    this.limit = limit;
+    this.active = 0;
+    this.waiting = [];
+    this.rejected = 0;
+  }
+
+  async run(task) {
+    await this.acquire();
+    try {
+      return await task();
+    } finally {
+      this.release();
+    }
+  }
+
+  acquire() {
+    if (this.active < this.limit) {
+      this.active += 1;
+      return Promise.resolve();
+    }
+    if (this.waiting.length >= QUEUE_LIMIT) {
+      this.rejected += 1;
+      return Promise.reject(new ProviderError(503, 'Provider queue is full', 1));
+    }
+    return new Promise((resolve, reject) => {
+      const entry = { resolve, reject };
+      entry.timer = setTimeout(() => {
+        this.waiting.splice(this.waiting.indexOf(entry), 1);
+        this.rejected += 1;
+        reject(new ProviderError(503, `Timed out after ${QUEUE_TIMEOUT_MS}ms waiting for a provider slot`, 1));
+      }, QUEUE_TIMEOUT_MS);
+      this.waiting.push(entry);
+    });
+  }
+
+  release() {
+    const next = this.waiting.shift();
+    if (next) {
+      // The slot passes straight to the next waiter; active stays the same
+      clearTimeout(next.timer);
+      next.resolve();
+    } else {
+      this.active -= 1;
+    }
+  }
+}
+
+class Provider {
+  constructor(name, adapter) {
+    const limit = parseInt(process.env[`${name.toUpperCase()}_CONCURRENCY`] || process.env.PROVIDER_CONCURRENCY || '16', 10);
+    const agentOptions = { keepAlive: true, maxSockets: limit, maxFreeSockets: limit };
+    this.name = name;
+    this.adapter = adapter;
+    this.limiter = new Limiter(limit);
+    this.client = axios.create({
+      baseURL: adapter.baseUrl,
+      timeout: UPSTREAM_TIMEOUT_MS,
+      httpAgent: new http.Agent(agentOptions),
+      httpsAgent: new https.Agent(agentOptions)
+    });
+    this.inflight = new Map();
+    this.stats = { requests: 0, upstream_calls: 0, coalesced: 0, errors: 0 };
+  }
+
+  // Identical requests that arrive while one is already in flight share its
+  // upstream call. The key covers everything that shapes the answer plus the
+  // API key, so tenants with their own keys are never billed for each other.
+  generate({ prompt, model, maxTokens, apiKey }) {
+    const request = {
+      prompt,
+      model: model || this.adapter.model,
+      maxTokens: maxTokens || DEFAULT_MAX_TOKENS,
+      apiKey: apiKey || this.adapter.apiKey
+    };
+    if (!request.apiKey) {
+      return Promise.reject(new ProviderError(500, `${this.name} API key not configured`));
+    }
+    this.stats.requests += 1;
+    const key = crypto.createHash('sha256')
+      .update(JSON.stringify([request.model, request.maxTokens, request.apiKey, request.prompt]))
+      .digest('hex');
+    const pending = this.inflight.get(key);
+    if (pending) {
+      this.stats.coalesced += 1;
+      return pending.then((result) => ({ ...result, coalesced: true }));
+    }
+    const call = this.limiter.run(() => this.call(request)).finally(() => this.inflight.delete(key));
+    this.inflight.set(key, call);
+    return call;
+  }
+
+  async call(request) {
+    const { path, headers, body } = this.adapter.request(request);
+    this.stats.upstream_calls += 1;
+    try {
+      const response = await this.client.post(path, body, { headers });
+      return { provider: this.name, model: request.model, ...this.adapter.parse(response.data) };
+    } catch (error) {
+      this.stats.errors += 1;
+      if (error.response) {
+        // Upstream rate limits are passed through so callers can back off; anything else is a bad gateway
+        const status = error.response.status === 429 ? 429 : 502;
+        throw new ProviderError(status, `${this.name} returned ${error.response.status}`, error.response.headers?.['retry-after']);
+      }
+      throw new ProviderError(502, `${this.name} request failed: ${error.message}`);
+    }
+  }
+
+  snapshot() {
+    return { ...this.stats, active: this.limiter.active, queued: this.limiter.waiting.length, rejected: this.limiter.rejected,
+             limit: this.limiter.limit, inflight: this.inflight.size };
+  }
+}
+
+const providers = Object.fromEntries(Object.entries(ADAPTERS).map(([name, adapter]) => [name, new Provider(name, adapter)]));
+
+module.exports = { providers, ProviderError };
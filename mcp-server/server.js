@@ -1,38 +1,52 @@
+require('./tracing');
 const express = require('express');
-const axios = require('axios');
+const { providers, ProviderError } = require('./providers');
 const app = express();
 const port = process.env.PORT || 3002;
 
-app.use(express.json());
+app.use(express.json({ limit: '2mb' }));
 
 app.get('/', (req, res) => {
   res.send('MCP Server is running');
 });
 
-app.post('/openai', async (req, res) => {
-  const { prompt } = req.body;
-  const apiKey = process.env.OPENAI_API_KEY;
+// Per-provider counters: requests, upstream calls, coalesced requests, queue depth and rejections
+app.get('/stats', (req, res) => {
+  res.json(Object.fromEntries(Object.entries(providers).map(([name, provider]) => [name, provider.snapshot()])));
+});
 
-  if (!apiKey) {
-    return res.status(500).json({ error: 'OpenAI API key not configured' });
+async function generate(req, res, providerName) {
+  const { prompt, model, max_tokens: maxTokens, api_key: apiKey } = req.body;
+  const provider = providers[providerName];
+  if (!provider) {
+    return res.status(400).json({ error: `Unknown provider '${providerName}', expected one of: ${Object.keys(providers).join(', ')}` });
+  }
+  if (!prompt) {
+    return res.status(400).json({ error: 'prompt is required' });
   }
 
   try {
-    const response = await axios.post('https://api.openai.com/v1/completions', {
-      model: 'text-davinci-003',
-      prompt: prompt,
-      max_tokens: 150
-    }, {
-      headers: {
-        'Authorization': `Bearer ${apiKey}`
-      }
-    });
-    res.json(response.data);
+    const result = await provider.generate({ prompt, model, maxTokens, apiKey });
+    // `choices[0].text` keeps the completions shape existing callers parse
+    res.json({ ...result, choices: [{ text: result.text }] });
   } catch (error) {
-    res.status(500).json({ error: error.message });
+    if (!(error instanceof ProviderError)) {
+      return res.status(500).json({ error: error.message });
+    }
+    if (error.retryAfter) {
+      res.set('Retry-After', String(error.retryAfter));
+    }
+    res.status(error.status).json({ error: error.message, provider: providerName });
   }
-});
+}
+
+// Routes to the provider the caller resolved for the tenant (openai, anthropic or google).
+// `api_key` and `model` come from the tenant's provider integration; without them the
+// service-wide key and default model for that provider are used.
+app.post('/generate', (req, res) => generate(req, res, req.body.provider || 'openai'));
+
+app.post('/openai', (req, res) => generate(req, res, 'openai'));
 
 app.listen(port, () => {
   console.log(`MCP Server listening at http://localhost:${port}`);
-});
\ No newline at end of file
+});
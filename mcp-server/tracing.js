@@ -0,0 +1,24 @@
+// OpenTelemetry setup for the MCP server. Required before express/axios so the
+// HTTP instrumentations can patch them; incoming W3C traceparent headers from the
+// backend are continued and propagated to upstream AI providers.
+const { NodeSDK } = require('@opentelemetry/sdk-node');
+const { HttpInstrumentation } = require('@opentelemetry/instrumentation-http');
+const { ExpressInstrumentation } = require('@opentelemetry/instrumentation-express');
+const { OTLPTraceExporter } = require('@opentelemetry/exporter-trace-otlp-http');
+const { ParentBasedSampler, TraceIdRatioBasedSampler } = require('@opentelemetry/sdk-trace-base');
+
+const exporter = process.env.OTEL_TRACES_EXPORTER || 'none';
+
+if (exporter === 'otlp') {
+  const endpoint = process.env.OTEL_EXPORTER_OTLP_ENDPOINT || 'http://otel-collector:4318';
+  const sdk = new NodeSDK({
+    serviceName: process.env.OTEL_SERVICE_NAME || 'mcp-server',
+    traceExporter: new OTLPTraceExporter({ url: `${endpoint}/v1/traces` }),
+    sampler: new ParentBasedSampler({
+      root: new TraceIdRatioBasedSampler(parseFloat(process.env.OTEL_TRACES_SAMPLER_ARG || '0.05'))
+    }),
+    instrumentations: [new HttpInstrumentation(), new ExpressInstrumentation()]
+  });
+  sdk.start();
+  process.on('SIGTERM', () => sdk.shutdown().finally(() => process.exit(0)));
+}
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Mock Keycloak Admin Server
+Minimal in-memory stand-in for the Keycloak endpoints used by keycloak_setup.py,
+for exercising bulk imports locally without a real Keycloak.
+
+Usage:
+  python3 mock_keycloak_server.py --port 8081 --token-ttl 60 --fail-rate 0.05
+  KEYCLOAK_URL=http://localhost:8081 python3 keycloak_setup.py --users-file users.json
+"""
+
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STATE = {"realms": {}, "tokens": {}, "refresh_tokens": {}, "requests": 0}
+LOCK = threading.Lock()
+CONFIG = {"token_ttl": 60, "fail_rate": 0.0}
+
+
+def issue_tokens():
+    access, refresh = uuid.uuid4().hex, uuid.uuid4().hex
+    now = time.time()
+    STATE["tokens"][access] = now + CONFIG["token_ttl"]
+    STATE["refresh_tokens"][refresh] = now + CONFIG["token_ttl"] * 5
+    return {"access_token": access, "refresh_token": refresh, "token_type": "Bearer",
+            "expires_in": CONFIG["token_ttl"], "refresh_expires_in": CONFIG["token_ttl"] * 5}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status, body=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            return {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+        return json.loads(raw) if raw else {}
+
+    def _authorized(self):
+        token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+        return STATE["tokens"].get(token, 0) > time.time()
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        body = self._body()
+        with LOCK:
+            STATE["requests"] += 1
+        if url.path == "/realms/master/protocol/openid-connect/token":
+            with LOCK:
+                if body.get("grant_type") == "refresh_token":
+                    if STATE["refresh_tokens"].pop(body.get("refresh_token"), 0) < time.time():
+                        return self._send(400, {"error": "invalid_grant"})
+                return self._send(200, issue_tokens())
+        if not url.path.startswith("/admin/realms"):
+            return self._send(404, {"error": "not found"})
+        if not self._authorized():
+            return self._send(401, {"error": "HTTP 401 Unauthorized"})
+        if random.random() < CONFIG["fail_rate"]:
+            return self._send(503, {"error": "injected failure"})
+
+        with LOCK:
+            if url.path == "/admin/realms" and method == "POST":
+                if body["realm"] in STATE["realms"]:
+                    return self._send(409, {"errorMessage": "Conflict detected"})
+                STATE["realms"][body["realm"]] = {"clients": {}, "users": {}}
+                return self._send(201)
+            m = re.fullmatch(r"/admin/realms/([^/]+)(/.*)?", url.path)
+            realm = STATE["realms"].get(m.group(1)) if m else None
+            if realm is None:
+                return self._send(404, {"error": "Realm not found"})
+            sub = m.group(2) or ""
+            if sub == "/clients" and method == "POST":
+                if body["clientId"] in realm["clients"]:
+                    return self._send(409, {"errorMessage": "Conflict detected"})
+                realm["clients"][body["clientId"]] = body
+                return self._send(201)
+            if sub == "/users" and method == "POST":
+                if body["username"] in realm["users"]:
+                    return self._send(409, {"errorMessage": "User exists with same username"})
+                realm["users"][body["username"]] = dict(body, id=str(uuid.uuid4()))
+                return self._send(201)
+            if sub == "/users" and method == "GET":
+                username = parse_qs(url.query).get("username", [None])[0]
+                users = [u for u in realm["users"].values() if username in (None, u["username"])]
+                return self._send(200, users)
+            if sub == "/users/count" and method == "GET":
+                return self._send(200, len(realm["users"]))
+            if re.fullmatch(r"/users/[^/]+/reset-password", sub) and method == "PUT":
+                return self._send(204)
+            if sub == "/partialImport" and method == "POST":
+                added = skipped = 0
+                for user in body.get("users", []):
+                    if user["username"] in realm["users"]:
+                        skipped += 1
+                    else:
+                        realm["users"][user["username"]] = dict(user, id=str(uuid.uuid4()))
+                        added += 1
+                return self._send(200, {"added": added, "skipped": skipped, "overwritten": 0})
+        return self._send(404, {"error": "not found"})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Keycloak admin server")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--token-ttl", type=int, default=60, help="Admin token lifetime in seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of admin calls answered with 503")
+    args = parser.parse_args()
+    CONFIG.update(token_ttl=args.token_ttl, fail_rate=args.fail_rate)
+    print(f"Mock Keycloak listening at http://localhost:{args.port}")
+    ThreadingHTTPServer(("", args.port), Handler).serve_forever()
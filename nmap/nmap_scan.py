@@ -1,30 +1,144 @@
+import os
 import sys
 import json
+import time
+import threading
+import ipaddress
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Usage: python3 nmap_scan.py '{"targets": ["192.168.1.1"], "options": "-sV"}'
+#
+# Large target lists are split into shards that run as parallel nmap processes:
+#   {"targets": ["10.0.0.0/16"], "options": "-sV", "shard_size": 256, "workers": 8,
+#    "shard_timeout": 120, "retries": 1, "stream": true}
+# With "stream": true one JSON line (carrying that shard's XML report) is printed per
+# finished shard before the final result; otherwise each shard of the final result
+# carries its report. The backend merges the reports of a scan. A previous plan can be re-run with "shards": [{"index": 3, "targets": [...]}],
+# which is how failed shards are retried without rescanning completed ones.
+# "skip_shards": [0, 1] leaves out shards of the plan that already completed
+# (how the backend resumes a scan another instance was stopped in the middle of).
+
+DEFAULT_SHARD_SIZE = 256
+DEFAULT_WORKERS = os.cpu_count() or 2
+# Parallel nmap processes per scan, whatever the request asks for
+MAX_WORKERS = int(os.environ.get("NMAP_MAX_WORKERS", "64"))
+DEFAULT_SHARD_TIMEOUT = 120
+DEFAULT_RETRIES = 1
+# Largest number of addresses a scan may plan (a /12); an IPv6 /64 would otherwise be split forever
+MAX_ADDRESSES = 1 << 20
+
+_print_lock = threading.Lock()
+
+
+def emit(event):
+    with _print_lock:
+        print(json.dumps(event), flush=True)
+
+
+def _target_weight(target):
+    try:
+        return ipaddress.ip_network(target, strict=False).num_addresses
+    except ValueError:
+        return 1  # hostname
+
+
+def plan_shards(targets, shard_size=DEFAULT_SHARD_SIZE):
+    """Splits targets into shards of at most shard_size addresses; large CIDRs become subnets."""
+    if shard_size < 1:
+        raise ValueError(f"shard_size must be at least 1, got {shard_size}")
+    weights = [(target, _target_weight(target)) for target in targets]
+    total = sum(weight for _, weight in weights)
+    if total > MAX_ADDRESSES:
+        raise ValueError(f"targets cover {total} addresses, more than the {MAX_ADDRESSES} a scan may plan")
+    items = []
+    for target, weight in weights:
+        if weight > shard_size:
+            net = ipaddress.ip_network(target, strict=False)
+            new_prefix = net.max_prefixlen - (shard_size.bit_length() - 1)
+            items.extend((str(subnet), subnet.num_addresses) for subnet in net.subnets(new_prefix=new_prefix))
+        else:
+            items.append((target, weight))
+    shards, current, current_weight = [], [], 0
+    for target, weight in items:
+        if current and current_weight + weight > shard_size:
+            shards.append(current)
+            current, current_weight = [], 0
+        current.append(target)
+        current_weight += weight
+    if current:
+        shards.append(current)
+    return [{"index": i, "targets": s} for i, s in enumerate(shards)]
+
+
+def run_shard(shard, options, timeout, retries):
+    cmd = ["nmap"] + options.split() + ["-oX", "-"] + shard["targets"]
+    result = dict(shard, status="failed", attempts=0, error=None)
+    for attempt in range(1, retries + 2):
+        result["attempts"] = attempt
+        try:
+            proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            result["error"] = f"timed out after {timeout}s"
+            continue
+        except OSError as e:
+            result["error"] = str(e)
+            break
+        result.update(stdout=proc.stdout, stderr=proc.stderr, returncode=proc.returncode)
+        if proc.returncode == 0:
+            result.update(status="done", error=None)
+            break
+        result["error"] = f"nmap exited with {proc.returncode}"
+    return result
+
 
 def run_scan(scan_request):
     targets = scan_request.get("targets", [])
     options = scan_request.get("options", "-sV")
-    if not targets:
+    shards = scan_request.get("shards")
+    if not targets and not shards:
         return {"error": "No targets specified"}
-    cmd = ["nmap"] + options.split() + targets
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-        return {
-            "command": " ".join(cmd),
-            "stdout": result.stdout,
-            "stderr": result.stderr,
-            "returncode": result.returncode
-        }
-    except Exception as e:
-        return {"error": str(e)}
+    if not shards:
+        try:
+            shards = plan_shards(targets, int(scan_request.get("shard_size", DEFAULT_SHARD_SIZE)))
+        except ValueError as e:
+            return {"error": str(e)}
+    skip = set(scan_request.get("skip_shards", ()))
+    shards = [s for s in shards if s["index"] not in skip]
+    workers = min(int(scan_request.get("workers", DEFAULT_WORKERS)), MAX_WORKERS)
+    timeout = int(scan_request.get("shard_timeout", DEFAULT_SHARD_TIMEOUT))
+    retries = int(scan_request.get("retries", DEFAULT_RETRIES))
+    stream = scan_request.get("stream", False)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(shards)))) as pool:
+        futures = [pool.submit(run_shard, shard, options, timeout, retries) for shard in shards]
+        for future in as_completed(futures):
+            shard_result = future.result()
+            results.append(shard_result)
+            if stream:
+                emit(dict(shard_result, event="shard"))
+    results.sort(key=lambda r: r["index"])
+    failed = [r for r in results if r["status"] != "done"]
+    fields = ("index", "targets", "status", "attempts", "error") + (() if stream else ("stdout",))
+    return {
+        "command": " ".join(["nmap"] + options.split() + ["-oX", "-"] + targets),
+        "stderr": "".join(r.get("stderr") or "" for r in results),
+        "returncode": 1 if failed else 0,
+        "shards": [{k: r.get(k) for k in fields} for r in results],
+    }
+
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print(json.dumps({"error": "No scan request provided"}))
         sys.exit(1)
     scan_request = json.loads(sys.argv[1])
+    start_ns = time.time_ns()
     result = run_scan(scan_request)
+    # Report timing to the backend so it can be recorded as a span of the caller's trace
+    if os.environ.get("TRACEPARENT"):
+        result["trace"] = {"traceparent": os.environ["TRACEPARENT"], "start_ns": start_ns, "end_ns": time.time_ns()}
+    if scan_request.get("stream"):
+        result["event"] = "done"
     print(json.dumps(result))